@@ -1,4 +1,6 @@
 import time
+import errno
+import select
 import socket
 import logging
 import json
@@ -21,18 +23,127 @@ import json
 #  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #  MA 02110-1301, USA.
 
+# Version 2 clients keep one connection open and wait for the coordinator
+# to push the response instead of polling. The framing is unchanged.
+PROTOCOL_VERSION = 2
+
+
+class Reply(object):
+    """
+    Collects the response written by the request handlers so that it can
+    be delivered, or held back until a wait is satisfied.
+    """
+
+    def __init__(self):
+        self.data = []
+        self.closed = False
+
+    def send(self, data):
+        self.data.append(data)
+        return len(data)
+
+    def close(self):
+        self.closed = True
+
+    def response(self):
+        if len(self.data) < 2:
+            return None
+        try:
+            return json.loads(''.join(self.data[1:]))
+        except ValueError:
+            return None
+
+
+class EventLoop(object):
+    """
+    Waits for socket events using epoll where available, select otherwise.
+    """
+
+    def __init__(self):
+        self.epoll = select.epoll() if hasattr(select, 'epoll') else None
+        # fd: (read, write)
+        self.fds = {}
+
+    def watch(self, fd, read=True, write=False):
+        if self.fds.get(fd) == (read, write):
+            return
+        if self.epoll:
+            mask = (select.EPOLLIN if read else 0) | (select.EPOLLOUT if write else 0)
+            if fd in self.fds:
+                self.epoll.modify(fd, mask)
+            else:
+                self.epoll.register(fd, mask)
+        self.fds[fd] = (read, write)
+
+    def forget(self, fd):
+        if fd not in self.fds:
+            return
+        del self.fds[fd]
+        if self.epoll:
+            self.epoll.unregister(fd)
+
+    def wait(self, timeout):
+        """
+        :return: list of (fd, readable, writable)
+        """
+        if self.epoll:
+            try:
+                events = self.epoll.poll(timeout)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    return []
+                raise
+            return [(fd, bool(mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR)),
+                     bool(mask & select.EPOLLOUT)) for fd, mask in events]
+        readers = [fd for fd, (read, write) in self.fds.items() if read]
+        writers = [fd for fd, (read, write) in self.fds.items() if write]
+        try:
+            readable, writable = select.select(readers, writers, [], timeout)[:2]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        writable = set(writable)
+        events = [(fd, True, fd in writable) for fd in readable]
+        events.extend([(fd, False, True) for fd in writable.difference(readable)])
+        return events
+
+    def close(self):
+        if self.epoll:
+            self.epoll.close()
+
+
+class Client(object):
+    """
+    Connection state of one node.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        # (group_name, messageID) of the request waiting to be satisfied
+        self.pending = None
+        # close the connection once the output has been sent
+        self.closing = False
+        self.closed = False
+
 
 class LavaCoordinator(object):
 
     running = False
     delay = 1
     rpc_delay = 2
+    # how often waiting aggregate requests are repeated
+    retry_delay = 1
     blocksize = 4 * 1024
     all_groups = {}
     # All data handling for each connection happens on this local reference into the
     # all_groups dict with a new group looked up each time.
     group = None
     conn = None
+    server = None
     host = "localhost"
 
     def __init__(self, json_data):
@@ -51,7 +162,7 @@ class LavaCoordinator(object):
         if 'host' in json_data:
             self.host = json_data['host']
 
-    def run(self):
+    def _bind(self):
         s = None
         while 1:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -64,32 +175,200 @@ class LavaCoordinator(object):
                 logging.warn("Unable to bind, trying again with delay=%d msg=%s" % (self.delay, e.message))
                 time.sleep(self.delay)
                 self.delay *= 2
-        s.listen(1)
+        s.listen(socket.SOMAXCONN)
+        return s
+
+    def run(self):
+        """
+        Serves all connections from one non-blocking event loop, so that a
+        slow client does not hold up the other groups.
+        Version 1 clients send one request per connection, version 2 clients
+        keep the connection open and have the response to a wait pushed
+        once it is satisfied.
+        """
+        self.server = self._bind()
+        self.server.setblocking(0)
+        self.loop = EventLoop()
+        self.loop.watch(self.server.fileno())
+        # fd: Client
+        self.clients = {}
+        # (group_name, messageID): {Client: request} for waiting version 2 clients
+        self.pending = {}
+        self.buffer = bytearray(self.blocksize)
+        self.view = memoryview(self.buffer)
         self.running = True
+        logging.info("Ready to accept new connections")
+        last_retry = time.time()
         while self.running:
-            logging.info("Ready to accept new connections")
-            self.conn, addr = s.accept()
-            # read the header to get the size of the message to follow
-            data = str(self.conn.recv(8))  # 32bit limit
+            for fd, readable, writable in self.loop.wait(self.retry_delay):
+                if fd == self.server.fileno():
+                    self._accept()
+                    continue
+                client = self.clients.get(fd)
+                if client and readable:
+                    self._read(client)
+                if client and writable and not client.closed:
+                    self._flush(client)
+            if time.time() - last_retry >= self.retry_delay:
+                # replies to aggregate depend on time, not on the other clients
+                self._retryPending(request='aggregate')
+                last_retry = time.time()
+        for client in self.clients.values():
+            self._dropClient(client)
+        self.loop.close()
+        self.server.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.server.accept()[0]
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    logging.warn("Unable to accept a connection: %s" % e)
+                return
+            conn.setblocking(0)
+            client = Client(conn)
+            self.clients[client.fd] = client
+            self.loop.watch(client.fd)
+
+    def _read(self, client):
+        try:
+            count = client.sock.recv_into(self.buffer)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                logging.debug("socket error on receive: %s" % e)
+                self._dropClient(client)
+            return
+        if not count:
+            # version 1 clients shut down writing once the request is sent
+            client.closing = True
+            self._flush(client)
+            return
+        client.inbuf.extend(self.view[:count])
+        while len(client.inbuf) >= 8 and not client.closing:
+            # the header is the size of the message to follow
             try:
-                count = int(data, 16)
+                size = int(str(client.inbuf[:8]), 16)  # 32bit limit
             except ValueError:
-                logging.debug("Invalid message: %s from %s" % (data, self.conn.getpeername()[0]))
-                self.conn.close()
-                continue
-            c = 0
-            data = ''
-            # get the message itself
-            while c < count:
-                data += self.conn.recv(self.blocksize)
-                c += self.blocksize
+                logging.debug("Invalid message: %s from %s" % (str(client.inbuf[:8]), client.sock.getpeername()[0]))
+                self._dropClient(client)
+                return
+            if len(client.inbuf) < 8 + size:
+                return
+            data = str(client.inbuf[8:8 + size])
+            del client.inbuf[:8 + size]
             try:
                 json_data = json.loads(data)
             except ValueError:
                 logging.warn("JSON error for '%s'" % data[:100])
-                self.conn.close()
-                continue
+                self._dropClient(client)
+                return
+            self._handleRequest(client, json_data)
+            if client.closed:
+                return
+
+    def _write(self, client, data):
+        client.outbuf.extend(data)
+        self._flush(client)
+
+    def _flush(self, client):
+        while client.outbuf:
+            try:
+                sent = client.sock.send(client.outbuf)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                logging.debug("socket error on send: %s" % e)
+                self._dropClient(client)
+                return
+            del client.outbuf[:sent]
+        if client.closing and not client.outbuf:
+            self._dropClient(client)
+        else:
+            self.loop.watch(client.fd, read=not client.closing, write=bool(client.outbuf))
+
+    def _dropClient(self, client):
+        if client.closed:
+            return
+        self._unpend(client)
+        self.loop.forget(client.fd)
+        self.clients.pop(client.fd, None)
+        client.sock.close()
+        client.closed = True
+
+    def _unpend(self, client):
+        if client.pending is None:
+            return
+        waiting = self.pending.get(client.pending, {})
+        waiting.pop(client, None)
+        if not waiting:
+            self.pending.pop(client.pending, None)
+        client.pending = None
+
+    def _handleRequest(self, client, json_data):
+        # a new request replaces any request still waiting on this connection
+        self._unpend(client)
+        self._process(client, json_data)
+        if 'group_name' in json_data:
+            # the group data has changed, waits on the same messageID may now be satisfied.
+            self._retryPending((json_data.get('group_name'), json_data.get('messageID')))
+
+    def _process(self, client, json_data):
+        """
+        Handles the request and delivers the response.
+        :return: False if the response is being held back until the wait is satisfied.
+        """
+        self.conn = Reply()
+        try:
             self.dataReceived(json_data)
+        except Exception as e:  # pylint: disable=broad-except
+            # one bad request must not take down every other group
+            logging.exception("Unable to handle request %s: %s" % (json.dumps(json_data)[:100], e))
+            self.conn = None
+            self._dropClient(client)
+            return True
+        reply = self.conn
+        self.conn = None
+        if json_data.get('protocol_version', 1) < PROTOCOL_VERSION:
+            client.closing = True
+            self._write(client, ''.join(reply.data))
+            return True
+        response = reply.response()
+        if response is None:
+            client.closing = True
+            self._flush(client)
+            return True
+        if response['response'] == 'wait':
+            client.pending = (json_data.get('group_name'), json_data.get('messageID'))
+            self.pending.setdefault(client.pending, {})[client] = json_data
+            return False
+        response['protocol_version'] = PROTOCOL_VERSION
+        msgdata = self._formatMessage(response)
+        if msgdata:
+            self._write(client, msgdata[0] + msgdata[1])
+        return True
+
+    def _retryPending(self, key=None, request=None):
+        """
+        Repeats the requests of the waiting version 2 clients, pushing the
+        response to each client for which the wait is now satisfied.
+        :param key: only retry the clients waiting on this (group_name, messageID)
+        :param request: only retry this type of request
+        """
+        keys = [key] if key else self.pending.keys()
+        for key in keys:
+            delivered = True
+            # each response may satisfy the waits before it, e.g. the last lava_sync
+            while delivered and key in self.pending:
+                delivered = False
+                for client, json_data in self.pending[key].items():
+                    if client.closed or client.pending != key:
+                        continue
+                    if request and json_data['request'] != request:
+                        continue
+                    self._unpend(client)
+                    if self._process(client, json_data):
+                        delivered = True
 
     def _updateData(self, json_data):
         """
@@ -121,6 +400,7 @@ class LavaCoordinator(object):
             if json_data['role'] not in self.group['roles']:
                 self.group['roles'][json_data['role']] = []
             self.group['roles'][json_data['role']].append(client_name)
+            self.group['client_roles'][client_name] = json_data['role']
         return client_name
 
     def _clear_group(self):
@@ -131,9 +411,18 @@ class LavaCoordinator(object):
             'rpc_delay': self.rpc_delay,
             'clients': {},
             'roles': {},
+            # client_name: role
+            'client_roles': {},
             'syncs': {},
+            # messageID: number of clients in syncs still to pick up the message
+            'sync_pending': {},
+            # messages set for one client by lava_sync
             'messages': {},
+            # messageID: messages from lava_send for every client
+            'broadcasts': {},
             'waits': {},
+            # messageID: {role: number of clients in the role which have sent the messageID}
+            'role_waits': {},
             'bundles': {}
         }
 
@@ -212,14 +501,14 @@ class LavaCoordinator(object):
         :param messageID: the message index set by lavaSend
         :rtype : None
         """
-        if client_name not in self.group['messages'] or messageID not in self.group['messages'][client_name]:
+        message = self._clientMessage(client_name, messageID)
+        if message is None:
             logging.error("Unable to find messageID %s for client %s" % (messageID, client_name))
             self._badRequest()
             return
         logging.info("Sending messageID '%s' to %s in group %s: %s" %
-                     (messageID, client_name, self.group['group'],
-                      json.dumps(self.group['messages'][client_name][messageID])))
-        msg = {"response": "ack", "message": self.group['messages'][client_name][messageID]}
+                     (messageID, client_name, self.group['group'], json.dumps(message)))
+        msg = {"response": "ack", "message": message}
         msgdata = self._formatMessage(msg)
         if msgdata:
             logging.info("Sending response to %s in group %s: %s" %
@@ -228,6 +517,21 @@ class LavaCoordinator(object):
             self.conn.send(msgdata[1])
         self.conn.close()
 
+    def _clientMessage(self, client_name, messageID):
+        """
+        A lava_sync message for this client, or the lava_send messages for the group.
+        """
+        messages = self.group['messages'].get(client_name, {})
+        if messageID in messages:
+            return messages[messageID]
+        return self.group['broadcasts'].get(messageID)
+
+    def _setSync(self, client_name, messageID, value):
+        syncs = self.group['syncs'][messageID]
+        previous = syncs.get(client_name, 0)
+        syncs[client_name] = value
+        self.group['sync_pending'][messageID] = self.group['sync_pending'].get(messageID, 0) + value - previous
+
     def _sendWaitMessage(self, client_name, messageID):
         """ Sends a wait message to the currently connected client.
         (the "connection name" or hostname of the connected client does not necessarily
@@ -350,21 +654,17 @@ class LavaCoordinator(object):
             self.group['messages'][client_name][messageID] = message
             self._sendMessage(client_name, messageID)
             # mark this client as having picked up the message
-            self.group['syncs'][messageID][client_name] = 0
+            self._setSync(client_name, messageID, 0)
         else:
             logging.info("waiting for '%s': not all clients in group '%s' have been seen yet %d < %d" %
                          (messageID, self.group['group'], len(self.group['syncs'][messageID]), self.group['count']))
             self.group['messages'][client_name][messageID] = message
-            self.group['syncs'][messageID][client_name] = 1
+            self._setSync(client_name, messageID, 1)
             self._waitResponse()
             return
         # clear the sync data for this messageID when the last client connects to
         # allow the message to be re-used later for another sync
-        clear_syncs = True
-        for pending in self.group['syncs'][messageID]:
-            if self.group['syncs'][messageID][pending]:
-                clear_syncs = False
-        if clear_syncs:
+        if not self.group['sync_pending'][messageID]:
             logging.debug("Clearing all sync messages for '%s' in group '%s'" % (messageID, self.group['group']))
             self.group['syncs'][messageID].clear()
 
@@ -374,6 +674,7 @@ class LavaCoordinator(object):
         IF <role> is passed, only wait until all devices with that given role send a message.
         """
         messageID = self._getMessageID(json_data)
+        waits = self.group['waits'].get(messageID)
         if 'waitrole' in json_data:
             expected = self.group['roles'][json_data['waitrole']]
             expected = expected[0] if type(expected) == list else None
@@ -382,39 +683,31 @@ class LavaCoordinator(object):
                     json_data['waitrole'],
                     expected)
             )
-            for client in self.group['roles'][json_data['role']]:
-                logging.debug("checking %s for wait message" % client)
-                if messageID not in self.group['waits']:
-                    logging.debug("messageID %s not yet seen" % messageID)
-                    self._waitResponse()
-                    return
-                if expected and expected in self.group['waits'][messageID]:
-                    logging.debug("Replying that %s has sent %s" % (client_name, messageID))
-                    self._sendWaitMessage(client_name, messageID)
-                    return
-                if client not in self.group['waits'][messageID]:
-                    logging.debug("FIXME: %s not in waits for %s: %s" % (
-                        client, messageID, self.group['waits'][messageID]))
-                    # FIXME: bug? if this client has not sent the messageID yet,
-                    # causing it to wait will simply force a timeout. node needs
-                    # to output a warning, so maybe send a "nack" ?
-                    self._waitResponse()
-                    return
-                if client in self.group['waits']:
-                    logging.debug("Replying: %s for %s" % (messageID, client_name))
-            if client_name in self.group['waits']:
-                logging.debug("lavaWaitAll message: %s" % json.dumps(self.group['waits'][client_name][messageID]))
+            if waits is None:
+                logging.debug("messageID %s not yet seen" % messageID)
+                self._waitResponse()
+                return
+            if expected and expected in waits:
+                logging.debug("Replying that %s has sent %s" % (client_name, messageID))
+            elif self.group['role_waits'][messageID].get(json_data['role'], 0) < \
+                    len(self.group['roles'][json_data['role']]):
+                # FIXME: bug? if a client in this role has not sent the messageID yet,
+                # causing it to wait will simply force a timeout. node needs
+                # to output a warning, so maybe send a "nack" ?
+                logging.debug("not all of role %s have sent %s" % (json_data['role'], messageID))
+                self._waitResponse()
+                return
         else:
             logging.debug("lavaWaitAll: no role.")
-            for client in self.group['clients']:
-                logging.debug("checking %s for wait message" % client)
-                if messageID not in self.group['waits']:
-                    self._badRequest()
-                    return
-                if client not in self.group['waits'][messageID]:
-                    logging.debug("setting waiting for %s" % client)
-                    self._waitResponse()
-                    return
+            if waits is None:
+                self._badRequest()
+                return
+            # waits holds the clients which have sent the messageID and the data
+            if len(waits) - 1 < len(self.group['clients']):
+                logging.debug("%d of %d clients have sent %s" % (
+                    len(waits) - 1, len(self.group['clients']), messageID))
+                self._waitResponse()
+                return
         self._sendWaitMessage(client_name, messageID)
 
     def lavaWait(self, json_data, client_name):
@@ -425,7 +718,7 @@ class LavaCoordinator(object):
         :param client_name: the client_name to receive the message
         """
         messageID = self._getMessageID(json_data)
-        if client_name not in self.group['messages'] or messageID not in self.group['messages'][client_name]:
+        if self._clientMessage(client_name, messageID) is None:
             logging.debug("MessageID %s not yet seen for %s" % (messageID, client_name))
             self._waitResponse()
             return
@@ -445,32 +738,23 @@ class LavaCoordinator(object):
         messageID = self._getMessageID(json_data)
         logging.info("lavaSend handler in Coordinator received a messageID '%s' for group '%s' from %s"
                      % (messageID, self.group['group'], client_name))
-        if client_name not in self.group['messages']:
-            self.group['messages'][client_name] = {}
         # construct the message hash which stores the data from each client separately
         # but which gets returned as a complete hash upon request
         msg_hash = {}
         msg_hash.update({client_name: message})
-        # always set this client data if the call is made to update the broadcast
-        if messageID not in self.group['messages'][client_name]:
-            self.group['messages'][client_name][messageID] = {}
-        self.group['messages'][client_name][messageID].update(msg_hash)
-        logging.debug("message %s for %s" % (json.dumps(self.group['messages'][client_name][messageID]), client_name))
-        # now broadcast the message into the other clients in this group
-        for client in self.group['clients']:
-            if client not in self.group['messages']:
-                self.group['messages'][client] = {}
-            if messageID not in self.group['messages'][client]:
-                self.group['messages'][client][messageID] = {}
-            self.group['messages'][client][messageID].update(msg_hash)
-            logging.debug("broadcast %s for %s" % (json.dumps(self.group['messages'][client][messageID]), client))
+        # always set this client data if the call is made to update the broadcast,
+        # the broadcast is shared by all the clients in this group.
+        self.group['broadcasts'].setdefault(messageID, {}).update(msg_hash)
+        logging.debug("broadcast %s" % json.dumps(self.group['broadcasts'][messageID]))
         # separate the waits from the messages for wait-all support
         if messageID not in self.group['waits']:
-            self.group['waits'][messageID] = {}
+            self.group['waits'][messageID] = {'data': {}}
+            self.group['role_waits'][messageID] = {}
         if client_name not in self.group['waits'][messageID]:
             self.group['waits'][messageID][client_name] = {}
-        if 'data' not in self.group['waits'][messageID]:
-            self.group['waits'][messageID]['data'] = {}
+            role = self.group['client_roles'][client_name]
+            role_waits = self.group['role_waits'][messageID]
+            role_waits[role] = role_waits.get(role, 0) + 1
         self.group['waits'][messageID]['data'].update(msg_hash)
         self._ackResponse()
 
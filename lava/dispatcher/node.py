@@ -35,6 +35,11 @@ import time
 from lava_dispatcher.config import get_config
 from lava_dispatcher.job import LavaTestJob
 
+# Coordinator protocol version which keeps one connection open per node,
+# the same as LAVA_MULTINODE_PROTOCOL_VERSION in the pipeline.
+# Version 1 is one request per connection with the node polling on "wait".
+PROTOCOL_VERSION = 2
+
 
 class Poller(object):
     """
@@ -44,6 +49,8 @@ class Poller(object):
     If the node needs to wait, it will get a {"response": "wait"}
     If the node should stop polling and send data back to the board, it will
     get a {"response": "ack", "message": "blah blah"}
+    Coordinators supporting protocol version 2 keep one connection open
+    and push the response to a wait when it is satisfied, instead.
     """
 
     json_data = None
@@ -51,6 +58,8 @@ class Poller(object):
     # how long between polls (in seconds)
     poll_delay = 1
     timeout = 0
+    persistent = True
+    sock = None
 
     def __init__(self, data_str):
         try:
@@ -68,6 +77,70 @@ class Poller(object):
         if 'timeout' in self.json_data:
             self.timeout = self.json_data['timeout']
 
+    def _disconnect(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+
+    def _recv_count(self, count):
+        data = ''
+        while len(data) < count:
+            chunk = self.sock.recv(min(count - len(data), self.blocks))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _poll_persistent(self, msg_str):
+        """
+        Sends the message over the persistent connection and blocks until
+        the Coordinator pushes the response, reconnecting if the connection is lost.
+        :return: a JSON string of the response or None if the Coordinator
+        only supports version 1.
+        """
+        delay = self.poll_delay
+        start = time.time()
+        while True:
+            remaining = self.timeout - (time.time() - start)
+            if remaining <= 0:
+                logging.info("Timed out waiting for the coordinator")
+                self._disconnect()
+                return json.dumps({"response": "nack"})
+            try:
+                if not self.sock:
+                    self.sock = socket.create_connection((self.json_data['host'], self.json_data['port']))
+                    delay = self.poll_delay
+                self.sock.settimeout(remaining)
+                self.sock.sendall("%08X" % len(msg_str) + msg_str)
+                header = self._recv_count(8)  # 32bit limit as a hexadecimal
+                response = self._recv_count(int(header, 16)) if header else None
+            except socket.timeout:
+                # the coordinator drops the wait when the connection closes.
+                logging.info("Timed out waiting for the coordinator")
+                self._disconnect()
+                return json.dumps({"response": "nack"})
+            except (socket.error, ValueError) as e:
+                logging.warning("Connection to coordinator failed: %s", e)
+                response = None
+            if not response:
+                logging.debug("Trying again in %s seconds.", delay)
+                self._disconnect()
+                time.sleep(delay)
+                delay += 2
+                continue
+            try:
+                json_data = json.loads(response)
+            except ValueError:
+                logging.error("response starting '%s' was not JSON", response[:42])
+                return response
+            if json_data.get('protocol_version') != PROTOCOL_VERSION:
+                logging.info("Coordinator does not support persistent connections, polling instead.")
+                self.persistent = False
+                self._disconnect()
+                if json_data['response'] == 'wait':
+                    return None
+            return response
+
     def poll(self, msg_str):
         """
         Blocking, synchronous polling of the Coordinator on the configured port.
@@ -81,6 +154,12 @@ class Poller(object):
         if msg_len > 0xFFFE:
             logging.error("Message was too long to send!")
             return
+        if self.persistent:
+            json_data = json.loads(msg_str)
+            json_data['protocol_version'] = PROTOCOL_VERSION
+            response = self._poll_persistent(json.dumps(json_data))
+            if response is not None:
+                return response
         c = 0
         waited = 0
         response = None
@@ -0,0 +1,276 @@
+#  Copyright 2016 Linaro Limited
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""
+lava.coordinator tests against a coordinator listening on a local port.
+"""
+
+import json
+import resource
+import socket
+import threading
+import time
+import uuid
+from unittest import TestCase
+
+from lava.coordinator import EventLoop, LavaCoordinator, PROTOCOL_VERSION
+
+
+class Node(object):
+    """
+    Minimal client for either version of the coordinator protocol.
+    """
+
+    def __init__(self, port, group_name, client_name, group_size, version=PROTOCOL_VERSION):
+        self.port = port
+        self.version = version
+        self.sock = None
+        self.connections = 0
+        self.responses = []
+        self.base = {
+            'group_name': group_name,
+            'client_name': client_name,
+            'group_size': group_size,
+            'hostname': 'localhost',
+            'role': 'node',
+        }
+        if version >= PROTOCOL_VERSION:
+            self.base['protocol_version'] = version
+
+    def _recv(self, count):
+        data = ''
+        while len(data) < count:
+            chunk = self.sock.recv(count - len(data))
+            if not chunk:
+                raise socket.error("connection closed")
+            data += chunk
+        return data
+
+    def request(self, **kwargs):
+        msg = dict(self.base)
+        msg.update(kwargs)
+        data = json.dumps(msg)
+        if not self.sock:
+            self.sock = socket.create_connection(('localhost', self.port))
+            self.sock.settimeout(10)
+            self.connections += 1
+        self.sock.sendall("%08X" % len(data) + data)
+        if self.version < PROTOCOL_VERSION:
+            self.sock.shutdown(socket.SHUT_WR)
+        response = json.loads(self._recv(int(self._recv(8), 16)))
+        self.responses.append(response['response'])
+        if self.version < PROTOCOL_VERSION:
+            self.sock.close()
+            self.sock = None
+        return response
+
+    def poll(self, **kwargs):
+        """
+        Version 1 nodes repeat the request until it is no longer a wait.
+        """
+        while True:
+            response = self.request(**kwargs)
+            if response['response'] != 'wait':
+                return response
+            time.sleep(0.1)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+
+
+class LoadTest(object):
+    """
+    Drives many version 2 nodes from a single thread. Each node registers
+    with its group, sends a message, waits for the rest of the group to
+    send the same message then syncs with the group.
+    """
+
+    def __init__(self, port, groups, size):
+        self.port = port
+        self.nodes = {}
+        self.finished = 0
+        self.steps = [
+            {'request': 'group_data'},
+            {'request': 'lava_send', 'messageID': 'ready', 'message': {'ready': 'yes'}},
+            {'request': 'lava_wait_all', 'messageID': 'ready'},
+            {'request': 'lava_sync', 'messageID': 'done'},
+        ]
+        self.names = []
+        for group in range(groups):
+            group_name = str(uuid.uuid4())
+            self.names.extend([(group_name, 'node%03d' % index, size) for index in range(size)])
+
+    def _send(self, node):
+        msg = dict(node.base)
+        msg.update(self.steps[node.step])
+        data = json.dumps(msg)
+        node.sock.sendall("%08X" % len(data) + data)
+
+    def _receive(self, node, loop):
+        data = node.sock.recv(4096)
+        if not data:
+            raise RuntimeError("%s was disconnected" % node.base['client_name'])
+        node.inbuf.extend(data)
+        if len(node.inbuf) < 8 or len(node.inbuf) < 8 + int(str(node.inbuf[:8]), 16):
+            return
+        response = json.loads(str(node.inbuf[8:]))
+        del node.inbuf[:]
+        node.responses.append(response['response'])
+        node.step += 1
+        if node.step < len(self.steps):
+            self._send(node)
+            return
+        loop.forget(node.sock.fileno())
+        node.close()
+        self.finished += 1
+
+    def run(self, timeout=60):
+        """
+        :param timeout: seconds after which the nodes still running are given up
+        """
+        loop = EventLoop()
+        start = time.time()
+        for group_name, client_name, size in self.names:
+            node = Node(self.port, group_name, client_name, size)
+            node.sock = socket.create_connection(('localhost', self.port))
+            node.inbuf = bytearray()
+            node.step = 0
+            self.nodes[node.sock.fileno()] = node
+            loop.watch(node.sock.fileno())
+            self._send(node)
+        while self.finished < len(self.nodes) and time.time() - start < timeout:
+            for fd, readable, writable in loop.wait(1):
+                self._receive(self.nodes[fd], loop)
+        loop.close()
+
+
+class TestCoordinator(TestCase):
+
+    def setUp(self):
+        super(TestCoordinator, self).setUp()
+        self.coordinator = LavaCoordinator({'port': 0})
+        self.coordinator.retry_delay = 0.1
+        self.thread = threading.Thread(target=self.coordinator.run)
+        self.thread.start()
+        while not self.coordinator.running:
+            time.sleep(0.01)
+        self.port = self.coordinator.server.getsockname()[1]
+        self.group_name = str(uuid.uuid4())
+
+    def tearDown(self):
+        self.coordinator.running = False
+        self.thread.join()
+        super(TestCoordinator, self).tearDown()
+
+    def _barrier(self, nodes, version):
+        """
+        Each node registers, sends a message and waits for all the others.
+        """
+        results = {}
+
+        def run(node):
+            wait = node.request if version >= PROTOCOL_VERSION else node.poll
+            wait(request='group_data')
+            node.request(request='lava_send', messageID='barrier', message={'key': node.base['client_name']})
+            results[node.base['client_name']] = wait(request='lava_wait_all', messageID='barrier')
+            node.close()
+
+        threads = [threading.Thread(target=run, args=(node,)) for node in nodes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_version_one(self):
+        node = Node(self.port, self.group_name, 'node01', 2, version=1)
+        self.assertEqual(node.request(request='group_data'), {'response': 'wait'})
+        self.assertIsNone(node.sock)
+        self.assertEqual(node.request(request='lava_send', messageID='test'), {'response': 'ack'})
+        self.assertEqual(node.request(request='lava_wait', messageID='test'), {
+            'response': 'ack', 'message': {'node01': {}}})
+
+    def test_persistent_barrier(self):
+        size = 32
+        nodes = [Node(self.port, self.group_name, 'node%02d' % index, size) for index in range(size)]
+        results = self._barrier(nodes, PROTOCOL_VERSION)
+        self.assertEqual(len(results), size)
+        for response in results.values():
+            self.assertEqual(response['response'], 'ack')
+            self.assertEqual(response['protocol_version'], PROTOCOL_VERSION)
+            self.assertEqual(len(response['message']), size)
+        # waits are pushed, not polled: one connection per node and exactly
+        # one response per request, in order, without any "wait".
+        for node in nodes:
+            self.assertEqual(node.connections, 1)
+            self.assertEqual(node.responses, ['group_data', 'ack', 'ack'])
+        self.assertEqual(self.coordinator.pending, {})
+
+    def test_mixed_versions(self):
+        nodes = [
+            Node(self.port, self.group_name, 'node01', 3, version=1),
+            Node(self.port, self.group_name, 'node02', 3),
+            Node(self.port, self.group_name, 'node03', 3),
+        ]
+        results = {}
+        old = threading.Thread(target=lambda: results.update(self._barrier(nodes[:1], 1)))
+        old.start()
+        results.update(self._barrier(nodes[1:], PROTOCOL_VERSION))
+        old.join()
+        self.assertEqual(sorted(results.keys()), ['node01', 'node02', 'node03'])
+        self.assertNotIn('protocol_version', results['node01'])
+        self.assertEqual(results['node02']['message'], results['node01']['message'])
+
+    def test_closed_while_waiting(self):
+        node = Node(self.port, self.group_name, 'node01', 2)
+        node.sock = socket.create_connection(('localhost', self.port))
+        data = json.dumps(dict(node.base, request='group_data'))
+        node.sock.sendall("%08X" % len(data) + data)
+        while not self.coordinator.pending:
+            time.sleep(0.01)
+        node.close()
+        while self.coordinator.pending:
+            time.sleep(0.01)
+        self.assertEqual(self.coordinator.clients, {})
+
+    def test_partial_request(self):
+        # a stalled client does not hold up the rest of the coordinator
+        stalled = socket.create_connection(('localhost', self.port))
+        stalled.sendall("00000100{")
+        node = Node(self.port, self.group_name, 'node01', 1)
+        self.assertEqual(node.request(request='group_data')['response'], 'group_data')
+        node.close()
+        stalled.close()
+
+    def test_load(self):
+        """
+        1,000 nodes in 50 groups, all connected at the same time.
+        """
+        groups, size = 50, 20
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < 2 * groups * size + 100:
+            if hard != resource.RLIM_INFINITY and hard < 2 * groups * size + 100:
+                self.skipTest("Not enough file descriptors for the load test")
+            resource.setrlimit(resource.RLIMIT_NOFILE, (2 * groups * size + 100, hard))
+        load = LoadTest(self.port, groups, size)
+        load.run()
+        self.assertEqual(load.finished, groups * size)
+        # every node got exactly one response per step, in order
+        for node in load.nodes.values():
+            self.assertEqual(node.responses, ['group_data', 'ack', 'ack', 'ack'])
+        self.assertEqual(self.coordinator.pending, {})
@@ -26,11 +26,13 @@ import time
 import types
 import signal
 import datetime
+import threading
 import subprocess
 from collections import OrderedDict
 from contextlib import contextmanager
 
 from lava_dispatcher.pipeline.log import YAMLLogger
+from lava_dispatcher.pipeline.utils import profile
 from lava_dispatcher.pipeline.utils.constants import OVERRIDE_CLAMP_DURATION, ACTION_TIMEOUT
 
 if sys.version > '3':
@@ -301,6 +303,7 @@ class Pipeline(object):  # pylint: disable=too-many-instance-attributes
                     signal.signal(signal.SIGTERM, cancelling_handler)
                 start = time.time()
                 new_connection = None
+                profile.action_started(action)
                 try:
                     # FIXME: not sure to understand why we have two cases here?
                     if not connection:
@@ -323,6 +326,8 @@ class Pipeline(object):  # pylint: disable=too-many-instance-attributes
                     raise RuntimeError(exc)
                 except KeyboardInterrupt:
                     raise KeyboardInterrupt
+                finally:
+                    profile.action_finished(action)
                 action.elapsed_time = time.time() - start
                 # Add action end timestamp to the log message
                 msg = {'msg': "%s duration: %.02f" % (action.name,
@@ -793,6 +798,12 @@ class Timeout(object):
 
     @contextmanager
     def action_timeout(self):
+        if not isinstance(threading.current_thread(), threading._MainThread):  # pylint: disable=protected-access
+            # signals are only delivered to the main thread, actions run in
+            # other threads are covered by the timeout of the action which started
+            # them and have to check their own duration, see ParallelDownloadAction.
+            yield
+            return
         signal.signal(signal.SIGALRM, self._timed_out)
         signal.alarm(int(self.duration))
         yield
@@ -36,9 +36,26 @@ from lava_dispatcher.pipeline.utils.constants import (
     DISPATCHER_DOWNLOAD_DIR,
 )
 from lava_dispatcher.pipeline.utils.filesystem import mkdtemp
+from lava_dispatcher.pipeline.utils.overlay import copy_overlay
+from lava_dispatcher.pipeline.utils.ramdisk import append_to_ramdisk, compressed_offset
 from lava_dispatcher.pipeline.utils.shell import which
 
 
+def copy_lava_overlay(data, directory):
+    """
+    Copy the lava overlay straight into directory, without the round trip
+    through the overlay tarball, if the overlay location is still available.
+    :param data: the context of the action
+    :return: False if the overlay tarball needs to be extracted instead
+    """
+    location = data.get('lava-overlay', {}).get('location')
+    paths = data.get('compress-overlay', {}).get('paths')
+    if not location or not paths or not os.path.isdir(location):
+        return False
+    copy_overlay(location, paths, directory)
+    return True
+
+
 class ApplyOverlayImage(Action):
     """
     Applies the overlay to an image using mntdir
@@ -59,10 +76,11 @@ class ApplyOverlayImage(Action):
         connection = super(ApplyOverlayImage, self).run(connection, args)
         # use tarfile module - no SELinux support here yet
         try:
-            tar = tarfile.open(self.data['compress-overlay'].get('output'))
-            tar.extractall(self.data['loop_mount']['mntdir'])
-            tar.close()
-        except tarfile.TarError as exc:
+            if not copy_lava_overlay(self.data, self.data['loop_mount']['mntdir']):
+                tar = tarfile.open(self.data['compress-overlay'].get('output'))
+                tar.extractall(self.data['loop_mount']['mntdir'])
+                tar.close()
+        except (IOError, OSError, tarfile.TarError) as exc:
             raise RuntimeError("Unable to unpack overlay: %s" % exc)
         return connection
 
@@ -110,6 +128,9 @@ class ApplyOverlayTftp(Action):  # FIXME: generic to more than just tftp
         overlay_file = None
         directory = None
         if self.parameters.get('ramdisk', None) is not None:
+            if self.data['extract-overlay-ramdisk'].get('append'):
+                self.logger.debug("The overlay will be appended to the ramdisk")
+                return connection
             overlay_type = 'ramdisk'
             overlay_file = self.data['compress-overlay'].get('output')
             directory = self.data['extract-overlay-ramdisk']['extracted_ramdisk']
@@ -125,10 +146,11 @@ class ApplyOverlayTftp(Action):  # FIXME: generic to more than just tftp
             self.logger.debug("No overlay directory")
             self.logger.debug(self.parameters)
         try:
-            tar = tarfile.open(overlay_file)
-            tar.extractall(directory)
-            tar.close()
-        except tarfile.TarError as exc:
+            if not directory or not copy_lava_overlay(self.data, directory):
+                tar = tarfile.open(overlay_file)
+                tar.extractall(directory)
+                tar.close()
+        except (IOError, OSError, tarfile.TarError) as exc:
             raise RuntimeError("Unable to unpack %s overlay: %s" % (overlay_type, exc))
         return connection
 
@@ -237,8 +259,11 @@ class ExtractModules(Action):
     def run(self, connection, args=None):
         if not self.parameters.get('modules', None):  # idempotency
             return connection
-        self.logger.info("extracting")
         connection = super(ExtractModules, self).run(connection, args)
+        if self.parameters.get('ramdisk', None) and self.data.get('extract-overlay-ramdisk', {}).get('append'):
+            self.logger.debug("The modules will be appended to the ramdisk")
+            return connection
+        self.logger.info("extracting")
         if not self.parameters.get('ramdisk', None):
             if not self.parameters.get('nfsrootfs', None):
                 raise JobError("Unable to identify a location for the unpacked modules")
@@ -268,6 +293,8 @@ class ExtractRamdisk(Action):
     applies the overlay and then leaves the ramdisk open
     for other actions to modify. Needs CompressRamdisk to
     recreate the ramdisk with modifications.
+    A gzip compressed ramdisk is not extracted at all, CompressRamdisk
+    appends the overlay and modules to it instead, see utils.ramdisk.
     """
     def __init__(self):
         super(ExtractRamdisk, self).__init__()
@@ -285,6 +312,11 @@ class ExtractRamdisk(Action):
             return connection
         connection = super(ExtractRamdisk, self).run(connection, args)
         ramdisk = self.data['download_action']['ramdisk']['file']
+        if self._can_append(ramdisk):
+            self.logger.debug("Leaving %s compressed, the overlay will be appended" % ramdisk)
+            self.data[self.name]['append'] = True
+            self.data[self.name]['ramdisk_file'] = ramdisk  # filename
+            return connection
         ramdisk_dir = mkdtemp()
         extracted_ramdisk = os.path.join(ramdisk_dir, 'ramdisk')
         os.mkdir(extracted_ramdisk)
@@ -316,6 +348,22 @@ class ExtractRamdisk(Action):
         self.data[self.name]['ramdisk_file'] = ramdisk_data  # filename
         return connection
 
+    def _can_append(self, ramdisk):
+        """
+        The overlay can be appended to gzip compressed ramdisks, if the
+        modules, when given, are in a tarball which tarfile can read.
+        """
+        uboot = self.parameters.get('ramdisk-type', None) == 'u-boot'
+        if compressed_offset(ramdisk, uboot) is None:
+            self.logger.debug("Unable to append to %s, extracting it" % ramdisk)
+            return False
+        if self.parameters.get('modules', None):
+            try:
+                return tarfile.is_tarfile(self.data['download_action']['modules']['file'])
+            except IOError:
+                return False
+        return True
+
 
 class CompressRamdisk(Action):
     """
@@ -340,6 +388,56 @@ class CompressRamdisk(Action):
         if not self.parameters.get('ramdisk', None):  # idempotency
             return connection
         connection = super(CompressRamdisk, self).run(connection, args)
+        if self.data['extract-overlay-ramdisk'].get('append'):
+            final_file = self._append_overlay()
+        else:
+            final_file = self._compress_ramdisk()
+        tftp_dir = os.path.dirname(self.data['download_action']['ramdisk']['file'])
+
+        os.rename(final_file, os.path.join(tftp_dir, os.path.basename(final_file)))
+        self.logger.debug("rename %s to %s" % (
+            final_file, os.path.join(tftp_dir, os.path.basename(final_file))
+        ))
+        if self.parameters['to'] == 'tftp':
+            suffix = self.data['tftp-deploy'].get('suffix', '')
+            self.set_common_data('file', 'ramdisk', os.path.join(suffix, os.path.basename(final_file)))
+        else:
+            self.set_common_data('file', 'ramdisk', final_file)
+        return connection
+
+    def _append_overlay(self):
+        """
+        Append the modules and the overlay to the compressed ramdisk as one
+        more compressed cpio archive.
+        :return: the new ramdisk
+        """
+        ramdisk = self.data['extract-overlay-ramdisk']['ramdisk_file']
+        tarballs = []
+        if self.parameters.get('modules', None):
+            tarballs.append(self.data['download_action']['modules']['file'])
+        tarballs.append(self.data['compress-overlay'].get('output'))
+        final_file = os.path.join(mkdtemp(), 'ramdisk.cpio.gz')
+        uboot = self.parameters.get('ramdisk-type', None) == 'u-boot'
+        if uboot:
+            final_file += '.uboot'
+        self.logger.debug("Appending %s to ramdisk %s" % (', '.join(tarballs), ramdisk))
+        try:
+            size = append_to_ramdisk(ramdisk, final_file, tarballs, uboot=uboot)
+        except (IOError, tarfile.TarError) as exc:
+            raise RuntimeError("Unable to append the overlay to the ramdisk: %s" % exc)
+        self.logger.debug("Built ramdisk %s of %d bytes" % (final_file, size))
+        if self.parameters.get('modules', None):
+            try:
+                os.unlink(tarballs[0])
+            except OSError as exc:
+                raise RuntimeError("Unable to remove tarball: '%s' - %s" % (tarballs[0], exc))
+        return final_file
+
+    def _compress_ramdisk(self):
+        """
+        Archive and compress the extracted ramdisk.
+        :return: the new ramdisk
+        """
         if 'extracted_ramdisk' not in self.data['extract-overlay-ramdisk']:
             raise RuntimeError("Unable to find unpacked ramdisk")
         if 'ramdisk_file' not in self.data['extract-overlay-ramdisk']:
@@ -363,7 +461,6 @@ class CompressRamdisk(Action):
             raise RuntimeError('Unable to compress cpio filesystem')
         os.chdir(pwd)
         final_file = os.path.join(os.path.dirname(ramdisk_data), 'ramdisk.cpio.gz')
-        tftp_dir = os.path.dirname(self.data['download_action']['ramdisk']['file'])
 
         if self.parameters.get('ramdisk-type', None) == 'u-boot':
             ramdisk_uboot = final_file + ".uboot"
@@ -373,14 +470,4 @@ class CompressRamdisk(Action):
             if not self.run_command(cmd):
                 raise RuntimeError("Unable to add uboot header to ramdisk")
             final_file = ramdisk_uboot
-
-        os.rename(final_file, os.path.join(tftp_dir, os.path.basename(final_file)))
-        self.logger.debug("rename %s to %s" % (
-            final_file, os.path.join(tftp_dir, os.path.basename(final_file))
-        ))
-        if self.parameters['to'] == 'tftp':
-            suffix = self.data['tftp-deploy'].get('suffix', '')
-            self.set_common_data('file', 'ramdisk', os.path.join(suffix, os.path.basename(final_file)))
-        else:
-            self.set_common_data('file', 'ramdisk', final_file)
-        return connection
+        return final_file
@@ -24,8 +24,12 @@
 
 import math
 import os
+import sys
 import time
+import threading
+import Queue
 import urlparse
+import weakref
 import hashlib
 import requests
 import subprocess
@@ -33,16 +37,24 @@ import bz2
 import contextlib
 import lzma
 import zlib
+from multiprocessing.pool import ThreadPool
 from lava_dispatcher.pipeline.action import (
     Action,
     JobError,
     Pipeline,
 )
+from lava_dispatcher.pipeline.log import YAMLLogger
 from lava_dispatcher.pipeline.logical import RetryAction
+from lava_dispatcher.pipeline.utils.cache import DownloadCache
+from lava_dispatcher.pipeline.utils import profile
 from lava_dispatcher.pipeline.utils.constants import (
     FILE_DOWNLOAD_CHUNK_SIZE,
     HTTP_DOWNLOAD_CHUNK_SIZE,
+    DOWNLOAD_QUEUE_SIZE,
     HTTP_DOWNLOAD_TIMEOUT,
+    HTTP_VALIDATION_TTL,
+    MAX_PARALLEL_DOWNLOADS,
+    MAX_PARALLEL_VALIDATIONS,
     SCP_DOWNLOAD_CHUNK_SIZE,
 )
 
@@ -51,6 +63,11 @@ from lava_dispatcher.pipeline.utils.constants import (
 # so that the logic can be held in the Strategy class, not the Action.
 # FIXME: create a download3.py which uses urllib.urlparse
 
+# Downloads which later actions modify in place (loop mounted images)
+# must not share the inode of the cached copy.
+MODIFIED_IN_PLACE = ['image']
+
+
 class DownloaderAction(RetryAction):
     """
     The retry pipeline for downloads.
@@ -80,6 +97,182 @@ class DownloaderAction(RetryAction):
         self.internal_pipeline.add_action(action)
 
 
+class MultiStreamDecompressor(object):
+    """
+    Decompresses files made of several concatenated streams, as produced by
+    pigz, pxz or cat, by starting a new decompressor at the end of each stream.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.decompressor = factory()
+
+    def decompress(self, buff):
+        output = []
+        while buff:
+            try:
+                output.append(self.decompressor.decompress(buff))
+            except EOFError:
+                # bz2 raises once the previous stream is complete
+                self.decompressor = self.factory()
+                continue
+            buff = self.decompressor.unused_data
+            if buff.strip('\0'):
+                self.decompressor = self.factory()
+            else:
+                # trailing padding
+                buff = None
+        return ''.join(output)
+
+
+class StreamStage(threading.Thread):
+    """
+    Consumes the chunks of a download in its own thread, fed through a
+    bounded queue, so that reading from the network, hashing and
+    decompressing overlap. Errors are raised again in the thread which
+    puts the chunks.
+    """
+    def __init__(self, name, consume):
+        super(StreamStage, self).__init__(name=name)
+        self.daemon = True
+        self.consume = consume
+        self.queue = Queue.Queue(DOWNLOAD_QUEUE_SIZE)
+        self.exc_info = None
+
+    def run(self):
+        try:
+            buff = self.queue.get()
+            while buff is not None:
+                self.consume(buff)
+                buff = self.queue.get()
+        except Exception:  # pylint: disable=broad-except
+            self.exc_info = sys.exc_info()
+            # keep draining so that the producer is never blocked
+            while self.queue.get() is not None:
+                pass
+
+    def _check(self):
+        if self.exc_info:
+            exc_type, exc_value, exc_traceback = self.exc_info
+            raise exc_type, exc_value, exc_traceback
+
+    def put(self, buff):
+        # put and join use timeouts so that the action timeout can interrupt them
+        while True:
+            self._check()
+            try:
+                self.queue.put(buff, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def stop(self):
+        """
+        Waits for the queued chunks to be consumed.
+        """
+        while self.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+                break
+            except Queue.Full:
+                pass
+        while self.is_alive():
+            self.join(1)
+
+    def finish(self):
+        self.stop()
+        self._check()
+
+
+class ParallelDownloadAction(Action):
+    """
+    Downloads all the files of a deployment at the same time, using at most
+    MAX_PARALLEL_DOWNLOADS threads. Each file keeps its own DownloaderAction,
+    so retries, progress logging and the download_action entry in the
+    context are the same as for a sequential download.
+    The timeout of this action covers all the downloads. The signal based
+    timeout of each download does not apply outside of the main thread, so
+    the workers give each download a deadline which the download checks
+    between chunks, as it checks whether the other downloads failed.
+    """
+    def __init__(self, downloads):
+        """
+        :param downloads: list of (key, path) tuples, as for DownloaderAction
+        """
+        super(ParallelDownloadAction, self).__init__()
+        self.name = "parallel-download"
+        self.description = "download the files of the deployment in parallel"
+        self.summary = "parallel download"
+        self.downloads = downloads
+        self.max_workers = MAX_PARALLEL_DOWNLOADS
+
+    def populate(self, parameters):
+        self.internal_pipeline = Pipeline(parent=self, job=self.job, parameters=parameters)
+        for key, path in self.downloads:
+            download = DownloaderAction(key, path=path)
+            download.max_retries = 3  # overridden by failure_retry in the parameters, if set.
+            self.internal_pipeline.add_action(download)
+
+    def _worker(self, queue, connection, failures, running, stop):
+        # the downloads are profiled as children of this action
+        profile.thread_started(running)
+        while not stop.is_set():
+            try:
+                action = queue.get_nowait()
+            except Queue.Empty:
+                return
+            # as run_actions does, for the messages logged by this thread
+            if isinstance(self.logger, YAMLLogger):
+                self.logger.setMetadata(action.level, action.name)
+            self.logger.debug("start: %s %s (max %ds)" % (action.level, action.name, action.timeout.duration))
+            start = time.time()
+            profile.action_started(action)
+            try:
+                if action.internal_pipeline:
+                    for handler in action.internal_pipeline.actions:
+                        handler.stop = stop
+                        handler.deadline = start + action.timeout.duration
+                action.run(connection)
+            except Exception:  # pylint: disable=broad-except
+                # re-raised in the main thread, the other downloads stop
+                failures.append(sys.exc_info())
+                stop.set()
+                return
+            finally:
+                profile.action_finished(action)
+            action.elapsed_time = time.time() - start
+            self.logger.debug("%s %s (%s) duration: %.02f" % (
+                action.level, action.name, action.key, action.elapsed_time))
+
+    def run(self, connection, args=None):
+        self.call_protocols()
+        queue = Queue.Queue()
+        for action in self.internal_pipeline.actions:
+            queue.put(action)
+        failures = []
+        threads = []
+        stop = threading.Event()
+        running = profile.running_actions()
+        try:
+            for _ in range(min(self.max_workers, len(self.internal_pipeline.actions))):
+                thread = threading.Thread(target=self._worker, args=(queue, connection, failures, running, stop))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                # join with a timeout so that the action timeout can interrupt the wait
+                while thread.is_alive():
+                    thread.join(1)
+        finally:
+            # on a timeout of this action, the downloads stop at the next chunk
+            stop.set()
+            for thread in threads:
+                thread.join()
+        if failures:
+            exc_type, exc_value, exc_traceback = failures[0]
+            raise exc_type, exc_value, exc_traceback
+        return connection
+
+
 class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
     """
     The identification of which downloader and whether to
@@ -101,10 +294,37 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
         self.key = key
         self.path = path
         self.size = -1
+        self.cache = None
+        # set by ParallelDownloadAction, which runs the download in a worker thread
+        self.stop = None
+        self.deadline = None
+
+    def _check_stopped(self):
+        """
+        Stands in for the action timeout when the download runs in a worker
+        thread, where the alarm signal is not delivered.
+        """
+        if self.stop is not None and self.stop.is_set():
+            raise JobError("Download of %s stopped" % self.key)
+        if self.deadline is not None and time.time() > self.deadline:
+            raise JobError("Download of %s timed out" % self.key)
 
     def reader(self):
         raise NotImplementedError
 
+    def open_cache(self):
+        """
+        The worker download cache, None if this downloader does not use it.
+        """
+        return None
+
+    def revalidate(self):
+        """
+        Called with the cache locked for the url.
+        :return: the cache entry if the cached content is current, None otherwise
+        """
+        return None
+
     def _url_to_fname_suffix(self, path, modify):
         filename = os.path.basename(self.url.path)
         parts = filename.split('.')
@@ -128,11 +348,11 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
         decompressor = None
         if compression:
             if compression == 'gz':
-                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                decompressor = MultiStreamDecompressor(lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
             elif compression == 'bz2':
-                decompressor = bz2.BZ2Decompressor()
+                decompressor = MultiStreamDecompressor(bz2.BZ2Decompressor)
             elif compression == 'xz':
-                decompressor = lzma.LZMADecompressor()  # pylint: disable=no-member
+                decompressor = MultiStreamDecompressor(lzma.LZMADecompressor)  # pylint: disable=no-member
             self.logger.debug("Using %s decompression" % compression)
         else:
             self.logger.debug("No compression specified.")
@@ -162,26 +382,100 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
             if compression not in ['gz', 'bz2', 'xz']:
                 self.errors = "Unknown 'compression' format '%s'" % compression
 
+        if not isinstance(self._checksum(), bool):
+            self.errors = "'checksum' must be a boolean or a dictionary of booleans"
+
+    def _checksum(self):
+        """
+        Checksums can be disabled for all the downloads of a deployment with
+        checksum: false or for some of them with checksum: {rootfs: false}
+        """
+        checksum = self.parameters.get('checksum', True)
+        if isinstance(checksum, dict):
+            return checksum.get(self.key, True)
+        return checksum
+
     def run(self, connection, args=None):
+        connection = super(DownloadHandler, self).run(connection, args)
+        self.cache = self.open_cache()
+        if not self.cache:
+            self._download()
+            return connection
+        # only one job at a time downloads the url, the others wait for the cache
+        with self.cache.locked(self.url.geturl()):
+            entry = self.revalidate()
+            if entry and not self.parameters.get('compression', False):
+                if self._deliver(entry):
+                    return connection
+                entry = None
+            self._download(entry)
+        return connection
+
+    def _deliver(self, entry):
+        """
+        Puts the cached content into the job directory without copying it, where possible.
+        """
+        fname, _ = self._url_to_fname_suffix(self.path, False)
+        if not self.cache.deliver(entry, fname, hardlink=self.key not in MODIFIED_IN_PLACE):
+            return False
+        self.logger.info("using the cached copy of %s as %s" % (self.parameters[self.key], fname))
+        self._set_result(fname, entry['md5'], entry['sha256'])
+        return True
+
+    def _set_result(self, fname, md5sum, sha256sum):
+        # set the dynamic data into the context
+        self.data['download_action'][self.key] = {
+            'file': fname,
+            'md5': md5sum,
+            'sha256': sha256sum
+        }
+        # certain deployments need prefixes set
+        if self.parameters['to'] == 'tftp':
+            suffix = self.data['tftp-deploy'].get('suffix', '')
+            self.set_common_data('file', self.key, os.path.join(suffix, os.path.basename(fname)))
+        else:
+            self.set_common_data('file', self.key, fname)
+        if md5sum:
+            self.logger.info("md5sum of downloaded content: %s" % md5sum)
+            self.logger.info("sha256sum of downloaded content: %s" % sha256sum)
+        else:
+            self.logger.info("checksums of %s disabled" % self.key)
+
+    def _download(self, cached=None):
+        """
+        :param cached: cache entry to decompress instead of downloading the content
+        """
         def progress_unknown_total(downloaded_size, last_value):
             """ Compute progress when the size is unknown """
             condition = downloaded_size >= last_value + 25 * 1024 * 1024
             return (condition, downloaded_size,
-                    "progress %dMB" % (int(downloaded_size / (1024 * 1024))) if condition else "")
+                    "%s: progress %dMB" % (self.key, int(downloaded_size / (1024 * 1024))) if condition else "")
 
         def progress_known_total(downloaded_size, last_value):
             """ Compute progress when the size is known """
             percent = math.floor(downloaded_size / float(self.size) * 100)
             condition = percent >= last_value + 5
             return (condition, percent,
-                    "progress %3d%% (%dMB)" % (percent, int(downloaded_size / (1024 * 1024))) if condition else "")
+                    "%s: progress %3d%% (%dMB)" % (self.key, percent, int(downloaded_size / (1024 * 1024))) if condition else "")
 
-        connection = super(DownloadHandler, self).run(connection, args)
         # self.cookies = self.job.context.config.lava_cookies  # FIXME: work out how to restore
         md5 = hashlib.md5()
         sha256 = hashlib.sha256()
+
+        def update_checksums(buff):
+            md5.update(buff)
+            sha256.update(buff)
+
+        checksum = self._checksum()
+        self._check_stopped()
         with self._decompressor_stream() as (writer, fname):
-            self.logger.info("downloading %s as %s" % (self.parameters[self.key], fname))
+            if cached:
+                self.logger.info("decompressing the cached copy of %s as %s" % (self.parameters[self.key], fname))
+                self.size = cached['size']
+                source = self.cache.read(cached)
+            else:
+                self.logger.info("downloading %s as %s" % (self.parameters[self.key], fname))
+                source = self.reader()
 
             downloaded_size = 0
             beginning = time.time()
@@ -195,16 +489,31 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
                 last_value = -5
                 progress = progress_known_total
 
-            # Download the file and log the progresses
-            for buff in self.reader():
-                downloaded_size += len(buff)
-                (printing, new_value, msg) = progress(downloaded_size, last_value)
-                if printing:
-                    last_value = new_value
-                    self.logger.debug(msg)
-                md5.update(buff)
-                sha256.update(buff)
-                writer(buff)
+            # this thread reads, hashing and decompression each have a thread
+            stages = [StreamStage("%s-write" % self.key, writer)]
+            if checksum:
+                stages.append(StreamStage("%s-checksum" % self.key, update_checksums))
+            for stage in stages:
+                stage.start()
+            try:
+                # Download the file and log the progresses
+                for buff in source:
+                    self._check_stopped()
+                    downloaded_size += len(buff)
+                    (printing, new_value, msg) = progress(downloaded_size, last_value)
+                    if printing:
+                        last_value = new_value
+                        self.logger.debug(msg)
+                    for stage in stages:
+                        stage.put(buff)
+            except BaseException:
+                for stage in stages:
+                    stage.stop()
+                raise
+            for stage in stages:
+                stage.finish()
+            if not cached:
+                profile.count('downloaded', downloaded_size)
 
             # Log the download speed
             ending = time.time()
@@ -212,21 +521,10 @@ class DownloadHandler(Action):  # pylint: disable=too-many-instance-attributes
                              (downloaded_size / (1024 * 1024), round(ending - beginning, 2),
                               round(downloaded_size / (1024 * 1024 * (ending - beginning)), 2)))
 
-        # set the dynamic data into the context
-        self.data['download_action'][self.key] = {
-            'file': fname,
-            'md5': md5.hexdigest(),
-            'sha256': sha256.hexdigest()
-        }
-        # certain deployments need prefixes set
-        if self.parameters['to'] == 'tftp':
-            suffix = self.data['tftp-deploy'].get('suffix', '')
-            self.set_common_data('file', self.key, os.path.join(suffix, os.path.basename(fname)))
+        if checksum:
+            self._set_result(fname, md5.hexdigest(), sha256.hexdigest())
         else:
-            self.set_common_data('file', self.key, fname)
-        self.logger.info("md5sum of downloaded content: %s" % (md5.hexdigest()))
-        self.logger.info("sha256sum of downloaded content: %s" % (sha256.hexdigest()))
-        return connection
+            self._set_result(fname, None, None)
 
 
 class FileDownloadAction(DownloadHandler):
@@ -263,6 +561,87 @@ class FileDownloadAction(DownloadHandler):
                 reader.close()
 
 
+class UrlValidator(object):
+    """
+    Checks http urls with HEAD requests over a shared keep-alive session.
+    The urls of a job are checked concurrently, once: the results, errors
+    included, are kept for the job so that the other actions of the job
+    only look up their own url. The status and size of each url are also
+    kept for HTTP_VALIDATION_TTL seconds, so that a url used by several
+    jobs validated by the same process is only requested once.
+    The session is only used for the HEAD requests.
+    """
+
+    def __init__(self, ttl=HTTP_VALIDATION_TTL, threads=MAX_PARALLEL_VALIDATIONS):
+        self.ttl = ttl
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=threads, pool_maxsize=threads)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # url: (time of the check, (status code, size))
+        self.results = {}
+        # job: (time of the check, results of check())
+        self.jobs = weakref.WeakKeyDictionary()
+
+    def _head(self, url):
+        """
+        :return: (status code, size), or the error message if there was no response
+        """
+        try:
+            res = self.session.head(url, allow_redirects=True, timeout=HTTP_DOWNLOAD_TIMEOUT)
+        except requests.Timeout:
+            return "'%s' timed out" % url
+        except requests.RequestException as exc:
+            return str(exc)
+        res.close()
+        result = (res.status_code, int(res.headers.get('content-length', -1)))
+        # failed requests are not kept, the next job tries again
+        with self.lock:
+            self.results[url] = (time.time(), result)
+        return result
+
+    def check(self, urls):
+        """
+        Request the urls which were not checked recently, at the same time.
+        :return: dict of url: (status code, size) or error message
+        """
+        now = time.time()
+        with self.lock:
+            for url in [url for url, (checked, _) in self.results.items() if now - checked >= self.ttl]:
+                del self.results[url]
+            results = dict([(url, self.results[url][1]) for url in urls if url in self.results])
+        pending = sorted(set(urls) - set(results))
+        if len(pending) == 1:
+            results[pending[0]] = self._head(pending[0])
+        elif pending:
+            pool = ThreadPool(min(self.threads, len(pending)))
+            try:
+                results.update(zip(pending, pool.map(self._head, pending)))
+            finally:
+                pool.terminate()
+                pool.join()
+        return results
+
+    def check_job(self, job, urls):
+        """
+        Check the urls of the job, unless they were checked less than
+        ttl seconds ago, in the same validation pass.
+        :return: dict of url: (status code, size) or error message
+        """
+        with self.lock:
+            checked, results = self.jobs.get(job, (None, None))
+        if results is None or time.time() - checked >= self.ttl:
+            results = self.check(urls)
+            with self.lock:
+                self.jobs[job] = (time.time(), results)
+        return results
+
+
+URL_VALIDATOR = UrlValidator()
+
+
 class HttpDownloadAction(DownloadHandler):
     """
     Download a resource over http or https using requests module
@@ -273,29 +652,87 @@ class HttpDownloadAction(DownloadHandler):
         self.name = "http_download"
         self.description = "use http to download the file"
         self.summary = "http download"
+        self.response = None
+
+    def _job_urls(self):
+        """
+        :return: the urls of all the http downloads of the job
+        """
+        urls = [self.url.geturl()]
+        pipelines = [self.job.pipeline] if self.job and self.job.pipeline else []
+        while pipelines:
+            for action in pipelines.pop().actions:
+                if isinstance(action, HttpDownloadAction):
+                    urls.append(action.url.geturl())
+                if action.internal_pipeline:
+                    pipelines.append(action.internal_pipeline)
+        return urls
 
     def validate(self):
         super(HttpDownloadAction, self).validate()
+        # the first download to validate checks the urls of the whole job,
+        # the others then find their result in the validator.
+        if self.job:
+            results = URL_VALIDATOR.check_job(self.job, self._job_urls())
+        else:
+            results = URL_VALIDATOR.check([self.url.geturl()])
+        result = results[self.url.geturl()]
+        if not isinstance(result, tuple):
+            # TODO: find a better way to report the error
+            self.errors = result
+        elif result[0] != requests.codes.OK:  # pylint: disable=no-member
+            self.errors = "Resources not available at '%s'" % (self.url.geturl())
+        else:
+            self.size = result[1]
+
+    def open_cache(self):
         try:
-            res = requests.head(self.url.geturl(), allow_redirects=True, timeout=HTTP_DOWNLOAD_TIMEOUT)
-            if res.status_code != requests.codes.OK:  # pylint: disable=no-member
-                self.errors = "Resources not available at '%s'" % (self.url.geturl())
-            else:
-                self.size = int(res.headers.get('content-length', -1))
-        except requests.Timeout:
-            self.errors = "'%s' timed out" % (self.url.geturl())
+            return DownloadCache()
+        except (IOError, OSError) as exc:
+            self.logger.debug("Download cache not available: %s" % exc)
+            return None
+
+    def revalidate(self):
+        """
+        Asks the server whether the cached copy is still current. A new
+        response is kept for the reader so the content is only requested once.
+        """
+        self.response = None
+        entry = self.cache.lookup(self.url.geturl())
+        if not entry:
+            return None
+        headers = self.cache.validators(entry)
+        if not headers:
+            # nothing to revalidate against, download again.
+            return None
+        try:
+            res = requests.get(self.url.geturl(), allow_redirects=True, stream=True,
+                               timeout=HTTP_DOWNLOAD_TIMEOUT, headers=headers)
         except requests.RequestException as exc:
-            # TODO: find a better way to report the error
-            self.errors = str(exc)
+            self.logger.debug("Unable to revalidate the cached copy of %s: %s" % (self.url.geturl(), exc))
+            return None
+        if res.status_code == requests.codes.not_modified:  # pylint: disable=no-member
+            res.close()
+            return entry
+        self.response = res
+        return None
 
     def reader(self):
-        res = None
+        res, self.response = self.response, None
         try:
-            res = requests.get(self.url.geturl(), allow_redirects=True, stream=True, timeout=HTTP_DOWNLOAD_TIMEOUT)
+            if res is None:
+                res = requests.get(self.url.geturl(), allow_redirects=True, stream=True, timeout=HTTP_DOWNLOAD_TIMEOUT)
             if res.status_code != requests.codes.OK:  # pylint: disable=no-member
                 raise JobError("Unable to download '%s'" % (self.url.geturl()))
-            for buff in res.iter_content(HTTP_DOWNLOAD_CHUNK_SIZE):
-                yield buff
+            if self.cache:
+                # the content is only added to the cache once it is complete
+                with self.cache.storing(self.url.geturl(), res.headers) as cached:
+                    for buff in res.iter_content(HTTP_DOWNLOAD_CHUNK_SIZE):
+                        cached.write(buff)
+                        yield buff
+            else:
+                for buff in res.iter_content(HTTP_DOWNLOAD_CHUNK_SIZE):
+                    yield buff
         except requests.RequestException as exc:
             # TODO: improve error reporting
             raise JobError(exc)
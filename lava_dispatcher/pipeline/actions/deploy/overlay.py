@@ -26,7 +26,9 @@ import tarfile
 from lava_dispatcher.pipeline.actions.deploy import DeployAction
 from lava_dispatcher.pipeline.action import Action, Pipeline
 from lava_dispatcher.pipeline.actions.deploy.testdef import TestDefinitionAction
+from lava_dispatcher.pipeline.utils.cache import OverlayCache
 from lava_dispatcher.pipeline.utils.filesystem import mkdtemp, check_ssh_identity_file
+from lava_dispatcher.pipeline.utils.overlay import write_overlay
 from lava_dispatcher.pipeline.protocols.multinode import MultinodeProtocol
 
 
@@ -220,6 +222,7 @@ class MultinodeOverlayAction(OverlayAction):
 class CompressOverlay(Action):
     """
     Makes a tarball of the finished overlay and declares filename of the tarball
+    An identical overlay is reused from the worker cache, see utils.overlay.
     """
     def __init__(self):
         super(CompressOverlay, self).__init__()
@@ -238,19 +241,23 @@ class CompressOverlay(Action):
         connection = super(CompressOverlay, self).run(connection, args)
         location = self.data['lava-overlay']['location']
         output = os.path.join(self.job.parameters['output_dir'], "overlay-%s.tar.gz" % self.level)
-        cur_dir = os.getcwd()
+        paths = [".%s" % self.data['lava_test_results_dir']]
+        # ssh authorization support
+        if os.path.exists(os.path.join(location, 'root')):
+            paths.append('./root/')
         try:
-            with tarfile.open(output, "w:gz") as tar:
-                os.chdir(location)
-                tar.add(".%s" % self.data['lava_test_results_dir'])
-                # ssh authorization support
-                if os.path.exists('./root/'):
-                    tar.add(".%s" % '/root/')
-        except tarfile.TarError as exc:
+            cache = OverlayCache()
+        except (IOError, OSError) as exc:
+            self.logger.debug("Overlay cache not available: %s" % exc)
+            cache = None
+        try:
+            if write_overlay(location, paths, output, cache=cache):
+                self.logger.debug("Reusing a cached copy of the overlay")
+        except (IOError, OSError, tarfile.TarError) as exc:
             self.errors = "Unable to create lava overlay tarball: %s" % exc
             raise RuntimeError("Unable to create lava overlay tarball: %s" % exc)
-        os.chdir(cur_dir)
         self.data[self.name]['output'] = output
+        self.data[self.name]['paths'] = paths
         return connection
 
 
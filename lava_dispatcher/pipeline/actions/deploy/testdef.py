@@ -35,6 +35,7 @@ from lava_dispatcher.pipeline.action import (
     Pipeline,
 )
 from lava_dispatcher.pipeline.actions.test import TestAction
+from lava_dispatcher.pipeline.utils.constants import VCS_MIRROR_DIR
 from lava_dispatcher.pipeline.utils.strings import indices
 from lava_dispatcher.pipeline.utils.vcs import BzrHelper, GitHelper
 
@@ -236,7 +237,7 @@ class GitRepoAction(RepoAction):  # pylint: disable=too-many-public-methods
             self.errors = "Path to YAML file not specified in the job definition"
         if not self.valid:
             return
-        self.vcs = GitHelper(self.parameters['repository'])
+        self.vcs = GitHelper(self.parameters['repository'], mirrors=VCS_MIRROR_DIR)
         super(GitRepoAction, self).validate()
 
     @classmethod
@@ -302,7 +303,7 @@ class BzrRepoAction(RepoAction):  # pylint: disable=too-many-public-methods
             self.errors = "Path to YAML file not specified in the job definition"
         if not self.valid:
             return
-        self.vcs = BzrHelper(self.parameters['repository'])
+        self.vcs = BzrHelper(self.parameters['repository'], mirrors=VCS_MIRROR_DIR)
         super(BzrRepoAction, self).validate()
 
     @classmethod
@@ -25,7 +25,7 @@ import os
 from lava_dispatcher.pipeline.action import Pipeline, InfrastructureError
 from lava_dispatcher.pipeline.logical import Deployment
 from lava_dispatcher.pipeline.actions.deploy import DeployAction
-from lava_dispatcher.pipeline.actions.deploy.download import DownloaderAction
+from lava_dispatcher.pipeline.actions.deploy.download import ParallelDownloadAction
 from lava_dispatcher.pipeline.actions.deploy.apply_overlay import PrepareOverlayTftp
 from lava_dispatcher.pipeline.actions.deploy.environment import DeployDeviceEnvironment
 from lava_dispatcher.pipeline.utils.shell import which
@@ -115,27 +115,18 @@ class TftpAction(DeployAction):  # pylint:disable=too-many-instance-attributes
 
     def populate(self, parameters):
         self.internal_pipeline = Pipeline(parent=self, job=self.job, parameters=parameters)
+        downloads = []
         if 'ramdisk' in parameters:
-            download = DownloaderAction('ramdisk', path=self.tftp_dir)
-            download.max_retries = 3  # overridden by failure_retry in the parameters, if set.
-            self.internal_pipeline.add_action(download)
+            downloads.append(('ramdisk', self.tftp_dir))
             self.set_common_data('tftp', 'ramdisk', True)
-        if 'kernel' in parameters:
-            download = DownloaderAction('kernel', path=self.tftp_dir)
-            download.max_retries = 3
-            self.internal_pipeline.add_action(download)
-        if 'dtb' in parameters:
-            download = DownloaderAction('dtb', path=self.tftp_dir)
-            download.max_retries = 3
-            self.internal_pipeline.add_action(download)
+        for key in ['kernel', 'dtb']:
+            if key in parameters:
+                downloads.append((key, self.tftp_dir))
         if 'nfsrootfs' in parameters:
-            download = DownloaderAction('nfsrootfs', path=self.download_dir)
-            download.max_retries = 3
-            self.internal_pipeline.add_action(download)
+            downloads.append(('nfsrootfs', self.download_dir))
         if 'modules' in parameters:
-            download = DownloaderAction('modules', path=self.tftp_dir)
-            download.max_retries = 3
-            self.internal_pipeline.add_action(download)
+            downloads.append(('modules', self.tftp_dir))
+        self.internal_pipeline.add_action(ParallelDownloadAction(downloads))
         # TftpAction is a deployment, so once the files are in place, just do the overlay
         self.internal_pipeline.add_action(PrepareOverlayTftp())
         self.internal_pipeline.add_action(DeployDeviceEnvironment())
@@ -29,6 +29,7 @@ from lava_dispatcher.pipeline.action import (
 )
 from lava_dispatcher.pipeline.logical import LavaTest, RetryAction
 from lava_dispatcher.pipeline.connection import BaseSignalHandler, SignalMatch
+from lava_dispatcher.pipeline.utils.constants import EXPECT_SEARCH_WINDOW
 
 
 class TestShell(LavaTest):
@@ -223,7 +224,8 @@ class TestShellAction(TestAction):
 
     def _keep_running(self, test_connection, timeout):
         self.logger.debug("test shell timeout: %d seconds" % timeout)
-        retval = test_connection.expect(list(self.patterns.values()), timeout=timeout)
+        retval = test_connection.expect(list(self.patterns.values()), timeout=timeout,
+                                        searchwindowsize=EXPECT_SEARCH_WINDOW)
         return self.check_patterns(list(self.patterns.keys())[retval], test_connection)
 
     class SignalDirector(object):
@@ -19,6 +19,7 @@
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
 import logging
+import os
 import yaml
 
 from lava_dispatcher.pipeline.action import Action, JobError
@@ -26,6 +27,7 @@ from lava_dispatcher.pipeline.log import YAMLLogger  # pylint: disable=unused-im
 from lava_dispatcher.pipeline.logical import PipelineContext
 from lava_dispatcher.pipeline.diagnostics import DiagnoseNetwork
 from lava_dispatcher.pipeline.protocols.multinode import MultinodeProtocol  # pylint: disable=unused-import
+from lava_dispatcher.pipeline.utils.profile import start_profile, stop_profile
 
 
 class Job(object):  # pylint: disable=too-many-instance-attributes
@@ -40,6 +42,7 @@ class Job(object):  # pylint: disable=too-many-instance-attributes
         yaml_line
         logging_level
         job_timeout
+        profile (optional, see utils.profile)
     Job also provides the primary access to the Device.
     The NewDevice class only loads the specific configuration of the
     device for this job - one job, one device.
@@ -143,12 +146,28 @@ class Job(object):  # pylint: disable=too-many-instance-attributes
                 self.logger.exception(msg)
                 raise JobError(msg)
 
-        self.pipeline.run_actions(self.connection)
+        profiler = start_profile() if self.parameters.get('profile', False) else None
+        try:
+            self.pipeline.run_actions(self.connection)
+        finally:
+            if profiler:
+                stop_profile()
+                self.write_profile(profiler)
         if self.pipeline.errors:
             self.logger.exception(self.pipeline.errors)
             return len(self.pipeline.errors)
         return 0
 
+    def write_profile(self, profiler):
+        """
+        Write the profile of the actions as profile.yaml in the output
+        directory and send it to the master with the results.
+        """
+        if self.parameters.get('output_dir'):
+            profiler.write(os.path.join(self.parameters['output_dir'], 'profile.yaml'))
+        if isinstance(self.logger, YAMLLogger):
+            self.logger.results({'profile': profiler.profile()})
+
 
 class ResetContext(Action):
     """
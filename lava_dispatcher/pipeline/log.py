@@ -21,10 +21,42 @@
 
 import datetime
 import logging
+import re
+import threading
+import time
 import yaml
 import zmq
 
 
+# Optional fifth frame of a log message, set on messages which contain
+# results so that the master does not need to parse every log line.
+# Masters from before the fifth frame drop messages which have one:
+# upgrade the master before the dispatchers. A current master still
+# accepts the four frame messages of older dispatchers.
+RESULTS_FRAME = 'results'
+
+# Fifth frame of a message holding several lines of console output, one
+# YAML list entry per line, which the master writes as it is.
+TARGET_BATCH_FRAME = 'target-batch'
+
+# Console output is sent in batches of this many bytes ...
+CONSOLE_BATCH_SIZE = 64 * 1024
+# ... or once the oldest line of the batch is this many seconds old.
+CONSOLE_BATCH_LATENCY = 0.1
+
+# Characters escaped in YAML double quoted scalars
+YAML_ESCAPE = re.compile(r'[\x00-\x1f\x7f"\\]')
+YAML_ESCAPES = dict([(chr(char), '\\x%02x' % char) for char in range(32) + [127]])
+YAML_ESCAPES.update({'"': '\\"', '\\': '\\\\'})
+
+
+def yaml_escape(line):
+    """
+    Escape a line of console output for a YAML double quoted scalar.
+    """
+    return YAML_ESCAPE.sub(lambda match: YAML_ESCAPES[match.group(0)], line)
+
+
 class ZMQPushHandler(logging.Handler):
     def __init__(self, socket_addr, job_id):
         super(ZMQPushHandler, self).__init__()
@@ -36,18 +68,21 @@ class ZMQPushHandler(logging.Handler):
         self.socket.connect(socket_addr)
 
         self.job_id = str(job_id)
+        # used for the messages logged outside of any action
         self.action_level = '0'
         self.action_name = 'dispatcher'
 
         self.formatter = logging.Formatter("%(message)s")
 
-    def setMetadata(self, level, name):
-        self.action_level = level
-        self.action_name = name
-
     def emit(self, record):
-        msg = [self.job_id, self.action_level, self.action_name,
+        # the action level and name are set on each record by YAMLLogger,
+        # actions can log from several threads at the same time.
+        msg = [self.job_id,
+               getattr(record, 'action_level', self.action_level),
+               getattr(record, 'action_name', self.action_name),
                self.formatter.format(record)]
+        if getattr(record, 'frame', None):
+            msg.append(record.frame)
         self.socket.send_multipart(msg)
 
     def close(self):
@@ -60,6 +95,15 @@ class YAMLLogger(logging.Logger):
     def __init__(self, name):
         super(YAMLLogger, self).__init__(name)
         self.handler = None
+        # console output waiting to be sent, see console()
+        self.console_lock = threading.Lock()
+        self.console_lines = []
+        self.console_size = 0
+        self.console_start = None
+        self.console_ts = None
+        self.console_extra = None
+        # level and name of the action running in each thread, see setMetadata()
+        self.metadata = threading.local()
 
     def addZMQHandler(self, socket_addr, job_id):
         self.handler = ZMQPushHandler(socket_addr, job_id)
@@ -67,20 +111,87 @@ class YAMLLogger(logging.Logger):
         return self.handler
 
     def setMetadata(self, level, name):
-        if isinstance(self.handler, ZMQPushHandler):
-            self.handler.setMetadata(level, name)
+        """
+        Set the action level and name of the messages logged by the calling thread.
+        """
+        # the waiting console output belongs to the previous action
+        self.flush_console()
+        self.metadata.level = level
+        self.metadata.name = name
+
+    def _extra(self, extra=None):
+        """
+        :return: the extra attributes of a record, with the action level
+        and name of the calling thread, if set.
+        """
+        extra = dict(extra) if extra else {}
+        if hasattr(self.metadata, 'level'):
+            extra['action_level'] = self.metadata.level
+            extra['action_name'] = self.metadata.name
+        return extra
+
+    def console(self, lines):
+        """
+        Log lines of console output. The lines are escaped with a regular
+        expression instead of being dumped by yaml and sent as a single
+        message once CONSOLE_BATCH_SIZE bytes or CONSOLE_BATCH_LATENCY
+        seconds are reached, or before any other message.
+        The batches are sent by the thread which logs, never in the
+        background: while there is no output, the expect loop of
+        ShellCommand sends the waiting batch, see console_wait().
+        """
+        if not self.isEnabledFor(logging.INFO):
+            return
+        with self.console_lock:
+            if not self.console_lines:
+                self.console_start = time.time()
+                self.console_ts = datetime.datetime.utcnow().isoformat()
+                self.console_extra = self._extra({'frame': TARGET_BATCH_FRAME})
+            for line in lines:
+                entry = '- {target: "%s", ts: "%s"}' % (yaml_escape(line), self.console_ts)
+                self.console_lines.append(entry)
+                self.console_size += len(entry)
+            if self.console_size < CONSOLE_BATCH_SIZE and \
+                    time.time() - self.console_start < CONSOLE_BATCH_LATENCY:
+                return
+        self.flush_console()
+
+    def console_wait(self):
+        """
+        :return: seconds until the waiting console output has to be sent,
+        None if there is none.
+        """
+        with self.console_lock:
+            if not self.console_lines:
+                return None
+            return max(0, self.console_start + CONSOLE_BATCH_LATENCY - time.time())
+
+    def flush_console(self):
+        with self.console_lock:
+            if not self.console_lines:
+                return
+            lines = self.console_lines
+            self.console_lines = []
+            self.console_size = 0
+            # invalid utf-8 would make the whole log unreadable
+            message = '\n'.join(lines).decode('utf-8', 'replace').encode('utf-8')
+            self._log(logging.INFO, message, (), extra=self.console_extra)
 
     def log_message(self, level, level_name, message, *args, **kwargs):
+        # keep the console output and the other messages in order
+        self.flush_console()
         # If the received message is a dictionary then we look for specific log
         # parameters such as timestamp, else we assume the log message is a
         # string and dump the message.
+        # Results are tagged with an extra frame for the master.
+        extra = self._extra({'frame': RESULTS_FRAME} if level_name == 'results' else None)
         if isinstance(message, dict) and 'ts' in message:
             self._log(level, yaml.dump([{'ts': message['ts'],
                                          level_name: message['msg']}])[:-1],
-                      args, kwargs)
+                      args, kwargs, extra=extra)
         else:
             self._log(level, yaml.dump([{level_name: message}])[:-1], args,
-                      kwargs)
+                      kwargs, extra=extra)
 
     def exception(self, exc, *args, **kwargs):
         self.log_message(logging.ERROR, 'exception', exc, *args, **kwargs)
@@ -32,7 +32,10 @@ from lava_dispatcher.pipeline.action import (
     InfrastructureError,
     TestError
 )
-from lava_dispatcher.pipeline.utils.constants import LAVA_MULTINODE_SYSTEM_TIMEOUT
+from lava_dispatcher.pipeline.utils.constants import (
+    LAVA_MULTINODE_SYSTEM_TIMEOUT,
+    LAVA_MULTINODE_PROTOCOL_VERSION,
+)
 
 
 class MultinodeProtocol(Protocol):
@@ -50,6 +53,10 @@ class MultinodeProtocol(Protocol):
         self.system_timeout = Timeout('system', LAVA_MULTINODE_SYSTEM_TIMEOUT)
         self.settings = None
         self.sock = None
+        # keep one connection open and have the coordinator push the response
+        # to a wait, unless the coordinator only supports version 1.
+        self.persistent = True
+        self.connected = False
         self.base_message = None
         self.logger = logging.getLogger('dispatcher')
         self.delayed_start = False
@@ -155,6 +162,88 @@ class MultinodeProtocol(Protocol):
             return json.dumps({"response": "wait"})
         return response
 
+    def _recv_count(self, count):
+        data = ''
+        while len(data) < count:
+            chunk = self.sock.recv(min(count - len(data), self.blocks))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _recv_pushed(self, timeout):
+        """
+        Wait on the persistent connection for the response, which the Coordinator
+        holds back until a wait is satisfied.
+        :return: the response or None if the connection was lost
+        """
+        self.sock.settimeout(max(timeout, 1))
+        try:
+            header = self._recv_count(8)  # 32bit limit as a hexadecimal
+            if not header:
+                return None
+            return self._recv_count(int(header, 16))
+        except ValueError:
+            self.logger.debug("invalid header received: %s" % header)
+        except socket.timeout:
+            raise
+        except socket.error as exc:
+            self.logger.debug("socket error '%s' on response" % exc)
+        return None
+
+    def _disconnect(self):
+        if self.connected:
+            self.sock.close()
+        self.connected = False
+
+    def _poll_persistent(self, message, timeout):
+        """
+        Sends the message over the persistent connection and blocks until
+        the Coordinator pushes the response, reconnecting if the connection is lost.
+        :return: the response or None if the Coordinator only supports version 1.
+        """
+        delay = self.settings['poll_delay']
+        start = time.time()
+        while True:
+            if time.time() - start > timeout:
+                self._disconnect()
+                self.finalise_protocol()
+                raise JobError("protocol %s timed out" % self.name)
+            if not self.connected:
+                if not self._connect(delay):
+                    delay += 2
+                    continue
+                delay = self.settings['poll_delay']
+                self.connected = True
+            if not self._send_message(message):
+                self.connected = False
+                continue
+            try:
+                response = self._recv_pushed(start + timeout - time.time())
+            except socket.timeout:
+                # the Coordinator drops the wait when the connection closes.
+                self._disconnect()
+                self.finalise_protocol()
+                raise JobError("protocol %s timed out" % self.name)
+            if response is None:
+                self._disconnect()
+                time.sleep(delay)
+                continue
+            try:
+                json_data = json.loads(response)
+            except ValueError:
+                self.logger.debug("response starting '%s' was not JSON" % response[:42])
+                self._disconnect()
+                self.finalise_protocol()
+                return response
+            if json_data.get('protocol_version') != LAVA_MULTINODE_PROTOCOL_VERSION:
+                self.logger.info("LAVA Coordinator does not support persistent connections, polling instead.")
+                self.persistent = False
+                self._disconnect()
+                if json_data['response'] == 'wait':
+                    return None
+            return response
+
     def poll(self, message, timeout=None):
         """
         Blocking, synchronous polling of the Coordinator on the configured port.
@@ -167,11 +256,18 @@ class MultinodeProtocol(Protocol):
         msg_len = len(message)
         if msg_len > 0xFFFE:
             raise JobError("Message was too long to send!")
+        self.logger.debug("Connecting to LAVA Coordinator on %s:%s timeout=%d seconds." % (
+            self.settings['coordinator_hostname'], self.settings['port'], timeout))
+        if self.persistent:
+            response = self._poll_persistent(message, timeout)
+            if response is not None:
+                return response
+            json_data = json.loads(message)
+            json_data.pop('protocol_version', None)
+            message = json.dumps(json_data)
         c_iter = 0
         response = None
         delay = self.settings['poll_delay']
-        self.logger.debug("Connecting to LAVA Coordinator on %s:%s timeout=%d seconds." % (
-            self.settings['coordinator_hostname'], self.settings['port'], timeout))
         while True:
             c_iter += self.settings['poll_delay']
             if self._connect(delay):
@@ -285,6 +381,7 @@ class MultinodeProtocol(Protocol):
             "group_size": self.parameters['protocols'][self.name]['group_size']
         }
         self._send(fin_msg, True)
+        self._disconnect()
         self.logger.debug("%s protocol finalised." % self.name)
 
     def _check_data(self, data):
@@ -395,6 +492,8 @@ class MultinodeProtocol(Protocol):
         """
         new_msg = copy.deepcopy(self.base_message)
         new_msg.update(msg)
+        if self.persistent:
+            new_msg['protocol_version'] = LAVA_MULTINODE_PROTOCOL_VERSION
         if system:
             return self.poll(json.dumps(new_msg), timeout=self.system_timeout.duration)
         self.logger.debug("final message: %s" % json.dumps(new_msg))
@@ -22,6 +22,7 @@ import contextlib
 import logging
 import os
 import pexpect
+import re
 import signal
 import sys
 import time
@@ -33,32 +34,32 @@ from lava_dispatcher.pipeline.action import (
     Timeout,
 )
 from lava_dispatcher.pipeline.connection import Connection, CommandRunner
+from lava_dispatcher.pipeline.log import YAMLLogger
 from lava_dispatcher.pipeline.utils.constants import SHELL_SEND_DELAY
+from lava_dispatcher.pipeline.utils.matcher import PatternMatcher
+from lava_dispatcher.pipeline.utils import profile
 from lava_dispatcher.pipeline.utils.shell import which
 
 
 class ShellLogger(object):
+    """
+    Forwards the console output to the YAMLLogger, which batches the lines.
+    """
     def __init__(self):
         self.line = ''
         self.logger = logging.getLogger('dispatcher')
 
     def write(self, new_line):
-        replacements = {
-            '\n\n': '\n',  # double lines to single
-            '\r': '',
-            '"': '\\\"',  # escape double quotes for YAML syntax
-            '\x1b': ''  # remove escape control characters
-        }
-        for key, value in replacements.items():
-            new_line = new_line.replace(key, value)
-        line = self.line + new_line
+        if isinstance(new_line, unicode):
+            new_line = new_line.encode('utf-8')
+        # remove carriage returns and escapes, the logger escapes the other control characters
+        line = self.line + new_line.translate(None, '\r\x1b')
         if '\n' in line:  # any number of newlines
-            for item in line.split('\n'):
-                self.logger.target(item)
+            self.logger.console([item for item in line.split('\n') if item])
             self.line = ''
         else:
             # keep building until a newline is seen
-            self.line += new_line
+            self.line = line
         return
 
     def flush(self):
@@ -88,6 +89,7 @@ class ShellCommand(pexpect.spawn):  # pylint: disable=too-many-public-methods
         # serial can be slow, races do funny things, so allow for a delay
         self.delaybeforesend = SHELL_SEND_DELAY
         self.lava_timeout = lava_timeout
+        self.matchers = {}
 
     def sendline(self, s='', delay=0, send_char=True):  # pylint: disable=arguments-differ
         """
@@ -119,18 +121,66 @@ class ShellCommand(pexpect.spawn):  # pylint: disable=too-many-public-methods
             sent = super(ShellCommand, self).send(string)
         return sent
 
-    def expect(self, *args, **kw):
+    def read_nonblocking(self, size=1, timeout=-1):
+        if timeout == -1:
+            timeout = self.timeout
+        logger = getattr(self.logfile, 'logger', None)
+        wait = logger.console_wait() if isinstance(logger, YAMLLogger) else None
+        if wait is not None and (timeout is None or wait < timeout):
+            try:
+                data = super(ShellCommand, self).read_nonblocking(size, wait)
+            except pexpect.TIMEOUT:
+                # no more output for now, send the console output which is waiting
+                logger.flush_console()
+                data = super(ShellCommand, self).read_nonblocking(
+                    size, None if timeout is None else timeout - wait)
+        else:
+            data = super(ShellCommand, self).read_nonblocking(size, timeout)
+        profile.count('serial_read', len(data))
+        return data
+
+    def matcher(self, patterns):
+        """
+        The compiled PatternMatcher for the patterns, reused by the
+        repeated expect calls of the test shell and prompt loops.
+        """
+        if patterns is None:
+            patterns = []
+        elif not isinstance(patterns, list):
+            patterns = [patterns]
+        flags = re.DOTALL | (re.IGNORECASE if self.ignorecase else 0)
+        key = (tuple(patterns), flags)
+        if key not in self.matchers:
+            if len(self.matchers) > 32:
+                self.matchers.clear()
+            self.matchers[key] = PatternMatcher(patterns, flags)
+        return self.matchers[key]
+
+    def expect(self, pattern, timeout=-1, searchwindowsize=-1, **kw):  # pylint: disable=arguments-differ
         """
         No point doing explicit logging here, the SignalDirector can help
         the TestShellAction make much more useful reports of what was matched
+
+        As for pexpect, all the output since the last match is searched unless
+        a searchwindowsize is given. Callers which only match short lines, like
+        the prompts and the test shell signals, pass EXPECT_SEARCH_WINDOW.
+        Other options of pexpect's expect are left to pexpect.
         """
+        if timeout == -1:
+            timeout = self.timeout
+        start = time.time()
         try:
-            proc = super(ShellCommand, self).expect(*args, **kw)
+            if kw:
+                proc = super(ShellCommand, self).expect(pattern, timeout, searchwindowsize, **kw)
+            else:
+                proc = self.expect_loop(self.matcher(pattern), timeout, searchwindowsize)
         except pexpect.TIMEOUT:
             raise TestError("command timed out.")
         except pexpect.EOF:
             # FIXME: deliberately closing the connection (and starting a new one) needs to be supported.
             raise InfrastructureError("Connection closed")
+        finally:
+            profile.count('expect_time', time.time() - start)
         return proc
 
     def empty_buffer(self):
@@ -0,0 +1,440 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+import bz2
+import gzip
+import hashlib
+import lzma
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from lava_dispatcher.pipeline.action import Pipeline
+from lava_dispatcher.pipeline.actions.deploy import download
+from lava_dispatcher.pipeline.job import Job
+
+
+def download_job(parameters, key, dest):
+    """
+    A job with a single download of the key into dest.
+    """
+    job = Job(4212, None, {'output_dir': None})
+    job.pipeline = Pipeline(job=job)
+    action = download.DownloaderAction(key, dest)
+    action.section = 'deploy'
+    job.pipeline.add_action(action, parameters)
+    job.pipeline.validate_actions()
+    return job
+
+
+def compress(data, compression, path, streams=1):
+    """
+    Write data to path as the given number of concatenated compressed streams.
+    """
+    size = len(data) // streams + 1
+    with open(path, 'wb') as compressed:
+        for index in range(streams):
+            chunk = data[index * size:(index + 1) * size]
+            if compression == 'gz':
+                stream = gzip.GzipFile(fileobj=compressed, mode='wb')
+                stream.write(chunk)
+                stream.close()
+            elif compression == 'bz2':
+                compressed.write(bz2.compress(chunk))
+            elif compression == 'xz':
+                compressed.write(lzma.compress(chunk))  # pylint: disable=no-member
+
+
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """
+    Serves the compressed files.
+    """
+    directory = None
+
+    def translate_path(self, path):
+        return os.path.join(self.directory, os.path.basename(path))
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class TestParallelDownload(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestParallelDownload, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmpdir, 'dest')
+        os.mkdir(self.dest)
+        self.parameters = {'to': 'tmpfs'}
+        self.keys = ['kernel', 'ramdisk', 'dtb']
+        for key in self.keys:
+            path = os.path.join(self.tmpdir, key)
+            with open(path, 'w') as artifact:
+                artifact.write(key * 1000)
+            self.parameters[key] = 'file://%s' % path
+        self.job = Job(4212, None, {'output_dir': None})
+        self.job.pipeline = Pipeline(job=self.job)
+        self.action = download.ParallelDownloadAction([(key, self.dest) for key in self.keys])
+        self.action.section = 'deploy'
+        self.job.pipeline.add_action(self.action, self.parameters)
+        self.reader = download.FileDownloadAction.reader
+
+    def tearDown(self):
+        download.FileDownloadAction.reader = self.reader
+        shutil.rmtree(self.tmpdir)
+        super(TestParallelDownload, self).tearDown()
+
+    def test_pipeline(self):
+        downloads = self.action.internal_pipeline.actions
+        self.assertEqual([action.key for action in downloads], self.keys)
+        self.assertEqual([action.max_retries for action in downloads], [3, 3, 3])
+        self.assertEqual(
+            [action.internal_pipeline.actions[0].name for action in downloads],
+            ['file_download'] * 3)
+
+    def test_concurrent(self):
+        started = []
+        all_started = threading.Event()
+        reader = self.reader
+
+        def waiting_reader(handler):
+            # each download waits until all of them have started
+            started.append(handler.key)
+            if len(started) == len(self.keys):
+                all_started.set()
+            all_started.wait(10)
+            for buff in reader(handler):
+                yield buff
+
+        download.FileDownloadAction.reader = waiting_reader
+        self.job.pipeline.validate_actions()
+        self.job.pipeline.run_actions(None)
+        self.assertTrue(all_started.is_set())
+        for key in self.keys:
+            result = self.job.context['download_action'][key]
+            self.assertEqual(result['file'], os.path.join(self.dest, key))
+            self.assertEqual(result['md5'], hashlib.md5(key * 1000).hexdigest())
+            self.assertEqual(result['sha256'], hashlib.sha256(key * 1000).hexdigest())
+            with open(result['file']) as downloaded:
+                self.assertEqual(downloaded.read(), key * 1000)
+
+    def test_retry(self):
+        failed = []
+        reader = self.reader
+
+        def failing_reader(handler):
+            if handler.key == 'dtb' and not failed:
+                failed.append(handler.key)
+                raise download.JobError("connection reset")
+            for buff in reader(handler):
+                yield buff
+
+        download.FileDownloadAction.reader = failing_reader
+        self.job.pipeline.validate_actions()
+        for action in self.action.internal_pipeline.actions:
+            action.sleep = 0
+        self.job.pipeline.run_actions(None)
+        retried = [action for action in self.action.internal_pipeline.actions if action.key == 'dtb'][0]
+        self.assertEqual(retried.retries, 1)
+        self.assertEqual(
+            self.job.context['download_action']['dtb']['md5'],
+            hashlib.md5('dtb' * 1000).hexdigest())
+
+    def _endless(self, read):
+        """
+        A reader which never finishes, counting the chunks read.
+        """
+        def endless_reader(handler):  # pylint: disable=unused-argument
+            while True:
+                read.append(handler.key)
+                time.sleep(0.01)
+                yield 'x' * 1024
+        return endless_reader
+
+    def _assert_stopped(self, read):
+        count = len(read)
+        time.sleep(0.1)
+        # the workers are joined and nothing reads in the background
+        self.assertEqual(len(read), count)
+
+    def test_timeout(self):
+        read = []
+        download.FileDownloadAction.reader = self._endless(read)
+        self.job.pipeline.validate_actions()
+        for action in self.action.internal_pipeline.actions:
+            action.timeout.duration = 0.2
+            action.sleep = 0
+        # each download has its own timeout in the worker threads, the
+        # retries after the timeout fail at once
+        self.job.pipeline.run_actions(None)
+        for action in self.action.internal_pipeline.actions:
+            self.assertIn("Download of %s timed out" % action.key, str(action.errors))
+        self.assertEqual(sorted(set(read)), sorted(self.keys))
+        self._assert_stopped(read)
+
+    def test_action_timeout(self):
+        read = []
+        download.FileDownloadAction.reader = self._endless(read)
+        self.job.pipeline.validate_actions()
+        self.action.timeout.duration = 1
+        # the downloads stop with the action instead of running in the background
+        self.assertRaises(download.JobError, self.job.pipeline.run_actions, None)
+        self.assertEqual(sorted(set(read)), sorted(self.keys))
+        self._assert_stopped(read)
+
+
+class SlowHeadHandler(QuietHandler):
+    """
+    Answers HEAD requests slowly, keeping a count of them and of the
+    largest number answered at the same time.
+    """
+    requests = []
+    active = []
+    overlap = 0
+    lock = threading.Lock()
+
+    def do_HEAD(self):
+        with self.lock:
+            self.requests.append(self.path)
+            self.active.append(self.path)
+            SlowHeadHandler.overlap = max(SlowHeadHandler.overlap, len(self.active))
+        time.sleep(0.5)
+        with self.lock:
+            self.active.remove(self.path)
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD(self)
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestUrlValidation(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestUrlValidation, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmpdir, 'dest')
+        os.mkdir(self.dest)
+        self.keys = ['kernel', 'ramdisk', 'dtb']
+        for key in self.keys:
+            with open(os.path.join(self.tmpdir, key), 'w') as artifact:
+                artifact.write(key * 1000)
+        SlowHeadHandler.directory = self.tmpdir
+        SlowHeadHandler.requests = []
+        SlowHeadHandler.overlap = 0
+        self.server = ThreadingServer(('localhost', 0), SlowHeadHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.validator = download.URL_VALIDATOR
+        download.URL_VALIDATOR = download.UrlValidator()
+        self.open_cache = download.HttpDownloadAction.open_cache
+        download.HttpDownloadAction.open_cache = lambda action: None
+
+    def tearDown(self):
+        download.HttpDownloadAction.open_cache = self.open_cache
+        download.URL_VALIDATOR = self.validator
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+        super(TestUrlValidation, self).tearDown()
+
+    def make_job(self, missing=False, port=None):
+        parameters = {'to': 'tmpfs'}
+        for key in self.keys:
+            name = 'missing' if missing and key == 'dtb' else key
+            parameters[key] = 'http://localhost:%d/%s' % (port or self.server.server_address[1], name)
+        job = Job(4212, None, {'output_dir': None})
+        job.pipeline = Pipeline(job=job)
+        action = download.ParallelDownloadAction([(key, self.dest) for key in self.keys])
+        action.section = 'deploy'
+        job.pipeline.add_action(action, parameters)
+        return job
+
+    def test_concurrent(self):
+        job = self.make_job()
+        job.pipeline.validate_actions()
+        # the three requests are answered at the same time
+        self.assertEqual(SlowHeadHandler.overlap, 3)
+        self.assertEqual(sorted(SlowHeadHandler.requests), ['/dtb', '/kernel', '/ramdisk'])
+        # a second job with the same urls uses the results of the first one
+        job = self.make_job()
+        job.pipeline.validate_actions()
+        self.assertEqual(len(SlowHeadHandler.requests), 3)
+        job.pipeline.run_actions(None)
+        for key in self.keys:
+            with open(job.context['download_action'][key]['file']) as downloaded:
+                self.assertEqual(downloaded.read(), key * 1000)
+
+    def test_expired(self):
+        download.URL_VALIDATOR.ttl = 1
+        self.make_job().pipeline.validate_actions()
+        time.sleep(1)
+        self.make_job().pipeline.validate_actions()
+        self.assertEqual(len(SlowHeadHandler.requests), 6)
+
+    def test_unreachable(self):
+        # a port with nothing listening
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        heads = []
+        head = download.URL_VALIDATOR._head  # pylint: disable=protected-access
+
+        def counting_head(url):
+            heads.append(url)
+            return head(url)
+
+        download.URL_VALIDATOR._head = counting_head  # pylint: disable=protected-access
+        job = self.make_job(port=port)
+        with self.assertRaises(download.JobError):
+            job.pipeline.validate_actions()
+        # each url is requested once for the job, the errors are not requested again
+        self.assertEqual(sorted(heads), sorted(job.pipeline.actions[0].parameters[key] for key in self.keys))
+        self.assertEqual(len([error for error in job.pipeline.errors if str(port) in error]), 3)
+
+    def test_missing(self):
+        job = self.make_job(missing=True)
+        with self.assertRaises(download.JobError):
+            job.pipeline.validate_actions()
+        self.assertIn("Resources not available at '%s'" % job.pipeline.actions[0].parameters['dtb'],
+                      job.pipeline.errors)
+
+
+class TestDecompression(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestDecompression, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = ''.join(["line %d of the rootfs\n" % index for index in range(20000)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestDecompression, self).tearDown()
+
+    def download(self, compression, streams=1, checksum=True):
+        path = os.path.join(self.tmpdir, 'rootfs.%s' % compression)
+        compress(self.data, compression, path, streams)
+        job = download_job(
+            {'to': 'tmpfs', 'rootfs': 'file://%s' % path, 'compression': compression, 'checksum': checksum},
+            'rootfs', self.tmpdir)
+        job.pipeline.run_actions(None)
+        result = job.context['download_action']['rootfs']
+        with open(result['file']) as rootfs:
+            self.assertEqual(rootfs.read(), self.data)
+        return result, path
+
+    def test_multiple_streams(self):
+        for compression in ['gz', 'bz2', 'xz']:
+            result, path = self.download(compression, streams=3)
+            with open(path) as compressed:
+                self.assertEqual(result['md5'], hashlib.md5(compressed.read()).hexdigest())
+
+    def test_padding(self):
+        path = os.path.join(self.tmpdir, 'rootfs.gz')
+        compress(self.data, 'gz', path)
+        with open(path, 'ab') as compressed:
+            compressed.write('\0' * 512)
+        job = download_job(
+            {'to': 'tmpfs', 'rootfs': 'file://%s' % path, 'compression': 'gz'}, 'rootfs', self.tmpdir)
+        job.pipeline.run_actions(None)
+        with open(job.context['download_action']['rootfs']['file']) as rootfs:
+            self.assertEqual(rootfs.read(), self.data)
+
+    def test_checksum_disabled(self):
+        result, _ = self.download('gz', checksum={'rootfs': False})
+        self.assertIsNone(result['md5'])
+        self.assertIsNone(result['sha256'])
+        result, _ = self.download('gz', checksum={'kernel': False})
+        self.assertIsNotNone(result['sha256'])
+
+    def test_invalid_checksum(self):
+        with self.assertRaises(download.JobError):
+            download_job({'to': 'tmpfs', 'rootfs': 'file:///rootfs', 'checksum': 'no'}, 'rootfs', self.tmpdir)
+
+    def test_corrupt(self):
+        path = os.path.join(self.tmpdir, 'rootfs.xz')
+        with open(path, 'wb') as compressed:
+            compressed.write('not xz data' * 10000)
+        job = download_job(
+            {'to': 'tmpfs', 'rootfs': 'file://%s' % path, 'compression': 'xz'}, 'rootfs', self.tmpdir)
+        # raised from the decompression thread
+        self.assertRaises(lzma.error, job.pipeline.run_actions, None)  # pylint: disable=no-member
+
+
+class TestCompressedDownload(unittest.TestCase):  # pylint: disable=too-many-public-methods
+    """
+    Downloads multi-stream compressed files from file:// and from a local
+    http server.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        # half random, half compressible: closer to a rootfs than either
+        block = os.urandom(64 * 1024) + ''.join(["%08d" % index for index in range(8 * 1024)])
+        cls.data = block * 64
+        for compression in ['gz', 'bz2', 'xz']:
+            # multiple streams, as from pigz or pxz
+            compress(cls.data, compression, os.path.join(cls.tmpdir, 'rootfs.%s' % compression), streams=4)
+        QuietHandler.directory = cls.tmpdir
+        cls.server = BaseHTTPServer.HTTPServer(('localhost', 0), QuietHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        super(TestCompressedDownload, self).setUp()
+        self.open_cache = download.HttpDownloadAction.open_cache
+        download.HttpDownloadAction.open_cache = lambda action: None
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        download.HttpDownloadAction.open_cache = self.open_cache
+        shutil.rmtree(self.dest)
+        super(TestCompressedDownload, self).tearDown()
+
+    def download(self, scheme):
+        for compression in ['gz', 'bz2', 'xz']:
+            if scheme == 'file':
+                url = 'file://%s/rootfs.%s' % (self.tmpdir, compression)
+            else:
+                url = 'http://localhost:%d/rootfs.%s' % (self.server.server_address[1], compression)
+            job = download_job({'to': 'tmpfs', 'rootfs': url, 'compression': compression}, 'rootfs', self.dest)
+            job.pipeline.run_actions(None)
+            self.assertEqual(os.path.getsize(job.context['download_action']['rootfs']['file']), len(self.data))
+
+    def test_file(self):
+        self.download('file')
+
+    def test_http(self):
+        self.download('http')
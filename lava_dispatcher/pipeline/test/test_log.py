@@ -0,0 +1,228 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+import logging
+import threading
+import time
+import unittest
+import yaml
+
+from lava_dispatcher.pipeline.log import (
+    CONSOLE_BATCH_LATENCY,
+    TARGET_BATCH_FRAME,
+    YAMLLogger,
+)
+from lava_dispatcher.pipeline.action import Timeout
+from lava_dispatcher.pipeline.shell import ShellCommand, ShellLogger
+
+
+class RecordingHandler(logging.Handler):
+    """
+    Keeps the (message, frame) of each record, as ZMQPushHandler would send them.
+    """
+
+    def __init__(self):
+        super(RecordingHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.getMessage(), getattr(record, 'frame', None)))
+
+
+class RecordingSocket(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def send_multipart(self, msg):
+        self.messages.append(msg)
+
+    def close(self):
+        pass
+
+
+def shell_logger(logger):
+    shell = ShellLogger()
+    shell.logger = logger
+    return shell
+
+
+class TestConsoleBatches(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestConsoleBatches, self).setUp()
+        self.logger = YAMLLogger('test-console')
+        self.logger.setLevel(logging.DEBUG)
+        self.handler = RecordingHandler()
+        self.logger.addHandler(self.handler)
+        self.shell = shell_logger(self.logger)
+
+    def tearDown(self):
+        self.logger.flush_console()
+        super(TestConsoleBatches, self).tearDown()
+
+    def targets(self):
+        lines = []
+        for message, frame in self.handler.messages:
+            self.assertEqual(frame, TARGET_BATCH_FRAME)
+            lines.extend([entry['target'] for entry in yaml.load(message, Loader=yaml.Loader)])
+        return lines
+
+    def test_escaping(self):
+        lines = [
+            'plain text',
+            'say "hello" to C:\\path\\',
+            'tab\there, bell\x07 and del\x7f',
+            '{flow: [mapping]}, # not a comment',
+            '- not a list: *alias &anchor !tag',
+            'caf\xc3\xa9',
+        ]
+        for line in lines:
+            self.shell.write(line + '\r\n')
+        self.logger.flush_console()
+        self.assertEqual(len(self.handler.messages), 1)
+        self.assertEqual(self.targets(), [line.decode('utf-8') for line in lines])
+
+    def test_invalid_utf8(self):
+        self.shell.write('bad \xff\xfe bytes\n')
+        self.logger.flush_console()
+        self.assertEqual(self.targets(), [u'bad \ufffd\ufffd bytes'])
+
+    def test_partial_lines(self):
+        for chunk in ['Starting ', 'kernel', ' ...\r\n\r\n', '\x1b[0mlogin:', ' \n']:
+            self.shell.write(chunk)
+        self.logger.flush_console()
+        self.assertEqual(self.targets(), ['Starting kernel ...', '[0mlogin: '])
+
+    def test_latency(self):
+        self.shell.write('Booting Linux\n')
+        self.assertEqual(self.handler.messages, [])
+        self.assertLessEqual(self.logger.console_wait(), CONSOLE_BATCH_LATENCY)
+        time.sleep(CONSOLE_BATCH_LATENCY)
+        # nothing is sent in the background
+        self.assertEqual(self.handler.messages, [])
+        self.assertEqual(self.logger.console_wait(), 0)
+        self.shell.write('Starting kernel\n')
+        self.assertEqual(self.targets(), ['Booting Linux', 'Starting kernel'])
+        self.assertIsNone(self.logger.console_wait())
+
+    def test_expect(self):
+        # the expect loop sends the waiting output while there is no more
+        shell = ShellCommand("sh -c 'echo booting; read line; echo login:'", Timeout('fake-boot', 10))
+        shell.logfile = self.shell
+        sent = []
+
+        def answer():
+            # the shell waits for an answer until the output has been sent
+            deadline = time.time() + 5
+            while not self.handler.messages and time.time() < deadline:
+                time.sleep(CONSOLE_BATCH_LATENCY / 10)
+            sent.extend(self.targets())
+            shell.sendline('')
+
+        thread = threading.Thread(target=answer)
+        thread.start()
+        try:
+            shell.expect('login:')
+        finally:
+            thread.join()
+            shell.close()
+        self.assertEqual(sent, ['booting'])
+
+    def test_set_metadata(self):
+        self.shell.write('before\n')
+        self.logger.setMetadata('1', 'fake-deploy')
+        self.assertEqual(self.targets(), ['before'])
+
+    def test_size(self):
+        for index in range(2000):
+            self.shell.write('line %d of a long boot %s\n' % (index, 'x' * 40))
+        # sent by size, well before the latency
+        self.assertGreater(len(self.handler.messages), 1)
+        self.logger.flush_console()
+        self.assertEqual(len(self.targets()), 2000)
+
+    def test_order(self):
+        self.shell.write('before\n')
+        self.logger.debug('debug message')
+        self.shell.write('after\n')
+        self.logger.flush_console()
+        frames = [frame for _, frame in self.handler.messages]
+        self.assertEqual(frames, [TARGET_BATCH_FRAME, None, TARGET_BATCH_FRAME])
+        self.assertEqual(
+            yaml.load(self.handler.messages[1][0], Loader=yaml.Loader), [{'debug': 'debug message'}])
+
+    def test_batches(self):
+        lines = ['[%12.6f] usb 1-1.%d: "device" number %d\r\n' % (index / 1000.0, index % 4, index)
+                 for index in range(5000)]
+        # one message per line, dumped by yaml
+        for line in lines:
+            self.logger.target(line.rstrip('\r\n'))
+        per_line = len(self.handler.messages)
+        self.handler.messages = []
+
+        for line in lines:
+            self.shell.write(line)
+        self.logger.flush_console()
+
+        self.assertEqual(self.targets(), [line.rstrip('\r\n') for line in lines])
+        self.assertGreater(per_line / len(self.handler.messages), 10)
+
+
+class TestMetadata(unittest.TestCase):
+
+    def setUp(self):
+        super(TestMetadata, self).setUp()
+        self.logger = YAMLLogger('test-metadata')
+        self.logger.setLevel(logging.DEBUG)
+        handler = self.logger.addZMQHandler('tcp://127.0.0.1:5555', 1)
+        handler.socket.close()
+        handler.socket = RecordingSocket()
+        self.messages = handler.socket.messages
+
+    def tearDown(self):
+        self.logger.removeHandler(self.logger.handler)
+        self.logger.handler.close()
+        super(TestMetadata, self).tearDown()
+
+    def test_default(self):
+        self.logger.info('outside of any action')
+        self.assertEqual(self.messages[0][:3], ['1', '0', 'dispatcher'])
+
+    def test_threads(self):
+        self.logger.setMetadata('1.1', 'parallel-download')
+        events = [threading.Event(), threading.Event()]
+
+        def worker(index):
+            self.logger.setMetadata('1.1.%d' % index, 'download-%d' % index)
+            # both threads have set their metadata before either logs
+            events[index - 1].set()
+            events[2 - index].wait(10)
+            self.logger.debug('downloading %d' % index)
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in (1, 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.logger.debug('done')
+        self.assertEqual(sorted([msg[:4] for msg in self.messages[:2]]), [
+            ['1', '1.1.1', 'download-1', '- debug: downloading 1'],
+            ['1', '1.1.2', 'download-2', '- debug: downloading 2']])
+        # the metadata of the main thread is left alone
+        self.assertEqual(self.messages[2][:4], ['1', '1.1', 'parallel-download', '- debug: done'])
@@ -0,0 +1,234 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import pexpect
+from pexpect.expect import searcher_re
+
+from lava_dispatcher.pipeline.action import Timeout
+from lava_dispatcher.pipeline.shell import ShellCommand
+from lava_dispatcher.pipeline.utils.constants import EXPECT_SEARCH_OVERLAP, EXPECT_SEARCH_WINDOW
+from lava_dispatcher.pipeline.utils.matcher import PatternMatcher
+from lava_dispatcher.pipeline.utils.shell import wait_for_prompt
+
+# the patterns of TestShellAction
+TEST_SHELL_PATTERNS = [
+    "<LAVA_TEST_RUNNER>: exiting",
+    pexpect.EOF,
+    pexpect.TIMEOUT,
+    r"<LAVA_SIGNAL_(\S+) ([^>]+)>",
+]
+
+
+def serial_log(boot_lines, test_lines):
+    """
+    A kernel boot followed by a test shell sending a signal every few lines.
+    """
+    lines = []
+    for index in range(boot_lines):
+        lines.append("[%12.6f] usb 1-1.%d: new high-speed USB device number %d using dwc_otg" % (
+            index / 1000.0, index % 4, index))
+    for index in range(test_lines):
+        lines.append("+ ./run-test.sh step %d" % index)
+        if index % 20 == 0:
+            lines.append("<LAVA_SIGNAL_TESTCASE TEST_CASE_ID=test%d RESULT=pass>" % index)
+    lines.append("<LAVA_TEST_RUNNER>: exiting")
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def replay(shell, patterns):
+    """
+    Expect the patterns until EOF, as TestShellAction does.
+    :return: the list of (pattern index, matched string)
+    """
+    events = []
+    while True:
+        index = shell.expect(patterns, timeout=30)
+        if patterns[index] is pexpect.EOF:
+            return events
+        events.append((index, shell.after))
+
+
+def chunked_search(searcher, data, chunk, window=None):
+    """
+    Feed data to a pexpect searcher as pexpect would, a chunk at a time.
+    """
+    buffer = ''
+    events = []
+    for offset in range(0, len(data), chunk):
+        fresh = data[offset:offset + chunk]
+        buffer += fresh
+        freshlen = len(fresh)
+        while True:
+            if window:
+                buffer = buffer[-window:]
+            index = searcher.search(buffer, freshlen, window)
+            if index < 0:
+                break
+            events.append((index, searcher.match.group(0), searcher.match.groups()))
+            buffer = buffer[searcher.end:]
+            freshlen = len(buffer)
+    return events
+
+
+class TestPatternMatcher(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def compare(self, patterns, data, chunk=7):
+        compiled = [re.compile(pattern, re.DOTALL) if isinstance(pattern, str) else pattern
+                    for pattern in patterns]
+        expected = chunked_search(searcher_re(compiled), data, chunk)
+        found = chunked_search(PatternMatcher(patterns), data, chunk)
+        self.assertEqual(expected, found)
+        return found
+
+    def test_same_as_pexpect(self):
+        found = self.compare(TEST_SHELL_PATTERNS, serial_log(50, 100))
+        self.assertEqual(len(found), 6)
+        self.assertEqual(found[0][2], ('TESTCASE', 'TEST_CASE_ID=test0 RESULT=pass'))
+
+    def test_precedence(self):
+        # the first match in the output, then the first pattern in the list
+        self.assertEqual(self.compare(['bar', 'foo', 'foobar'], 'xxfoobar', chunk=100), [
+            (1, 'foo', ()), (0, 'bar', ())])
+        self.assertEqual(self.compare(['foobar', 'foo'], 'xxfoobar', chunk=100), [(0, 'foobar', ())])
+
+    def test_special(self):
+        matcher = PatternMatcher([pexpect.TIMEOUT, 'login:', pexpect.EOF])
+        self.assertEqual(matcher.timeout_index, 0)
+        self.assertEqual(matcher.eof_index, 2)
+        self.assertEqual(matcher.search('debian login:', 13), 1)
+
+    def test_uncombined(self):
+        # numbered back references and repeated group names are searched in turn
+        for patterns in [[r'(a)\1', 'b'], ['(?P<id>a)', '(?P<id>b)']]:
+            self.assertIsNone(PatternMatcher(patterns)._combined)  # pylint: disable=protected-access
+            self.compare(patterns, 'xxbxxaaxx')
+
+    def test_overlap(self):
+        # a match which started in an earlier read is still found
+        matcher = PatternMatcher(['start.*end'], overlap=16)
+        self.assertEqual(matcher.search('xx start xx', 11), -1)
+        self.assertEqual(matcher.search('xx start xx end', 4), 0)
+        # output beyond the overlap is not searched again
+        self.assertEqual(matcher.search('start' + 'x' * 20 + 'end', 3), -1)
+
+
+class TestMatcherReplay(unittest.TestCase):  # pylint: disable=too-many-public-methods
+    """
+    Replays a serial log through pexpect.spawn and through ShellCommand.
+    Without a search window, pexpect searches all the output since the last
+    match for each pattern on every read, so a long kernel boot costs
+    quadratic time.
+    """
+
+    def setUp(self):
+        super(TestMatcherReplay, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdir, 'serial.log')
+        with open(self.log, 'w') as log:
+            log.write(serial_log(15000, 2000))
+        self.searches = {searcher_re: searcher_re.search, PatternMatcher: PatternMatcher.search}
+        # searcher class: list of (bytes searched, bytes not searched before)
+        self.searched = {searcher_re: [], PatternMatcher: []}
+
+        def counting(cls):
+            def search(searcher, buffer, freshlen, searchwindowsize=None):
+                if cls is PatternMatcher:
+                    start = max(0, len(buffer) - freshlen - searcher.overlap)
+                else:
+                    start = 0
+                if searchwindowsize is not None:
+                    start = max(start, len(buffer) - searchwindowsize)
+                self.searched[cls].append((len(buffer) - start, freshlen))
+                return self.searches[cls](searcher, buffer, freshlen, searchwindowsize)
+            return search
+
+        for cls in self.searches:
+            cls.search = counting(cls)
+
+    def tearDown(self):
+        for cls, search in self.searches.items():
+            cls.search = search
+        shutil.rmtree(self.tmpdir)
+        super(TestMatcherReplay, self).tearDown()
+
+    def test_replay(self):
+        patterns = TEST_SHELL_PATTERNS + [r"root@\w+:~# ", "Kernel panic - not syncing"]
+        spawn = pexpect.spawn('cat %s' % self.log)
+        # serial connections return small reads
+        spawn.maxread = 1024
+        expected = replay(spawn, patterns)
+
+        shell = ShellCommand('cat %s' % self.log, Timeout('replay', 30))
+        shell.logfile = None
+        shell.maxread = 1024
+        found = replay(shell, patterns)
+
+        self.assertEqual(expected, found)
+        self.assertEqual(len(found), 101)
+        # the patterns are compiled once for all the expect calls
+        self.assertEqual(len(shell.matchers), 1)
+        # each read only searches the new output and the overlap ...
+        for searched, freshlen in self.searched[PatternMatcher]:
+            self.assertLessEqual(searched, freshlen + EXPECT_SEARCH_OVERLAP)
+        # ... instead of all the output since the last match
+        self.assertGreater(sum([searched for searched, _ in self.searched[searcher_re]]),
+                           10 * sum([searched for searched, _ in self.searched[PatternMatcher]]))
+
+
+class TestSearchWindow(unittest.TestCase):  # pylint: disable=too-many-public-methods
+    """
+    The search window is only used by the callers which ask for it.
+    """
+
+    def setUp(self):
+        super(TestSearchWindow, self).setUp()
+        self.search = PatternMatcher.search
+        self.windows = []
+        search = self.search
+
+        def recording(searcher, buffer, freshlen, searchwindowsize=None):
+            self.windows.append(searchwindowsize)
+            return search(searcher, buffer, freshlen, searchwindowsize)
+
+        PatternMatcher.search = recording
+        self.shell = ShellCommand("echo 'root@host:~# '", Timeout('window', 10))
+        self.shell.logfile = None
+
+    def tearDown(self):
+        PatternMatcher.search = self.search
+        self.shell.close()
+        super(TestSearchWindow, self).tearDown()
+
+    def test_default(self):
+        # as for pexpect, all the output since the last match is searched
+        self.assertEqual(self.shell.expect(r'root@\w+:~# '), 0)
+        self.assertEqual(set(self.windows), set([None]))
+
+    def test_prompt(self):
+        wait_for_prompt(self.shell, r'root@\w+:~# ', 10)
+        self.assertEqual(set(self.windows), set([EXPECT_SEARCH_WINDOW]))
+
+    def test_pexpect_options(self):
+        # options of pexpect's expect are handled by pexpect
+        self.assertEqual(self.shell.expect([r'root@\w+:~# '], async_=False), 0)
+        self.assertEqual(self.windows, [])
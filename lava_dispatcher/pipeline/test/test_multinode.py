@@ -596,6 +596,8 @@ class TestProtocol(unittest.TestCase):  # pylint: disable=too-many-public-method
             self.name = "fake-multinode"
             super(TestProtocol.FakeProtocol, self).__init__(parameters)
             self.sock = TestProtocol.FakeClient(fake_coordinator)
+            # FakeClient only implements the version 1 framing
+            self.persistent = False
             self.debug_setup()
 
         def _connect(self, delay):
@@ -0,0 +1,161 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import yaml
+
+from lava_dispatcher.pipeline.action import Action, Pipeline, Timeout
+from lava_dispatcher.pipeline.actions.deploy.download import ParallelDownloadAction
+from lava_dispatcher.pipeline.shell import ShellCommand
+from lava_dispatcher.pipeline.utils import profile
+
+# pylint: disable=invalid-name,too-many-public-methods
+
+
+class TestProfile(unittest.TestCase):
+
+    class Download(Action):
+
+        def __init__(self):
+            super(TestProfile.Download, self).__init__()
+            self.name = "fake-download"
+
+        def run(self, connection, args=None):
+            profile.count('downloaded', 1024)
+            time.sleep(0.1)
+            return connection
+
+    class Deploy(Action):
+
+        def __init__(self):
+            super(TestProfile.Deploy, self).__init__()
+            self.name = "fake-deploy"
+
+        def run(self, connection, args=None):
+            return self.internal_pipeline.run_actions(connection, args)
+
+    def setUp(self):
+        super(TestProfile, self).setUp()
+        self.pipeline = Pipeline()
+        deploy = TestProfile.Deploy()
+        self.pipeline.add_action(deploy)
+        deploy.internal_pipeline = Pipeline(parent=deploy)
+        deploy.internal_pipeline.add_action(TestProfile.Download())
+        deploy.internal_pipeline.add_action(TestProfile.Download())
+
+    def tearDown(self):
+        profile.stop_profile()
+        super(TestProfile, self).tearDown()
+
+    def test_not_profiled(self):
+        profile.count('downloaded', 1024)
+        self.pipeline.run_actions(None)
+        self.assertIsNone(profile.stop_profile())
+
+    def test_profile(self):
+        profiler = profile.start_profile()
+        self.pipeline.run_actions(None)
+        # counted after the actions stopped, outside of any action
+        profile.count('downloaded', 1024)
+        self.assertIs(profile.stop_profile(), profiler)
+        actions = profiler.profile()
+        self.assertEqual([(action['level'], action['name']) for action in actions],
+                         [('1', 'fake-deploy'), ('1.1', 'fake-download'), ('1.2', 'fake-download')])
+        deploy, first, second = actions
+        # the counters of an action include those of its internal pipeline
+        self.assertEqual((deploy['downloaded'], first['downloaded'], second['downloaded']), (2048, 1024, 1024))
+        self.assertGreaterEqual(first['wall'], 0.1)
+        self.assertGreaterEqual(deploy['wall'], first['wall'] + second['wall'])
+        self.assertEqual(deploy['runs'], 1)
+        for action in actions:
+            self.assertEqual(action['serial_read'], 0)
+            self.assertEqual(action['expect_time'], 0)
+            self.assertGreaterEqual(action['cpu'], 0)
+
+        # retried actions add up
+        profiler = profile.start_profile()
+        self.pipeline.run_actions(None)
+        self.pipeline.run_actions(None)
+        self.assertEqual(profiler.profile()[1]['runs'], 2)
+        self.assertEqual(profiler.profile()[1]['downloaded'], 2048)
+
+    def test_write(self):
+        profiler = profile.start_profile()
+        self.pipeline.run_actions(None)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'profile.yaml')
+            profiler.write(path)
+            with open(path) as output:
+                self.assertEqual(yaml.safe_load(output), profiler.profile())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_shell_counters(self):
+        profiler = profile.start_profile()
+        action = Action()
+        action.level = '1'
+        action.name = 'fake-boot'
+        profiler.start(action)
+        shell = ShellCommand("sh -c 'sleep 0.2; echo booted'", Timeout('fake-boot', 10))
+        # the console output needs the YAMLLogger of a running job
+        shell.logfile = None
+        shell.expect('booted')
+        shell.close()
+        profiler.stop(action)
+        counters = profiler.profile()[0]
+        self.assertGreaterEqual(counters['serial_read'], len('booted'))
+        self.assertGreaterEqual(counters['expect_time'], 0.2)
+
+    def test_parallel_downloads(self):
+        started = [threading.Event(), threading.Event()]
+
+        class OverlappingDownload(Action):
+
+            def __init__(self, index):
+                super(OverlappingDownload, self).__init__()
+                self.name = "fake-download"
+                self.key = 'file%d' % index
+                self.index = index
+
+            def run(self, connection, args=None):
+                # both downloads are running before either counts or stops
+                started[self.index].set()
+                started[1 - self.index].wait(10)
+                profile.count('downloaded', 1024 * (self.index + 1))
+                return connection
+
+        pipeline = Pipeline()
+        parallel = ParallelDownloadAction([])
+        pipeline.add_action(parallel)
+        parallel.internal_pipeline = Pipeline(parent=parallel)
+        parallel.internal_pipeline.add_action(OverlappingDownload(0))
+        parallel.internal_pipeline.add_action(OverlappingDownload(1))
+
+        profiler = profile.start_profile()
+        pipeline.run_actions(None)
+        actions = sorted(profiler.profile(), key=lambda action: action['level'])
+        self.assertEqual([(action['level'], action['downloaded'], action['runs']) for action in actions],
+                         [('1', 3072, 1), ('1.1', 1024, 1), ('1.2', 2048, 1)])
+        # the downloads stopped in the threads, the action stopped in the main thread
+        self.assertEqual(profiler.running(), [])
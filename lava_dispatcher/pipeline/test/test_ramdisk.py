@@ -0,0 +1,188 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import unittest
+import zlib
+
+from lava_dispatcher.pipeline.utils.ramdisk import (
+    UBOOT_HEADER,
+    UBOOT_HEADER_SIZE,
+    UBOOT_MAGIC,
+    NewcWriter,
+    _GzipMember,
+    append_to_ramdisk,
+    compressed_offset,
+    read_uboot_header,
+)
+
+# pylint: disable=invalid-name,too-many-public-methods
+
+
+def gunzip_members(data):
+    """
+    Decompress all the concatenated gzip members, as the kernel does.
+    """
+    output = []
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        output.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return ''.join(output)
+
+
+def read_newc(data):
+    """
+    :return: the files of concatenated newc archives as a dict of
+    name: (mode, data), later entries replacing earlier ones.
+    """
+    files = {}
+    offset = 0
+    while offset < len(data):
+        if data[offset] == '\0':
+            offset += 4
+            continue
+        assert data[offset:offset + 6] == '070701'
+        fields = [int(data[offset + 6 + 8 * index:offset + 14 + 8 * index], 16) for index in range(13)]
+        mode, size, namesize = fields[1], fields[6], fields[11]
+        offset += 110
+        name = data[offset:offset + namesize - 1]
+        offset += namesize + (-(110 + namesize) % 4)
+        content = data[offset:offset + size]
+        offset += size + (-size % 4)
+        if name != 'TRAILER!!!':
+            files[name] = (mode, content)
+    return files
+
+
+def make_ramdisk(path, files, uboot=False):
+    with open(path, 'wb') as ramdisk:
+        if uboot:
+            ramdisk.write('\0' * UBOOT_HEADER_SIZE)
+        member = _GzipMember(ramdisk)
+        archive = NewcWriter(member)
+        for name, data in files:
+            if data is None:
+                archive.add(name, stat.S_IFDIR | 0o755)
+            else:
+                archive.add(name, stat.S_IFREG | 0o644, data=data)
+        archive.close()
+        member.close()
+    if uboot:
+        with open(path, 'r+b') as ramdisk:
+            ramdisk.seek(UBOOT_HEADER_SIZE)
+            data = ramdisk.read()
+            size, crc = len(data), zlib.crc32(data) & 0xffffffff
+            fields = [UBOOT_MAGIC, 0, 0, size, 0, 0, crc, 5, 2, 3, 0, 'ramdisk']
+            fields[1] = zlib.crc32(UBOOT_HEADER.pack(*fields)) & 0xffffffff
+            ramdisk.seek(0)
+            ramdisk.write(UBOOT_HEADER.pack(*fields))
+
+
+def make_tarball(path, directory):
+    with tarfile.open(path, 'w:gz') as tar:
+        tar.add(directory, arcname='.')
+
+
+class TestAppendToRamdisk(unittest.TestCase):
+
+    def setUp(self):
+        super(TestAppendToRamdisk, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.ramdisk = os.path.join(self.tmpdir, 'initrd.cpio.gz')
+        self.output = os.path.join(self.tmpdir, 'ramdisk.cpio.gz')
+        overlay_dir = os.path.join(self.tmpdir, 'overlay')
+        os.makedirs(os.path.join(overlay_dir, 'lava-1234', 'bin'))
+        with open(os.path.join(overlay_dir, 'lava-1234', 'bin', 'lava-test-runner'), 'w') as runner:
+            runner.write('#!/bin/sh\necho runner\n')
+        os.chmod(os.path.join(overlay_dir, 'lava-1234', 'bin', 'lava-test-runner'), 0o755)
+        os.symlink('bin/lava-test-runner', os.path.join(overlay_dir, 'lava-1234', 'runner'))
+        with open(os.path.join(overlay_dir, 'init'), 'w') as init:
+            init.write('replaced')
+        self.overlay = os.path.join(self.tmpdir, 'overlay.tar.gz')
+        make_tarball(self.overlay, overlay_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestAppendToRamdisk, self).tearDown()
+
+    def check(self, data):
+        files = read_newc(gunzip_members(data))
+        self.assertEqual(files['etc/fstab'][1], 'proc /proc proc\n')
+        self.assertEqual(files['init'][1], 'replaced')
+        self.assertTrue(stat.S_ISDIR(files['lava-1234'][0]))
+        runner = files['lava-1234/bin/lava-test-runner']
+        self.assertEqual(runner, (stat.S_IFREG | 0o755, '#!/bin/sh\necho runner\n'))
+        self.assertEqual(files['lava-1234/runner'], (stat.S_IFLNK | 0o777, 'bin/lava-test-runner'))
+
+    def test_append(self):
+        make_ramdisk(self.ramdisk, [('etc', None), ('etc/fstab', 'proc /proc proc\n'), ('init', 'original')])
+        self.assertEqual(compressed_offset(self.ramdisk), 0)
+        self.assertIsNone(compressed_offset(self.ramdisk, uboot=True))
+        size = append_to_ramdisk(self.ramdisk, self.output, [self.overlay])
+        self.assertEqual(size, os.path.getsize(self.output))
+        with open(self.ramdisk, 'rb') as ramdisk:
+            original = ramdisk.read()
+        with open(self.output, 'rb') as output:
+            data = output.read()
+        # the original ramdisk is not recompressed
+        self.assertTrue(data.startswith(original))
+        self.check(data)
+
+    def test_append_uboot(self):
+        make_ramdisk(self.ramdisk, [('etc', None), ('etc/fstab', 'proc /proc proc\n'), ('init', 'original')],
+                     uboot=True)
+        self.assertEqual(compressed_offset(self.ramdisk, uboot=True), UBOOT_HEADER_SIZE)
+        append_to_ramdisk(self.ramdisk, self.output, [self.overlay], uboot=True)
+        with open(self.output, 'rb') as output:
+            data = output.read()
+        header = read_uboot_header(data)
+        self.assertEqual(header[3], len(data) - UBOOT_HEADER_SIZE)
+        self.assertEqual(header[6], zlib.crc32(data[UBOOT_HEADER_SIZE:]) & 0xffffffff)
+        self.assertEqual(header[7:11], [5, 2, 3, 0])
+        self.assertEqual(header[11].rstrip('\0'), 'ramdisk')
+        hcrc = header[1]
+        header[1] = 0
+        self.assertEqual(hcrc, zlib.crc32(UBOOT_HEADER.pack(*header)) & 0xffffffff)
+        self.check(data[UBOOT_HEADER_SIZE:])
+
+    def test_not_gzip(self):
+        with open(self.ramdisk, 'wb') as ramdisk:
+            ramdisk.write('070701' + '0' * 200)
+        self.assertIsNone(compressed_offset(self.ramdisk))
+
+    def test_appended_member(self):
+        make_ramdisk(self.ramdisk, [('lib', None), ('lib/module.ko', os.urandom(64 * 1024)), ('init', 'original')])
+        append_to_ramdisk(self.ramdisk, self.output, [self.overlay, self.overlay])
+        with open(self.ramdisk, 'rb') as ramdisk:
+            original = ramdisk.read()
+        with open(self.output, 'rb') as output:
+            data = output.read()
+        # the compressed bytes of the original ramdisk are copied unchanged ...
+        self.assertEqual(data[:len(original)], original)
+        # ... followed by one new gzip member with the files of all the tarballs
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        appended = read_newc(decompressor.decompress(data[len(original):]))
+        self.assertEqual(decompressor.unused_data, '')
+        self.assertIn('lava-1234/bin/lava-test-runner', appended)
+        self.assertEqual(appended['init'][1], 'replaced')
+        self.assertNotIn('lib/module.ko', appended)
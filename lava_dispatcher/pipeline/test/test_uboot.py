@@ -86,13 +86,18 @@ class TestUbootAction(unittest.TestCase):  # pylint: disable=too-many-public-met
         self.assertIsNotNone(tftp.internal_pipeline)
         self.assertEqual(
             [action.name for action in tftp.internal_pipeline.actions],
-            ['download_retry', 'download_retry', 'download_retry', 'prepare-tftp-overlay', 'deploy-device-env']
+            ['parallel-download', 'prepare-tftp-overlay', 'deploy-device-env']
         )
-        self.assertIn('ramdisk', [action.key for action in tftp.internal_pipeline.actions if hasattr(action, 'key')])
-        self.assertIn('kernel', [action.key for action in tftp.internal_pipeline.actions if hasattr(action, 'key')])
-        self.assertIn('dtb', [action.key for action in tftp.internal_pipeline.actions if hasattr(action, 'key')])
+        downloads = tftp.internal_pipeline.actions[0].internal_pipeline.actions
+        self.assertEqual(
+            [action.name for action in downloads],
+            ['download_retry', 'download_retry', 'download_retry']
+        )
+        self.assertIn('ramdisk', [action.key for action in downloads])
+        self.assertIn('kernel', [action.key for action in downloads])
+        self.assertIn('dtb', [action.key for action in downloads])
         # allow root to compare the path (with the mkdtemp added)
-        paths = {action.path for action in tftp.internal_pipeline.actions if hasattr(action, 'path')}
+        paths = {action.path for action in downloads}
         self.assertIn(
             tftpd_dir(),
             [item for item in paths][0]
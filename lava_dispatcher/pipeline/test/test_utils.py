@@ -18,10 +18,13 @@
 # along
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
+import hashlib
 import os
 import shutil
 import subprocess
+import tarfile
 import tempfile
+import time
 import unittest
 
 from lava_dispatcher.pipeline.utils.filesystem import mkdtemp
@@ -31,6 +34,8 @@ from lava_dispatcher.pipeline.power import ResetDevice, RebootDevice
 from lava_dispatcher.pipeline.utils.constants import SHUTDOWN_MESSAGE
 from lava_dispatcher.pipeline.action import InfrastructureError
 from lava_dispatcher.pipeline.utils import vcs
+from lava_dispatcher.pipeline.utils.cache import DownloadCache, OverlayCache
+from lava_dispatcher.pipeline.utils.overlay import copy_overlay, write_overlay
 
 
 class TestGit(unittest.TestCase):  # pylint: disable=too-many-public-methods
@@ -103,6 +108,48 @@ class TestGit(unittest.TestCase):  # pylint: disable=too-many-public-methods
         git = vcs.GitHelper('git')
         self.assertRaises(InfrastructureError, git.clone, 'foo.bar', 'badhash')
 
+    def test_mirror(self):
+        url = 'file://%s' % os.path.join(self.tmpdir, 'git')
+        mirrors = os.path.join(self.tmpdir, 'mirrors')
+        git = vcs.GitHelper(url, mirrors=mirrors)
+        self.assertEqual(git.clone('git.clone1'), 'a7af835862da0e0592eeeac901b90e8de2cf5b67')
+        self.assertEqual(len([name for name in os.listdir(mirrors) if name.endswith('.updated')]), 1)
+        self.assertEqual(subprocess.check_output(['git', '-C', 'git.clone1', 'config', 'remote.origin.url']).strip(),
+                         url)
+        # a new commit upstream
+        subprocess.check_output(['git', '-C', 'git', 'commit', '--allow-empty', '-m', 'Third commit'],
+                                env={'GIT_AUTHOR_NAME': 'Foo Bar',
+                                     'GIT_AUTHOR_EMAIL': 'foo@example.com',
+                                     'GIT_COMMITTER_NAME': 'Foo Bar',
+                                     'GIT_COMMITTER_EMAIL': 'foo@example.com'})
+        head = subprocess.check_output(['git', '-C', 'git', 'rev-parse', 'HEAD']).strip()
+        # the mirror is used as it is until the ttl expires: it is not fetched again
+        updated = [os.path.join(mirrors, name) for name in os.listdir(mirrors) if name.endswith('.updated')][0]
+        fetched = int(time.time()) - 10
+        os.utime(updated, (fetched, fetched))
+        self.assertEqual(git.clone('git.clone2', '2f83e6d8189025e356a9563b8d78bdc8e2e9a3ed'),
+                         '2f83e6d8189025e356a9563b8d78bdc8e2e9a3ed')
+        self.assertEqual(git.clone('git.clone3'), 'a7af835862da0e0592eeeac901b90e8de2cf5b67')
+        self.assertEqual(os.stat(updated).st_mtime, fetched)
+        # unless a revision is missing
+        self.assertEqual(git.clone('git.clone4', head), head)
+        self.assertGreater(os.stat(updated).st_mtime, fetched)
+        self.assertRaises(InfrastructureError, git.clone, 'git.clone5', 'badhash')
+        # or the ttl has expired
+        subprocess.check_output(['git', '-C', 'git', 'commit', '--allow-empty', '-m', 'Fourth commit'],
+                                env={'GIT_AUTHOR_NAME': 'Foo Bar',
+                                     'GIT_AUTHOR_EMAIL': 'foo@example.com',
+                                     'GIT_COMMITTER_NAME': 'Foo Bar',
+                                     'GIT_COMMITTER_EMAIL': 'foo@example.com'})
+        head = subprocess.check_output(['git', '-C', 'git', 'rev-parse', 'HEAD']).strip()
+        for name in os.listdir(mirrors):
+            if name.endswith('.updated'):
+                os.utime(os.path.join(mirrors, name), (1, 1))
+        self.assertEqual(git.clone('git.clone6'), head)
+        # the clone does not depend on the mirror
+        shutil.rmtree(mirrors)
+        subprocess.check_output(['git', '-C', 'git.clone6', 'fsck'], stderr=subprocess.STDOUT)
+
 
 class TestBzr(unittest.TestCase):  # pylint: disable=too-many-public-methods
 
@@ -167,6 +214,176 @@ class TestBzr(unittest.TestCase):  # pylint: disable=too-many-public-methods
         self.assertRaises(InfrastructureError, bzr.clone, 'foo.bar', 'badrev')
 
 
+class TestDownloadCache(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestDownloadCache, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = DownloadCache(os.path.join(self.tmpdir, 'cache'), max_size=1024)
+        self.url = 'http://example.com/kernel'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestDownloadCache, self).tearDown()
+
+    def store(self, url, data, headers=None):
+        with self.cache.storing(url, headers or {'etag': '"1234"'}) as cached:
+            cached.write(data)
+        return self.cache.lookup(url)
+
+    def test_store_and_deliver(self):
+        self.assertIsNone(self.cache.lookup(self.url))
+        entry = self.store(self.url, 'kernel data')
+        self.assertEqual(entry['size'], 11)
+        self.assertEqual(entry['sha256'], hashlib.sha256('kernel data').hexdigest())
+        self.assertEqual(entry['md5'], hashlib.md5('kernel data').hexdigest())
+        self.assertEqual(self.cache.validators(entry), {'If-None-Match': '"1234"'})
+        dest = os.path.join(self.tmpdir, 'kernel')
+        self.assertTrue(self.cache.deliver(entry, dest))
+        with open(dest) as delivered:
+            self.assertEqual(delivered.read(), 'kernel data')
+        self.assertEqual(''.join(self.cache.read(entry)), 'kernel data')
+        # identical content from another url is only stored once
+        self.store('http://example.com/mirror/kernel', 'kernel data')
+        self.assertEqual(os.listdir(self.cache.objects), [entry['sha256']])
+
+    def test_failed_download(self):
+        with self.assertRaises(RuntimeError):
+            with self.cache.storing(self.url) as cached:
+                cached.write('partial')
+                raise RuntimeError("connection lost")
+        self.assertIsNone(self.cache.lookup(self.url))
+        self.assertEqual(os.listdir(self.cache.tmp), [])
+
+    def test_modified_in_place(self):
+        entry = self.store(self.url, 'image data')
+        dest = os.path.join(self.tmpdir, 'image')
+        self.assertTrue(self.cache.deliver(entry, dest, hardlink=False))
+        with open(dest, 'w') as image:
+            image.write('modified')
+        self.assertIsNotNone(self.cache.lookup(self.url))
+        self.assertTrue(self.cache.deliver(entry, dest, hardlink=True))
+        if os.stat(dest).st_ino == os.stat(self.cache.object_path(entry)).st_ino:
+            # a change through a hard link is detected and the object discarded
+            with open(dest, 'w') as image:
+                image.write('modified')
+            os.utime(dest, (entry['mtime'] + 10, entry['mtime'] + 10))
+            self.assertIsNone(self.cache.lookup(self.url))
+            self.assertFalse(self.cache.deliver(entry, dest))
+
+    def test_eviction(self):
+        first = self.store('http://example.com/first', 'a' * 400)
+        second = self.store('http://example.com/second', 'b' * 400)
+        # use the first object again, the second becomes the least recently used
+        os.utime(self.cache.object_path(second), (1, second['mtime']))
+        self.cache.touch(first)
+        self.store('http://example.com/third', 'c' * 400)
+        self.assertIsNotNone(self.cache.lookup('http://example.com/first'))
+        self.assertIsNone(self.cache.lookup('http://example.com/second'))
+        self.assertIsNotNone(self.cache.lookup('http://example.com/third'))
+
+
+class TestOverlayTarball(unittest.TestCase):  # pylint: disable=too-many-public-methods
+
+    def setUp(self):
+        super(TestOverlayTarball, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = OverlayCache(os.path.join(self.tmpdir, 'cache'))
+        self.location = os.path.join(self.tmpdir, 'overlay')
+        self.make_overlay('lava-1234')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestOverlayTarball, self).tearDown()
+
+    def make_overlay(self, results_dir):
+        lava = os.path.join(self.location, results_dir)
+        os.makedirs(os.path.join(lava, 'bin'))
+        os.makedirs(os.path.join(lava, 'tests', '0_smoke', '.git'))
+        os.makedirs(os.path.join(self.location, 'root', '.ssh'))
+        with open(os.path.join(lava, 'bin', 'lava-test-runner'), 'w') as runner:
+            runner.write('#!/bin/sh\n')
+        os.chmod(os.path.join(lava, 'bin', 'lava-test-runner'), 0o755)
+        # larger than a compression block
+        with open(os.path.join(lava, 'tests', '0_smoke', '.git', 'pack'), 'w') as pack:
+            pack.write(os.urandom(1024 * 1024) * 3 + 'end')
+        os.symlink('bin/lava-test-runner', os.path.join(lava, 'runner'))
+        with open(os.path.join(self.location, 'root', '.ssh', 'authorized_keys'), 'w') as keys:
+            keys.write('ssh-rsa key')
+        return ['./%s' % results_dir, './root/']
+
+    def contents(self, directory):
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                info = os.lstat(path)
+                if os.path.islink(path):
+                    content = os.readlink(path)
+                elif os.path.isdir(path):
+                    content = None
+                else:
+                    with open(path) as data:
+                        content = hashlib.md5(data.read()).hexdigest()
+                files[os.path.relpath(path, directory)] = (info.st_mode, content)
+        return files
+
+    def extract(self, tarball):
+        directory = tempfile.mkdtemp(dir=self.tmpdir)
+        with tarfile.open(tarball) as tar:
+            tar.extractall(directory)
+        return self.contents(directory)
+
+    def test_same_as_tarfile(self):
+        paths = ['./lava-1234', './root/']
+        expected = os.path.join(self.tmpdir, 'expected.tar.gz')
+        with tarfile.open(expected, 'w:gz') as tar:
+            for path in paths:
+                tar.add(os.path.join(self.location, path), path)
+        output = os.path.join(self.tmpdir, 'overlay.tar.gz')
+        self.assertFalse(write_overlay(self.location, paths, output, threads=4))
+        self.assertEqual(self.extract(output), self.extract(expected))
+        # also readable by gzip and tar
+        names = subprocess.check_output(['tar', '-tzf', output]).split()
+        self.assertIn('./lava-1234/tests/0_smoke/.git/pack', names)
+
+    def test_cache(self):
+        paths = ['./lava-1234', './root/']
+        output = os.path.join(self.tmpdir, 'overlay.tar.gz')
+        self.assertFalse(write_overlay(self.location, paths, output, cache=self.cache))
+        expected = self.extract(output)
+        os.unlink(output)
+        self.assertTrue(write_overlay(self.location, paths, output, cache=self.cache))
+        self.assertEqual(self.extract(output), expected)
+        # the same test definitions for another job reuse the compressed pack
+        shutil.copytree(os.path.join(self.location, 'lava-1234'), os.path.join(self.location, 'lava-1235'),
+                        symlinks=True)
+        other = os.path.join(self.tmpdir, 'other.tar.gz')
+        pack = [name for name in os.listdir(self.cache.objects) if name.startswith('file-')]
+        self.assertEqual(len(pack), 1)
+        os.utime(self.cache.object_path(pack[0]), (1, 1))
+        self.assertFalse(write_overlay(self.location, ['./lava-1235', './root/'], other, cache=self.cache))
+        self.assertGreater(os.stat(self.cache.object_path(pack[0])).st_atime, 1)
+        contents = self.extract(other)
+        self.assertEqual(contents['lava-1235/tests/0_smoke/.git/pack'],
+                         expected['lava-1234/tests/0_smoke/.git/pack'])
+        self.assertEqual(len(os.listdir(self.cache.objects)), 3)
+
+    def test_copy_overlay(self):
+        paths = ['./lava-1234', './root/']
+        output = os.path.join(self.tmpdir, 'overlay.tar.gz')
+        write_overlay(self.location, paths, output)
+        target = os.path.join(self.tmpdir, 'rootfs')
+        os.makedirs(os.path.join(target, 'root'))
+        # an existing symlink is replaced, not written through
+        outside = os.path.join(self.tmpdir, 'outside')
+        os.makedirs(os.path.join(target, 'lava-1234', 'bin'))
+        os.symlink(outside, os.path.join(target, 'lava-1234', 'bin', 'lava-test-runner'))
+        copy_overlay(self.location, paths, target)
+        self.assertFalse(os.path.exists(outside))
+        self.assertEqual(self.contents(target), self.extract(output))
+
+
 class TestConstants(unittest.TestCase):  # pylint: disable=too-many-public-methods
     """
     Tests that constants set in the Job YAML as parameters in an Action stanza
@@ -0,0 +1,345 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from lava_dispatcher.pipeline.utils.constants import (
+    DOWNLOAD_CACHE_DIR,
+    DOWNLOAD_CACHE_SIZE,
+    FILE_DOWNLOAD_CHUNK_SIZE,
+    OVERLAY_CACHE_DIR,
+    OVERLAY_CACHE_SIZE,
+)
+
+# ioctl to clone the extents of a file on filesystems with reflink support (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def _mkdir(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+class CacheWriter(object):
+    """
+    Content being added to the cache, see DownloadCache.storing
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, buff):
+        self.stream.write(buff)
+        self.md5.update(buff)
+        self.sha256.update(buff)
+        self.size += len(buff)
+
+
+class DownloadCache(object):
+    """
+    Downloads shared by all the pipeline jobs on a worker.
+
+    objects/<sha256> holds the content, so identical content from several
+    urls is only kept once. urls/<sha256 of the url>.json records the sha256
+    of the content last downloaded from the url, with the ETag and
+    Last-Modified headers needed to revalidate it. Holding the lock of a
+    url means concurrent jobs only download it once.
+
+    Content is delivered into the job directory as a reflink, a hard link
+    or a copy. The mtime of each object is recorded so that content
+    modified through a hard link is not delivered again. The atime is used
+    to remove the least recently used objects once the cache is too large.
+    """
+
+    def __init__(self, path=DOWNLOAD_CACHE_DIR, max_size=DOWNLOAD_CACHE_SIZE):
+        self.logger = logging.getLogger('dispatcher')
+        self.path = path
+        self.max_size = max_size
+        self.objects = os.path.join(path, 'objects')
+        self.urls = os.path.join(path, 'urls')
+        self.tmp = os.path.join(path, 'tmp')
+        for directory in [self.objects, self.urls, self.tmp]:
+            _mkdir(directory)
+
+    def _url_path(self, url, suffix):
+        return os.path.join(self.urls, hashlib.sha256(url).hexdigest() + suffix)
+
+    def object_path(self, entry):
+        return os.path.join(self.objects, entry['sha256'])
+
+    @contextlib.contextmanager
+    def _flock(self, path):
+        with open(path, 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def locked(self, url):
+        """
+        Only one job at a time downloads the url, the others then use the cache.
+        """
+        return self._flock(self._url_path(url, '.lock'))
+
+    def lookup(self, url):
+        """
+        :return: the cache entry for the url, None if the content is not in the cache
+        """
+        try:
+            with open(self._url_path(url, '.json')) as meta:
+                entry = json.load(meta)
+            stat = os.stat(self.object_path(entry))
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        if stat.st_size != entry['size'] or int(stat.st_mtime) != entry['mtime']:
+            self.logger.warning("Cached copy of %s has been modified, discarding it" % url)
+            _remove(self.object_path(entry))
+            return None
+        return entry
+
+    @staticmethod
+    def validators(entry):
+        """
+        Headers for a conditional request for the cached content.
+        """
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def touch(self, entry):
+        """
+        Mark the entry as recently used, without changing the recorded mtime.
+        """
+        try:
+            os.utime(self.object_path(entry), (time.time(), entry['mtime']))
+        except OSError:
+            pass
+
+    def read(self, entry):
+        with open(self.object_path(entry), 'rb') as cached:
+            buff = cached.read(FILE_DOWNLOAD_CHUNK_SIZE)
+            while buff:
+                yield buff
+                buff = cached.read(FILE_DOWNLOAD_CHUNK_SIZE)
+
+    @contextlib.contextmanager
+    def storing(self, url, headers=None):
+        """
+        Writes new content for the url into the cache. The content is only
+        added if the block completes without an exception.
+        :param headers: response headers, for the ETag and Last-Modified validators
+        """
+        headers = headers or {}
+        handle, tmp_name = tempfile.mkstemp(dir=self.tmp)
+        try:
+            with os.fdopen(handle, 'wb') as stream:
+                writer = CacheWriter(stream)
+                yield writer
+        except BaseException:
+            _remove(tmp_name)
+            raise
+        entry = {
+            'url': url,
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+            'sha256': writer.sha256.hexdigest(),
+            'md5': writer.md5.hexdigest(),
+            'size': writer.size,
+        }
+        try:
+            os.rename(tmp_name, self.object_path(entry))
+            entry['mtime'] = int(os.stat(self.object_path(entry)).st_mtime)
+            handle, meta_name = tempfile.mkstemp(dir=self.tmp)
+            with os.fdopen(handle, 'w') as meta:
+                json.dump(entry, meta)
+            os.rename(meta_name, self._url_path(url, '.json'))
+        except (IOError, OSError) as exc:
+            # a full cache must not fail the download
+            self.logger.warning("Unable to cache %s: %s" % (url, exc))
+            _remove(tmp_name)
+            return
+        self.evict()
+
+    def deliver(self, entry, dest, hardlink=True):
+        """
+        Puts the cached content at dest, as a reflink where the filesystem
+        supports it, otherwise as a hard link or a copy.
+        :param hardlink: False if the content will be modified in place
+        :return: False if the content is no longer in the cache
+        """
+        src = self.object_path(entry)
+        _remove(dest)
+        try:
+            with open(src, 'rb') as source:
+                with open(dest, 'wb') as target:
+                    try:
+                        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                        self.touch(entry)
+                        return True
+                    except IOError:
+                        pass
+            _remove(dest)
+            if hardlink:
+                try:
+                    os.link(src, dest)
+                    self.touch(entry)
+                    return True
+                except OSError:
+                    pass
+            shutil.copyfile(src, dest)
+        except (IOError, OSError) as exc:
+            self.logger.debug("Unable to deliver %s from the cache: %s" % (entry['url'], exc))
+            _remove(dest)
+            return False
+        self.touch(entry)
+        return True
+
+    def evict(self):
+        """
+        Remove the least recently used objects until the cache fits in max_size.
+        """
+        with self._flock(os.path.join(self.path, 'lock')):
+            _evict(self.objects, self.max_size, self.logger)
+
+
+def _evict(directory, max_size, logger):
+    """
+    Remove the least recently used files of directory until they fit in max_size.
+    """
+    objects = []
+    for name in os.listdir(directory):
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        objects.append((stat.st_atime, stat.st_size, name))
+    total = sum([size for _, size, _ in objects])
+    for _, size, name in sorted(objects):
+        if total <= max_size:
+            break
+        logger.debug("Removing %s from the cache" % name)
+        _remove(os.path.join(directory, name))
+        total -= size
+
+
+class OverlayCache(object):
+    """
+    Compressed overlay tarballs, and compressed pieces of them, shared by
+    all the pipeline jobs on a worker, see utils.overlay.
+
+    Entries are named by the sha256 of what they hold, so they never need
+    revalidating. They are written to tmp/ and renamed, jobs storing the
+    same entry at the same time both produce the same content.
+    """
+
+    def __init__(self, path=OVERLAY_CACHE_DIR, max_size=OVERLAY_CACHE_SIZE):
+        self.logger = logging.getLogger('dispatcher')
+        self.path = path
+        self.max_size = max_size
+        self.objects = os.path.join(path, 'objects')
+        self.tmp = os.path.join(path, 'tmp')
+        for directory in [self.objects, self.tmp]:
+            _mkdir(directory)
+
+    def object_path(self, key):
+        return os.path.join(self.objects, key)
+
+    def lookup(self, key):
+        """
+        :return: the path of the entry, None if it is not in the cache
+        """
+        path = self.object_path(key)
+        try:
+            # mark the entry as recently used
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def store(self, key, chunks):
+        """
+        Add an entry, unless it is already in the cache.
+        :param chunks: the content, as an iterable of strings
+        """
+        if self.lookup(key):
+            return
+        handle, tmp_name = tempfile.mkstemp(dir=self.tmp)
+        try:
+            with os.fdopen(handle, 'wb') as stream:
+                for chunk in chunks:
+                    stream.write(chunk)
+            os.rename(tmp_name, self.object_path(key))
+        except (IOError, OSError) as exc:
+            # a full cache must not fail the job
+            self.logger.warning("Unable to cache %s: %s" % (key, exc))
+            _remove(tmp_name)
+
+    def deliver(self, key, dest):
+        """
+        Puts a copy of the entry at dest, as a hard link where possible.
+        :return: False if the entry is no longer in the cache
+        """
+        src = self.lookup(key)
+        if not src:
+            return False
+        _remove(dest)
+        try:
+            try:
+                os.link(src, dest)
+            except OSError:
+                shutil.copyfile(src, dest)
+        except (IOError, OSError) as exc:
+            self.logger.debug("Unable to deliver %s from the cache: %s" % (key, exc))
+            _remove(dest)
+            return False
+        return True
+
+    def evict(self):
+        with open(os.path.join(self.path, 'lock'), 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                _evict(self.objects, self.max_size, self.logger)
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
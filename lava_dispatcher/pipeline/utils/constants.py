@@ -28,9 +28,23 @@ SHELL_SEND_DELAY = 0.05
 # Default timeout for shell operations
 SHELL_DEFAULT_TIMEOUT = 60
 
+# Shell output kept for matching the patterns of an expect call
+EXPECT_SEARCH_WINDOW = 64 * 1024
+
+# Output which was already searched is searched again for this many bytes
+# when new output arrives, for matches which started in the previous read.
+EXPECT_SEARCH_OVERLAP = 4096
+
 # Default timeout when downloading over http/https
 HTTP_DOWNLOAD_TIMEOUT = 15
 
+# The status and size of http urls checked by the validation of a job are
+# reused for this many seconds ...
+HTTP_VALIDATION_TTL = 60
+
+# ... and at most this many urls are checked at the same time.
+MAX_PARALLEL_VALIDATIONS = 8
+
 # Retry at most 5 times
 MAX_RETRY = 5
 
@@ -53,6 +67,12 @@ HTTP_DOWNLOAD_CHUNK_SIZE = 32768
 # Size of the chunks when downloading over scp
 SCP_DOWNLOAD_CHUNK_SIZE = 32768
 
+# Maximum number of files of a deployment downloaded at the same time
+MAX_PARALLEL_DOWNLOADS = 4
+
+# Number of chunks queued between the download, checksum and decompression threads
+DOWNLOAD_QUEUE_SIZE = 64
+
 # Clamp on the maximum timeout allowed for overrides
 OVERRIDE_CLAMP_DURATION = 300
 
@@ -64,6 +84,28 @@ AUTOLOGIN_DEFAULT_TIMEOUT = 120
 # Files here are for download using the Apache /tmp alias.
 DISPATCHER_DOWNLOAD_DIR = "/var/lib/lava/dispatcher/tmp"
 
+# Worker-local cache of downloads, shared by all pipeline jobs
+DOWNLOAD_CACHE_DIR = "/var/lib/lava/dispatcher/cache"
+
+# Least recently used downloads are removed from the cache beyond this size
+DOWNLOAD_CACHE_SIZE = 20 * 1024 * 1024 * 1024
+
+# Worker-local cache of compressed lava overlays, shared by all pipeline jobs
+OVERLAY_CACHE_DIR = "/var/lib/lava/dispatcher/cache/overlays"
+
+# Least recently used overlays are removed from the cache beyond this size
+OVERLAY_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+# Files of the overlay are compressed in blocks of this size in parallel
+OVERLAY_BLOCK_SIZE = 1024 * 1024
+
+# Worker-local mirrors of the test definition repositories
+VCS_MIRROR_DIR = "/var/lib/lava/dispatcher/cache/vcs"
+
+# Mirrors are updated from the remote repository at most this often (in seconds),
+# unless a job asks for a revision they do not have.
+VCS_MIRROR_TTL = 300
+
 # OS shutdown message
 # Override: set as the shutdown-message parameter of an Action.
 SHUTDOWN_MESSAGE = 'The system is going down for reboot NOW'
@@ -74,5 +116,9 @@ BOOT_MESSAGE = 'Booting Linux'
 # LAVA Coordinator setup and finalize timeout
 LAVA_MULTINODE_SYSTEM_TIMEOUT = 90
 
+# LAVA Coordinator protocol version which keeps one connection open per node.
+# Version 1 is one request per connection with the node polling on "wait".
+LAVA_MULTINODE_PROTOCOL_VERSION = 2
+
 # Default Action timeout
 ACTION_TIMEOUT = 30
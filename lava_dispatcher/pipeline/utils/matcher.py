@@ -0,0 +1,122 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+import re
+import pexpect
+
+from lava_dispatcher.pipeline.utils.constants import EXPECT_SEARCH_OVERLAP
+
+# a numbered back reference would point at the wrong group once combined
+BACKREFERENCE = re.compile(r'\\[1-9]')
+
+
+class PatternMatcher(object):
+    """
+    A pexpect searcher which combines all the patterns of an expect call
+    into a single compiled alternation of named groups, so the console
+    output is scanned once for all the patterns instead of once per pattern.
+
+    Only the data which arrived since the last search is scanned, with an
+    overlap of EXPECT_SEARCH_OVERLAP bytes for matches which started in the
+    previous read. As with pexpect, the first match in the output wins and
+    the earliest pattern in the list wins between matches at the same place.
+
+    After a match, the match attribute comes from the individual pattern so
+    that groups() and groupdict() are unchanged for the callers.
+    """
+
+    def __init__(self, patterns, flags=re.DOTALL, overlap=EXPECT_SEARCH_OVERLAP):
+        """
+        :param patterns: list of strings, compiled regular expressions,
+            pexpect.EOF or pexpect.TIMEOUT, as for pexpect.spawn.expect
+        :param flags: flags used to compile the string patterns
+        :param overlap: number of bytes searched again before the new data
+        """
+        self.eof_index = -1
+        self.timeout_index = -1
+        self.overlap = overlap
+        self.start = None
+        self.end = None
+        self.match = None
+        self._searches = []
+        for index, pattern in enumerate(patterns):
+            if pattern is pexpect.EOF:
+                self.eof_index = index
+            elif pattern is pexpect.TIMEOUT:
+                self.timeout_index = index
+            else:
+                if isinstance(pattern, basestring):
+                    pattern = re.compile(pattern, flags)
+                self._searches.append((index, pattern))
+        self._combined = self._combine(flags)
+
+    def _combine(self, flags):
+        """
+        :return: the combined expression, None if the patterns cannot be combined
+        """
+        alternatives = []
+        for index, pattern in self._searches:
+            if pattern.flags & ~re.UNICODE != flags or BACKREFERENCE.search(pattern.pattern):
+                return None
+            alternatives.append('(?P<_lava_%d>%s)' % (index, pattern.pattern))
+        if not alternatives:
+            return None
+        try:
+            return re.compile('|'.join(alternatives), flags)
+        except (re.error, AssertionError):
+            # named groups repeated across the patterns, or too many groups
+            return None
+
+    def __str__(self):
+        lines = ['PatternMatcher:']
+        for index, pattern in self._searches:
+            lines.append('    %d: re.compile(%r)' % (index, pattern.pattern))
+        return '\n'.join(lines)
+
+    def search(self, buffer, freshlen, searchwindowsize=None):
+        """
+        Called by pexpect with the search window and the number of bytes
+        at the end of it which have not been searched before.
+        :return: the index of the matching pattern, -1 if there is no match
+        """
+        searchstart = max(0, len(buffer) - freshlen - self.overlap)
+        if searchwindowsize is not None:
+            searchstart = max(searchstart, len(buffer) - searchwindowsize)
+        if self._combined:
+            match = self._combined.search(buffer, searchstart)
+            if match is None:
+                return -1
+            index = int(match.lastgroup[6:])
+            pattern = [search for position, search in self._searches if position == index][0]
+            self.match = pattern.match(buffer, match.start())
+            self.start = match.start()
+            self.end = match.end()
+            return index
+        # the patterns could not be combined, search for each in turn.
+        first_match = None
+        for index, pattern in self._searches:
+            match = pattern.search(buffer, searchstart)
+            if match and (first_match is None or match.start() < first_match.start()):
+                first_match = match
+                best_index = index
+        if first_match is None:
+            return -1
+        self.match = first_match
+        self.start = first_match.start()
+        self.end = first_match.end()
+        return best_index
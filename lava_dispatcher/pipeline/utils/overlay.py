@@ -0,0 +1,242 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+"""
+Build the tarball of a lava overlay in parallel, from cached pieces.
+
+The tarball is a series of gzip members, which gzip, tar and tarfile
+read as a single stream, so the members can be compressed in parallel.
+Files of at least OVERLAY_BLOCK_SIZE, typically the history of the git
+repositories of the test definitions, get one member per block and are
+kept in the OverlayCache under the sha256 of their content. The whole
+tarball is kept under a hash of the names, metadata and content of all
+its files, so an identical overlay is not compressed again at all.
+"""
+
+import hashlib
+import io
+import multiprocessing
+import os
+import shutil
+import stat
+import tarfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from lava_dispatcher.pipeline.utils.constants import OVERLAY_BLOCK_SIZE
+
+
+def _gzip_member(data, compresslevel):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _sha256(path):
+    if path is None:
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as data:
+        for chunk in iter(lambda: data.read(OVERLAY_BLOCK_SIZE), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read(path, offset, size):
+    with open(path, 'rb') as data:
+        data.seek(offset)
+        buff = data.read(size)
+    if len(buff) != size:
+        raise IOError("%s changed while building the overlay" % path)
+    return buff
+
+
+def overlay_members(location, paths):
+    """
+    :param location: the overlay directory
+    :param paths: directories of the overlay to include, relative to location
+    :return: (arcname, path) of each file, directory and symlink, parents
+    before their contents, in a stable order
+    """
+    members = []
+    for top in paths:
+        arcname = './' + os.path.normpath(top).lstrip('/')
+        path = os.path.join(location, arcname)
+        if not os.path.lexists(path):
+            continue
+        members.append((arcname, path))
+        if os.path.islink(path) or not os.path.isdir(path):
+            continue
+        # symlinks to directories are listed but not followed
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            prefix = arcname + dirpath[len(path):]
+            for name in sorted(dirnames + filenames):
+                members.append((prefix + '/' + name, os.path.join(dirpath, name)))
+    return members
+
+
+def _compress(task):
+    """
+    Runs in the threads of the pool, zlib releases the GIL.
+    """
+    kind, _, args = task
+    if kind == 'data':
+        data, compresslevel = args
+        return task, _gzip_member(data, compresslevel)
+    if kind == 'block':
+        path, offset, size, padding, compresslevel = args
+        return task, _gzip_member(_read(path, offset, size) + padding, compresslevel)
+    return task, None
+
+
+def _tasks(tar, infos, cache, compresslevel):
+    """
+    Split the tar stream into the members of the tarball.
+    :return: tasks for _compress, as (kind, cache key, arguments)
+    """
+    pending = []
+    pending_size = 0
+    offset = 0
+    for info, path, digest in infos:
+        header = info.tobuf(tar.format, tar.encoding, tar.errors)
+        pending.append(header)
+        pending_size += len(header)
+        offset += len(header)
+        if info.isreg() and info.size:
+            padding = tarfile.NUL * (-info.size % tarfile.BLOCKSIZE)
+            offset += info.size + len(padding)
+            if info.size < OVERLAY_BLOCK_SIZE:
+                pending.append(_read(path, 0, info.size) + padding)
+                pending_size += info.size
+            else:
+                yield ('data', None, (''.join(pending), compresslevel))
+                pending = []
+                pending_size = 0
+                key = 'file-%d-%s' % (compresslevel, digest)
+                cached = cache.lookup(key) if cache else None
+                if cached:
+                    yield ('cached', key, cached)
+                    continue
+                for start in range(0, info.size, OVERLAY_BLOCK_SIZE):
+                    size = min(OVERLAY_BLOCK_SIZE, info.size - start)
+                    last = start + size == info.size
+                    yield ('block', key, (path, start, size, padding if last else '', compresslevel))
+        if pending_size >= OVERLAY_BLOCK_SIZE:
+            yield ('data', None, (''.join(pending), compresslevel))
+            pending = []
+            pending_size = 0
+    # end of archive, as written by TarFile.close
+    end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+    offset += len(end)
+    pending.append(end + tarfile.NUL * (-offset % tarfile.RECORDSIZE))
+    yield ('data', None, (''.join(pending), compresslevel))
+
+
+def _read_range(path, start, end):
+    with open(path, 'rb') as data:
+        data.seek(start)
+        while start < end:
+            buff = data.read(min(OVERLAY_BLOCK_SIZE, end - start))
+            if not buff:
+                break
+            start += len(buff)
+            yield buff
+
+
+def write_overlay(location, paths, output, cache=None, compresslevel=6, threads=None):
+    """
+    Write a gzip compressed tarball of paths of the overlay at location,
+    with the same contents as adding each of the paths with tarfile.
+    :param cache: an OverlayCache, None to build the tarball without a cache
+    :param threads: number of compression threads, one per cpu by default
+    :return: True if the tarball was reused from the cache
+    """
+    tar = tarfile.open(fileobj=io.BytesIO(), mode='w')
+    infos = [(tar.gettarinfo(path, arcname), path) for arcname, path in overlay_members(location, paths)]
+    pool = ThreadPool(threads or multiprocessing.cpu_count())
+    try:
+        if cache:
+            # hashlib also releases the GIL
+            digests = pool.map(_sha256, [path if info.isreg() else None for info, path in infos])
+        else:
+            digests = [None] * len(infos)
+        infos = [(info, path, digest) for (info, path), digest in zip(infos, digests)]
+        tree = hashlib.sha256()
+        for info, _, digest in infos:
+            tree.update(repr((info.name, info.type, info.mode, info.uid, info.gid, info.uname, info.gname,
+                              info.linkname, info.size, info.devmajor, info.devminor, digest)))
+        key = 'overlay-%d-%s' % (compresslevel, tree.hexdigest())
+        if cache and cache.deliver(key, output):
+            return True
+        blobs = []
+        with open(output, 'wb') as tarball:
+            for task, member in pool.imap(_compress, _tasks(tar, infos, cache, compresslevel)):
+                kind, blob_key, args = task
+                if kind == 'cached':
+                    with open(args, 'rb') as cached:
+                        shutil.copyfileobj(cached, tarball, OVERLAY_BLOCK_SIZE)
+                    continue
+                if kind == 'block' and args[1] == 0:
+                    blobs.append([blob_key, tarball.tell(), None])
+                tarball.write(member)
+                if kind == 'block':
+                    blobs[-1][2] = tarball.tell()
+    finally:
+        pool.terminate()
+        pool.join()
+    if cache:
+        for blob_key, start, end in blobs:
+            cache.store(blob_key, _read_range(output, start, end))
+        cache.store(key, _read_range(output, 0, os.path.getsize(output)))
+        cache.evict()
+    return False
+
+
+def copy_overlay(location, paths, dest):
+    """
+    Copy paths of the overlay at location into dest, with the same result
+    as extracting the tarball of write_overlay into dest.
+    """
+    directories = []
+    for arcname, path in overlay_members(location, paths):
+        target = os.path.normpath(os.path.join(dest, arcname))
+        info = os.lstat(path)
+        if stat.S_ISDIR(info.st_mode):
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            directories.append((target, info))
+            continue
+        # replace, never write through, whatever is already in the target
+        if os.path.lexists(target) and not os.path.isdir(target):
+            os.unlink(target)
+        if stat.S_ISLNK(info.st_mode):
+            os.symlink(os.readlink(path), target)
+        elif stat.S_ISREG(info.st_mode):
+            shutil.copyfile(path, target)
+            os.chmod(target, stat.S_IMODE(info.st_mode))
+            os.utime(target, (info.st_atime, info.st_mtime))
+        else:
+            continue
+        if os.geteuid() == 0:
+            os.lchown(target, info.st_uid, info.st_gid)
+    # as tarfile, set the directories last, their contents change the mtime
+    for target, info in reversed(directories):
+        os.chmod(target, stat.S_IMODE(info.st_mode))
+        os.utime(target, (info.st_atime, info.st_mtime))
+        if os.geteuid() == 0:
+            os.lchown(target, info.st_uid, info.st_gid)
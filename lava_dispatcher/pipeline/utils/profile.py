@@ -0,0 +1,211 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+"""
+Opt-in profile of where the time of a job goes, for jobs with
+profile: true in the job parameters.
+
+For each action level, the profile holds the wall and cpu time of the
+action, the bytes it downloaded, wrote to disk and read from the console
+and the time it spent blocked in expect. The counters of an action
+include those of the actions of its internal pipeline. Nothing is
+recorded while no profile is running, so count() costs a single check
+in normal jobs.
+"""
+
+import os
+import threading
+import time
+import yaml
+
+# counters reported by the code doing the work, see count()
+COUNTERS = ['downloaded', 'serial_read', 'expect_time']
+
+_PROFILER = None
+
+
+def _cpu_time():
+    # user and system time of the dispatcher and of its finished children
+    return sum(os.times()[:4])
+
+
+def _written():
+    """
+    :return: bytes the dispatcher process caused to be written to storage,
+    None where /proc/self/io is not available.
+    """
+    try:
+        with open('/proc/self/io') as stats:
+            for line in stats:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+class Profiler(object):
+    """
+    Collects the counters of the running actions. Each thread has its own
+    stack of running actions, as actions such as ParallelDownloadAction run
+    their internal pipeline in several threads. A thread started by an
+    action starts with the stack of that action, see thread_started(), so
+    the counters added from the thread are added to the actions it runs
+    and to their parents.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # actions running in the calling thread, outermost first: (level, counters, start)
+        self.local = threading.local()
+        # level: profile of the action, in the order the actions started
+        self.actions = {}
+        self.order = []
+
+    def running(self):
+        """
+        :return: the stack of the actions running in the calling thread
+        """
+        if not hasattr(self.local, 'running'):
+            self.local.running = []
+        return self.local.running
+
+    def thread_started(self, running):
+        """
+        Called from a new thread with the running() stack of the thread which
+        started it. The entries are shared, the list is not.
+        """
+        self.local.running = list(running)
+
+    def start(self, action):
+        counters = dict([(counter, 0) for counter in COUNTERS])
+        start = (time.time(), _cpu_time(), _written())
+        with self.lock:
+            if action.level not in self.actions:
+                self.order.append(action.level)
+                self.actions[action.level] = {
+                    'level': action.level, 'name': action.name, 'runs': 0, 'wall': 0.0, 'cpu': 0.0,
+                    'written': 0 if start[2] is not None else None}
+                self.actions[action.level].update(counters)
+            self.running().append((action.level, counters, start))
+
+    def stop(self, action):
+        now = (time.time(), _cpu_time(), _written())
+        running = self.running()
+        with self.lock:
+            # actions which raised may leave their children behind
+            while running:
+                level, counters, start = running.pop()
+                if level == action.level:
+                    break
+            else:
+                return
+            profile = self.actions[level]
+            # retried actions add up
+            profile['runs'] += 1
+            profile['wall'] += now[0] - start[0]
+            profile['cpu'] += now[1] - start[1]
+            if profile['written'] is not None:
+                profile['written'] += now[2] - start[2]
+            for counter, value in counters.items():
+                profile[counter] += value
+
+    def count(self, counter, value):
+        running = self.running()
+        with self.lock:
+            for _, counters, _ in running:
+                counters[counter] += value
+
+    def profile(self):
+        """
+        :return: the profile of each action level which ran, in the order they started
+        """
+        with self.lock:
+            profiles = [dict(self.actions[level]) for level in self.order]
+        for profile in profiles:
+            profile['wall'] = round(profile['wall'], 3)
+            profile['cpu'] = round(profile['cpu'], 3)
+            profile['expect_time'] = round(profile['expect_time'], 3)
+        return profiles
+
+    def write(self, path):
+        with open(path, 'w') as output:
+            yaml.safe_dump(self.profile(), output, default_flow_style=False)
+
+
+def start_profile():
+    """
+    Record the counters of the actions from now on.
+    :return: the running Profiler
+    """
+    global _PROFILER  # pylint: disable=global-statement
+    _PROFILER = Profiler()
+    return _PROFILER
+
+
+def stop_profile():
+    """
+    :return: the Profiler which was running, None if there was none
+    """
+    global _PROFILER  # pylint: disable=global-statement
+    profiler = _PROFILER
+    _PROFILER = None
+    return profiler
+
+
+def action_started(action):
+    profiler = _PROFILER
+    if profiler:
+        profiler.start(action)
+
+
+def action_finished(action):
+    profiler = _PROFILER
+    if profiler:
+        profiler.stop(action)
+
+
+def running_actions():
+    """
+    :return: the actions running in the calling thread, to pass to
+    thread_started() in the threads it starts. None if no profile is running.
+    """
+    profiler = _PROFILER
+    if profiler:
+        return list(profiler.running())
+    return None
+
+
+def thread_started(running):
+    """
+    Called first in a thread started by an action, so that the actions run
+    by the thread are profiled as children of that action.
+    :param running: the running_actions() of the thread which started this one
+    """
+    profiler = _PROFILER
+    if profiler and running is not None:
+        profiler.thread_started(running)
+
+
+def count(counter, value):
+    """
+    Add value to one of the COUNTERS of the running actions, if a profile is running.
+    """
+    profiler = _PROFILER
+    if profiler:
+        profiler.count(counter, value)
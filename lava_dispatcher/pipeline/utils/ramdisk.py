@@ -0,0 +1,252 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+"""
+Add files to a compressed ramdisk without unpacking it.
+
+The kernel unpacks each of a series of concatenated, optionally compressed,
+newc cpio archives into the initramfs, files of later archives replacing
+those of earlier ones. The contents of tarballs can therefore be added to
+a gzip compressed ramdisk by appending a gzip member holding one more cpio
+archive, instead of decompressing, extracting, archiving and compressing
+the whole ramdisk again.
+"""
+
+import os
+import stat
+import struct
+import tarfile
+import time
+import zlib
+
+# legacy u-boot image header, see image.h in u-boot
+UBOOT_MAGIC = 0x27051956
+UBOOT_HEADER = struct.Struct('>7I4B32s')
+UBOOT_HEADER_SIZE = UBOOT_HEADER.size
+GZIP_MAGIC = '\x1f\x8b'
+
+CPIO_MAGIC = '070701'
+CPIO_TRAILER = 'TRAILER!!!'
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _pad(size):
+    return '\0' * (-size % 4)
+
+
+def read_uboot_header(data):
+    """
+    :param data: the first UBOOT_HEADER_SIZE bytes of a u-boot image
+    :return: the fields of the header as a list, None if data is not a u-boot header
+    """
+    if len(data) < UBOOT_HEADER_SIZE:
+        return None
+    fields = list(UBOOT_HEADER.unpack(data[:UBOOT_HEADER_SIZE]))
+    if fields[0] != UBOOT_MAGIC:
+        return None
+    return fields
+
+
+def pack_uboot_header(fields, size, data_crc):
+    """
+    :param fields: the fields of the original header, see read_uboot_header
+    :return: the header for data_size bytes of data with the data_crc checksum
+    """
+    fields = list(fields)
+    # hcrc, time, size, dcrc
+    fields[1] = 0
+    fields[2] = int(time.time())
+    fields[3] = size
+    fields[6] = data_crc
+    fields[1] = zlib.crc32(UBOOT_HEADER.pack(*fields)) & 0xffffffff
+    return UBOOT_HEADER.pack(*fields)
+
+
+def compressed_offset(path, uboot=False):
+    """
+    :param path: the ramdisk
+    :param uboot: True if the ramdisk has a u-boot header
+    :return: the offset of the gzip compressed data in the ramdisk, None if
+    the ramdisk is not gzip compressed or the u-boot header is invalid.
+    """
+    with open(path, 'rb') as ramdisk:
+        offset = 0
+        if uboot:
+            if read_uboot_header(ramdisk.read(UBOOT_HEADER_SIZE)) is None:
+                return None
+            offset = UBOOT_HEADER_SIZE
+        if ramdisk.read(2) != GZIP_MAGIC:
+            return None
+    return offset
+
+
+class _Checksummed(object):
+    """
+    Writes to a file, keeping the size and CRC32 of the data written.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+        self.crc = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.size += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+
+
+class _GzipMember(object):
+    """
+    Compresses the data written into a single gzip member.
+    """
+
+    def __init__(self, fileobj, compresslevel=6):
+        self.fileobj = fileobj
+        self._compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self.fileobj.write(compressed)
+
+    def close(self):
+        self.fileobj.write(self._compressor.flush())
+
+
+class NewcWriter(object):
+    """
+    Writes a newc (SVR4 without CRC) cpio archive, as
+    find | cpio --create --format=newc
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+        self._ino = 0
+        self._directories = set()
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def add(self, name, mode, data='', fileobj=None, size=0,  # pylint: disable=too-many-arguments
+            uid=0, gid=0, mtime=0, rdev=(0, 0)):
+        """
+        Add one entry, with its data read from fileobj if given.
+        """
+        self._ino += 1
+        nlink = 2 if stat.S_ISDIR(mode) else 1
+        if fileobj is None:
+            size = len(data)
+        fields = [self._ino, mode, uid, gid, nlink, int(mtime), size,
+                  0, 0, rdev[0], rdev[1], len(name) + 1, 0]
+        header = CPIO_MAGIC + ''.join(['%08x' % field for field in fields]) + name + '\0'
+        self._write(header + _pad(self.offset + len(header)))
+        if fileobj is None:
+            self._write(data)
+        else:
+            remaining = size
+            while remaining:
+                chunk = fileobj.read(min(COPY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError("Unexpected end of %s" % name)
+                self._write(chunk)
+                remaining -= len(chunk)
+        self._write(_pad(size))
+        if stat.S_ISDIR(mode):
+            self._directories.add(name)
+
+    def _add_parents(self, name):
+        """
+        The kernel does not create missing parent directories.
+        """
+        parent = os.path.dirname(name)
+        if parent and parent not in self._directories:
+            self._add_parents(parent)
+            self.add(parent, stat.S_IFDIR | 0o755)
+
+    def add_tarball(self, path):
+        """
+        Add the members of a tarball, with the same names as extracting it
+        at the root of the ramdisk would give.
+        """
+        with tarfile.open(path) as tar:
+            for member in tar:
+                name = os.path.normpath(member.name).lstrip('/')
+                if name in ['', '.'] or name.startswith('../'):
+                    continue
+                self._add_parents(name)
+                perms = member.mode & 0o7777
+                owner = {'uid': member.uid, 'gid': member.gid, 'mtime': member.mtime}
+                if member.isdir():
+                    self.add(name, stat.S_IFDIR | perms, **owner)
+                elif member.issym():
+                    self.add(name, stat.S_IFLNK | 0o777, data=member.linkname, **owner)
+                elif member.isfile() or member.islnk():
+                    # hard links get a copy of the data of their target
+                    data = tar.extractfile(member)
+                    size = member.size if member.isfile() else tar.getmember(member.linkname).size
+                    self.add(name, stat.S_IFREG | perms, fileobj=data, size=size, **owner)
+                elif member.ischr() or member.isblk():
+                    kind = stat.S_IFCHR if member.ischr() else stat.S_IFBLK
+                    self.add(name, kind | perms, rdev=(member.devmajor, member.devminor), **owner)
+                elif member.isfifo():
+                    self.add(name, stat.S_IFIFO | perms, **owner)
+
+    def close(self):
+        self.add(CPIO_TRAILER, 0)
+
+
+def append_to_ramdisk(ramdisk, output, tarballs, uboot=False, compresslevel=6):
+    """
+    Write a copy of a gzip compressed ramdisk with the contents of the
+    tarballs appended as another compressed cpio archive. The original
+    ramdisk is copied as it is, only the new files are compressed.
+    :param ramdisk: the original ramdisk, see compressed_offset
+    :param output: path of the new ramdisk
+    :param tarballs: tarballs to add, in order, later ones replacing files of earlier ones
+    :param uboot: True if the ramdisk has a u-boot header, the new ramdisk
+    gets a header with the same fields for the new data
+    :return: the size of the new ramdisk
+    """
+    with open(ramdisk, 'rb') as original:
+        header = None
+        if uboot:
+            header = read_uboot_header(original.read(UBOOT_HEADER_SIZE))
+            if header is None:
+                raise RuntimeError("Invalid u-boot header in %s" % ramdisk)
+        with open(output, 'wb') as ramdisk_file:
+            if header:
+                ramdisk_file.write('\0' * UBOOT_HEADER_SIZE)
+            data = _Checksummed(ramdisk_file)
+            while True:
+                chunk = original.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                data.write(chunk)
+            member = _GzipMember(data, compresslevel)
+            archive = NewcWriter(member)
+            for tarball in tarballs:
+                archive.add_tarball(tarball)
+            archive.close()
+            member.close()
+            if header:
+                ramdisk_file.seek(0)
+                ramdisk_file.write(pack_uboot_header(header, data.size, data.crc & 0xffffffff))
+    return os.path.getsize(output)
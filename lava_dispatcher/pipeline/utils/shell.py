@@ -23,6 +23,7 @@ import os
 import pexpect
 from stat import S_IXUSR
 from lava_dispatcher.pipeline.action import InfrastructureError, TestError
+from lava_dispatcher.pipeline.utils.constants import EXPECT_SEARCH_WINDOW
 
 
 def _which_check(path, match):
@@ -77,7 +78,7 @@ def wait_for_prompt(connection, prompt_pattern, timeout):
     partial_timeout = timeout / 2.0
     while True:
         try:
-            connection.expect(prompt_pattern, timeout=partial_timeout)
+            connection.expect(prompt_pattern, timeout=partial_timeout, searchwindowsize=EXPECT_SEARCH_WINDOW)
         except TestError as exc:
             if prompt_wait_count < 6:
                 logger = logging.getLogger('dispatcher')
@@ -18,51 +18,160 @@
 # along
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
+import contextlib
+import errno
+import fcntl
+import hashlib
 import logging
 import os
+import shutil
 import subprocess
+import tempfile
+import time
 
 from lava_dispatcher.pipeline.action import InfrastructureError
+from lava_dispatcher.pipeline.utils.constants import VCS_MIRROR_TTL
 
 
 # pylint: disable=too-few-public-methods
 
 
+class MirrorCache(object):
+    """
+    Local mirrors of remote repositories, shared by all the pipeline jobs
+    on a worker. Each mirror is updated at most once every ttl seconds,
+    or when a job asks for a revision which it does not have yet, so
+    repeated jobs clone their test definitions without using the network.
+    Holding the lock of a mirror means only one job updates it at a time.
+    """
+
+    def __init__(self, path, ttl=VCS_MIRROR_TTL):
+        self.path = path
+        self.ttl = ttl
+        try:
+            os.makedirs(path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def mirror_path(self, kind, url):
+        return os.path.join(self.path, '%s-%s' % (kind, hashlib.sha256(url).hexdigest()))
+
+    @contextlib.contextmanager
+    def locked(self, mirror):
+        with open(mirror + '.lock', 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def is_fresh(self, mirror):
+        try:
+            return time.time() - os.stat(mirror + '.updated').st_mtime < self.ttl
+        except OSError:
+            return False
+
+    @staticmethod
+    def mark_updated(mirror):
+        with open(mirror + '.updated', 'a'):
+            os.utime(mirror + '.updated', None)
+
+    def create(self, mirror, command):
+        """
+        Run command with the path to create the mirror at as last argument.
+        An interrupted run leaves no mirror behind.
+        """
+        tmp_dir = tempfile.mkdtemp(dir=self.path)
+        try:
+            subprocess.check_output(command + [os.path.join(tmp_dir, 'mirror')], stderr=subprocess.STDOUT)
+            os.rename(os.path.join(tmp_dir, 'mirror'), mirror)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.mark_updated(mirror)
+
+
 class VCSHelper(object):
 
-    def __init__(self, url):
+    def __init__(self, url, mirrors=None):
+        """
+        :param mirrors: directory of the worker MirrorCache, None to always
+        clone from url
+        """
         self.url = url
+        self.mirrors = mirrors
 
     def clone(self, dest_path, revision=None):
         raise NotImplementedError
 
+    def open_mirrors(self):
+        """
+        :return: the MirrorCache, None if the repository is not mirrored
+        """
+        # local repositories are cheap to clone already
+        if not self.mirrors or os.path.isdir(self.url):
+            return None
+        try:
+            return MirrorCache(self.mirrors)
+        except OSError as exc:
+            logging.getLogger('dispatcher').debug("Repository mirrors not available: %s" % exc)
+            return None
+
 
 class BzrHelper(VCSHelper):
 
-    def __init__(self, url):
-        super(BzrHelper, self).__init__(url)
+    def __init__(self, url, mirrors=None):
+        super(BzrHelper, self).__init__(url, mirrors)
         self.binary = '/usr/bin/bzr'
 
-    def clone(self, dest_path, revision=None):
-        cwd = os.getcwd()
+    def _update_mirror(self, cache, env):
+        """
+        Create or update the mirror if it is older than the ttl of the cache.
+        :return: the path of the mirror and whether it was just updated
+        """
+        mirror = cache.mirror_path('bzr', self.url)
+        if not os.path.exists(mirror):
+            cache.create(mirror, [self.binary, 'branch', '--no-tree', self.url])
+        elif not cache.is_fresh(mirror):
+            self._pull(cache, mirror, env)
+        else:
+            return mirror, False
+        return mirror, True
+
+    def _pull(self, cache, mirror, env):
+        subprocess.check_output([self.binary, 'pull', '--overwrite', '-d', mirror, self.url],
+                                stderr=subprocess.STDOUT, env=env)
+        cache.mark_updated(mirror)
+
+    def _branch(self, source, dest_path, revision, env):
+        if revision is not None:
+            subprocess.check_output([self.binary, 'branch', '-r', str(revision), source, dest_path],
+                                    stderr=subprocess.STDOUT, env=env)
+            return str(revision)
+        subprocess.check_output([self.binary, 'branch', source, dest_path],
+                                stderr=subprocess.STDOUT, env=env)
+        return subprocess.check_output([self.binary, 'revno', dest_path], env=env).strip()
 
+    def clone(self, dest_path, revision=None):
         env = dict(os.environ)
         env.update({'BZR_HOME': '/dev/null', 'BZR_LOG': '/dev/null'})
 
+        existed = os.path.exists(dest_path)
         try:
-            if revision is not None:
-                subprocess.check_output([self.binary, 'branch', '-r',
-                                         str(revision), self.url,
-                                         dest_path],
-                                        stderr=subprocess.STDOUT, env=env)
-                commit_id = str(revision)
-            else:
-                subprocess.check_output([self.binary, 'branch', self.url,
-                                         dest_path],
-                                        stderr=subprocess.STDOUT, env=env)
-                os.chdir(dest_path)
-                commit_id = subprocess.check_output(['bzr', 'revno'],
-                                                    env=env).strip()
+            cache = self.open_mirrors()
+            if cache is None:
+                return self._branch(self.url, dest_path, revision, env)
+            with cache.locked(cache.mirror_path('bzr', self.url)):
+                mirror, updated = self._update_mirror(cache, env)
+                try:
+                    return self._branch(mirror, dest_path, revision, env)
+                except subprocess.CalledProcessError:
+                    if revision is None or updated or existed:
+                        raise
+                # the revision may be newer than the mirror
+                shutil.rmtree(dest_path, ignore_errors=True)
+                self._pull(cache, mirror, env)
+                return self._branch(mirror, dest_path, revision, env)
 
         except subprocess.CalledProcessError as exc:
             logger = logging.getLogger('dispatcher')
@@ -72,10 +181,6 @@ class BzrHelper(VCSHelper):
                 'output': exc.output.split('\n')})
             raise InfrastructureError("Unable to fetch bzr repository '%s'"
                                       % (self.url))
-        finally:
-            os.chdir(cwd)
-
-        return commit_id
 
 
 class GitHelper(VCSHelper):
@@ -87,28 +192,52 @@ class GitHelper(VCSHelper):
       commit_id = git.clone('destination')
       commit_id = git.clone('destination2, 'hash')
 
+    With mirrors, the clone is made from a bare mirror of the repository
+    on the worker. The objects of the mirror are copied, or hard linked,
+    rather than shared with --reference, as the clone is part of the
+    overlay and has to work on the device without the mirror.
+
     This helper will raise a InfrastructureError for any error encountered.
     """
 
-    def __init__(self, url):
-        super(GitHelper, self).__init__(url)
+    def __init__(self, url, mirrors=None):
+        super(GitHelper, self).__init__(url, mirrors)
         self.binary = '/usr/bin/git'
 
+    def _update_mirror(self, cache, revision):
+        """
+        Create or update the mirror if needed and make sure it holds the revision.
+        :return: the path of the mirror
+        """
+        mirror = cache.mirror_path('git', self.url)
+        if not os.path.exists(mirror):
+            cache.create(mirror, [self.binary, 'clone', '--mirror', self.url])
+        elif not cache.is_fresh(mirror):
+            self._fetch(cache, mirror)
+        elif revision is not None:
+            try:
+                subprocess.check_output([self.binary, '--git-dir', mirror, 'rev-parse', '--verify',
+                                         '%s^{commit}' % revision], stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError:
+                # the revision may be newer than the mirror
+                self._fetch(cache, mirror)
+        return mirror
+
+    def _fetch(self, cache, mirror):
+        subprocess.check_output([self.binary, '--git-dir', mirror, 'fetch', '--prune', '--quiet'],
+                                stderr=subprocess.STDOUT)
+        cache.mark_updated(mirror)
+
     def clone(self, dest_path, revision=None):
         try:
-            subprocess.check_output([self.binary, 'clone', self.url, dest_path],
+            cache = self.open_mirrors()
+            if cache is None:
+                return self._clone(self.url, dest_path, revision)
+            with cache.locked(cache.mirror_path('git', self.url)):
+                mirror = self._update_mirror(cache, revision)
+                commit_id = self._clone(mirror, dest_path, revision)
+            subprocess.check_output([self.binary, '-C', dest_path, 'remote', 'set-url', 'origin', self.url],
                                     stderr=subprocess.STDOUT)
-
-            if revision is not None:
-                subprocess.check_output([self.binary, '--git-dir',
-                                         os.path.join(dest_path, '.git'),
-                                         'checkout', str(revision)],
-                                        stderr=subprocess.STDOUT)
-
-            commit_id = subprocess.check_output([self.binary, '--git-dir',
-                                                 os.path.join(dest_path, '.git'),
-                                                 'log', '-1', '--pretty=%H'],
-                                                stderr=subprocess.STDOUT).strip()
         except subprocess.CalledProcessError as exc:
             logger = logging.getLogger('dispatcher')
             logger.exception({
@@ -120,6 +249,21 @@ class GitHelper(VCSHelper):
 
         return commit_id
 
+    def _clone(self, source, dest_path, revision):
+        """
+        :return: the commit checked out
+        """
+        if revision is None:
+            subprocess.check_output([self.binary, 'clone', source, dest_path],
+                                    stderr=subprocess.STDOUT)
+        else:
+            subprocess.check_output([self.binary, 'clone', '--no-checkout', source, dest_path],
+                                    stderr=subprocess.STDOUT)
+            subprocess.check_output([self.binary, '-C', dest_path, 'checkout', str(revision)],
+                                    stderr=subprocess.STDOUT)
+        return subprocess.check_output([self.binary, '-C', dest_path, 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.STDOUT).strip()
+
 
 class TarHelper(VCSHelper):
     # TODO: implement TarHelper
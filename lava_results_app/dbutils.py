@@ -16,9 +16,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Lava Server.  If not, see <http://www.gnu.org/licenses/>.
 
+import math
+import time
 import yaml
 import logging
 from django.db import transaction
+from django.db.models import Q
 from collections import OrderedDict
 from lava_results_app.models import (
     TestSuite,
@@ -43,9 +46,125 @@ METADATA_MAPPING_DESCRIPTION = {
 }
 
 
-def _test_case(name, suite, result, testset=None, testshell=False):
+# Buffered test cases are written once this many are pending ...
+RESULTS_FLUSH_SIZE = 1000
+# ... or once the oldest has been pending for this many seconds.
+RESULTS_FLUSH_INTERVAL = 1
+
+# ActionData fields set from the counters of a job profile
+PROFILE_FIELDS = [
+    ('duration', 'wall'),
+    ('cpu_time', 'cpu'),
+    ('bytes_downloaded', 'downloaded'),
+    ('bytes_written', 'written'),
+    ('serial_bytes_read', 'serial_read'),
+    ('expect_time', 'expect_time'),
+]
+
+
+class ResultsStore(object):
+    """
+    Writes the results of a single job. The suites and action data of
+    the job are only looked up once and new test cases are
+    buffered, then written with bulk_create when RESULTS_FLUSH_SIZE cases
+    are pending, on tick() once RESULTS_FLUSH_INTERVAL has passed and when
+    the job ends.
+    Test cases linked to an ActionData are written immediately, as the
+    link needs the primary key which bulk_create does not return.
+    """
+
+    def __init__(self, job, flush_size=RESULTS_FLUSH_SIZE, flush_interval=RESULTS_FLUSH_INTERVAL):
+        self.logger = logging.getLogger('dispatcher-master')
+        self.job = job
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.suites = {}
+        self.actions = None
+        self.cases = []
+        self.pending_since = None
+
+    def suite(self, name):
+        if name not in self.suites:
+            suite = TestSuite.objects.get_or_create(name=name, job=self.job)[0]
+            suite.job = self.job
+            self.logger.debug("%s" % suite)
+            self.suites[name] = suite
+        return self.suites[name]
+
+    def action_data(self, level):
+        """
+        :return: the ActionData of the job for the action level, None if there is none
+        """
+        if self.actions is None:
+            # the action data is created when the job starts, read it all at once
+            self.actions = {}
+            for action in ActionData.objects.filter(testdata__testjob=self.job).order_by('id'):
+                self.actions.setdefault(action.action_level, action)
+        level = str(level)
+        if level not in self.actions:
+            action = ActionData.objects.filter(
+                action_level=level, testdata__testjob=self.job).first()
+            if not action:
+                # not cached, the action data may not have been stored yet
+                return None
+            self.actions[level] = action
+        return self.actions[level]
+
+    def add(self, case):
+        self.cases.append(case)
+        if self.pending_since is None:
+            self.pending_since = time.time()
+        if len(self.cases) >= self.flush_size:
+            self.flush()
+
+    def save(self, case, action):
+        """
+        Write a test case linked to the action data immediately.
+        """
+        # keep the test cases in the order of the results
+        self.flush()
+        with transaction.atomic():
+            case.save()
+            action.testcase = case
+            action.save(update_fields=['testcase', 'duration', 'timeout'])
+
+    def save_profile(self, profile):
+        """
+        Store the profile of the actions of the job, see
+        lava_dispatcher.pipeline.utils.profile. The wall time of the
+        profile also sets the duration of actions which had no results.
+        :param profile: list of the counters of each action level
+        """
+        with transaction.atomic():
+            for counters in profile:
+                action = self.action_data(counters.get('level'))
+                if not action:
+                    continue
+                for field, counter in PROFILE_FIELDS:
+                    if counters.get(counter) is not None:
+                        setattr(action, field, counters[counter])
+                action.save(update_fields=[field for field, _ in PROFILE_FIELDS])
+
+    def flush(self):
+        if not self.cases:
+            return
+        cases = self.cases
+        self.cases = []
+        self.pending_since = None
+        TestCase.objects.bulk_create(cases)
+
+    def tick(self):
+        """
+        Flush the test cases once the oldest has been pending for flush_interval.
+        """
+        if self.pending_since is not None and time.time() - self.pending_since >= self.flush_interval:
+            self.flush()
+
+
+def _test_case(store, name, suite, result, testset=None, testshell=False):
     """
     Create a TestCase for the specified name and result
+    :param store: the ResultsStore of the job
     :param name: name of the testcase to create
     :param suite: current TestSuite
     :param result: the result for this TestCase
@@ -55,18 +174,18 @@ def _test_case(name, suite, result, testset=None, testshell=False):
     """
     logger = logging.getLogger('dispatcher-master')
     if testshell:
-        TestCase.objects.create(
+        store.add(TestCase(
             name=name,
             suite=suite,
             result=TestCase.RESULT_MAP[result]
-        ).save()
+        ))
     elif testset:
-        TestCase.objects.create(
+        store.add(TestCase(
             name=name,
             suite=suite,
             test_set=testset,
             result=TestCase.RESULT_MAP[result]
-        ).save()
+        ))
     else:
         try:
             metadata = yaml.dump(result)
@@ -77,34 +196,31 @@ def _test_case(name, suite, result, testset=None, testshell=False):
         match_action = None
         # the action level should exist already
         if 'level' in result and metadata:
-            match_action = ActionData.objects.filter(
-                action_level=str(result['level']),
-                testdata__testjob=suite.job)
+            match_action = store.action_data(result['level'])
             if match_action:
-                match_action = match_action[0]
                 if 'duration' in result:
                     match_action.duration = result['duration']
                 if 'timeout' in result:
                     match_action.timeout = result['timeout']  # duration, positive integer
-        case = TestCase.objects.create(
+        case = TestCase(
             name=name,
             suite=suite,
             test_set=testset,
             metadata=metadata,
             result=TestCase.RESULT_UNKNOWN
         )
-        with transaction.atomic():
-            case.save()
-            if match_action:
-                match_action.testcase = case
-                match_action.save(update_fields=['testcase', 'duration', 'timeout'])
+        if match_action:
+            store.save(case, match_action)
+        else:
+            store.add(case)
 
 
-def _check_for_testset(result_dict, suite):
+def _check_for_testset(store, result_dict, suite):
     """
     Within a lava-test-shell, an OrderedDict indicates the start of a
     TestSet. Handle all results in the OrderedDict as part of that set.
     Handle all other results within the lava-test-shell items without using a TestSet.
+    :param store: the ResultsStore of the job
     :param result_dict: lava-test-shell results
     :param suite: current test suite
     """
@@ -115,21 +231,22 @@ def _check_for_testset(result_dict, suite):
                 name=shell_testcase,
                 suite=suite
             )
-            testset.save()
             for set_casename, set_result in shell_result.items():
-                _test_case(set_casename, suite, set_result, testset=testset)
+                _test_case(store, set_casename, suite, set_result, testset=testset)
         elif shell_testcase == 'level':
             # needs to be stored in the existing testcase, not a new one
             pass
         else:
-            _test_case(shell_testcase, suite, shell_result, testshell=True)
+            _test_case(store, shell_testcase, suite, shell_result, testshell=True)
 
 
-def map_scanned_results(scanned_dict, job):
+def map_scanned_results(scanned_dict, job, store=None):
     """
     Sanity checker on the logged results dictionary
     :param scanned_dict: results logged via the slave
-    :param suite: the current test suite
+    :param job: the TestJob of the results
+    :param store: the ResultsStore of the job, which buffers the test cases.
+        Without a store, the results are written before returning.
     :return: False on error, else True
     """
     logger = logging.getLogger('dispatcher-master')
@@ -140,22 +257,68 @@ def map_scanned_results(scanned_dict, job):
         logger.debug("missing results in %s", scanned_dict.keys())
         return False
     results = scanned_dict['results']
-    if 'testsuite' in results:
-        suite = TestSuite.objects.get_or_create(name=results['testsuite'], job=job)[0]
-        logger.debug("%s" % suite)
-    else:
-        suite = TestSuite.objects.get_or_create(name='lava', job=job)[0]
+    buffered = store is not None
+    if not buffered:
+        store = ResultsStore(job)
+    if type(results.get('profile')) is list:
+        # sent once at the end of jobs with profile: true
+        store.save_profile(results['profile'])
+        return True
+    suite = store.suite(results.get('testsuite', 'lava'))
     for name, result in results.items():
         if name == 'testsuite':
             # already handled
             pass
         elif name == 'testset':
-            _check_for_testset(result, suite)
+            _check_for_testset(store, result, suite)
         else:
-            _test_case(name, suite, result, testshell=(suite.name != 'lava'))
+            _test_case(store, name, suite, result, testshell=(suite.name != 'lava'))
+    if not buffered:
+        store.flush()
     return True
 
 
+def _percentile(values, percent):
+    """
+    Nearest rank percentile of a sorted list.
+    """
+    return values[max(0, int(math.ceil(percent * len(values) / 100.0)) - 1)]
+
+
+def action_profile_ranking(device_type, since):
+    """
+    Rank the action types which ran on devices of a device type by the
+    90th percentile of their duration, slowest first.
+    :param device_type: the DeviceType
+    :param since: only include jobs which started after this time
+    :return: a list of dicts with the action name, the number of runs,
+        the p50, p90 and p99 percentiles of the duration and the median
+        of the other counters of the jobs which were profiled.
+    """
+    fields = [field for field, _ in PROFILE_FIELDS]
+    values = {}
+    for row in ActionData.objects.filter(
+            testdata__testjob__actual_device__device_type=device_type,
+            testdata__testjob__start_time__gte=since,
+            duration__isnull=False).values_list('action_name', *fields).iterator():
+        columns = values.setdefault(row[0], [[] for _ in fields])
+        for column, value in zip(columns, row[1:]):
+            if value is not None:
+                column.append(value)
+    ranking = []
+    for name, columns in values.items():
+        columns = [sorted(column) for column in columns]
+        durations = columns[0]
+        entry = {'name': name, 'count': len(durations)}
+        for percent in [50, 90, 99]:
+            entry['p%d' % percent] = _percentile(durations, percent)
+        for field, column in zip(fields[1:], columns[1:]):
+            entry[field] = _percentile(column, 50) if column else None
+        ranking.append(entry)
+    ranking.sort(key=lambda entry: (-entry['p90'], entry['name']))
+    return ranking
+
+
 def _get_nested_value(data, mapping):
     # get the value from a nested dictionary based on keys given in 'mapping'.
     value = data
@@ -173,51 +336,94 @@ def _get_nested_value(data, mapping):
     return value
 
 
-def build_action(action_data, testdata, submission):
+def _flatten_actions(data):
+    """
+    The actions of the pipeline description, each followed by its internal pipeline.
+    """
+    for action in data:
+        yield action
+        if 'pipeline' in action:
+            for child in _flatten_actions(action['pipeline']):
+                yield child
+
+
+def _action_meta_key(action_data, submission, type_names):
+    """
+    :param type_names: type names already found in the submission, by section
+    :return: the (name, metatype) of the MetaType of the action, None to skip the action
+    """
     # test for a known section
     logger = logging.getLogger('lava_results_app')
     if 'section' not in action_data:
         logger.warn("Invalid action data - missing section")
-        return
+        return None
 
     metatype = MetaType.get_section(action_data['section'])
     if metatype is None:  # 0 is allowed
         logger.debug("Unrecognised metatype in action_data: %s" % action_data['section'])
-        return
+        return None
     # lookup the type from the job definition.
-    type_name = MetaType.get_type_name(action_data['section'], submission)
+    if action_data['section'] not in type_names:
+        type_names[action_data['section']] = MetaType.get_type_name(action_data['section'], submission)
+    type_name = type_names[action_data['section']]
     if not type_name:
         logger.debug(
             "type_name failed for %s metatype %s" % (
                 action_data['section'], MetaType.TYPE_CHOICES[metatype]))
-        return
-    action_meta, created = MetaType.objects.get_or_create(
-        name=type_name, metatype=metatype)
-    if created:
-        action_meta.save()
-    max_retry = None
-    if 'max_retries' in action_data:
-        max_retry = action_data['max_retries']
-
-    action = ActionData.objects.create(
-        action_name=action_data['name'],
-        action_level=action_data['level'],
-        action_summary=action_data['summary'],
-        testdata=testdata,
-        action_description=action_data['description'],
-        meta_type=action_meta,
-        max_retries=max_retry,
-        timeout=int(Timeout.parse(action_data['timeout']))
-    )
-    with transaction.atomic():
-        action.save()
+        return None
+    return type_name, metatype
+
+
+def _meta_types(keys):
+    """
+    Look up the MetaTypes with a single query, creating any which are missing.
+    The MetaTypes are not cached across jobs: a cache in the master would
+    keep rows which an admin deleted or which were rolled back with the
+    transaction that created them, for the cost of one query per job.
+    :param keys: set of (name, metatype)
+    :return: dict of MetaType by (name, metatype)
+    """
+    if not keys:
+        return {}
+    query = Q()
+    for name, metatype in keys:
+        query |= Q(name=name, metatype=metatype)
+    meta_types = {}
+    for meta_type in MetaType.objects.filter(query).order_by('id'):
+        meta_types.setdefault((meta_type.name, meta_type.metatype), meta_type)
+    for name, metatype in keys:
+        if (name, metatype) not in meta_types:
+            meta_types[(name, metatype)] = MetaType.objects.get_or_create(name=name, metatype=metatype)[0]
+    return meta_types
 
 
 def walk_actions(data, testdata, submission):
-    for action in data:
-        build_action(action, testdata, submission)
-        if 'pipeline' in action:
-            walk_actions(action['pipeline'], testdata, submission)
+    """
+    Create the ActionData of every action in the pipeline description
+    with a single bulk insert.
+    :param data: the pipeline of the description
+    :param testdata: the TestData of the job
+    :param submission: the job definition
+    """
+    type_names = {}
+    actions = []
+    for action_data in _flatten_actions(data):
+        meta_key = _action_meta_key(action_data, submission, type_names)
+        if meta_key:
+            actions.append((action_data, meta_key))
+    meta_types = _meta_types(set([key for _, key in actions]))
+    with transaction.atomic():
+        ActionData.objects.bulk_create([
+            ActionData(
+                action_name=action_data['name'],
+                action_level=action_data['level'],
+                action_summary=action_data['summary'],
+                testdata=testdata,
+                action_description=action_data['description'],
+                meta_type=meta_types[key],
+                max_retries=action_data.get('max_retries', None),
+                timeout=int(Timeout.parse(action_data['timeout']))
+            ) for action_data, key in actions])
 
 
 def map_metadata(description, job):
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lava_results_app', '0002_auto_20150825_1926'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='actiondata',
+            name='bytes_downloaded',
+            field=models.BigIntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='actiondata',
+            name='bytes_written',
+            field=models.BigIntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='actiondata',
+            name='cpu_time',
+            field=models.DecimalField(null=True, max_digits=8, decimal_places=2, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='actiondata',
+            name='expect_time',
+            field=models.DecimalField(null=True, max_digits=8, decimal_places=2, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='actiondata',
+            name='serial_bytes_read',
+            field=models.BigIntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
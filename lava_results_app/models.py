@@ -404,6 +404,20 @@ class ActionData(models.Model):
     # only retry actions set a count or max_retries
     count = models.PositiveIntegerField(blank=True, null=True)
     max_retries = models.PositiveIntegerField(blank=True, null=True)
+    # profile of the action, only for jobs with profile: true
+    # see lava_dispatcher.pipeline.utils.profile
+    cpu_time = models.DecimalField(
+        decimal_places=2,
+        max_digits=8,
+        blank=True, null=True)
+    bytes_downloaded = models.BigIntegerField(blank=True, null=True)
+    bytes_written = models.BigIntegerField(blank=True, null=True)
+    serial_bytes_read = models.BigIntegerField(blank=True, null=True)
+    # time blocked in expect, waiting for the device
+    expect_time = models.DecimalField(
+        decimal_places=2,
+        max_digits=8,
+        blank=True, null=True)
 
     def __unicode__(self):
         return _(u"{0} {1} Level {2}, Meta {3}").format(
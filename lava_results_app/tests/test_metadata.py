@@ -2,12 +2,14 @@ import os
 import yaml
 import decimal
 import unittest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from lava_results_app.tests.test_names import TestCaseWithFactory
 from lava_scheduler_app.models import (
     TestJob,
     Device,
 )
-from lava_results_app.dbutils import map_metadata, testcase_export_fields, export_testcase
+from lava_results_app.dbutils import map_metadata, walk_actions, testcase_export_fields, export_testcase
 from lava_results_app.models import ActionData, MetaType, TestData, TestCase, TestSuite
 from lava_dispatcher.pipeline.parser import JobParser
 from lava_dispatcher.pipeline.device import PipelineDevice
@@ -91,3 +93,47 @@ class TestMetaTypes(TestCaseWithFactory):
         action_data.timeout = 300
         action_data.save(update_fields=['timeout'])
         self.assertEqual(action_data.timeout, 300)
+
+    def test_walk_actions(self):
+        user = self.factory.make_user()
+        job = TestJob.from_yaml_and_user(
+            self.factory.make_job_yaml(), user)
+        submission = {'actions': [
+            {'deploy': {'to': 'tmpfs'}},
+            {'boot': {'method': 'qemu'}},
+            {'test': {'definitions': []}}]}
+
+        def description(repeats):
+            # a retry action for each section with nested repeats
+            pipeline = []
+            for index, section in enumerate(['deploy', 'boot', 'test', 'finalize'], 1):
+                pipeline.append({
+                    'name': '%s-retry' % section, 'level': str(index), 'section': section,
+                    'summary': section, 'description': section, 'timeout': {'seconds': 30},
+                    'max_retries': 3, 'pipeline': [{
+                        'name': 'repeat', 'level': '%d.%d' % (index, repeat), 'section': section,
+                        'summary': 'repeat', 'description': 'repeat', 'timeout': {'minutes': 1},
+                        'pipeline': [{
+                            'name': 'command', 'level': '%d.%d.1' % (index, repeat), 'section': section,
+                            'summary': 'command', 'description': 'command', 'timeout': {'seconds': 5}}]}
+                        for repeat in range(1, repeats + 1)]})
+            return pipeline
+
+        testdata = TestData.objects.create(testjob=job)
+        walk_actions(description(1), testdata, submission)
+        # deploy and boot, test and finalize have no type name in the submission
+        self.assertEqual(ActionData.objects.filter(testdata=testdata).count(), 6)
+        self.assertEqual(
+            ActionData.objects.get(testdata=testdata, action_level='2.1.1').meta_type,
+            MetaType.objects.get(name='qemu', metatype=MetaType.BOOT_TYPE))
+        retry = ActionData.objects.get(testdata=testdata, action_level='1')
+        self.assertEqual((retry.max_retries, retry.timeout), (3, 30))
+
+        # the number of queries does not depend on the number of actions
+        with CaptureQueriesContext(connection) as few:
+            walk_actions(description(1), testdata, submission)
+        with CaptureQueriesContext(connection) as many:
+            walk_actions(description(100), testdata, submission)
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(ActionData.objects.filter(testdata=testdata).count(), 6 + 6 + 402)
+        self.assertEqual(MetaType.objects.filter(name__in=['tmpfs', 'qemu']).count(), 2)
@@ -1,13 +1,19 @@
+import datetime
 import os
+import time
 import yaml
 import logging
 from collections import OrderedDict
 from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
 from django.core.validators import URLValidator
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from lava_results_app.models import (
-    TestCase, TestSuite
+    ActionData, MetaType, TestCase, TestData, TestSuite, TestSet
 )
-from lava_results_app.dbutils import map_scanned_results
+from lava_results_app.dbutils import action_profile_ranking, map_scanned_results, ResultsStore
 from lava_scheduler_app.models import (
     TestJob, Device,
     DeviceType, DeviceDictionary,
@@ -328,3 +334,132 @@ results:
                 self.assertTrue(testcase.name.startswith('linux-linaro'))
                 val('http://localhost/%s' % testcase.get_absolute_url())
         self.factory.cleanup()
+
+
+class TestResultsStore(TestCaseWithFactory):
+    """
+    Buffered storage of the results of a job
+    """
+
+    def test_flush_size(self):
+        user = self.factory.make_user()
+        job = TestJob.from_yaml_and_user(
+            self.factory.make_job_yaml(), user)
+        store = ResultsStore(job, flush_size=10)
+        for index in range(25):
+            self.assertTrue(map_scanned_results(
+                scanned_dict={'results': {'testsuite': 'smoke', 'test%d' % index: 'pass'}},
+                job=job, store=store))
+        self.assertEqual(TestCase.objects.filter(suite__job=job).count(), 20)
+        store.flush()
+        self.assertEqual(
+            list(TestCase.objects.filter(suite__job=job).order_by('id').values_list('name', flat=True)),
+            ['test%d' % index for index in range(25)])
+        self.assertEqual(TestSuite.objects.filter(job=job).count(), 1)
+        self.factory.cleanup()
+
+    def test_flush_interval(self):
+        user = self.factory.make_user()
+        job = TestJob.from_yaml_and_user(
+            self.factory.make_job_yaml(), user)
+        store = ResultsStore(job, flush_interval=0.1)
+        map_scanned_results(scanned_dict={'results': {'testsuite': 'smoke', 'ping-test': 'fail'}}, job=job, store=store)
+        store.tick()
+        self.assertEqual(TestCase.objects.filter(suite__job=job).count(), 0)
+        time.sleep(0.1)
+        store.tick()
+        self.assertEqual(TestCase.objects.get(suite__job=job).result, TestCase.RESULT_FAIL)
+        self.factory.cleanup()
+
+    def test_testset(self):
+        user = self.factory.make_user()
+        job = TestJob.from_yaml_and_user(
+            self.factory.make_job_yaml(), user)
+        store = ResultsStore(job)
+        for name in ['linux-linaro-foo', 'linux-linaro-bar']:
+            map_scanned_results(scanned_dict={'results': {
+                'testsuite': 'smoke',
+                'testset': OrderedDict([('set-name', OrderedDict([(name, 'pass')]))])}}, job=job, store=store)
+        store.flush()
+        # one test set for each result, as without a store
+        testsets = TestSet.objects.filter(suite__job=job).order_by('id')
+        self.assertEqual([testset.name for testset in testsets], ['set-name', 'set-name'])
+        self.assertEqual([testset.test_cases.get().name for testset in testsets],
+                         ['linux-linaro-foo', 'linux-linaro-bar'])
+        self.factory.cleanup()
+
+    def test_action_data(self):
+        user = self.factory.make_user()
+        job = TestJob.from_yaml_and_user(
+            self.factory.make_job_yaml(), user)
+        store = ResultsStore(job)
+        self.assertIsNone(store.action_data('1.1'))
+        metatype = MetaType.objects.create(name='fake', metatype=MetaType.DEPLOY_TYPE)
+        testdata = TestData.objects.create(testjob=job)
+        action = ActionData.objects.create(
+            meta_type=metatype, testdata=testdata, action_level='1.1', action_name='download')
+        # a level which was missing is looked up again
+        self.assertEqual(store.action_data('1.1'), action)
+        self.factory.cleanup()
+
+    def test_many_results(self):
+        user = self.factory.make_user()
+        job = TestJob.from_yaml_and_user(
+            self.factory.make_job_yaml(), user)
+        # lava-test-shell logs each test case as a separate result
+        scanned = [{'results': {'testsuite': 'stress', 'test%d' % index: 'pass' if index % 7 else 'fail'}}
+                   for index in range(10000)]
+        store = ResultsStore(job)
+        with CaptureQueriesContext(connection) as queries:
+            for result in scanned:
+                map_scanned_results(scanned_dict=result, job=job, store=store)
+            store.flush()
+        self.assertEqual(TestCase.objects.filter(suite__job=job).count(), 10000)
+        self.assertEqual(TestCase.objects.filter(suite__job=job, result=TestCase.RESULT_FAIL).count(), 1429)
+        # written in batches, not one query per test case
+        self.assertLess(len(queries), 100)
+        self.factory.cleanup()
+
+    def test_profile(self):
+        user = self.factory.make_user()
+        metatype = MetaType.objects.create(name='fake', metatype=MetaType.DEPLOY_TYPE)
+        for index in range(10):
+            job = TestJob.from_yaml_and_user(
+                self.factory.make_job_yaml(), user)
+            job.actual_device = Device.objects.get(hostname='fakeqemu1')
+            job.start_time = timezone.now()
+            job.save()
+            testdata = TestData.objects.create(testjob=job)
+            for level, name in [('1', 'deploy'), ('1.1', 'download'), ('2', 'boot')]:
+                ActionData.objects.create(
+                    meta_type=metatype, testdata=testdata, action_level=level, action_name=name)
+            profile = [
+                {'level': '1', 'name': 'deploy', 'wall': 10.0 + index, 'cpu': 2.5, 'downloaded': 1024,
+                 'written': 4096, 'serial_read': 0, 'expect_time': 0.0, 'runs': 1},
+                {'level': '1.1', 'name': 'download', 'wall': 9.0, 'cpu': 2.0, 'downloaded': 1024,
+                 'written': None, 'serial_read': 0, 'expect_time': 0.0, 'runs': 1},
+                {'level': '2', 'name': 'boot', 'wall': 30.0 + index, 'cpu': 0.5, 'downloaded': 0,
+                 'written': 0, 'serial_read': 2048, 'expect_time': 25.0, 'runs': 1},
+            ]
+            store = ResultsStore(job)
+            self.assertTrue(map_scanned_results(scanned_dict={'results': {'profile': profile}}, job=job, store=store))
+        boot = ActionData.objects.get(testdata__testjob=job, action_level='2')
+        self.assertEqual((float(boot.duration), float(boot.expect_time), boot.serial_bytes_read), (39.0, 25.0, 2048))
+        self.assertIsNone(ActionData.objects.get(testdata__testjob=job, action_level='1.1').bytes_written)
+        self.assertEqual(TestCase.objects.filter(suite__job=job).count(), 0)
+
+        ranking = action_profile_ranking(self.device_type, timezone.now() - datetime.timedelta(days=1))
+        self.assertEqual([entry['name'] for entry in ranking], ['boot', 'deploy', 'download'])
+        self.assertEqual(ranking[0]['count'], 10)
+        self.assertEqual([float(ranking[0][key]) for key in ['p50', 'p90', 'p99']], [34.0, 38.0, 39.0])
+        self.assertEqual(ranking[1]['bytes_written'], 4096)
+        self.assertIsNone(ranking[2]['bytes_written'])
+        self.factory.cleanup()
+
+    def test_profile_hidden_device_type(self):
+        url = reverse('lava.results.action_profile', args=[self.device_type.name])
+        self.device_type.owners_only = True
+        self.device_type.save()
+        # as for the device type page, hidden types are not found
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.factory.cleanup()
@@ -19,7 +19,7 @@
 """
 URL mappings for the LAVA Results application
 """
-from django.conf.urls import *
+from django.conf.urls import url, patterns
 
 
 urlpatterns = patterns(
@@ -42,6 +42,8 @@ urlpatterns = patterns(
     url(r'^query/~(?P<username>[^/]+)/(?P<name>[a-zA-Z0-9-_]+)/\+add-condition$', 'query.views.query_add_condition', name='lava.results.query_add_condition'),
     url(r'^query/~(?P<username>[^/]+)/(?P<name>[a-zA-Z0-9-_]+)/(?P<id>\d+)/\+remove-condition$', 'query.views.query_remove_condition', name='lava.results.query_remove_condition'),
     url(r'^query/~(?P<username>[^/]+)/(?P<name>[a-zA-Z0-9-_]+)/(?P<id>\d+)/\+edit-condition$', 'query.views.query_edit_condition', name='lava.results.query_edit_condition'),
+    url(r'^profile/(?P<device_type>[-_a-zA-Z0-9.]+)$',
+        'action_profile', name='lava.results.action_profile'),
     url(r'^(?P<job>[0-9]+|[0-9]+.[0-9]+)$',
         'testjob', name='lava.results.testjob'),
     url(r'^(?P<job>[0-9]+|[0-9]+.[0-9]+)/csv$',
@@ -21,10 +21,13 @@ Views for the Results application
 Keep to just the response rendering functions
 """
 import csv
+import datetime
 import yaml
 from django.template import RequestContext
+from django.http import Http404
 from django.http.response import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render_to_response
+from django.utils import timezone
 from lava_server.views import index as lava_index
 from lava_server.bread_crumbs import (
     BreadCrumb,
@@ -34,9 +37,10 @@ from django.shortcuts import get_object_or_404
 from lava_results_app.models import TestSuite, TestCase
 from lava_results_app.tables import ResultsTable, SuiteTable
 from lava_results_app.utils import StreamEcho
-from lava_results_app.dbutils import export_testcase, testcase_export_fields
-from lava_scheduler_app.models import TestJob
+from lava_results_app.dbutils import action_profile_ranking, export_testcase, testcase_export_fields
+from lava_scheduler_app.models import DeviceType, TestJob
 from lava_scheduler_app.tables import pklink
+from lava_scheduler_app.views import filter_device_types
 from django_tables2 import RequestConfig
 
 from lava_results_app.models import TestSuite, TestCase
@@ -81,6 +85,30 @@ def query(request):
         }, RequestContext(request))
 
 
+@BreadCrumb("Action profile of {device_type}", parent=index, needs=['device_type'])
+def action_profile(request, device_type):
+    """
+    The action types of the jobs which ran on the device type, slowest first.
+    """
+    device_type = get_object_or_404(DeviceType, pk=device_type)
+    if device_type.owners_only:
+        visible = filter_device_types(request.user)
+        if device_type.name not in visible:
+            raise Http404('No device type matches the given query.')
+    try:
+        days = max(1, int(request.GET.get('days', 7)))
+    except ValueError:
+        days = 7
+    ranking = action_profile_ranking(device_type, timezone.now() - datetime.timedelta(days=days))
+    return render_to_response(
+        "lava_results_app/action_profile.html", {
+            'bread_crumb_trail': BreadCrumbTrail.leading_to(action_profile, device_type=device_type.name),
+            'device_type': device_type,
+            'days': days,
+            'ranking': ranking,
+        }, RequestContext(request))
+
+
 @BreadCrumb("Test job {job}", parent=index, needs=['job'])
 def testjob(request, job):
     job = get_object_or_404(TestJob, pk=job)
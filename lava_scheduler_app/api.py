@@ -1,5 +1,7 @@
+import hashlib
 import os
 import xmlrpclib
+import zlib
 import json
 import yaml
 import jinja2
@@ -27,6 +29,10 @@ from lava_scheduler_app.utils import (
 )
 from lava_scheduler_app.schema import validate_submission, validate_device
 
+# Bytes of output returned by job_output_chunk, by default and at most
+JOB_OUTPUT_CHUNK_SIZE = 1024 * 1024
+JOB_OUTPUT_MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
 
 class SchedulerAPI(ExposedAPI):
 
@@ -248,13 +254,127 @@ class SchedulerAPI(ExposedAPI):
         except TestJob.DoesNotExist:
             raise xmlrpclib.Fault(404, "Specified job not found.")
 
-        output_file = job.output_file()
-        if output_file:
-            output_file.seek(offset)
-            return xmlrpclib.Binary(output_file.read().encode('UTF-8'))
+        log = job.output_log()
+        if log:
+            with log:
+                content = log.read(offset)
+            return xmlrpclib.Binary(content.decode('utf-8', 'replace').encode('UTF-8'))
         else:
             raise xmlrpclib.Fault(404, "Job output not found.")
 
+    def job_output_chunk(self, job_id, offset=0, size=JOB_OUTPUT_CHUNK_SIZE, compress=False, etag=None):
+        """
+        Name
+        ----
+        `job_output_chunk` (`job_id`, `offset=0`, `size=1048576`, `compress=False`, `etag=None`)
+
+        Description
+        -----------
+        Get part of the output of given job id. Unlike job_output, only
+        the requested part of the output is read, so the output of a running
+        job can be followed, or a large output downloaded, a chunk at a time.
+
+        Arguments
+        ---------
+        `job_id`: string
+            Job id for which the output is required.
+        `offset`: integer
+            Offset from which to start reading the output file specified in bytes.
+            It defaults to 0.
+        `size`: integer
+            Maximum number of bytes of output to return, at most 16MB.
+            It defaults to 1MB.
+        `compress`: boolean
+            Compress the data with zlib.
+        `etag`: string
+            The etag of a previous call with the same arguments. If the output
+            and the job status did not change since that call, no data is
+            returned and modified is False.
+
+        Return value
+        ------------
+        This function returns an XML-RPC structure with the following fields,
+        provided the user is authenticated with an username and token.
+
+        `data`: binary
+        The output, as bytes, compressed if requested.
+
+        `compressed`: boolean
+        True if the data is compressed with zlib.
+
+        `offset`: integer
+        The offset from which to read the next chunk.
+
+        `size`: integer
+        The size of the output so far.
+
+        `finished`: boolean
+        True if the job has finished and the whole output has been read.
+
+        `etag`: string
+        Identifies this chunk of the output, see the etag argument.
+
+        `modified`: boolean
+        False if the etag argument matches the etag of this chunk.
+
+        Example
+        -------
+        offset = 0
+        while True:
+            chunk = server.scheduler.job_output_chunk(job_id, offset, 1048576, True)
+            sys.stdout.write(zlib.decompress(chunk['data'].data))
+            offset = chunk['offset']
+            if chunk['finished']:
+                break
+            if offset == chunk['size']:
+                time.sleep(5)
+        """
+        self._authenticate()
+        if not job_id:
+            raise xmlrpclib.Fault(400, "Bad request: TestJob id was not "
+                                  "specified.")
+        if offset < 0 or size <= 0:
+            raise xmlrpclib.Fault(400, "Bad request: invalid offset or size.")
+        try:
+            job = get_restricted_job(self.user, job_id)
+        except PermissionDenied:
+            raise xmlrpclib.Fault(
+                401, "Permission denied for user to job %s" % job_id)
+        except TestJob.DoesNotExist:
+            raise xmlrpclib.Fault(404, "Specified job not found.")
+
+        ended = job.status in [TestJob.COMPLETE, TestJob.INCOMPLETE, TestJob.CANCELED]
+        size = min(size, JOB_OUTPUT_MAX_CHUNK_SIZE)
+        log = job.output_log()
+        if log is None and ended:
+            raise xmlrpclib.Fault(404, "Job output not found.")
+        # the output of a job which has not started yet is empty
+        total = 0
+        data = ''
+        try:
+            if log:
+                total = log.size()
+            next_offset = max(offset, min(offset + size, total))
+            current = hashlib.sha1('%s:%d:%d:%d:%d:%d' % (
+                job.id, job.status, total, offset, size, bool(compress))).hexdigest()
+            modified = current != etag
+            if log and modified:
+                data = log.read(offset, next_offset - offset)
+        finally:
+            if log:
+                log.close()
+        if compress:
+            data = zlib.compress(data)
+        return {
+            'data': xmlrpclib.Binary(data),
+            'compressed': bool(compress),
+            'offset': next_offset,
+            'size': total,
+            'finished': ended and next_offset >= total,
+            'etag': current,
+            'modified': modified,
+        }
+
     def all_devices(self):
         """
         Name
@@ -1,4 +1,8 @@
+import errno
+import json
+import os
 import re
+import tempfile
 
 
 def getDispatcherErrors(logfile):
@@ -101,3 +105,157 @@ def formatLogFile(logfile):
     sections.close()
 
     return sections.sections
+
+
+# The section index of a log is kept next to the log with this suffix
+SECTIONS_SUFFIX = '.sections'
+TRACEBACK_START = 'Traceback (most recent call last):\n'
+ERROR_TYPES = [
+    "Infrastructure Error:",
+    "Bootloader Error:",
+    "Kernel Error:",
+    "Userspace Error:",
+    "Test Shell Error:",
+    "Master Image Error:",
+    "OperationFailed:",
+]
+
+
+class SectionIndex(object):
+    """
+    The sections of formatLogFile and the errors of getDispatcherErrors,
+    with the byte range of each section instead of its content, so that
+    only the sections which are shown need to be read from the log.
+    The index is stored next to the log and extended as the log grows.
+    """
+    VERSION = 1
+
+    def __init__(self):
+        # size of the log covered by the index, up to the last complete line
+        self.size = 0
+        # [type, number of lines, start offset, end offset]
+        self.sections = []
+        # the type of the last section if more lines can be added to it
+        self.current = None
+        self.errors = []
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        try:
+            with open(path + SECTIONS_SUFFIX) as data:
+                content = json.load(data)
+        except (IOError, ValueError):
+            return index
+        if content.get('version') == cls.VERSION:
+            index.size = content['size']
+            index.sections = content['sections']
+            index.current = content['current']
+            index.errors = content['errors']
+        return index
+
+    def save(self, path):
+        try:
+            handle, tmp_name = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.sections')
+            with os.fdopen(handle, 'w') as data:
+                json.dump({
+                    'version': self.VERSION, 'size': self.size, 'sections': self.sections,
+                    'current': self.current, 'errors': self.errors}, data)
+            os.rename(tmp_name, path + SECTIONS_SUFFIX)
+        except (IOError, OSError) as exc:
+            # the index is only a cache
+            if exc.errno not in [errno.EACCES, errno.EPERM, errno.EROFS]:
+                raise
+
+    def _push(self, sect_type, start, end):
+        if sect_type != self.current:
+            self.sections.append([sect_type, 0, start, start])
+            self.current = sect_type
+        self.sections[-1][1] += 1
+        self.sections[-1][3] = end
+
+    def update(self, log):
+        """
+        Index the lines added to the log since the last update.
+        :param log: the JobLog of the log
+        :return: True if the index has changed
+        """
+        data = log.read(self.size)
+        data = data[:data.rfind('\n') + 1]
+        if not data:
+            return False
+        offset = self.size
+        for line in data.split('\n')[:-1]:
+            line += '\n'
+            start = offset
+            offset += len(line)
+            for error in ERROR_TYPES:
+                index = line.find(error)
+                if index != -1:
+                    message = line[index:].decode('utf-8', 'replace')
+                    if message not in self.errors:
+                        self.errors.append(message)
+            line = line.replace('\r', '')
+            if line == TRACEBACK_START:
+                self._push('traceback', start, offset)
+            elif self.current == 'traceback':
+                self._push('traceback', start, offset)
+                if not line.startswith(' '):
+                    self.current = None
+            elif line.find("<LAVA_DISPATCHER>") != -1 \
+                    or line.find("lava_dispatcher") != -1 \
+                    or line.find("CriticalError:") != -1:
+                self._push('log', start, offset)
+            else:
+                self._push('console', start, offset)
+        self.size = offset
+        return True
+
+    def visible(self, start=0, size_limit=None):
+        """
+        :param start: offset in the log from which sections are shown
+        :param size_limit: only the sections in this many bytes at the end are shown
+        :return: list of [type, number of lines, start offset, end offset],
+            the first section may be truncated
+        """
+        if size_limit is not None:
+            start = max(start, self.size - size_limit)
+        sections = []
+        for section in self.sections:
+            if section[3] > start:
+                sections.append(list(section))
+        if sections and sections[0][2] < start:
+            # the number of lines is only known once the section is read
+            sections[0][1:3] = [None, start]
+        return sections
+
+
+def section_index(log):
+    """
+    :param log: the JobLog of the job
+    :return: the SectionIndex of the log, updated to the current end of the log
+    """
+    index = SectionIndex.load(log.path)
+    if index.update(log):
+        index.save(log.path)
+    return index
+
+
+def read_sections(log, sections):
+    """
+    Read the content of the sections, as formatLogFile would return them.
+    :param log: the JobLog of the job
+    :param sections: the sections from SectionIndex.visible
+    """
+    content = []
+    for sect_type, lines, start, end in sections:
+        data = log.read(start, end - start)
+        if lines is None:
+            # skip to the first complete line of a truncated section
+            if start and log.read(start - 1, 1) != '\n':
+                data = data[data.find('\n') + 1:]
+            lines = data.count('\n')
+            if not lines:
+                continue
+        content.append((sect_type, lines, data.replace('\r', '').decode('utf-8', 'replace')))
+    return content
@@ -0,0 +1,401 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Scheduler.
+#
+# LAVA Scheduler is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3 as
+# published by the Free Software Foundation
+#
+# LAVA Scheduler is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Log ingest for the dispatcher-master.
+
+The master drains batches of log messages from its PULL socket and hands
+them to a LogWriter thread, so that handling of the command socket is not
+held up behind file I/O. The LogWriter buffers the pipeline logs and
+output.txt of each job, with the line index of output.txt, keeping a
+bounded number of files open, and passes results on to a ResultsWriter
+thread which owns the database work.
+"""
+
+import errno
+import logging
+import os
+import Queue
+import threading
+import time
+import yaml
+from collections import OrderedDict
+
+from django.db import connection
+
+from lava_dispatcher.pipeline.log import RESULTS_FRAME, TARGET_BATCH_FRAME
+from lava_scheduler_app.logstore import INDEX_SUFFIX, pack_line_ends, recover_index
+
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
+
+# Flush buffered log data once this many bytes are pending ...
+FLUSH_SIZE = 64 * 1024
+# ... or once this many seconds have passed since the last flush.
+FLUSH_INTERVAL = 1
+# Maximum number of log files kept open at the same time
+MAX_OPEN_FILES = 256
+# Close files which have not been written for this many seconds
+FD_TIMEOUT = 60
+# Maximum number of batches waiting for the LogWriter, and of results
+# waiting for the ResultsWriter
+QUEUE_SIZE = 1024
+# Seconds a job which sent END waits for its results to be stored
+END_TIMEOUT = 30
+
+# Older dispatchers do not send the results frame, YAMLLogger dumps
+# results as a list of one dict so the message starts with this prefix.
+RESULTS_PREFIX = '- results:'
+
+# pylint: disable=too-few-public-methods
+
+
+def _mkdir(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
+
+
+class ResultsLoader(_SafeLoader):  # pylint: disable=too-many-ancestors
+    """
+    Safe loader, using libyaml where available, which also understands the
+    python tags which yaml.dump in the dispatcher emits for results.
+    """
+    pass
+
+
+def _construct_ordered_dict(loader, node):
+    return OrderedDict(*loader.construct_sequence(node, deep=True))
+
+
+ResultsLoader.add_constructor(
+    u'tag:yaml.org,2002:python/object/apply:collections.OrderedDict', _construct_ordered_dict)
+ResultsLoader.add_constructor(
+    u'tag:yaml.org,2002:python/unicode', lambda loader, node: loader.construct_scalar(node))
+ResultsLoader.add_constructor(
+    u'tag:yaml.org,2002:python/str', lambda loader, node: str(loader.construct_scalar(node)))
+
+
+def parse_results(message, frame=None):
+    """
+    Only messages tagged with the results frame, or which look like results
+    from an older dispatcher, are parsed.
+    :param message: the YAML log message
+    :param frame: the optional fifth frame of the message
+    :return: the results dict or None if the message has no results
+    """
+    if frame != RESULTS_FRAME and not message.startswith(RESULTS_PREFIX):
+        return None
+    try:
+        scanned = yaml.load(message, Loader=ResultsLoader)
+    except yaml.YAMLError:
+        # results with other python objects need the full loader, this is rare.
+        try:
+            scanned = yaml.load(message, Loader=yaml.Loader)
+        except yaml.YAMLError:
+            return None
+    # the results logger wraps the OrderedDict in a dict called results, for identification,
+    # YAML then puts that into a list of one item for each call to log.results.
+    if type(scanned) is list and len(scanned) == 1:
+        if type(scanned[0]) is dict and 'results' in scanned[0]:
+            return scanned[0]
+    return None
+
+
+class LogFiles(object):
+    """
+    Buffered appends to a bounded LRU of open files.
+    """
+
+    def __init__(self, max_open=MAX_OPEN_FILES, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.max_open = max_open
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        # path: (file object, last usage), least recently used first
+        self.files = OrderedDict()
+        self.buffers = {}
+        self.pending = 0
+        self.last_flush = time.time()
+
+    def write(self, path, data):
+        self.buffers.setdefault(path, []).append(data)
+        self.pending += len(data)
+        if self.pending >= self.flush_size:
+            self.flush()
+
+    def _open(self, path):
+        now = time.time()
+        if path in self.files:
+            fd = self.files.pop(path)[0]  # pylint: disable=invalid-name
+        else:
+            _mkdir(os.path.dirname(path))
+            fd = open(path, 'a+')  # pylint: disable=invalid-name
+            while len(self.files) >= self.max_open:
+                self.files.popitem(last=False)[1][0].close()
+        self.files[path] = (fd, now)
+        return fd
+
+    def flush(self):
+        for path, chunks in self.buffers.items():
+            fd = self._open(path)  # pylint: disable=invalid-name
+            fd.write(''.join(chunks))
+            fd.flush()
+        self.buffers = {}
+        self.pending = 0
+        self.last_flush = time.time()
+
+    def tick(self):
+        """
+        Flush on the time threshold and close files which are no longer used.
+        """
+        now = time.time()
+        if self.buffers and now - self.last_flush > self.flush_interval:
+            self.flush()
+        while self.files:
+            path, (fd, last_usage) = next(self.files.iteritems())  # pylint: disable=invalid-name
+            if now - last_usage <= FD_TIMEOUT:
+                break
+            fd.close()
+            del self.files[path]
+
+    def close(self, prefix=''):
+        """
+        Flush then close the files under the prefix, all files by default.
+        """
+        self.flush()
+        for path in [path for path in self.files if path.startswith(prefix)]:
+            self.files.pop(path)[0].close()
+
+
+class ResultsWriter(threading.Thread):
+    """
+    Stores the results found in the log stream, using its own database connection.
+    Each running job has a ResultsStore which buffers its test cases until
+    enough are pending, some time has passed or the job ends. Results which
+    arrive after the end of the job are written at once.
+    The queue is bounded so that a slow database holds up the LogWriter
+    thread, and in turn the reading of the log socket, instead of growing
+    the memory of the master.
+    """
+
+    def __init__(self):
+        super(ResultsWriter, self).__init__(name='results-writer')
+        self.daemon = True
+        self.logger = logging.getLogger('dispatcher-master')
+        self.queue = Queue.Queue(QUEUE_SIZE)
+        # job_id: ResultsStore
+        self.stores = {}
+        # the jobs which have ended, oldest first: job_id: None
+        self.finished = OrderedDict()
+
+    def put(self, job_id, scanned):
+        self.queue.put(('RESULTS', str(job_id), scanned))
+
+    def job_finished(self, job_id, done=None):
+        """
+        Store the pending results of the job and forget about it.
+        :param done: optional threading.Event, set once the results are stored
+        """
+        self.queue.put(('END', str(job_id), done))
+
+    def _new_store(self, job_id):
+        # imported here so that the models are only loaded in the master
+        from lava_scheduler_app.models import TestJob
+        from lava_results_app.dbutils import ResultsStore
+        return ResultsStore(TestJob.objects.get(id=job_id))
+
+    def _store(self, job_id):
+        """
+        :return: the ResultsStore of the job, None once the job has ended
+        """
+        if job_id in self.finished:
+            return None
+        if job_id not in self.stores:
+            self.stores[job_id] = self._new_store(job_id)
+        return self.stores[job_id]
+
+    def _map_results(self, job_id, scanned, store):
+        from lava_scheduler_app.models import TestJob
+        from lava_results_app.dbutils import map_scanned_results
+        # without a store, the results are written before returning
+        job = store.job if store is not None else TestJob.objects.get(id=job_id)
+        return map_scanned_results(scanned_dict=scanned, job=job, store=store)
+
+    def _flush(self, job_id, method='flush'):
+        try:
+            getattr(self.stores[job_id], method)()
+        except Exception as exc:  # pylint: disable=broad-except
+            # the buffered test cases are lost but the master keeps going.
+            self.logger.exception("[%s] Failed to store results: %s", job_id, exc)
+            self.stores[job_id].cases = []
+
+    def _add(self, job_id, scanned):
+        try:
+            if not self._map_results(job_id, scanned, self._store(job_id)):
+                self.logger.warning("[%s] Unable to map scanned results: %s" % (job_id, yaml.dump(scanned)))
+        except Exception as exc:  # pylint: disable=broad-except
+            # do not let a bad result stop the master.
+            self.logger.exception("[%s] Failed to store results: %s", job_id, exc)
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=FLUSH_INTERVAL)
+                except Queue.Empty:
+                    item = ('TICK', None, None)
+                if item is None:
+                    break
+                action, job_id, data = item
+                if action == 'RESULTS':
+                    self._add(job_id, data)
+                elif action == 'END':
+                    if job_id in self.stores:
+                        self._flush(job_id)
+                        del self.stores[job_id]
+                    # late results are only expected shortly after the end
+                    self.finished[job_id] = None
+                    while len(self.finished) > QUEUE_SIZE:
+                        self.finished.popitem(last=False)
+                    if data:
+                        data.set()
+                for pending in self.stores.keys():
+                    self._flush(pending, 'tick')
+            for pending in self.stores.keys():
+                self._flush(pending)
+        finally:
+            connection.close()
+
+
+class LogWriter(threading.Thread):
+    """
+    Writes batches of (job_id, level, name, message) log messages to the
+    pipeline logs and output.txt of each job and forwards any results.
+    A message can also be a batch of console output from the dispatcher,
+    tagged with TARGET_BATCH_FRAME, which is written in the same way.
+    """
+
+    def __init__(self, output_dir):
+        super(LogWriter, self).__init__(name='log-writer')
+        self.daemon = True
+        self.logger = logging.getLogger('dispatcher-master')
+        self.output_dir = output_dir
+        self.queue = Queue.Queue()
+        self.files = LogFiles()
+        self.results = ResultsWriter()
+        self.jobs = set()
+        # job_id: size of output.txt, including the buffered data
+        self.sizes = {}
+
+    def full(self):
+        """
+        The master stops reading the log socket while QUEUE_SIZE batches are
+        waiting, so that the dispatchers wait to send instead of the master
+        growing. The queue itself is not bounded, the master loop never
+        waits for the LogWriter.
+        """
+        return self.queue.qsize() >= QUEUE_SIZE
+
+    def put(self, batch):
+        """
+        Called from the master loop with a list of multipart messages.
+        """
+        self.queue.put_nowait(('LOG', batch))
+
+    def job_finished(self, job_id):
+        """
+        Called from the master loop on END, flushes and closes the files of the job
+        and stores its pending results.
+        :return: threading.Event set once the results of the job are stored, the
+        master checks it before ending the job so that the job does not end
+        with results missing.
+        """
+        done = threading.Event()
+        self.queue.put_nowait(('END', (job_id, done)))
+        return done
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+        self.results.queue.put(None)
+        self.results.join()
+
+    def start(self):
+        self.results.start()
+        super(LogWriter, self).start()
+
+    def write(self, msg):
+        # dispatchers send four frames, or five with the optional frame
+        frame = msg[4] if len(msg) == 5 else None
+        try:
+            (job_id, level, name, message) = msg[:4] if len(msg) == 5 else msg
+        except ValueError:
+            # do not let a bad message stop the master.
+            self.logger.error("Failed to parse log message, skipping: %s", msg)
+            return
+        # batches of console output are already formatted, one line per entry
+        scanned = parse_results(message, frame) if frame != TARGET_BATCH_FRAME else None
+        if scanned:
+            self.results.put(job_id, scanned)
+
+        # Clear filename
+        if '/' in level or '/' in name:
+            self.logger.error("[%s] Wrong level or name received, dropping the message", job_id)
+            return
+        job_dir = os.path.join(self.output_dir, "job-%s" % job_id)
+        output = os.path.join(job_dir, 'output.txt')
+        if job_id not in self.jobs:
+            self.logger.info("[%s] Receiving logs from a new job", job_id)
+            self.jobs.add(job_id)
+            self.sizes[job_id] = recover_index(output)
+        # n.b. logging here would produce a log entry for every message in every job.
+        self.files.write(
+            os.path.join(job_dir, 'pipeline', level.split('.')[0], '%s-%s.log' % (level, name)),
+            message + '\n')
+        # FIXME: to be removed when the web UI knows how to deal with
+        # pipeline logs
+        self.files.write(output, message + '\n')
+        # the line index of output.txt, see logstore
+        self.files.write(output + INDEX_SUFFIX, pack_line_ends(message + '\n', self.sizes[job_id]))
+        self.sizes[job_id] += len(message) + 1
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=FLUSH_INTERVAL)
+            except Queue.Empty:
+                item = ('TICK', None)
+            if item is None:
+                break
+            action, data = item
+            if action == 'LOG':
+                for msg in data:
+                    self.write(msg)
+            elif action == 'END':
+                job_id, done = data
+                self.files.close(os.path.join(self.output_dir, "job-%s" % job_id, ''))
+                self.results.job_finished(job_id, done)
+                self.jobs.discard(str(job_id))
+                self.sizes.pop(str(job_id), None)
+            self.files.tick()
+        self.files.close()
@@ -0,0 +1,337 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Scheduler.
+#
+# LAVA Scheduler is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3 as
+# published by the Free Software Foundation
+#
+# LAVA Scheduler is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Storage of the output.txt log of a job.
+
+While the job runs, the log is written uncompressed along with an index,
+<log>.idx, holding the byte offset of the end of each line as a little
+endian unsigned 64 bit integer.
+
+Once the job has finished, the log can be compressed into <log>.gz as a
+series of gzip members of about CHUNK_SIZE bytes, each ending on a line
+boundary, with a table of the members in <log>.gz.idx. The result is
+still a valid gzip file, and any range of bytes or lines can be read by
+decompressing only the members which hold it.
+"""
+
+import bisect
+import codecs
+import errno
+import gzip
+import os
+import struct
+import zlib
+
+INDEX_SUFFIX = '.idx'
+COMPRESSED_SUFFIX = '.gz'
+
+# Uncompressed size of each gzip member of a compressed log
+CHUNK_SIZE = 256 * 1024
+
+# End of a line in the index of an uncompressed log
+LINE_END = struct.Struct('<Q')
+# A member of a compressed log: first line, offset, offset in the compressed
+# log. The last record holds the number of lines and both sizes.
+CHUNK = struct.Struct('<QQQ')
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def line_ends(data, offset):
+    """
+    :param data: data appended to the log
+    :param offset: size of the log before data was appended
+    :return: the offsets of the ends of the lines in data
+    """
+    ends = []
+    index = data.find('\n')
+    while index != -1:
+        ends.append(offset + index + 1)
+        index = data.find('\n', index + 1)
+    return ends
+
+
+def pack_line_ends(data, offset):
+    """
+    :return: the entries to append to the index when data is appended to the log
+    """
+    ends = line_ends(data, offset)
+    return struct.pack('<%dQ' % len(ends), *ends)
+
+
+def _split_lines(data):
+    """
+    Split on line feeds only, unlike str.splitlines.
+    """
+    parts = data.split('\n')
+    lines = [part + '\n' for part in parts[:-1]]
+    if parts[-1]:
+        lines.append(parts[-1])
+    return lines
+
+
+def _scan(log, start, end):
+    """
+    :return: the offsets of the ends of the lines of log between start and end
+    """
+    log.seek(start)
+    ends = []
+    while start < end:
+        data = log.read(min(CHUNK_SIZE, end - start))
+        if not data:
+            break
+        ends.extend(line_ends(data, start))
+        start += len(data)
+    return ends
+
+
+def _last_entry(index, size):
+    """
+    Skip the index entries which point beyond the end of the log, the
+    index can be flushed before the log.
+    :return: the number of valid entries and the last valid entry
+    """
+    index.seek(0, os.SEEK_END)
+    count = index.tell() // LINE_END.size
+    while count:
+        index.seek((count - 1) * LINE_END.size)
+        last = LINE_END.unpack(index.read(LINE_END.size))[0]
+        if last <= size:
+            return count, last
+        count -= 1
+    return 0, 0
+
+
+def recover_index(path):
+    """
+    Bring the index of the log up to date before appending to the log,
+    for logs written before a restart of the master or without an index.
+    :param path: path of the uncompressed log
+    :return: the size of the log
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+    with open(path + INDEX_SUFFIX, 'a+b') as index:
+        count, last = _last_entry(index, size)
+        index.truncate(count * LINE_END.size)
+        with open(path, 'rb') as log:
+            ends = _scan(log, last, size)
+        index.write(struct.pack('<%dQ' % len(ends), *ends))
+    return size
+
+
+def compress_log(path, chunk_size=CHUNK_SIZE, compresslevel=6):
+    """
+    Replace the uncompressed log and its index with a compressed log.
+    :param path: path of the uncompressed log
+    :return: the uncompressed and compressed sizes, None if there is no uncompressed log
+    """
+    compressed_path = path + COMPRESSED_SUFFIX
+    chunks = []
+    try:
+        log = open(path, 'rb')
+    except IOError as exc:
+        if exc.errno == errno.ENOENT:
+            return None
+        raise
+    with log:
+        with open(compressed_path + '.tmp', 'wb') as compressed:
+            lines = 0
+            offset = 0
+            while True:
+                data = log.read(chunk_size)
+                if not data:
+                    break
+                # each member ends on a line boundary
+                if not data.endswith('\n'):
+                    data += log.readline()
+                chunks.append((lines, offset, compressed.tell()))
+                member = gzip.GzipFile(
+                    filename='', mode='wb', compresslevel=compresslevel, fileobj=compressed, mtime=0)
+                member.write(data)
+                member.close()
+                lines += data.count('\n')
+                offset += len(data)
+            chunks.append((lines, offset, compressed.tell()))
+    with open(compressed_path + INDEX_SUFFIX + '.tmp', 'wb') as table:
+        for chunk in chunks:
+            table.write(CHUNK.pack(*chunk))
+    # readers use the uncompressed log while it exists
+    os.rename(compressed_path + INDEX_SUFFIX + '.tmp', compressed_path + INDEX_SUFFIX)
+    os.rename(compressed_path + '.tmp', compressed_path)
+    _remove(path)
+    _remove(path + INDEX_SUFFIX)
+    return chunks[-1][1], chunks[-1][2]
+
+
+class JobLog(object):
+    """
+    Reads ranges of bytes or lines of a log, compressed or not, without
+    reading the rest of the log.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the uncompressed log, which may have been compressed since
+        """
+        self.path = path
+        self.compressed = False
+        self._chunks = None
+        self._index = None
+        self._indexed = 0
+        self._tail = None
+        try:
+            self._file = open(path, 'rb')
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            self.compressed = True
+            self._file = open(path + COMPRESSED_SUFFIX, 'rb')
+            with open(path + COMPRESSED_SUFFIX + INDEX_SUFFIX, 'rb') as table:
+                data = table.read()
+            self._chunks = [CHUNK.unpack_from(data, offset) for offset in range(0, len(data), CHUNK.size)]
+
+    @classmethod
+    def find(cls, path):
+        """
+        :return: the JobLog of the log at path, None if there is no such log
+        """
+        try:
+            return cls(path)
+        except IOError as exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+
+    def close(self):
+        self._file.close()
+        if self._index:
+            self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open_text(self):
+        """
+        :return: the whole log as a stream of unicode lines
+        """
+        if self.compressed:
+            return codecs.getreader('utf-8')(gzip.GzipFile(self.path + COMPRESSED_SUFFIX, 'rb'), errors='replace')
+        return codecs.open(self.path, encoding='utf-8', errors='replace')
+
+    def size(self):
+        if self.compressed:
+            return self._chunks[-1][1]
+        return os.fstat(self._file.fileno()).st_size
+
+    def _member(self, number):
+        start, end = self._chunks[number][2], self._chunks[number + 1][2]
+        self._file.seek(start)
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(self._file.read(end - start))
+
+    def read(self, offset=0, size=None):
+        """
+        :param offset: offset of the first byte to read
+        :param size: number of bytes to read, up to the end of the log by default
+        """
+        end = self.size() if size is None else min(offset + size, self.size())
+        if offset >= end:
+            return ''
+        if not self.compressed:
+            self._file.seek(offset)
+            return self._file.read(end - offset)
+        offsets = [chunk[1] for chunk in self._chunks]
+        number = bisect.bisect_right(offsets, offset) - 1
+        data = []
+        start = offsets[number]
+        while offsets[number] < end:
+            data.append(self._member(number))
+            number += 1
+        return ''.join(data)[offset - start:end - start]
+
+    def _load_index(self):
+        """
+        The index can lag behind the log being written, or be missing for
+        logs written by older versions, the remaining lines are scanned.
+        """
+        if self._tail is not None:
+            return
+        size = self.size()
+        try:
+            self._index = open(self.path + INDEX_SUFFIX, 'rb')
+            count, last = _last_entry(self._index, size)
+        except IOError:
+            count, last = 0, 0
+        self._indexed = count
+        self._tail = _scan(self._file, last, size)
+
+    def line_count(self):
+        """
+        :return: number of complete lines in the log
+        """
+        if self.compressed:
+            return self._chunks[-1][0]
+        self._load_index()
+        return self._indexed + len(self._tail)
+
+    def _line_end(self, number):
+        if number < 0:
+            return 0
+        if number >= self._indexed:
+            return self._tail[number - self._indexed]
+        self._index.seek(number * LINE_END.size)
+        return LINE_END.unpack(self._index.read(LINE_END.size))[0]
+
+    def lines(self, start, end=None):
+        """
+        :param start: number of the first line, from 0
+        :param end: number of the line after the last line, the end of the log by default
+        :return: the lines, with their line breaks
+        """
+        count = self.line_count()
+        end = count if end is None else min(end, count)
+        if start >= end:
+            return ''
+        if not self.compressed:
+            offset = self._line_end(start - 1)
+            return self.read(offset, self._line_end(end - 1) - offset)
+        first_lines = [chunk[0] for chunk in self._chunks[:-1]]
+        number = bisect.bisect_right(first_lines, start) - 1
+        lines = []
+        first = first_lines[number]
+        while number < len(first_lines) and first_lines[number] < end:
+            lines.extend(_split_lines(self._member(number)))
+            number += 1
+        return ''.join(lines[start - first:end - first])
+
+    def tail(self, count):
+        """
+        :return: the last count lines of the log
+        """
+        total = self.line_count()
+        return self.lines(max(0, total - count), total)
@@ -0,0 +1,45 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Scheduler.
+#
+# LAVA Scheduler is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3 as
+# published by the Free Software Foundation
+#
+# LAVA Scheduler is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from lava_scheduler_app.models import DailyJobReport
+
+
+class Command(BaseCommand):
+    """
+    Build the DailyJobReport rollups of the reports pages from the jobs,
+    after upgrading or to repair them. Jobs saved afterwards update their
+    own report.
+    """
+    help = "Build the daily job reports from existing jobs"
+    option_list = BaseCommand.option_list + (
+        make_option('--days',
+                    type='int',
+                    default=None,
+                    help="Only rebuild the reports of the last DAYS days, all of them by default"),
+    )
+
+    def handle(self, *args, **options):
+        since = None
+        if options['days']:
+            since = DailyJobReport.day_of(timezone.now()) - datetime.timedelta(days=options['days'] - 1)
+        count = DailyJobReport.rebuild(since)
+        self.stdout.write("Built %d daily job reports" % count)
@@ -0,0 +1,69 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Scheduler.
+#
+# LAVA Scheduler is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3 as
+# published by the Free Software Foundation
+#
+# LAVA Scheduler is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import os
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from lava_scheduler_app.logfile_helper import section_index
+from lava_scheduler_app.logstore import JobLog, compress_log
+from lava_scheduler_app.models import TestJob
+
+
+class Command(BaseCommand):
+    """
+    Compress the output.txt of finished jobs, see logstore, after
+    completing their section index. Meant to be run regularly, for
+    example from cron.
+    """
+    help = "Compress the logs of finished jobs"
+    option_list = BaseCommand.option_list + (
+        make_option('--older-than',
+                    type='int',
+                    default=1,
+                    help="Only compress the logs of jobs which ended this many hours ago"),
+    )
+
+    def handle(self, *args, **options):
+        output_dir = os.path.join(settings.MEDIA_ROOT, 'job-output')
+        job_ids = []
+        for name in os.listdir(output_dir):
+            if name.startswith('job-') and os.path.exists(os.path.join(output_dir, name, 'output.txt')):
+                try:
+                    job_ids.append(int(name[4:]))
+                except ValueError:
+                    continue
+        ended = timezone.now() - datetime.timedelta(hours=options['older_than'])
+        jobs = TestJob.objects.filter(
+            id__in=job_ids,
+            status__in=[TestJob.COMPLETE, TestJob.INCOMPLETE, TestJob.CANCELED],
+            end_time__lt=ended).values_list('id', flat=True)
+        total = 0
+        compressed = 0
+        for job_id in jobs:
+            path = os.path.join(output_dir, 'job-%d' % job_id, 'output.txt')
+            # complete the section index while the log is still uncompressed
+            with JobLog(path) as log:
+                section_index(log)
+            sizes = compress_log(path)
+            if sizes:
+                total += sizes[0]
+                compressed += sizes[1]
+        self.stdout.write("Compressed %d logs from %d to %d bytes" % (len(jobs), total, compressed))
@@ -18,7 +18,6 @@
 # along
 # with this program; if not, see <http://www.gnu.org/licenses>.
 
-import errno
 import fcntl
 import jinja2
 import logging
@@ -31,10 +30,14 @@ import zmq
 
 from django.core.management.base import BaseCommand
 from django.db import transaction
+from django.db.models import Q
+from django.db.utils import DatabaseError
 from django.utils import timezone
 from lava_scheduler_app.models import Device, TestJob, JobPipeline
+from lava_scheduler_app.logsink import END_TIMEOUT, LogWriter
+from lava_scheduler_app.notify import Listener, NotificationsUnavailable
 from lava_results_app.models import TestSuite
-from lava_results_app.dbutils import map_scanned_results, map_metadata
+from lava_results_app.dbutils import map_metadata
 from lava_dispatcher.pipeline.device import PipelineDevice
 from lava_dispatcher.pipeline.parser import JobParser
 from lava_dispatcher.pipeline.action import JobError
@@ -44,25 +47,21 @@ from lava_dispatcher.pipeline.action import JobError
 
 
 # TODO constants to move into external files
-FD_TIMEOUT = 60
 TIMEOUT = 10
 DB_LIMIT = 10
+# When database notifications are available, every SUBMITTED and CANCELING
+# job is only re-checked at this interval, as a safety net.
+DB_SWEEP = 120
+# Maximum number of log messages read from the log socket in one go
+LOG_BATCH = 1000
+# Poll timeout while jobs which sent END wait for their results to be stored
+END_POLL = 0.1
 
 # TODO: share this value with dispatcher-slave
 # This should be 3 times the slave ping timeout
 DISPATCHER_TIMEOUT = 3 * 10
 
 
-def mkdir(path):
-    try:
-        os.makedirs(path)
-    except OSError as exc:
-        if exc.errno == errno.EEXIST and os.path.isdir(path):
-            pass
-        else:
-            raise
-
-
 class SlaveDispatcher(object):  # pylint: disable=too-few-public-methods
 
     def __init__(self, hostname, online=False):
@@ -74,17 +73,6 @@ class SlaveDispatcher(object):  # pylint: disable=too-few-public-methods
         self.last_msg = time.time()
 
 
-class FileHandler(object):  # pylint: disable=too-few-public-methods
-
-    def __init__(self, name, path):
-        self.filename = name
-        self.fd = open(path, 'a+')  # pylint: disable=invalid-name
-        self.last_usage = time.time()
-
-    def close(self):
-        self.fd.close()
-
-
 def create_job(job, device):
     # FIXME check the incoming device status
     job.actual_device = device
@@ -368,6 +356,178 @@ class Command(BaseCommand):
                 self.logger.info("[%d] Canceling", job.id)
                 cancel_job(job)
 
+    def _start_jobs(self, jobs, controler, options):
+        """
+        Send START for each pipeline job which has a Reserved device.
+        :param jobs: queryset of SUBMITTED pipeline jobs with an actual device
+        """
+        # TODO: make this atomic
+        not_allocated = 0
+        # only pick up pipeline jobs with devices in Reserved state
+        for job in jobs.order_by('-health_check', '-priority', 'submit_time', 'target_group', 'id'):
+            if job.dynamic_connection:
+                # A secondary connection must be made from a dispatcher local to the host device
+                # to allow for local firewalls etc. So the secondary connection is started on the
+                # remote worker of the "nominated" host.
+                # FIXME:
+                worker_host = job.lookup_worker
+                self.logger.info("[%d] START => %s (connection)", job.id,
+                                 worker_host.hostname)
+            else:
+                device = select_device(job)
+                if not device:
+                    continue
+                # selecting device can change the job
+                job = TestJob.objects.get(id=job.id)
+                self.logger.info("[%d] Assigning %s device", job.id, device)
+                if job.actual_device is None:
+                    device = job.requested_device
+
+                    # Launch the job
+                    create_job(job, device)
+                    self.logger.info("[%d] START => %s (%s)", job.id,
+                                     device.worker_host.hostname, device.hostname)
+                    worker_host = device.worker_host
+                else:
+                    device = job.actual_device
+                    self.logger.info("[%d] START => %s (%s) (retrying)", job.id,
+                                     device.worker_host.hostname, device.hostname)
+                    worker_host = device.worker_host
+            try:
+                # Load job definition to get the variables for template
+                # rendering
+                job_def = yaml.load(job.definition)
+                job_ctx = job_def.get('context', {})
+
+                # Load device configuration
+                device_configuration = None \
+                    if job.dynamic_connection else device.load_device_configuration(job_ctx)
+
+                if job.is_multinode:
+                    for group_job in job.sub_jobs_list:
+                        if group_job.dynamic_connection:
+                            # to get this far, the rest of the multinode group must also be ready
+                            # so start the dynamic connections
+                            # FIXME: rationalise and streamline
+                            controler.send_multipart(
+                                [str(worker_host.hostname),
+                                 'START', str(group_job.id), str(group_job.definition),
+                                 str(device_configuration),
+                                 str(open(options['env'], 'r').read())])
+
+                controler.send_multipart(
+                    [str(worker_host.hostname),
+                     'START', str(job.id), str(job.definition),
+                     str(device_configuration),
+                     get_env_string(options['env']), get_env_string(options['env_dut'])])
+                self.starting[job.id] = time.time()
+
+            except (jinja2.TemplateError, IOError, yaml.YAMLError) as exc:
+                if isinstance(exc, jinja2.TemplateNotFound):
+                    self.logger.error("Template not found: '%s'", exc.message)
+                    msg = "Infrastructure error: Template not found: '%s'" % \
+                          exc.message
+                elif isinstance(exc, jinja2.TemplateSyntaxError):
+                    self.logger.error("Template syntax error in '%s', line %d: %s",
+                                      exc.name, exc.lineno, exc.message)
+                    msg = "Infrastructure error: Template syntax error in '%s', line %d: %s" % \
+                          (exc.name, exc.lineno, exc.message)
+                elif isinstance(exc, IOError):
+                    self.logger.error("Unable to read '%s': %s",
+                                      options['env'], exc.strerror)
+                    msg = "Infrastructure error: cannot open '%s': %s" % \
+                          (options['env'], exc.strerror)
+                elif isinstance(exc, yaml.YAMLError):
+                    self.logger.error("Unable to parse job definition: %s",
+                                      exc)
+                    msg = "Infrastructure error: cannot parse job definition: %s" % \
+                          exc
+                else:
+                    self.logger.exception(exc)
+                    msg = "Infrastructure error: %s" % exc.message
+
+                self.logger.error("[%d] INCOMPLETE job", job.id)
+                job.status = TestJob.INCOMPLETE
+                if job.dynamic_connection:
+                    job.failure_comment = msg
+                    job.save()
+                else:
+                    new_status = Device.IDLE
+                    device.state_transition_to(
+                        new_status,
+                        message=msg,
+                        job=job)
+                    device.status = new_status
+                    device.current_job = None
+                    job.failure_comment = msg
+                    job.save()
+                    device.save()
+
+        if not_allocated > 0:
+            self.logger.info("%d jobs not allocated yet", not_allocated)
+
+    def _cancel_jobs(self, jobs, controler):
+        """
+        Send CANCEL for each pipeline job in Canceling.
+        :param jobs: queryset of CANCELING pipeline jobs
+        """
+        for job in jobs:
+            worker_host = job.lookup_worker if job.dynamic_connection else job.actual_device.worker_host
+            if not worker_host:
+                self.logger.warning("[%d] Invalid worker information" % job.id)
+                # shouldn't happen
+                fail_job(job, 'invalid worker information', TestJob.CANCELED)
+                continue
+            self.logger.info("[%d] CANCEL => %s", job.id,
+                             worker_host.hostname)
+            controler.send_multipart([str(worker_host.hostname),
+                                      'CANCEL', str(job.id)])
+            self.canceling[job.id] = time.time()
+
+    def _finish_jobs(self, controler):
+        """
+        End the jobs which sent END once their results are stored, or once
+        END_TIMEOUT has passed, and acknowledge the END. Called on each
+        iteration of the master loop, never waits.
+        """
+        now = time.time()
+        for job_id, (hostname, status, stored, received) in self.ending.items():
+            if not stored.is_set():
+                if now - received < END_TIMEOUT:
+                    continue
+                self.logger.warning("[%d] Timed out waiting for the results to be stored", job_id)
+            del self.ending[job_id]
+            try:
+                with transaction.atomic():
+                    job = TestJob.objects.select_for_update() \
+                                         .get(id=job_id)
+                    if job.status == TestJob.CANCELING:
+                        cancel_job(job)
+                    else:
+                        end_job(job, job_status=status)
+            except TestJob.DoesNotExist:
+                self.logger.error("[%d] Unknown job", job_id)
+            # ACK even if the job is unknown to let the dispatcher
+            # forget about it
+            controler.send_multipart([hostname, 'END_OK', str(job_id)])
+
+    def _notified_jobs(self, notified, controler, options):
+        """
+        Send START or CANCEL for the jobs which were notified, instead of the whole queue.
+        :param notified: ids of the jobs which changed
+        """
+        # a multinode job can only start once the whole group has devices,
+        # so a change to one job has to be checked against the whole group.
+        groups = TestJob.objects.filter(
+            id__in=notified).exclude(target_group=None).values('target_group')
+        self._start_jobs(TestJob.objects.filter(
+            Q(id__in=notified) | Q(target_group__in=groups),
+            status=TestJob.SUBMITTED,
+            is_pipeline=True,
+            actual_device__isnull=False), controler, options)
+        self._cancel_jobs(TestJob.objects.filter(
+            id__in=notified, status=TestJob.CANCELING, is_pipeline=True), controler)
+
     def handle(self, *args, **options):
         # FIXME: this function is getting much too long and complex.
         del logging.root.handlers[:]
@@ -393,8 +553,9 @@ class Command(BaseCommand):
         controler = context.socket(zmq.ROUTER)
         controler.bind(options['master_socket'])
 
-        # List of logs
-        logs = {}
+        # Writes logs and results away from the command loop
+        log_writer = LogWriter(options['output_dir'])
+        log_writer.start()
         # List of known dispatchers. At startup do not laod this from the
         # database. This will help to know if the slave as restarted or not.
         dispatchers = {}
@@ -418,13 +579,37 @@ class Command(BaseCommand):
         signal.signal(signal.SIGTERM, lambda x, y: None)
         signal.signal(signal.SIGQUIT, lambda x, y: None)
         poller.register(pipe_r, zmq.POLLIN)
+
+        # React to job and device changes as they are committed rather than
+        # polling the database, fall back to polling if that is not possible.
+        listener = None
+        try:
+            listener = Listener()
+            poller.register(listener.fileno(), zmq.POLLIN)
+        except (NotificationsUnavailable, DatabaseError) as exc:
+            self.logger.warning("[INIT] Database notifications unavailable, polling instead: %s", exc)
+        # jobs which need attention and START or CANCEL messages waiting for an answer
+        notified = set()
+        self.starting = {}
+        self.canceling = {}
+        self.ending = {}
+        reading_logs = True
         self.logger.info("[INIT] LAVA dispatcher-master has started.")
 
         while True:
+            # Only read the log socket while the log writer keeps up: the
+            # dispatchers then wait to send, the command socket is still read.
+            if reading_logs and log_writer.full():
+                self.logger.warning("[POLL] Log writer is behind, pausing the log socket")
+                poller.unregister(pull_socket)
+                reading_logs = False
+            elif not reading_logs and not log_writer.full():
+                poller.register(pull_socket, zmq.POLLIN)
+                reading_logs = True
             try:
                 # TODO: Fix the timeout computation
                 # Wait for data or a timeout
-                sockets = dict(poller.poll(TIMEOUT * 1000))
+                sockets = dict(poller.poll((END_POLL if self.ending else TIMEOUT) * 1000))
             except zmq.error.ZMQError:
                 continue
 
@@ -434,83 +619,15 @@ class Command(BaseCommand):
 
             # Logging socket
             if sockets.get(pull_socket) == zmq.POLLIN:
-                msg = pull_socket.recv_multipart()
-                try:
-                    (job_id, level, name, message) = msg
-                except ValueError:
-                    # do not let a bad message stop the master.
-                    self.logger.error("Failed to parse log message, skipping: %s", msg)
-                    continue
-
-                try:
-                    scanned = yaml.load(message)
-                except yaml.YAMLError:
-                    # failure to scan is not an error here, it just means the message is not a result
-                    scanned = None
-                # the results logger wraps the OrderedDict in a dict called results, for identification,
-                # YAML then puts that into a list of one item for each call to log.results.
-                if type(scanned) is list and len(scanned) == 1:
-                    if type(scanned[0]) is dict and 'results' in scanned[0]:
-                        job = TestJob.objects.get(id=job_id)
-                        ret = map_scanned_results(scanned_dict=scanned[0], job=job)
-                        if not ret:
-                            self.logger.warning("[%s] Unable to map scanned results: %s" % (job_id, yaml.dump(scanned[0])))
-
-                # Clear filename
-                if '/' in level or '/' in name:
-                    self.logger.error("[%s] Wrong level or name received, dropping the message", job_id)
-                    continue
-                filename = "%s/job-%s/pipeline/%s/%s-%s.log" % (options['output_dir'],
-                                                                job_id, level.split('.')[0],
-                                                                level, name)
-
-                # Find the handler (if available)
-                f_handler = None
-                if job_id in logs:
-                    if filename != logs[job_id].filename:
-                        # Close the old file handler
-                        logs[job_id].close()
-
-                        path = os.path.join('/tmp', 'lava-dispatcher', 'jobs',
-                                            job_id, filename)
-                        mkdir(os.path.dirname(path))
-                        logs[job_id] = FileHandler(filename, path)
-                else:
-                    self.logger.info("[%s] Receiving logs from a new job", job_id)
-                    path = os.path.join('/tmp', 'lava-dispatcher', 'jobs',
-                                        job_id, filename)
-                    mkdir(os.path.dirname(path))
-                    logs[job_id] = FileHandler(filename, path)
-
-                # Mark the file handler as used
-                # TODO: try to use a more pythonnic way
-                logs[job_id].last_usage = time.time()
-
-                # n.b. logging here would produce a log entry for every message in every job.
-
-                # Write data
-                f_handler = logs[job_id].fd
-                f_handler.write(message)
-                f_handler.write('\n')
-                f_handler.flush()
-
-                # FIXME: to be removed when the web UI knows how to deal with
-                # pipeline logs
-                filename = os.path.join(options['output_dir'],
-                                        "job-%s" % job_id,
-                                        'output.txt')
-                with open(filename, 'a+') as f_out:
-                    f_out.write(message)
-                    f_out.write('\n')
-
-            # Garbage collect file handlers
-            now = time.time()
-            for job_id in logs.keys():
-                if now - logs[job_id].last_usage > FD_TIMEOUT:
-                    self.logger.info("[%s] Collecting file handler '%s'",
-                                     job_id, logs[job_id].filename)
-                    logs[job_id].close()
-                    del logs[job_id]
+                # drain a batch and leave the writing to the log writer so
+                # that the command socket stays responsive.
+                batch = []
+                while len(batch) < LOG_BATCH:
+                    try:
+                        batch.append(pull_socket.recv_multipart(zmq.NOBLOCK))
+                    except zmq.error.Again:
+                        break
+                log_writer.put(batch)
 
             # Command socket
             if sockets.get(controler) == zmq.POLLIN:
@@ -585,19 +702,12 @@ class Command(BaseCommand):
                         status = TestJob.INCOMPLETE
                     else:
                         self.logger.info("[%d] %s => END", job_id, hostname)
-                    try:
-                        with transaction.atomic():
-                            job = TestJob.objects.select_for_update() \
-                                                 .get(id=job_id)
-                            if job.status == TestJob.CANCELING:
-                                cancel_job(job)
-                            else:
-                                end_job(job, job_status=status)
-                    except TestJob.DoesNotExist:
-                        self.logger.error("[%d] Unknown job", job_id)
-                    # ACK even if the job is unknown to let the dispatcher
-                    # forget about it
-                    controler.send_multipart([hostname, 'END_OK', str(job_id)])
+                    self.starting.pop(job_id, None)
+                    self.canceling.pop(job_id, None)
+                    # the job ends once its results are stored, see _finish_jobs.
+                    # A repeated END is answered when the job ends.
+                    if job_id not in self.ending:
+                        self.ending[job_id] = (hostname, status, log_writer.job_finished(job_id), time.time())
 
                     if hostname not in dispatchers:
                         # The server crashed: send a STATUS message
@@ -615,6 +725,7 @@ class Command(BaseCommand):
                         self.logger.error("Invalid message from <%s> '%s'", hostname, msg)
                         continue
                     self.logger.info("[%d] %s => START_OK", job_id, hostname)
+                    self.starting.pop(job_id, None)
                     try:
                         with transaction.atomic():
                             job = TestJob.objects.select_for_update() \
@@ -636,6 +747,8 @@ class Command(BaseCommand):
                     self.logger.error("<%s> sent unknown action=%s, args=(%s)",
                                       hostname, action, msg[1:])
 
+            self._finish_jobs(controler)
+
             # Check dispatchers status
             now = time.time()
             for hostname in dispatchers.keys():
@@ -647,133 +760,42 @@ class Command(BaseCommand):
                     # devices
 
             # Limit accesses to the database. This will also limit the rate of
-            # CANCEL and START messages
-            if now - last_db_access > DB_LIMIT:
+            # CANCEL and START messages. With database notifications, only the
+            # jobs which changed are loaded and the full sweep is a safety net.
+            if listener and sockets.get(listener.fileno()) == zmq.POLLIN:
+                try:
+                    notified.update(listener.drain())
+                except DatabaseError as exc:
+                    self.logger.error("[POLL] Lost the notification connection: %s", exc)
+                    poller.unregister(listener.fileno())
+                    listener = None
+            if now - last_db_access > (DB_SWEEP if listener else DB_LIMIT):
                 last_db_access = now
-                # Dispatch jobs
-                # TODO: make this atomic
-                not_allocated = 0
-                # only pick up pipeline jobs with devices in Reserved state
-                for job in TestJob.objects.filter(
-                        status=TestJob.SUBMITTED,
-                        is_pipeline=True,
-                        actual_device__isnull=False).order_by(
-                            '-health_check', '-priority', 'submit_time', 'target_group', 'id'):
-                    if job.dynamic_connection:
-                        # A secondary connection must be made from a dispatcher local to the host device
-                        # to allow for local firewalls etc. So the secondary connection is started on the
-                        # remote worker of the "nominated" host.
-                        # FIXME:
-                        worker_host = job.lookup_worker
-                        self.logger.info("[%d] START => %s (connection)", job.id,
-                                         worker_host.hostname)
-                    else:
-                        device = select_device(job)
-                        if not device:
-                            continue
-                        # selecting device can change the job
-                        job = TestJob.objects.get(id=job.id)
-                        self.logger.info("[%d] Assigning %s device", job.id, device)
-                        if job.actual_device is None:
-                            device = job.requested_device
-
-                            # Launch the job
-                            create_job(job, device)
-                            self.logger.info("[%d] START => %s (%s)", job.id,
-                                             device.worker_host.hostname, device.hostname)
-                            worker_host = device.worker_host
-                        else:
-                            device = job.actual_device
-                            self.logger.info("[%d] START => %s (%s) (retrying)", job.id,
-                                             device.worker_host.hostname, device.hostname)
-                            worker_host = device.worker_host
-                    try:
-                        # Load job definition to get the variables for template
-                        # rendering
-                        job_def = yaml.load(job.definition)
-                        job_ctx = job_def.get('context', {})
-
-                        # Load device configuration
-                        device_configuration = None \
-                            if job.dynamic_connection else device.load_device_configuration(job_ctx)
-
-                        if job.is_multinode:
-                            for group_job in job.sub_jobs_list:
-                                if group_job.dynamic_connection:
-                                    # to get this far, the rest of the multinode group must also be ready
-                                    # so start the dynamic connections
-                                    # FIXME: rationalise and streamline
-                                    controler.send_multipart(
-                                        [str(worker_host.hostname),
-                                         'START', str(group_job.id), str(group_job.definition),
-                                         str(device_configuration),
-                                         str(open(options['env'], 'r').read())])
-
-                        controler.send_multipart(
-                            [str(worker_host.hostname),
-                             'START', str(job.id), str(job.definition),
-                             str(device_configuration),
-                             get_env_string(options['env']), get_env_string(options['env_dut'])])
-
-                    except (jinja2.TemplateError, IOError, yaml.YAMLError) as exc:
-                        if isinstance(exc, jinja2.TemplateNotFound):
-                            self.logger.error("Template not found: '%s'", exc.message)
-                            msg = "Infrastructure error: Template not found: '%s'" % \
-                                  exc.message
-                        elif isinstance(exc, jinja2.TemplateSyntaxError):
-                            self.logger.error("Template syntax error in '%s', line %d: %s",
-                                              exc.name, exc.lineno, exc.message)
-                            msg = "Infrastructure error: Template syntax error in '%s', line %d: %s" % \
-                                  (exc.name, exc.lineno, exc.message)
-                        elif isinstance(exc, IOError):
-                            self.logger.error("Unable to read '%s': %s",
-                                              options['env'], exc.strerror)
-                            msg = "Infrastructure error: cannot open '%s': %s" % \
-                                  (options['env'], exc.strerror)
-                        elif isinstance(exc, yaml.YAMLError):
-                            self.logger.error("Unable to parse job definition: %s",
-                                              exc)
-                            msg = "Infrastructure error: cannot parse job definition: %s" % \
-                                  exc
-                        else:
-                            self.logger.exception(exc)
-                            msg = "Infrastructure error: %s" % exc.message
-
-                        self.logger.error("[%d] INCOMPLETE job", job.id)
-                        job.status = TestJob.INCOMPLETE
-                        if job.dynamic_connection:
-                            job.failure_comment = msg
-                            job.save()
-                        else:
-                            new_status = Device.IDLE
-                            device.state_transition_to(
-                                new_status,
-                                message=msg,
-                                job=job)
-                            device.status = new_status
-                            device.current_job = None
-                            job.failure_comment = msg
-                            job.save()
-                            device.save()
-
-                if not_allocated > 0:
-                    self.logger.info("%d jobs not allocated yet", not_allocated)
-
-                # Handle canceling jobs
-                for job in TestJob.objects.filter(status=TestJob.CANCELING, is_pipeline=True):
-                    worker_host = job.lookup_worker if job.dynamic_connection else job.actual_device.worker_host
-                    if not worker_host:
-                        self.logger.warning("[%d] Invalid worker information" % job.id)
-                        # shouldn't happen
-                        fail_job(job, 'invalid worker information', TestJob.CANCELED)
-                        continue
-                    self.logger.info("[%d] CANCEL => %s", job.id,
-                                     worker_host.hostname)
-                    controler.send_multipart([str(worker_host.hostname),
-                                              'CANCEL', str(job.id)])
+                notified.clear()
+                self.starting.clear()
+                self.canceling.clear()
+                self._start_jobs(TestJob.objects.filter(
+                    status=TestJob.SUBMITTED,
+                    is_pipeline=True,
+                    actual_device__isnull=False), controler, options)
+                self._cancel_jobs(TestJob.objects.filter(
+                    status=TestJob.CANCELING, is_pipeline=True), controler)
+            else:
+                # retry START and CANCEL messages which have not been acknowledged
+                for pending in [self.starting, self.canceling]:
+                    expired = [pending_id for pending_id, sent in pending.items() if now - sent > DB_LIMIT]
+                    for pending_id in expired:
+                        notified.add(pending_id)
+                        del pending[pending_id]
+                if notified:
+                    self._notified_jobs(notified, controler, options)
+                    notified.clear()
 
         # Closing sockets and droping messages.
         self.logger.info("Closing the socket and dropping messages")
+        if listener:
+            listener.close()
+        log_writer.stop()
         controler.close(linger=0)
         pull_socket.close(linger=0)
         context.term()
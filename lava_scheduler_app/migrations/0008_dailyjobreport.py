@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lava_scheduler_app', '0007_devicetype_description'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyJobReport',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('health_check', models.BooleanField(default=False)),
+                ('passed', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('device', models.ForeignKey(blank=True, to='lava_scheduler_app.Device', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyjobreport',
+            unique_together=set([('day', 'device', 'health_check')]),
+        ),
+    ]
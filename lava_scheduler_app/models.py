@@ -1,5 +1,8 @@
 # pylint: disable=too-many-lines
 
+import base64
+import copy
+import datetime
 import logging
 import os
 import uuid
@@ -9,7 +12,12 @@ import urlparse
 import smtplib
 import socket
 import sys
+import time
 import yaml
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.contrib.sites.models import Site
@@ -22,7 +30,10 @@ from django.core.exceptions import (
 )
 from django.core.mail import send_mail
 from django.core.validators import validate_email
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.template.loader import render_to_string
 from django.utils.translation import ugettext_lazy as _
 from django.shortcuts import get_object_or_404
@@ -36,6 +47,8 @@ from dashboard_app.models import Bundle, BundleStream
 
 from lava_dispatcher.job import validate_job_data
 from lava_scheduler_app import utils
+from lava_scheduler_app.logstore import JobLog
+from lava_scheduler_app.notify import notify
 
 from linaro_django_xmlrpc.models import AuthToken
 
@@ -548,6 +561,57 @@ class PipelineKVStore(ExtendedKVStore):
     kvstore = get_kvstore('db://lava_scheduler_app_pipelinestore')
 
 
+# Process-wide caches used by Device.load_device_configuration, by hostname
+# or template path. Each entry holds what it was built from, and is only
+# used while that did not change.
+_DEVICE_DICTIONARIES = {}
+_DEVICE_TEMPLATES = {}
+_DEVICE_CONFIGURATIONS = {}
+_TEMPLATE_ENVIRONMENTS = {}
+_DEVICE_TYPES_VERSIONS = {}
+
+# Seconds between two checks of the device-type templates for changes
+DEVICE_TYPES_CHECK_INTERVAL = 5
+
+
+def _device_type_environment(path):
+    """
+    :param path: path of the jinja2 templates, see utils.jinja_template_path
+    :return: the jinja2 Environment of the device-type templates, which keeps
+    the compiled templates and compiles a template again when its file is
+    modified.
+    """
+    env = _TEMPLATE_ENVIRONMENTS.get(path)
+    if env is None:
+        env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader([os.path.join(path, 'device-types')]),
+            trim_blocks=True)
+        _TEMPLATE_ENVIRONMENTS[path] = env
+    return env
+
+
+def _device_types_version(path):
+    """
+    :return: the names and modification times of the device-type templates,
+    which change when a template extended or included by a device
+    configuration changes. The templates are checked at most once every
+    DEVICE_TYPES_CHECK_INTERVAL seconds.
+    """
+    now = time.time()
+    cached = _DEVICE_TYPES_VERSIONS.get(path)
+    if cached and now - cached[0] < DEVICE_TYPES_CHECK_INTERVAL:
+        return cached[1]
+    directory = os.path.join(path, 'device-types')
+    version = []
+    for name in sorted(os.listdir(directory)):
+        try:
+            version.append((name, os.stat(os.path.join(directory, name)).st_mtime))
+        except OSError:
+            continue
+    _DEVICE_TYPES_VERSIONS[path] = (now, tuple(version))
+    return _DEVICE_TYPES_VERSIONS[path][1]
+
+
 class DeviceDictionary(DeviceKVStore):
     """
     KeyValue store for Pipeline device support
@@ -559,6 +623,83 @@ class DeviceDictionary(DeviceKVStore):
     class Meta:
         app_label = 'pipeline'
 
+    @classmethod
+    def decode(cls, hostname, value):
+        """
+        Decode a value read from DeviceDictionaryTable without a kvstore lookup.
+        This depends on the private encoding of the db:// backend of
+        django_kvstore, a base64 encoded pickle of the fields. get_many,
+        get_cached and, through get_many, the scheduler snapshot and the
+        xmlrpc API all rely on it. Values which cannot be decoded in this
+        way are read again through the kvstore with get.
+        :param hostname: device hostname
+        :param value: the value column of the DeviceDictionaryTable row
+        :return: the DeviceDictionary, None if there is none
+        """
+        try:
+            fields = pickle.loads(base64.decodestring(value))
+        except Exception:  # pylint: disable=broad-except
+            # unpickling unexpected data can raise almost anything
+            fields = None
+        if not isinstance(fields, dict):
+            logger = logging.getLogger('lava_scheduler_app')
+            logger.warning("Unable to decode the device dictionary of %s, using the kvstore", hostname)
+            return cls.get(hostname)
+        return cls.from_dict(fields)
+
+    @classmethod
+    def get_many(cls, hostnames):
+        """
+        Fetch the dictionaries of several devices with a single query instead
+        of one kvstore lookup per device, see decode.
+        :param hostnames: list of device hostnames
+        :return: dict of hostname to DeviceDictionary, devices without a
+        dictionary are omitted.
+        """
+        keys = dict([(kvmodels.generate_key(cls, hostname), hostname) for hostname in hostnames])
+        dictionaries = {}
+        for kee, value in DeviceDictionaryTable.objects.filter(
+                kee__in=keys.keys()).values_list('kee', 'value'):
+            device_dict = cls.decode(keys[kee], value)
+            if device_dict is not None:
+                dictionaries[keys[kee]] = device_dict
+        return dictionaries
+
+    @classmethod
+    def get_cached(cls, hostname):
+        """
+        Fetch the dictionary of a device as get does, but only decode it
+        when the stored value changed since the last call in this process.
+        The dictionary is shared between callers and must not be modified.
+        :param hostname: device hostname
+        :return: the stored value, which identifies this version of the
+        dictionary, and the DeviceDictionary. (None, None) if the device has
+        no dictionary.
+        """
+        values = list(DeviceDictionaryTable.objects.filter(
+            kee=kvmodels.generate_key(cls, hostname)).values_list('value', flat=True)[:1])
+        if not values:
+            _DEVICE_DICTIONARIES.pop(hostname, None)
+            return None, None
+        cached = _DEVICE_DICTIONARIES.get(hostname)
+        if cached is None or cached[0] != values[0]:
+            device_dict = cls.decode(hostname, values[0])
+            if device_dict is None:
+                return None, None
+            cached = (values[0], device_dict)
+            _DEVICE_DICTIONARIES[hostname] = cached
+        return cached
+
+    @property
+    def exclusive(self):
+        """
+        True if the device is exclusively a pipeline device.
+        """
+        device_dict = self.to_dict()
+        if 'parameters' not in device_dict or device_dict['parameters'] is None:
+            return False
+        return device_dict['parameters'].get('exclusive') == 'True'
+
 
 class Device(RestrictedResource):
     """
@@ -878,37 +1019,44 @@ class Device(RestrictedResource):
         if job_ctx is None:
             job_ctx = {}
 
-        element = DeviceDictionary.get(self.hostname)
+        version, element = DeviceDictionary.get_cached(self.hostname)
         # TODO: hardcoded path (determined by setup.py)
         path = utils.jinja_template_path()
         if element is None:
             return None
-        data = utils.devicedictionary_to_jinja2(
-            element.parameters,
-            element.parameters['extends']
-        )
-        string_loader = jinja2.DictLoader({'%s.yaml' % self.hostname: data})
-        type_loader = jinja2.FileSystemLoader([
-            os.path.join(path, 'device-types')])
-        env = jinja2.Environment(
-            loader=jinja2.ChoiceLoader([string_loader, type_loader]),
-            trim_blocks=True)
-        template = env.get_template("%s.yaml" % self.hostname)
-
-        return yaml.load(template.render(**job_ctx))
+        # without a job context, the configuration only depends on the
+        # device dictionary and the device-type templates
+        if not job_ctx:
+            types_version = _device_types_version(path)
+            cached = _DEVICE_CONFIGURATIONS.get(self.hostname)
+            if cached and cached[:3] == (path, version, types_version):
+                return copy.deepcopy(cached[3])
+
+        cached = _DEVICE_TEMPLATES.get(self.hostname)
+        if cached and cached[:2] == (path, version):
+            template = cached[2]
+        else:
+            data = utils.devicedictionary_to_jinja2(
+                element.parameters,
+                element.parameters['extends']
+            )
+            # the device-type template it extends is compiled once by the environment
+            template = _device_type_environment(path).from_string(data)
+            _DEVICE_TEMPLATES[self.hostname] = (path, version, template)
+
+        config = yaml.load(template.render(**job_ctx))
+        if not job_ctx:
+            _DEVICE_CONFIGURATIONS[self.hostname] = (path, version, types_version, config)
+            return copy.deepcopy(config)
+        return config
 
     @property
     def is_exclusive(self):
-        exclusive = False
         # check the device dictionary if this is exclusively a pipeline device
-        device_dict = DeviceDictionary.get(self.hostname)
+        device_dict = DeviceDictionary.get_cached(self.hostname)[1]
         if device_dict:
-            device_dict = device_dict.to_dict()
-            if 'parameters' not in device_dict or device_dict['parameters'] is None:
-                return exclusive
-            if 'exclusive' in device_dict['parameters'] and device_dict['parameters']['exclusive'] == 'True':
-                exclusive = True
-        return exclusive
+            return device_dict.exclusive
+        return False
 
 
 class TemporaryDevice(Device):
@@ -1507,10 +1655,21 @@ class TestJob(RestrictedResource):
     def output_dir(self):
         return os.path.join(settings.MEDIA_ROOT, 'job-output', 'job-%s' % self.id)
 
+    def output_log(self):
+        """
+        :return: a JobLog to read parts of the output, None if there is no output
+        """
+        log = JobLog.find(os.path.join(self.output_dir, 'output.txt'))
+        if log is None and self.log_file:
+            log = JobLog.find(self.log_file.path)
+        return log
+
     def output_file(self):
         output_path = os.path.join(self.output_dir, 'output.txt')
-        if os.path.exists(output_path):
-            return open(output_path, encoding='utf-8', errors='replace')
+        log = JobLog.find(output_path)
+        if log:
+            log.close()
+            return log.open_text()
         elif self.log_file:
             log_file = self.log_file
             if log_file:
@@ -2305,3 +2464,146 @@ class DeviceStateTransition(models.Model):
     def update_message(self, message):
         self.message = message
         self.save()
+
+
+class DailyJobReport(models.Model):
+    """
+    Number of jobs which passed and failed on a device on one day, by the
+    start time of the jobs, so that the reports pages do not need to count
+    the jobs. Updated when jobs are saved in a reported state, the
+    backfill-job-reports command builds it for existing jobs.
+    """
+    # states counted by the reports, jobs which did not complete failed
+    REPORTED = [TestJob.COMPLETE, TestJob.INCOMPLETE, TestJob.CANCELED, TestJob.CANCELING]
+
+    day = models.DateField()
+    device = models.ForeignKey(Device, null=True, blank=True, on_delete=models.CASCADE)
+    health_check = models.BooleanField(default=False)
+    passed = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("day", "device", "health_check")
+
+    def __unicode__(self):
+        return u"%s %s %s: %d/%d" % (self.day, self.device_id, self.health_check,
+                                     self.passed, self.passed + self.failed)
+
+    @staticmethod
+    def day_of(value):
+        """
+        :return: the UTC date of a datetime
+        """
+        if timezone.is_aware(value):
+            value = value.astimezone(timezone.utc)
+        return value.date()
+
+    @staticmethod
+    def day_range(day):
+        """
+        :return: the start of the day and the start of the next day
+        """
+        start = datetime.datetime.combine(day, datetime.time())
+        if settings.USE_TZ:
+            start = timezone.make_aware(start, timezone.utc)
+        return start, start + datetime.timedelta(days=1)
+
+    @classmethod
+    def update(cls, day, device_id, health_check):
+        """
+        Count the jobs of one day, device and kind of job again, so that
+        saving a job more than once does not count it more than once.
+        The report is locked while the jobs are counted. When two saves
+        create the same report at once, the second one counts again once
+        the report exists.
+        """
+        try:
+            cls._update(day, device_id, health_check)
+        except IntegrityError:
+            cls._update(day, device_id, health_check)
+
+    @classmethod
+    def _update(cls, day, device_id, health_check):
+        start, end = cls.day_range(day)
+        with transaction.atomic():
+            report = cls.objects.select_for_update().filter(
+                day=day, device=device_id, health_check=health_check).first()
+            passed = failed = 0
+            for row in TestJob.objects.filter(
+                    actual_device=device_id, health_check=health_check,
+                    start_time__gte=start, start_time__lt=end,
+                    status__in=cls.REPORTED).values('status').annotate(count=Count('id')):
+                if row['status'] == TestJob.COMPLETE:
+                    passed += row['count']
+                else:
+                    failed += row['count']
+            if report is None:
+                if passed or failed:
+                    cls.objects.create(day=day, device_id=device_id, health_check=health_check,
+                                       passed=passed, failed=failed)
+            elif passed or failed:
+                report.passed = passed
+                report.failed = failed
+                report.save(update_fields=['passed', 'failed'])
+            else:
+                report.delete()
+
+    @classmethod
+    def rebuild(cls, since=None):
+        """
+        Replace the reports of the jobs which started on or after since,
+        all the jobs by default, reading the jobs once.
+        :return: the number of reports
+        """
+        jobs = TestJob.objects.filter(status__in=cls.REPORTED, start_time__isnull=False)
+        reports = cls.objects.all()
+        if since:
+            jobs = jobs.filter(start_time__gte=cls.day_range(since)[0])
+            reports = reports.filter(day__gte=since)
+        counts = {}
+        for start_time, device_id, health_check, status in jobs.values_list(
+                'start_time', 'actual_device', 'health_check', 'status').iterator():
+            key = (cls.day_of(start_time), device_id, health_check)
+            count = counts.setdefault(key, [0, 0])
+            count[0 if status == TestJob.COMPLETE else 1] += 1
+        with transaction.atomic():
+            reports.delete()
+            cls.objects.bulk_create([
+                cls(day=day, device_id=device_id, health_check=health_check,
+                    passed=passed, failed=failed)
+                for (day, device_id, health_check), (passed, failed) in counts.items()],
+                batch_size=1000)
+        return len(counts)
+
+
+@receiver(post_save, sender=TestJob)
+def testjob_report(sender, instance, raw=False, **kwargs):  # pylint: disable=unused-argument
+    """
+    Keep the DailyJobReport of the job up to date.
+    """
+    if raw or instance.status not in DailyJobReport.REPORTED or not instance.start_time:
+        return
+    DailyJobReport.update(
+        DailyJobReport.day_of(instance.start_time), instance.actual_device_id, instance.health_check)
+
+
+@receiver(post_save, sender=TestJob)
+def testjob_notify(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    Wake the dispatcher-master when a pipeline job can be started or
+    needs to be canceled, instead of waiting for the next database sweep.
+    """
+    if not instance.is_pipeline:
+        return
+    if instance.status == TestJob.CANCELING or (
+            instance.status == TestJob.SUBMITTED and instance.actual_device_id is not None):
+        notify(instance.id)
+
+
+@receiver(post_save, sender=Device)
+def device_notify(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    Wake the dispatcher-master when a pipeline device has been Reserved.
+    """
+    if instance.is_pipeline and instance.status == Device.RESERVED and instance.current_job_id:
+        notify(instance.current_job_id)
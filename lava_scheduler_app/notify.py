@@ -0,0 +1,113 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Scheduler.
+#
+# LAVA Scheduler is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3 as
+# published by the Free Software Foundation
+#
+# LAVA Scheduler is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Scheduling notifications for the dispatcher-master.
+
+Saving a pipeline TestJob which is ready to start or being canceled, or a
+device which has been Reserved, issues a PostgreSQL NOTIFY carrying the
+id of the job concerned. NOTIFY is transactional, so the dispatcher-master
+only hears about a change once it has been committed.
+"""
+
+import logging
+import psycopg2
+import psycopg2.extensions
+
+from django.db import connection
+from django.db.utils import DatabaseError
+
+CHANNEL = 'lava_scheduler'
+
+
+def notify(job_id):
+    """
+    Tell the dispatcher-master that the job needs attention.
+    A no-op on databases other than PostgreSQL.
+    """
+    if connection.vendor != 'postgresql':
+        return
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT pg_notify(%s, %s)", [CHANNEL, str(job_id)])
+    finally:
+        cursor.close()
+
+
+class NotificationsUnavailable(Exception):
+    """
+    The database cannot send notifications, the dispatcher-master has to poll.
+    """
+    pass
+
+
+class Listener(object):
+    """
+    Dedicated autocommit connection which LISTENs for scheduling notifications.
+    The file descriptor can be registered with a zmq.Poller so that the
+    dispatcher-master wakes up as soon as a notification arrives.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('dispatcher-master')
+        if connection.vendor != 'postgresql':
+            raise NotificationsUnavailable("Notifications need a PostgreSQL database")
+        try:
+            self.conn = connection.get_new_connection(connection.get_connection_params())
+            self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = self.conn.cursor()
+            cursor.execute("LISTEN %s" % CHANNEL)
+            cursor.close()
+        except psycopg2.Error as exc:
+            raise DatabaseError(str(exc))
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def backend_pid(self):  # pylint: disable=no-self-use
+        """
+        :return: the pid of the database backend of the calling process, None if not connected
+        """
+        if connection.connection is not None and not connection.connection.closed:
+            return connection.connection.get_backend_pid()
+        return None
+
+    def drain(self):
+        """
+        Read all pending notifications.
+        Notifications sent by the connection of the calling process are skipped
+        as the caller already knows about its own changes - this also prevents
+        the dispatcher-master from waking itself up in a loop.
+        :return: set of job ids
+        """
+        own_pid = self.backend_pid()
+        try:
+            self.conn.poll()
+        except psycopg2.Error as exc:
+            raise DatabaseError(str(exc))
+        job_ids = set()
+        while self.conn.notifies:
+            notification = self.conn.notifies.pop(0)
+            if notification.pid == own_pid:
+                continue
+            try:
+                job_ids.add(int(notification.payload))
+            except ValueError:
+                self.logger.warning("Ignoring invalid notification '%s'", notification.payload)
+        return job_ids
+
+    def close(self):
+        self.conn.close()
@@ -173,6 +173,19 @@ class DeviceDictionaryTest(TestCaseWithFactory):
         baz = DeviceDictionary.get('foo')
         self.assertIsNone(baz)
 
+    def test_get_many(self):
+        for hostname in ['foo', 'bar']:
+            device_dict = DeviceDictionary(hostname=hostname)
+            device_dict.parameters = {'extends': '%s.yaml' % hostname}
+            device_dict.save()
+        dictionaries = DeviceDictionary.get_many(['foo', 'bar', 'missing'])
+        self.assertEqual(sorted(dictionaries.keys()), ['bar', 'foo'])
+        self.assertEqual(dictionaries['foo'].parameters, {'extends': 'foo.yaml'})
+        self.assertEqual(DeviceDictionary.get_cached('bar')[1].parameters, {'extends': 'bar.yaml'})
+        # values in another encoding are read through the kvstore
+        self.assertEqual(DeviceDictionary.decode('foo', 'not a pickle').parameters, {'extends': 'foo.yaml'})
+        self.assertIsNone(DeviceDictionary.decode('missing', 'not a pickle'))
+
     def test_jinja_string_templates(self):
         jinja2_path = os.path.realpath(os.path.join(
             __file__, '..', '..', '..', 'etc', 'dispatcher-config'))
@@ -0,0 +1,92 @@
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+from lava_scheduler_app.logfile_helper import (
+    SECTIONS_SUFFIX,
+    SectionIndex,
+    formatLogFile,
+    getDispatcherErrors,
+    read_sections,
+    section_index,
+)
+from lava_scheduler_app.logstore import JobLog, compress_log
+
+# pylint: disable=invalid-name,too-many-public-methods
+
+
+def v1_log(repeats):
+    """
+    An output.txt with dispatcher messages, console output and tracebacks.
+    """
+    lines = []
+    for index in range(repeats):
+        lines.append("<LAVA_DISPATCHER>2016-03-01 10:12:01 AM INFO: [ACTION-B] boot_image is started\n")
+        lines.append("<LAVA_DISPATCHER>2016-03-01 10:12:01 AM DEBUG: lava_dispatcher.actions %d\n" % index)
+        lines.extend(["[%8.6f] console output line\r\n" % line for line in range(index % 30)])
+        if index % 7 == 0:
+            lines.append("Traceback (most recent call last):\n")
+            lines.append('  File "/usr/lib/python2.7/dist-packages/lava_dispatcher/job.py", line 1\n')
+            lines.append("CriticalError: Infrastructure Error: no device %d\n" % (index % 3))
+            lines.append("after the traceback\n")
+        if index % 11 == 0:
+            lines.append("ErrorMessage: Kernel Error: panic\n")
+    return lines
+
+
+class TestSectionIndex(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSectionIndex, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'output.txt')
+        self.lines = v1_log(200)
+        self.data = ''.join(self.lines)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestSectionIndex, self).tearDown()
+
+    def write(self, data):
+        with open(self.path, 'ab') as output:
+            output.write(data)
+
+    def test_same_as_format(self):
+        self.write(self.data)
+        with JobLog(self.path) as log:
+            index = section_index(log)
+            self.assertEqual(read_sections(log, index.visible()), formatLogFile(StringIO.StringIO(self.data)))
+            self.assertEqual(sorted(index.errors), sorted(getDispatcherErrors(StringIO.StringIO(self.data))))
+
+    def test_incremental(self):
+        # the log grows in pieces which end anywhere
+        for offset in range(0, len(self.data), 997):
+            self.write(self.data[offset:offset + 997])
+            with JobLog(self.path) as log:
+                index = section_index(log)
+        with JobLog(self.path) as log:
+            self.assertEqual(read_sections(log, index.visible()), formatLogFile(StringIO.StringIO(self.data)))
+            # kept next to the log, nothing new to index
+            self.assertTrue(os.path.exists(self.path + SECTIONS_SUFFIX))
+            self.assertFalse(SectionIndex.load(self.path).update(log))
+
+    def test_since(self):
+        split = len(''.join(self.lines[:1000]))
+        self.write(self.data)
+        with JobLog(self.path) as log:
+            sections = read_sections(log, section_index(log).visible(split))
+        self.assertEqual(''.join([content for _, _, content in sections]),
+                         ''.join(self.lines[1000:]).replace('\r', ''))
+
+    def test_size_limit(self):
+        self.write(self.data)
+        compress_log(self.path)
+        with JobLog(self.path) as log:
+            index = section_index(log)
+            sections = read_sections(log, index.visible(size_limit=10000))
+        content = ''.join([section[2] for section in sections])
+        self.assertLessEqual(len(content), 10000)
+        self.assertTrue(self.data.replace('\r', '').endswith(content))
+        self.assertEqual(sum([section[1] for section in sections]), content.count('\n'))
@@ -0,0 +1,267 @@
+import os
+import time
+import yaml
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+from collections import OrderedDict
+
+from lava_dispatcher.pipeline.log import YAMLLogger, RESULTS_FRAME
+from lava_scheduler_app.logsink import LogWriter, ResultsWriter, QUEUE_SIZE, parse_results
+
+# pylint: disable=invalid-name,too-few-public-methods,no-self-use
+
+
+class RecordingHandler(logging.Handler):
+    """
+    Records the messages and frames which ZMQPushHandler would send.
+    """
+
+    def __init__(self):
+        super(RecordingHandler, self).__init__()
+        self.formatter = logging.Formatter("%(message)s")
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((self.formatter.format(record), getattr(record, 'frame', None)))
+
+
+def record_job_log(lines):
+    """
+    Record the log of a job with a chatty console and occasional results.
+    """
+    logger = YAMLLogger('logsink-benchmark')
+    handler = RecordingHandler()
+    logger.addHandler(handler)
+    for index in range(lines):
+        logger.target("[%8.6f] usb 1-1: new high-speed USB device number %d using ehci-platform" % (index / 1000.0, index))
+        if index % 10 == 0:
+            logger.debug({'ts': time.time(), 'msg': "Received signal: <TESTCASE_RESULT> test%d pass" % index})
+        if index % 100 == 0:
+            logger.results({'testsuite': 'smoke', 'test%d' % index: 'pass'})
+            logger.results({'boot': OrderedDict([('duration', index), ('success', True)])})
+    logger.removeHandler(handler)
+    return handler.messages
+
+
+def full_scan(message):
+    """
+    What the dispatcher-master used to do with every log message.
+    """
+    try:
+        scanned = yaml.load(message, Loader=yaml.Loader)
+    except yaml.YAMLError:
+        return None
+    if type(scanned) is list and len(scanned) == 1:
+        if type(scanned[0]) is dict and 'results' in scanned[0]:
+            return scanned[0]
+    return None
+
+
+class TestResultsParsing(unittest.TestCase):
+
+    def test_results_frame(self):
+        messages = record_job_log(1)
+        frames = [frame for message, frame in messages]
+        self.assertEqual(frames, [None, None, RESULTS_FRAME, RESULTS_FRAME])
+        self.assertEqual(
+            parse_results(messages[2][0], RESULTS_FRAME),
+            {'results': {'testsuite': 'smoke', 'test0': 'pass'}})
+        scanned = parse_results(messages[3][0], RESULTS_FRAME)
+        self.assertEqual(scanned['results']['boot'], OrderedDict([('duration', 0), ('success', True)]))
+        self.assertIsNone(parse_results(messages[0][0]))
+
+    def test_old_dispatcher(self):
+        # four frame messages from older dispatchers are still detected
+        messages = record_job_log(1)
+        self.assertEqual(
+            parse_results(messages[2][0]),
+            {'results': {'testsuite': 'smoke', 'test0': 'pass'}})
+
+    def test_replay(self):
+        """
+        Replay a recorded job log, only the messages tagged with the
+        results frame are parsed and the same results are found as
+        when parsing every message.
+        """
+        messages = record_job_log(2000)
+        expected = [full_scan(message) for message, frame in messages]
+        parsed = []
+        load = yaml.load
+
+        def counting_load(stream, Loader=None):  # pylint: disable=invalid-name
+            parsed.append(stream)
+            return load(stream, Loader=Loader)
+
+        yaml.load = counting_load
+        try:
+            found = [parse_results(message, frame) for message, frame in messages]
+        finally:
+            yaml.load = load
+        self.assertEqual(expected, found)
+        self.assertEqual(40, len([item for item in found if item]))
+        self.assertEqual(parsed, [message for message, frame in messages if frame == RESULTS_FRAME])
+
+
+class FakeStore(object):
+    """
+    Stands in for the ResultsStore of a job.
+    """
+
+    def __init__(self, fail=False):
+        self.cases = []
+        self.stored = []
+        self.fail = fail
+
+    def tick(self):
+        pass
+
+    def flush(self):
+        if self.fail:
+            raise RuntimeError("database unavailable")
+        self.stored.extend(self.cases)
+        self.cases = []
+
+
+class FakeResultsWriter(ResultsWriter):
+
+    def __init__(self, failing=None):
+        super(FakeResultsWriter, self).__init__()
+        self.failing = failing or []
+        # job_id: every store created for the job
+        self.created = {}
+        # (job_id, results) written without a store
+        self.written = []
+
+    def _new_store(self, job_id):
+        store = FakeStore(job_id in self.failing)
+        self.created.setdefault(job_id, []).append(store)
+        return store
+
+    def _map_results(self, job_id, scanned, store):
+        if store is None:
+            self.written.append((job_id, scanned))
+        else:
+            store.cases.append(scanned)
+        return True
+
+
+class TestResultsWriter(unittest.TestCase):
+
+    def setUp(self):
+        super(TestResultsWriter, self).setUp()
+        self.writer = FakeResultsWriter(failing=['3'])
+        self.writer.start()
+
+    def tearDown(self):
+        self.writer.queue.put(None)
+        self.writer.join()
+        super(TestResultsWriter, self).tearDown()
+
+    def test_bounded(self):
+        self.assertEqual(self.writer.queue.maxsize, QUEUE_SIZE)
+
+    def test_end(self):
+        for index in range(3):
+            self.writer.put(1, {'results': {'test%d' % index: 'pass'}})
+        self.writer.put(2, {'results': {'test': 'pass'}})
+        done = threading.Event()
+        self.writer.job_finished(1, done)
+        self.assertTrue(done.wait(10))
+        # all the results of the job are stored once END has been handled
+        store = self.writer.created['1'][0]
+        self.assertEqual(store.stored, [{'results': {'test%d' % index: 'pass'}} for index in range(3)])
+        self.assertEqual(store.cases, [])
+        # other jobs are left alone
+        self.assertEqual(self.writer.created['2'][0].stored, [])
+
+    def test_late_results(self):
+        self.writer.put(1, {'results': {'test': 'pass'}})
+        done = threading.Event()
+        self.writer.job_finished(1, done)
+        self.assertTrue(done.wait(10))
+        self.writer.put(1, {'results': {'late': 'pass'}})
+        done = threading.Event()
+        self.writer.job_finished(2, done)
+        self.assertTrue(done.wait(10))
+        # written at once, no store is kept for the job
+        self.assertEqual(self.writer.written, [('1', {'results': {'late': 'pass'}})])
+        self.assertEqual(len(self.writer.created['1']), 1)
+        self.assertNotIn('1', self.writer.stores)
+
+    def test_end_unknown_job(self):
+        done = threading.Event()
+        self.writer.job_finished(4, done)
+        self.assertTrue(done.wait(10))
+
+    def test_failed_flush(self):
+        self.writer.put(3, {'results': {'test': 'pass'}})
+        done = threading.Event()
+        self.writer.job_finished(3, done)
+        # the results are lost but the master is not held up
+        self.assertTrue(done.wait(10))
+        self.writer.put(1, {'results': {'test': 'pass'}})
+        done = threading.Event()
+        self.writer.job_finished(1, done)
+        self.assertTrue(done.wait(10))
+        self.assertEqual(self.writer.created['1'][0].stored, [{'results': {'test': 'pass'}}])
+
+    def test_stop(self):
+        self.writer.put(2, {'results': {'test': 'pass'}})
+        self.writer.queue.put(None)
+        self.writer.join()
+        self.assertEqual(self.writer.created['2'][0].stored, [{'results': {'test': 'pass'}}])
+        # tearDown stops the writer again
+        self.writer = FakeResultsWriter()
+        self.writer.start()
+
+
+class TestLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        super(TestLogWriter, self).setUp()
+        self.output_dir = tempfile.mkdtemp()
+        self.writer = LogWriter(self.output_dir)
+        self.writer.results = FakeResultsWriter()
+        self.writer.start()
+
+    def tearDown(self):
+        self.writer.stop()
+        shutil.rmtree(self.output_dir)
+        super(TestLogWriter, self).tearDown()
+
+    def test_end(self):
+        messages = record_job_log(1)
+        self.writer.put([['1', '1.1', 'fake-action', message, frame] if frame else ['1', '1.1', 'fake-action', message]
+                         for message, frame in messages])
+        self.assertTrue(self.writer.job_finished('1').wait(10))
+        # once END is done, the logs are on disk and the results are stored
+        with open(os.path.join(self.output_dir, 'job-1', 'output.txt')) as output:
+            self.assertEqual(output.read(), ''.join([message + '\n' for message, frame in messages]))
+        self.assertEqual(self.writer.results.created['1'][0].stored, [
+            parse_results(message, frame) for message, frame in messages if frame])
+        self.assertNotIn('1', self.writer.results.stores)
+
+    def test_frames(self):
+        # four frames from older dispatchers, five with an empty or unknown frame
+        self.writer.put([['2', '1.1', 'fake-action', '- {target: one}'],
+                         ['2', '1.1', 'fake-action', '- {target: two}', ''],
+                         ['2', '1.1', 'fake-action', '- {target: three}', 'unknown']])
+        self.assertTrue(self.writer.job_finished('2').wait(10))
+        with open(os.path.join(self.output_dir, 'job-2', 'output.txt')) as output:
+            self.assertEqual(output.read(), '- {target: one}\n- {target: two}\n- {target: three}\n')
+
+    def test_full(self):
+        # a writer which is not running never empties its queue
+        writer = LogWriter(self.output_dir)
+        self.assertFalse(writer.full())
+        for index in range(QUEUE_SIZE):
+            writer.put([['3', '1.1', 'fake-action', '- {target: %d}' % index]])
+        self.assertTrue(writer.full())
+        # the master loop is never held up, it stops reading the log socket instead
+        writer.put([['3', '1.1', 'fake-action', '- {target: late}']])
+        done = writer.job_finished('3')
+        self.assertFalse(done.is_set())
+        self.assertEqual(writer.queue.qsize(), QUEUE_SIZE + 2)
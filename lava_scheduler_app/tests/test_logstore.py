@@ -0,0 +1,159 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from lava_scheduler_app import logstore
+from lava_scheduler_app.logsink import LogWriter
+from lava_scheduler_app.logstore import (
+    INDEX_SUFFIX,
+    JobLog,
+    compress_log,
+    recover_index,
+)
+
+# pylint: disable=invalid-name,too-many-public-methods
+
+
+def job_log_lines(count):
+    """
+    Lines of output.txt, as written by the master for a pipeline job.
+    """
+    lines = []
+    for index in range(count):
+        if index % 10:
+            lines.append('- {target: "[%8.6f] usb 1-1: new high-speed USB device number %d", '
+                         'ts: "2016-03-01T10:12:%02d.%06d"}\n' % (index / 1000.0, index, index % 60, index))
+        else:
+            lines.append("- {debug: 'Received signal: <TESTCASE> test%d pass'}\n" % index)
+    return lines
+
+
+class CountingFile(object):
+    """
+    Counts the bytes read from the file it wraps.
+    """
+
+    def __init__(self, fileobj, read):
+        self.fileobj = fileobj
+        self.counted = read
+
+    def read(self, *args):
+        data = self.fileobj.read(*args)
+        self.counted.append(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fileobj.close()
+
+
+class TestJobLog(unittest.TestCase):
+
+    def setUp(self):
+        super(TestJobLog, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'job-1', 'output.txt')
+        self.lines = job_log_lines(50000)
+        self.data = ''.join(self.lines)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestJobLog, self).tearDown()
+
+    def write_log(self):
+        writer = LogWriter(self.tmpdir)
+        for line in self.lines:
+            writer.write(['1', '0', 'dispatcher', line[:-1]])
+        writer.files.close()
+
+    def check(self, log):
+        self.assertEqual(log.size(), len(self.data))
+        self.assertEqual(log.line_count(), len(self.lines))
+        self.assertEqual(log.lines(0, 3), ''.join(self.lines[:3]))
+        self.assertEqual(log.lines(20000, 30000), ''.join(self.lines[20000:30000]))
+        self.assertEqual(log.lines(49990), ''.join(self.lines[49990:]))
+        self.assertEqual(log.lines(60000, 60010), '')
+        self.assertEqual(log.tail(5), ''.join(self.lines[-5:]))
+        self.assertEqual(log.read(1000, 100), self.data[1000:1100])
+        self.assertEqual(log.read(len(self.data) - 10), self.data[-10:])
+        self.assertEqual(log.read(len(self.data)), '')
+
+    def test_index(self):
+        self.write_log()
+        self.assertEqual(os.path.getsize(self.path + INDEX_SUFFIX), 8 * len(self.lines))
+        with JobLog(self.path) as log:
+            self.assertFalse(log.compressed)
+            self.check(log)
+
+    def test_recover(self):
+        self.write_log()
+        # the index lags behind the log
+        with open(self.path + INDEX_SUFFIX, 'r+b') as index:
+            index.truncate(8 * 1000 + 3)
+        with JobLog(self.path) as log:
+            self.check(log)
+        self.assertEqual(recover_index(self.path), len(self.data))
+        self.assertEqual(os.path.getsize(self.path + INDEX_SUFFIX), 8 * len(self.lines))
+        # the index is ahead of the log
+        with open(self.path, 'ab') as output:
+            output.write('partial')
+        with open(self.path + INDEX_SUFFIX, 'ab') as index:
+            index.write('\xff' * 16)
+        with JobLog(self.path) as log:
+            self.assertEqual(log.line_count(), len(self.lines))
+            self.assertEqual(log.read(len(self.data)), 'partial')
+        # no index, as for older logs
+        os.unlink(self.path + INDEX_SUFFIX)
+        with JobLog(self.path) as log:
+            self.assertEqual(log.tail(1), self.lines[-1])
+
+    def test_compressed(self):
+        self.write_log()
+        sizes = compress_log(self.path)
+        self.assertEqual(sizes[0], len(self.data))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + INDEX_SUFFIX))
+        with JobLog(self.path) as log:
+            self.assertTrue(log.compressed)
+            self.check(log)
+            self.assertEqual(log.open_text().read(), self.data.decode('utf-8'))
+        # still a valid gzip file
+        self.assertEqual(gzip.open(self.path + '.gz').read(), self.data)
+        self.assertIsNone(compress_log(self.path))
+
+    def test_missing(self):
+        self.assertIsNone(JobLog.find(self.path))
+
+    def test_disk_usage(self):
+        self.write_log()
+        uncompressed = os.path.getsize(self.path) + os.path.getsize(self.path + INDEX_SUFFIX)
+        compress_log(self.path)
+        compressed = os.path.getsize(self.path + '.gz') + os.path.getsize(self.path + '.gz' + INDEX_SUFFIX)
+        self.assertGreater(uncompressed / float(compressed), 4)
+
+    def test_tail_reads(self):
+        self.write_log()
+        read = []
+
+        def counting_open(path, mode='r'):
+            return CountingFile(open(path, mode), read)
+
+        logstore.open = counting_open
+        try:
+            with JobLog(self.path) as log:
+                for _ in range(100):
+                    self.assertEqual(log.tail(100), ''.join(self.lines[-100:]))
+        finally:
+            del logstore.open
+        # the last lines and a few index entries, not the whole log
+        tail = len(''.join(self.lines[-100:]))
+        self.assertGreaterEqual(sum(read), 100 * tail)
+        self.assertLess(sum(read), 2 * 100 * tail)
+        self.assertLess(sum(read), len(self.data))
@@ -0,0 +1,187 @@
+import importlib
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from django.db import connection
+
+import lava_scheduler_app.models
+from lava_scheduler_app.models import Device, TestJob, Worker
+from lava_scheduler_app.notify import Listener, NotificationsUnavailable
+from lava_scheduler_app.tests.test_submission import TestCaseWithFactory
+
+# pylint: disable=invalid-name,protected-access
+
+Notification = namedtuple('Notification', 'pid channel payload')
+
+
+class FakeConnection(object):
+
+    def __init__(self, notifies):
+        self.notifies = notifies
+        self.polled = 0
+
+    def poll(self):
+        self.polled += 1
+
+
+class FakeControler(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def send_multipart(self, message):
+        self.messages.append(message)
+
+
+class TestNotify(TestCaseWithFactory):
+
+    def setUp(self):
+        super(TestNotify, self).setUp()
+        self.notified = []
+        self.notify = lava_scheduler_app.models.notify
+        lava_scheduler_app.models.notify = self.notified.append
+        self.worker = Worker.objects.create(hostname='worker-1')
+        self.device = self.factory.make_device(is_pipeline=True, worker_host=self.worker)
+
+    def tearDown(self):
+        lava_scheduler_app.models.notify = self.notify
+        super(TestNotify, self).tearDown()
+
+    def make_pipeline_job(self):
+        job = self.factory.make_testjob()
+        job.is_pipeline = True
+        job.save()
+        return job
+
+    def test_testjob_notify(self):
+        job = self.make_pipeline_job()
+        # not assigned to a device yet
+        self.assertEqual(self.notified, [])
+        job.actual_device = self.device
+        job.save()
+        self.assertEqual(self.notified, [job.id])
+        job.status = TestJob.RUNNING
+        job.save()
+        self.assertEqual(self.notified, [job.id])
+        job.status = TestJob.CANCELING
+        job.save()
+        self.assertEqual(self.notified, [job.id, job.id])
+
+    def test_testjob_notify_not_pipeline(self):
+        job = self.factory.make_testjob()
+        job.actual_device = self.device
+        job.status = TestJob.CANCELING
+        job.save()
+        self.assertEqual(self.notified, [])
+
+    def test_device_notify(self):
+        job = self.factory.make_testjob()
+        self.device.status = Device.RESERVED
+        self.device.save()
+        # no job to start
+        self.assertEqual(self.notified, [])
+        self.device.current_job = job
+        self.device.save()
+        self.assertEqual(self.notified, [job.id])
+        self.device.is_pipeline = False
+        self.device.save()
+        self.assertEqual(self.notified, [job.id])
+
+    def test_listener_drain(self):
+        listener = Listener()
+        try:
+            own_pid = listener.backend_pid()
+            listener.conn.close()
+            listener.conn = FakeConnection([
+                Notification(own_pid + 1, 'lava_scheduler', '3'),
+                Notification(own_pid, 'lava_scheduler', '4'),
+                Notification(own_pid + 1, 'lava_scheduler', 'invalid'),
+                Notification(own_pid + 2, 'lava_scheduler', '3'),
+                Notification(own_pid + 2, 'lava_scheduler', '5'),
+            ])
+            # the changes made by the caller itself are skipped
+            self.assertEqual(listener.drain(), set([3, 5]))
+            self.assertEqual(listener.conn.polled, 1)
+            self.assertEqual(listener.conn.notifies, [])
+            self.assertEqual(listener.drain(), set())
+        finally:
+            listener.conn = FakeConnection([])
+
+    def test_listener_unavailable(self):
+        connection.vendor = 'sqlite'
+        try:
+            self.assertRaises(NotificationsUnavailable, Listener)
+        finally:
+            del connection.vendor
+
+    def test_notified_jobs(self):
+        master = importlib.import_module('lava_scheduler_app.management.commands.dispatcher-master')
+        command = master.Command()
+        command.logger = logging.getLogger('dispatcher-master')
+        command.canceling = {}
+        started = []
+        command._start_jobs = lambda jobs, controler, options: started.extend(jobs)
+        controler = FakeControler()
+
+        waiting = self.make_pipeline_job()
+        assigned = self.make_pipeline_job()
+        assigned.actual_device = self.device
+        assigned.save()
+        other = self.make_pipeline_job()
+        other.actual_device = self.factory.make_device(is_pipeline=True, worker_host=self.worker)
+        other.save()
+        canceling = self.make_pipeline_job()
+        canceling.actual_device = self.device
+        canceling.status = TestJob.CANCELING
+        canceling.save()
+
+        command._notified_jobs(set([waiting.id, assigned.id, canceling.id]), controler, {})
+        # only the notified jobs, not the whole queue
+        self.assertEqual(started, [assigned])
+        self.assertEqual(controler.messages, [['worker-1', 'CANCEL', str(canceling.id)]])
+        self.assertIn(canceling.id, command.canceling)
+
+    def test_notified_multinode(self):
+        master = importlib.import_module('lava_scheduler_app.management.commands.dispatcher-master')
+        command = master.Command()
+        command.logger = logging.getLogger('dispatcher-master')
+        command.canceling = {}
+        started = []
+        command._start_jobs = lambda jobs, controler, options: started.extend(jobs)
+        jobs = []
+        for device in [self.device, self.factory.make_device(is_pipeline=True, worker_host=self.worker)]:
+            job = self.make_pipeline_job()
+            job.target_group = 'group-1'
+            job.actual_device = device
+            job.save()
+            jobs.append(job)
+        # the last job of the group to get a device is enough to start the whole group
+        command._notified_jobs(set([jobs[1].id]), FakeControler(), {})
+        self.assertEqual(sorted(started, key=lambda job: job.id), jobs)
+
+    def test_finish_jobs(self):
+        master = importlib.import_module('lava_scheduler_app.management.commands.dispatcher-master')
+        command = master.Command()
+        command.logger = logging.getLogger('dispatcher-master')
+        controler = FakeControler()
+        job = self.make_pipeline_job()
+        unknown = job.id + 1000
+        waiting = threading.Event()
+        stored = threading.Event()
+        stored.set()
+        command.ending = {
+            job.id: ('worker-1', TestJob.COMPLETE, waiting, time.time()),
+            unknown: ('worker-1', TestJob.COMPLETE, stored, time.time()),
+        }
+        command._finish_jobs(controler)
+        # the job waits for its results, the loop does not
+        self.assertEqual(list(command.ending), [job.id])
+        self.assertEqual(controler.messages, [['worker-1', 'END_OK', str(unknown)]])
+        # the job ends without its results after END_TIMEOUT
+        command.ending[job.id] = ('worker-1', TestJob.COMPLETE, waiting, time.time() - master.END_TIMEOUT)
+        command._finish_jobs(controler)
+        self.assertEqual(command.ending, {})
+        self.assertEqual(controler.messages[-1], ['worker-1', 'END_OK', str(job.id)])
+        self.assertEqual(TestJob.objects.get(id=job.id).status, TestJob.COMPLETE)
@@ -1,4 +1,5 @@
 import os
+import time
 import yaml
 import jinja2
 import logging
@@ -11,8 +12,13 @@ from lava_scheduler_app.models import (
     Tag,
     DevicesUnavailableException,
     _pipeline_protocols,
+    _device_types_version,
+    _DEVICE_CONFIGURATIONS,
+    _DEVICE_TYPES_VERSIONS,
+    DEVICE_TYPES_CHECK_INTERVAL,
 )
-from django.db import models
+from django.db import connection, models
+from django.test.utils import CaptureQueriesContext
 from django_testscenarios.ubertest import TestCase
 from django.contrib.auth.models import Group, Permission, User
 from collections import OrderedDict
@@ -240,6 +246,50 @@ class TestPipelineSubmit(TestCaseWithFactory):
         self.assertTrue(device.is_pipeline)
         self.assertTrue(device.is_exclusive)
 
+    def test_device_configuration_cache(self):
+        device = Device.objects.get(hostname="fakeqemu1")
+        config = device.load_device_configuration()
+        with CaptureQueriesContext(connection) as queries:
+            cached = device.load_device_configuration()
+        # only the stored device dictionary is checked
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(config, cached)
+        # callers get their own copy
+        del cached['device_type']
+        self.assertEqual(config, device.load_device_configuration())
+        self.assertEqual(device.load_device_configuration({'arch': 'amd64'})['device_type'], config['device_type'])
+
+        version = _DEVICE_CONFIGURATIONS[device.hostname][1]
+        device_dict = DeviceDictionary.get(device.hostname)
+        device_dict.parameters = {'extends': 'qemu.yaml', 'arch': 'amd64', 'exclusive': 'True'}
+        device_dict.save()
+        self.assertTrue(device.is_exclusive)
+        self.assertEqual(config, device.load_device_configuration())
+        self.assertNotEqual(version, _DEVICE_CONFIGURATIONS[device.hostname][1])
+
+    def test_device_types_version(self):
+        path = jinja_template_path()
+        listdir = os.listdir
+        listed = []
+
+        def counting_listdir(directory):
+            listed.append(directory)
+            return listdir(directory)
+
+        os.listdir = counting_listdir
+        try:
+            _DEVICE_TYPES_VERSIONS.pop(path, None)
+            version = _device_types_version(path)
+            # the templates are not listed on each lookup
+            self.assertEqual(_device_types_version(path), version)
+            self.assertEqual(len(listed), 1)
+            # but again once the interval has passed
+            _DEVICE_TYPES_VERSIONS[path] = (time.time() - DEVICE_TYPES_CHECK_INTERVAL, ())
+            self.assertEqual(_device_types_version(path), version)
+            self.assertEqual(len(listed), 2)
+        finally:
+            os.listdir = listdir
+
 
 class TestPipelineStore(TestCaseWithFactory):
 
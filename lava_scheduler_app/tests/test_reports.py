@@ -0,0 +1,114 @@
+import datetime
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from lava_scheduler_app.models import DailyJobReport, TestJob
+from lava_scheduler_app.tests.test_submission import TestCaseWithFactory
+from lava_scheduler_app.views import _job_reports
+
+# pylint: disable=invalid-name,too-many-public-methods
+
+
+class TestDailyJobReport(TestCaseWithFactory):
+
+    def setUp(self):
+        super(TestDailyJobReport, self).setUp()
+        self.device_type = self.factory.make_device_type('panda')
+        self.panda01 = self.factory.make_device(self.device_type, hostname='panda01')
+        self.panda02 = self.factory.make_device(self.device_type, hostname='panda02')
+        self.now = timezone.now()
+
+    def make_jobs(self, count):
+        """
+        count jobs of each status, device and kind on each of the last 10 days
+        """
+        user = self.factory.make_user()
+        statuses = [TestJob.COMPLETE, TestJob.INCOMPLETE, TestJob.CANCELED, TestJob.RUNNING]
+        for day in range(10):
+            for device in [self.panda01, self.panda02]:
+                for health_check in [True, False]:
+                    for status in statuses * count:
+                        TestJob.objects.create(
+                            submitter=user, user=user, definition='{}', actual_device=device,
+                            health_check=health_check, status=status,
+                            start_time=self.now - datetime.timedelta(days=day))
+
+    def reports(self):
+        return dict([((report.day, report.device_id, report.health_check), (report.passed, report.failed))
+                     for report in DailyJobReport.objects.all()])
+
+    def test_update(self):
+        self.make_jobs(1)
+        today = DailyJobReport.day_of(self.now)
+        reports = self.reports()
+        self.assertEqual(len(reports), 40)
+        self.assertEqual(reports[(today, 'panda01', True)], (1, 2))
+        # saving a job again does not count it twice
+        job = TestJob.objects.filter(status=TestJob.INCOMPLETE, actual_device=self.panda01)[0]
+        job.failure_comment = 'annotated'
+        job.save()
+        self.assertEqual(self.reports(), reports)
+        job = TestJob.objects.filter(
+            status=TestJob.RUNNING, actual_device=self.panda01, health_check=True,
+            start_time__gt=self.now - datetime.timedelta(hours=1))[0]
+        job.status = TestJob.COMPLETE
+        job.save()
+        self.assertEqual(self.reports()[(today, 'panda01', True)], (2, 2))
+
+    def test_update_concurrent(self):
+        self.make_jobs(1)
+        today = DailyJobReport.day_of(self.now)
+        DailyJobReport.objects.all().delete()
+        create = DailyJobReport.objects.create
+        created = []
+
+        def racing_create(**kwargs):
+            # another save creates the same report first
+            if not created:
+                created.append(create(**dict(kwargs, passed=0, failed=0)))
+            return create(**kwargs)
+
+        DailyJobReport.objects.create = racing_create
+        try:
+            DailyJobReport.update(today, 'panda01', True)
+        finally:
+            del DailyJobReport.objects.create
+        self.assertEqual(len(created), 1)
+        self.assertEqual(self.reports(), {(today, 'panda01', True): (1, 2)})
+
+    def test_rebuild(self):
+        self.make_jobs(2)
+        reports = self.reports()
+        DailyJobReport.objects.all().delete()
+        self.assertEqual(DailyJobReport.rebuild(), 40)
+        self.assertEqual(self.reports(), reports)
+        DailyJobReport.objects.all().delete()
+        DailyJobReport.rebuild(DailyJobReport.day_of(self.now) - datetime.timedelta(days=1))
+        self.assertEqual(len(self.reports()), 8)
+
+    def test_job_reports(self):
+        self.make_jobs(1)
+        data = _job_reports()
+        self.assertEqual(len(data['health_day_report']), 7)
+        self.assertEqual(len(data['job_week_report']), 10)
+        today = data['health_day_report'][-1]
+        self.assertEqual((today['pass'], today['fail']), (2, 4))
+        self.assertEqual(today['date'], DailyJobReport.day_of(self.now).strftime('%m-%d'))
+        week = data['job_week_report'][-1]
+        self.assertEqual((week['pass'], week['fail']), (14, 28))
+        self.assertEqual(sum([item['pass'] for item in data['job_week_report']]), 20)
+        week = _job_reports('&device=panda01', device=self.panda01)['health_week_report'][-1]
+        self.assertEqual((week['pass'], week['fail']), (7, 14))
+        self.assertIn('device=panda01', week['failure_url'])
+
+    def test_constant_queries(self):
+        def report_queries(count):
+            self.make_jobs(count)
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse('lava.scheduler.reports'))
+                self.client.get(reverse('lava.scheduler.device_type_report', args=['panda']))
+            return len(queries)
+
+        self.assertEqual(report_queries(1), report_queries(5))
@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import yaml
 import cStringIO
 import json
@@ -7,9 +9,14 @@ import logging
 import sys
 import warnings
 import unittest
+import zlib
 from dashboard_app.models import BundleStream
 
 from django.contrib.auth.models import Group, Permission, User
+from django.core.exceptions import PermissionDenied
+from django.db import connection
+from django.http import Http404
+from django.test.utils import CaptureQueriesContext
 from django.test import TransactionTestCase
 from django.test.client import Client
 from django.core.exceptions import ValidationError
@@ -29,6 +36,7 @@ from lava_scheduler_app.models import (
     SubmissionException,
     _check_exclusivity,
 )
+from lava_scheduler_app.views import get_restricted_job
 from lava_scheduler_daemon.dbjobsource import DatabaseJobSource
 from lava_scheduler_app.schema import validate_submission
 import simplejson
@@ -878,6 +886,139 @@ actions:
         job = TestJob.objects.get(id=job_id)
         self.assertTrue(job.is_pipeline)
 
+    def test_job_output_chunk(self):
+        user = User.objects.create_user('test', 'e@mail.invalid', 'test')
+        job = self.factory.make_testjob(submitter=user)
+        server = self.server_proxy('test', 'test')
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with self.settings(MEDIA_ROOT=media_root):
+            # not started yet
+            chunk = server.scheduler.job_output_chunk(job.id)
+            self.assertEqual((chunk['data'].data, chunk['offset'], chunk['finished']), ('', 0, False))
+
+            content = ''.join(['- {target: "line %d"}\n' % index for index in range(10000)])
+            os.makedirs(job.output_dir)
+            with open(os.path.join(job.output_dir, 'output.txt'), 'w') as output:
+                output.write(content)
+            data = []
+            offset = 0
+            while offset < len(content):
+                chunk = server.scheduler.job_output_chunk(job.id, offset, 50000, True)
+                self.assertTrue(chunk['compressed'])
+                self.assertLess(len(chunk['data'].data), 50000)
+                data.append(zlib.decompress(chunk['data'].data))
+                offset = chunk['offset']
+                self.assertFalse(chunk['finished'])
+            self.assertEqual(''.join(data), content)
+
+            # nothing new
+            chunk = server.scheduler.job_output_chunk(job.id, offset, 50000, True)
+            self.assertEqual(zlib.decompress(chunk['data'].data), '')
+            unchanged = server.scheduler.job_output_chunk(job.id, offset, 50000, True, chunk['etag'])
+            self.assertFalse(unchanged['modified'])
+            self.assertEqual(unchanged['offset'], offset)
+
+            job.status = TestJob.COMPLETE
+            job.save()
+            chunk = server.scheduler.job_output_chunk(job.id, offset, 50000, False, chunk['etag'])
+            self.assertTrue(chunk['modified'])
+            self.assertTrue(chunk['finished'])
+            chunk = server.scheduler.job_output_chunk(job.id, 100, 10)
+            self.assertEqual(chunk['data'].data, content[100:110])
+            self.assertEqual(chunk['offset'], 110)
+            self.assertFalse(chunk['finished'])
+
+    def make_visibility_fixtures(self, user, count):
+        """
+        Devices and jobs for each combination of device type, device
+        ownership, group membership and job restriction.
+        """
+        group = self.factory.make_group()
+        user.groups.add(group)
+        other = self.factory.make_user()
+        public_type = self.factory.make_device_type()
+        hidden_type = self.factory.make_hidden_device_type()
+        owned_type = self.factory.make_hidden_device_type()
+        empty_type = self.factory.make_device_type()
+        hostnames = []
+        job_ids = []
+        for _ in range(count):
+            devices = [
+                self.factory.make_device(public_type),
+                self.factory.make_device(public_type, is_public=False, user=other),
+                self.factory.make_device(public_type, is_public=False, group=group),
+                self.factory.make_device(public_type, is_public=False, user=user, status=Device.RETIRED),
+                self.factory.make_device(hidden_type, is_public=False, user=other),
+                self.factory.make_device(owned_type, is_public=False, group=group),
+            ]
+            hostnames.extend([device.hostname for device in devices])
+            for device in devices:
+                for owner in [{'user': user}, {'user': other}, {'group': group}, {'user': other, 'is_public': True}]:
+                    job_ids.append(TestJob.objects.create(
+                        submitter=other, requested_device=device, definition='{}', **owner).id)
+            job = TestJob.objects.create(
+                submitter=other, user=other, requested_device_type=empty_type, definition='{}')
+            job.sub_id = '%d.0' % job.id
+            job.save()
+            job_ids.append(job.sub_id)
+            job_ids.append(TestJob.objects.create(submitter=other, user=other, definition='{}').id)
+        types = [public_type.name, hidden_type.name, owned_type.name, empty_type.name, 'missing']
+        return hostnames + ['missing'], job_ids + [999999], types
+
+    def test_user_can_view(self):
+        """
+        The results are those of the model methods, in a number of queries
+        which does not depend on the length of the lists.
+        """
+        user = User.objects.create_user('test', 'e@mail.invalid', 'test')
+        user.user_permissions.add(Permission.objects.get(codename='add_testjob'))
+        server = self.server_proxy('test', 'test')
+
+        def expected_jobs(job_ids):
+            retval = {}
+            for job_id in job_ids:
+                try:
+                    get_restricted_job(user, job_id)
+                except Http404:
+                    continue
+                except PermissionDenied:
+                    retval[str(job_id)] = False
+                    continue
+                retval[str(job_id)] = True
+            return retval
+
+        def expected_devices(hostnames):
+            retval = {}
+            devices = Device.objects.in_bulk(hostnames)
+            for device in [devices[hostname] for hostname in hostnames if hostname in devices]:
+                if device.device_type.owners_only and not device.is_owned_by(user):
+                    continue
+                status = {'visible': device.is_visible_to(user)}
+                if status['visible']:
+                    status.update({'is_pipeline': device.is_pipeline, 'exclusive': device.is_exclusive})
+                retval.setdefault(device.device_type.name, []).append({device.hostname: status})
+            return retval
+
+        def expected_types(types):
+            return dict([(device_type.name, any([device.can_submit(user) for device in device_type.device_set.all()]))
+                         for device_type in DeviceType.objects.filter(name__in=types)])
+
+        def check(count):
+            hostnames, job_ids, types = self.make_visibility_fixtures(user, count)
+            queries = []
+            for method, items, expected in [
+                    (server.system.user_can_view_jobs, job_ids, expected_jobs),
+                    (server.system.user_can_view_devices, hostnames, expected_devices),
+                    (server.system.user_can_submit_to_types, types, expected_types)]:
+                with CaptureQueriesContext(connection) as captured:
+                    result = method(items)
+                queries.append(len(captured))
+                self.assertEqual(result, expected(items))
+            return queries
+
+        self.assertEqual(check(1), check(10))
+
 
 class TransactionTestCaseWithFactory(TransactionTestCase):
 
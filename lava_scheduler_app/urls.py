@@ -114,6 +114,9 @@ urlpatterns = patterns(
     url(r'^job/(?P<pk>[0-9]+)/output$',
         'job_output',
         name='lava.scheduler.job.output'),
+    url(r'^job/(?P<pk>[0-9]+)/log_lines$',
+        'job_log_lines',
+        name='lava.scheduler.job.log_lines'),
     url(r'^job/(?P<pk>[0-9]+)/log_incremental$',
         'job_log_incremental',
         name='lava.scheduler.job.log_incremental'),
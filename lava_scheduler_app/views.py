@@ -11,7 +11,7 @@ from django import forms
 
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
-from django.db.models import Count
+from django.db.models import Count, Sum
 from django.http import (
     HttpResponse,
     Http404,
@@ -47,11 +47,12 @@ from lava_server.bread_crumbs import (
 )
 
 from lava_scheduler_app.logfile_helper import (
-    formatLogFile,
-    getDispatcherErrors,
-    getDispatcherLogMessages
+    getDispatcherLogMessages,
+    read_sections,
+    section_index,
 )
 from lava_scheduler_app.models import (
+    DailyJobReport,
     Device,
     DeviceType,
     DeviceStateTransition,
@@ -231,7 +232,8 @@ class FailureTableView(JobTableView):
 
         start = self.request.GET.get('start', None)
         if start:
-            now = timezone.now()
+            # whole days, as in the reports, the end of today is 0
+            now = DailyJobReport.day_range(DailyJobReport.day_of(timezone.now()))[1]
             start = now + datetime.timedelta(int(start))
 
             end = self.request.GET.get('end', None)
@@ -325,15 +327,17 @@ def index(request):
     discrete_data.update(dt_overview_table.prepare_discrete_data(dt_overview_data))
 
     (num_online, num_not_retired) = _online_total()
-    health_check_completed = health_jobs_in_hr().filter(status=TestJob.COMPLETE).count()
-    health_check_total = health_jobs_in_hr().count()
+    # devices with a health check in the last day, and with a completed one
+    health_checks = health_jobs_in_hr().values_list('actual_device', 'status')
+    health_check_completed = len(set([device for device, status in health_checks if status == TestJob.COMPLETE]))
+    health_check_total = len(set([device for device, status in health_checks]))
     running_jobs_count = TestJob.objects.filter(status=TestJob.RUNNING).count()
     active_devices_count = Device.objects.filter(status__in=[Device.RESERVED, Device.RUNNING]).count()
     return render(
         request,
         "lava_scheduler_app/index.html",
         {
-            'device_status': "%d/%d" % _online_total(),
+            'device_status': "%d/%d" % (num_online, num_not_retired),
             'num_online': num_online,
             'num_not_retired': num_not_retired,
             'num_jobs_running': running_jobs_count,
@@ -352,86 +356,58 @@ def index(request):
         })
 
 
-def type_report_data(start_day, end_day, dt, health_check):
-    now = timezone.now()
-    start_date = now + datetime.timedelta(start_day)
-    end_date = now + datetime.timedelta(end_day)
-
-    res = TestJob.objects.filter(actual_device__in=Device.objects.filter(device_type=dt),
-                                 health_check=health_check,
-                                 start_time__range=(start_date, end_date),
-                                 status__in=(TestJob.COMPLETE, TestJob.INCOMPLETE,
-                                             TestJob.CANCELED, TestJob.CANCELING),).values('status')
-    url = reverse('lava.scheduler.failure_report')
-    params = 'start=%s&end=%s&device_type=%s&health_check=%d' % (start_day, end_day, dt, health_check)
-    return {
-        'pass': res.filter(status=TestJob.COMPLETE).count(),
-        'fail': res.exclude(status=TestJob.COMPLETE).count(),
-        'date': start_date.strftime('%m-%d'),
-        'failure_url': '%s?%s' % (url, params),
-    }
-
-
-def device_report_data(start_day, end_day, device, health_check):
-    now = timezone.now()
-    start_date = now + datetime.timedelta(start_day)
-    end_date = now + datetime.timedelta(end_day)
-
-    res = TestJob.objects.filter(actual_device=device, health_check=health_check,
-                                 start_time__range=(start_date, end_date),
-                                 status__in=(TestJob.COMPLETE, TestJob.INCOMPLETE,
-                                             TestJob.CANCELED, TestJob.CANCELING),).values('status')
+def _job_reports(params='', **filters):
+    """
+    Pass and fail counts of the jobs which started on each of the last 7
+    days and in each of the last 10 weeks, from the DailyJobReport rollups.
+    :param params: query string selecting the same jobs in the failure report
+    :param filters: filters of the DailyJobReport rollups
+    :return: the day and week reports of health checks and of other jobs
+    """
+    today = DailyJobReport.day_of(timezone.now())
+    counts = {}
+    for row in DailyJobReport.objects.filter(
+            day__gt=today - datetime.timedelta(days=70), **filters).values(
+                'day', 'health_check').annotate(passed=Sum('passed'), failed=Sum('failed')):
+        counts[(row['day'], row['health_check'])] = (row['passed'], row['failed'])
     url = reverse('lava.scheduler.failure_report')
-    params = 'start=%s&end=%s&device=%s&health_check=%d' % (start_day, end_day, device.pk, health_check)
-    return {
-        'pass': res.filter(status=TestJob.COMPLETE).count(),
-        'fail': res.exclude(status=TestJob.COMPLETE).count(),
-        'date': start_date.strftime('%m-%d'),
-        'failure_url': '%s?%s' % (url, params),
-    }
 
+    def report(start_day, end_day, health_check):
+        passed = failed = 0
+        for day in range(start_day + 1, end_day + 1):
+            day_counts = counts.get((today + datetime.timedelta(days=day), health_check), (0, 0))
+            passed += day_counts[0]
+            failed += day_counts[1]
+        return {
+            'pass': passed,
+            'fail': failed,
+            'date': (today + datetime.timedelta(days=start_day + 1)).strftime('%m-%d'),
+            'failure_url': '%s?start=%s&end=%s&health_check=%d%s' % (
+                url, start_day, end_day, health_check, params),
+        }
 
-def job_report(start_day, end_day, health_check):
-    now = timezone.now()
-    start_date = now + datetime.timedelta(start_day)
-    end_date = now + datetime.timedelta(end_day)
-
-    res = TestJob.objects.filter(health_check=health_check,
-                                 start_time__range=(start_date, end_date),
-                                 status__in=(TestJob.COMPLETE, TestJob.INCOMPLETE,
-                                             TestJob.CANCELED, TestJob.CANCELING),).values('status')
-    url = reverse('lava.scheduler.failure_report')
-    params = 'start=%s&end=%s&health_check=%d' % (start_day, end_day, health_check)
-    return {
-        'pass': res.filter(status=TestJob.COMPLETE).count(),
-        'fail': res.exclude(status=TestJob.COMPLETE).count(),
-        'date': start_date.strftime('%m-%d'),
-        'failure_url': '%s?%s' % (url, params),
+    reports = {
+        'health_day_report': [],
+        'health_week_report': [],
+        'job_day_report': [],
+        'job_week_report': [],
     }
+    for day in reversed(range(7)):
+        reports['health_day_report'].append(report(day * -1 - 1, day * -1, True))
+        reports['job_day_report'].append(report(day * -1 - 1, day * -1, False))
+    for week in reversed(range(10)):
+        reports['health_week_report'].append(report(week * -7 - 7, week * -7, True))
+        reports['job_week_report'].append(report(week * -7 - 7, week * -7, False))
+    return reports
 
 
 @BreadCrumb("Reports", parent=index)
 def reports(request):
-    health_day_report = []
-    health_week_report = []
-    job_day_report = []
-    job_week_report = []
-    for day in reversed(range(7)):
-        health_day_report.append(job_report(day * -1 - 1, day * -1, True))
-        job_day_report.append(job_report(day * -1 - 1, day * -1, False))
-    for week in reversed(range(10)):
-        health_week_report.append(job_report(week * -7 - 7, week * -7, True))
-        job_week_report.append(job_report(week * -7 - 7, week * -7, False))
-
+    data = _job_reports()
+    data['bread_crumb_trail'] = BreadCrumbTrail.leading_to(index)
     return render_to_response(
         "lava_scheduler_app/reports.html",
-        {
-            'health_week_report': health_week_report,
-            'health_day_report': health_day_report,
-            'job_week_report': job_week_report,
-            'job_day_report': job_day_report,
-            'bread_crumb_trail': BreadCrumbTrail.leading_to(index),
-        },
+        data,
         RequestContext(request))
 
 
@@ -857,33 +833,20 @@ def device_type_health_history_log(request, pk):
 @BreadCrumb("{pk} device type report", parent=device_type_detail, needs=['pk'])
 def device_type_reports(request, pk):
     device_type = get_object_or_404(DeviceType, pk=pk)
-    health_day_report = []
-    health_week_report = []
-    job_day_report = []
-    job_week_report = []
-    for day in reversed(range(7)):
-        health_day_report.append(type_report_data(day * -1 - 1, day * -1, device_type, True))
-        job_day_report.append(type_report_data(day * -1 - 1, day * -1, device_type, False))
-    for week in reversed(range(10)):
-        health_week_report.append(type_report_data(week * -7 - 7, week * -7, device_type, True))
-        job_week_report.append(type_report_data(week * -7 - 7, week * -7, device_type, False))
-
     long_running = TestJob.objects.filter(
         actual_device__in=Device.objects.filter(device_type=device_type),
         status__in=[TestJob.RUNNING,
                     TestJob.CANCELING]).order_by('start_time')[:5]
 
+    data = _job_reports('&device_type=%s' % device_type.pk, device__device_type=device_type)
+    data.update({
+        'device_type': device_type,
+        'long_running': long_running,
+        'bread_crumb_trail': BreadCrumbTrail.leading_to(device_type_reports, pk=pk),
+    })
     return render_to_response(
         "lava_scheduler_app/devicetype_reports.html",
-        {
-            'device_type': device_type,
-            'health_week_report': health_week_report,
-            'health_day_report': health_day_report,
-            'job_week_report': job_week_report,
-            'job_day_report': job_day_report,
-            'long_running': long_running,
-            'bread_crumb_trail': BreadCrumbTrail.leading_to(device_type_reports, pk=pk),
-        },
+        data,
         RequestContext(request))
 
 
@@ -1290,32 +1253,25 @@ def job_detail(request, pk):
             'description_file': description_filename(job.id)
         })
 
-    log_file = job.output_file()
-    if log_file:
-        with log_file as f:
-            f.seek(0, 2)
-            job_file_size = f.tell()
-
-        if job_file_size >= job.size_limit:
-            data.update({
-                'job_file_present': True,
-                'job_log_messages': None,
-                'levels': None,
-                'size_warning': job.size_limit,
-                'job_file_size': job_file_size,
-            })
-            return render_to_response(
-                "lava_scheduler_app/job.html", data, RequestContext(request))
+    log = job.output_log()
+    if log:
+        with log:
+            job_file_size = log.size()
+            if job_file_size >= job.size_limit:
+                # only the end of large logs is shown
+                data['size_warning'] = job.size_limit
+                log_file = _log_tail(log, job.size_limit)
+            else:
+                log_file = job.output_file()
+            job_errors = section_index(log).errors if not job.failure_comment else []
 
-        if not job.failure_comment:
-            job_errors = getDispatcherErrors(job.output_file())
-            if len(job_errors) > 0:
-                msg = job_errors[-1]
-                if msg != "ErrorMessage: None":
-                    job.failure_comment = msg
-                    job.save()
+        if len(job_errors) > 0:
+            msg = job_errors[-1]
+            if msg != "ErrorMessage: None":
+                job.failure_comment = msg
+                job.save()
 
-        job_log_messages = getDispatcherLogMessages(job.output_file())
+        job_log_messages = getDispatcherLogMessages(log_file)
         levels = defaultdict(int)
         for kl in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
             levels[kl] = 0
@@ -1521,20 +1477,20 @@ def favorite_jobs(request, username=None):
 @BreadCrumb("Complete log", parent=job_detail, needs=['pk'])
 def job_log_file(request, pk):
     job = get_restricted_job(request.user, pk)
-    log_file = job.output_file()
-    if not log_file:
+    log = job.output_log()
+    if not log:
         raise Http404
 
-    with log_file as f:
-        f.seek(0, 2)
-        job_file_size = f.tell()
-
-    size_warning = 0
-    if job_file_size >= job.size_limit:
-        size_warning = job.size_limit
-        content = None
-    else:
-        content = formatLogFile(job.output_file())
+    with log:
+        job_file_size = log.size()
+        size_warning = 0
+        index = section_index(log)
+        if job_file_size >= job.size_limit:
+            # only the end of large logs is shown
+            size_warning = job.size_limit
+            content = read_sections(log, index.visible(size_limit=job.size_limit))
+        else:
+            content = read_sections(log, index.visible())
 
     return render_to_response(
         "lava_scheduler_app/job_log_file.html",
@@ -1542,10 +1498,11 @@ def job_log_file(request, pk):
             'show_cancel': job.can_cancel(request.user),
             'show_resubmit': job.can_resubmit(request.user),
             'job': TestJob.objects.get(pk=pk),
-            'job_file_present': bool(log_file),
+            'job_file_present': True,
             'sections': content,
             'size_warning': size_warning,
             'job_file_size': job_file_size,
+            'log_offset': index.size,
             'bread_crumb_trail': BreadCrumbTrail.leading_to(job_log_file, pk=pk),
             'show_failure': job.can_annotate(request.user),
             'context_help': BreadCrumbTrail.leading_to(job_detail, pk='detail'),
@@ -1567,10 +1524,12 @@ def job_log_file_plain(request, pk):
 def job_log_incremental(request, pk):
     start = int(request.GET.get('start', 0))
     job = get_restricted_job(request.user, pk)
-    log_file = job.output_file()
-    log_file.seek(start)
-    new_content = log_file.read()
-    m = getDispatcherLogMessages(StringIO.StringIO(new_content))
+    log = job.output_log()
+    if not log:
+        raise Http404
+    with log:
+        new_content = log.read(start)
+    m = getDispatcherLogMessages(StringIO.StringIO(new_content.decode('utf-8', 'replace')))
     response = HttpResponse(
         simplejson.dumps(m), content_type='application/json')
     response['X-Current-Size'] = str(start + len(new_content))
@@ -1582,16 +1541,15 @@ def job_log_incremental(request, pk):
 def job_full_log_incremental(request, pk):
     start = int(request.GET.get('start', 0))
     job = get_restricted_job(request.user, pk)
-    log_file = job.output_file()
-    log_file.seek(start)
-    new_content = log_file.read()
-    nl_index = new_content.rfind('\n', -NEWLINE_SCAN_SIZE)
-    if nl_index >= 0:
-        new_content = new_content[:nl_index + 1]
-    m = formatLogFile(StringIO.StringIO(new_content))
+    log = job.output_log()
+    if not log:
+        raise Http404
+    with log:
+        index = section_index(log)
+        m = read_sections(log, index.visible(start))
     response = HttpResponse(
         simplejson.dumps(m), content_type='application/json')
-    response['X-Current-Size'] = str(start + len(new_content))
+    response['X-Current-Size'] = str(max(start, index.size))
     if job.status not in [TestJob.RUNNING, TestJob.CANCELING]:
         response['X-Is-Finished'] = '1'
     return response
@@ -1609,20 +1567,20 @@ def job_output(request, pk):
         return HttpResponseBadRequest("invalid start")
     count_present = 'count' in request.GET
     job = get_restricted_job(request.user, pk)
-    log_file = job.output_file()
-    log_file.seek(0, os.SEEK_END)
-    size = int(request.GET.get('count', log_file.tell()))
-    if size - start > LOG_CHUNK_SIZE and not count_present:
-        log_file.seek(-LOG_CHUNK_SIZE, os.SEEK_END)
-        content = log_file.read(LOG_CHUNK_SIZE)
-        nl_index = content.find('\n', 0, NEWLINE_SCAN_SIZE)
-        if nl_index > 0 and not count_present:
-            content = content[nl_index + 1:]
-        skipped = size - start - len(content)
-    else:
-        skipped = 0
-        log_file.seek(start, os.SEEK_SET)
-        content = log_file.read(size - start)
+    log = job.output_log()
+    if not log:
+        raise Http404
+    with log:
+        size = int(request.GET.get('count', log.size()))
+        if size - start > LOG_CHUNK_SIZE and not count_present:
+            content = log.read(size - LOG_CHUNK_SIZE, LOG_CHUNK_SIZE)
+            nl_index = content.find('\n', 0, NEWLINE_SCAN_SIZE)
+            if nl_index > 0 and not count_present:
+                content = content[nl_index + 1:]
+            skipped = size - start - len(content)
+        else:
+            skipped = 0
+            content = log.read(start, size - start)
     nl_index = content.rfind('\n', -NEWLINE_SCAN_SIZE)
     if nl_index >= 0 and not count_present:
         content = content[:nl_index + 1]
@@ -1635,6 +1593,43 @@ def job_output(request, pk):
     return response
 
 
+def job_log_lines(request, pk):
+    """
+    Lines of the output of a job, either from start (counting from 0) up
+    to end or the last lines as set by tail.
+    """
+    try:
+        start = int(request.GET.get('start', 0))
+        end = int(request.GET['end']) if 'end' in request.GET else None
+        tail = int(request.GET['tail']) if 'tail' in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest("invalid line numbers")
+    job = get_restricted_job(request.user, pk)
+    log = job.output_log()
+    if not log:
+        raise Http404
+    with log:
+        content = log.tail(tail) if tail is not None else log.lines(start, end)
+        line_count = log.line_count()
+    response = HttpResponse(content, content_type='text/plain; charset=utf-8')
+    response['X-Line-Count'] = str(line_count)
+    if job.status not in [TestJob.RUNNING, TestJob.CANCELING]:
+        response['X-Is-Finished'] = '1'
+    return response
+
+
+def _log_tail(log, size_limit):
+    """
+    The end of a log which is too large to view, from the first complete line.
+    :param log: the JobLog of the job
+    :param size_limit: the number of bytes to keep
+    :return: the content as a file object
+    """
+    content = log.read(log.size() - size_limit)
+    content = content[content.find('\n') + 1:]
+    return StringIO.StringIO(content.decode('utf-8', 'replace'))
+
+
 def job_cancel(request, pk):
     job = get_restricted_job(request.user, pk)
     if job.can_cancel(request.user):
@@ -2068,33 +2063,20 @@ def device_detail(request, pk):
 @BreadCrumb("{pk} device report", parent=device_detail, needs=['pk'])
 def device_reports(request, pk):
     device = get_object_or_404(Device, pk=pk)
-    health_day_report = []
-    health_week_report = []
-    job_day_report = []
-    job_week_report = []
-    for day in reversed(range(7)):
-        health_day_report.append(device_report_data(day * -1 - 1, day * -1, device, True))
-        job_day_report.append(device_report_data(day * -1 - 1, day * -1, device, False))
-    for week in reversed(range(10)):
-        health_week_report.append(device_report_data(week * -7 - 7, week * -7, device, True))
-        job_week_report.append(device_report_data(week * -7 - 7, week * -7, device, False))
-
     long_running = TestJob.objects.filter(
         actual_device=device,
         status__in=[TestJob.RUNNING,
                     TestJob.CANCELING]).order_by('start_time')[:5]
 
+    data = _job_reports('&device=%s' % device.pk, device=device)
+    data.update({
+        'device': device,
+        'long_running': long_running,
+        'bread_crumb_trail': BreadCrumbTrail.leading_to(device_reports, pk=pk),
+    })
     return render_to_response(
         "lava_scheduler_app/device_reports.html",
-        {
-            'device': device,
-            'health_week_report': health_week_report,
-            'health_day_report': health_day_report,
-            'job_week_report': job_week_report,
-            'job_day_report': job_day_report,
-            'long_running': long_running,
-            'bread_crumb_trail': BreadCrumbTrail.leading_to(device_reports, pk=pk),
-        },
+        data,
         RequestContext(request))
 
 
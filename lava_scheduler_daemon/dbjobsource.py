@@ -6,7 +6,6 @@ import urlparse
 import signal
 from dashboard_app.models import Bundle
 
-import django
 from django.core.files.base import ContentFile
 from django.db import connection
 from django.db import IntegrityError, transaction
@@ -14,7 +13,6 @@ from django.db.models import Q
 from django.db.utils import DatabaseError
 from django.utils import timezone
 
-from linaro_django_xmlrpc.models import AuthToken
 from psycopg2.extensions import TransactionRollbackError
 import simplejson
 
@@ -31,6 +29,8 @@ from lava_scheduler_app.models import (
     JSONDataError,
 )
 from lava_scheduler_app import utils
+from lava_scheduler_daemon.matcher import DeviceMatcher
+from lava_scheduler_daemon.snapshot import SchedulerSnapshot
 from lava_scheduler_daemon.worker import WorkerData
 from lava_scheduler_daemon.jobsource import IJobSource
 
@@ -58,7 +58,8 @@ def find_device_for_job(job, device_list):
     allowed to run non-pipeline jobs.
 
     Note: with a large queue and a lot of devices, this function can be a
-    significant delay.
+    significant delay. The scheduler tick uses a DeviceMatcher instead, see
+    DatabaseJobSource._build_matcher.
     """
     if job.dynamic_connection:
         # secondary connection, the "host" has a real device
@@ -251,6 +252,8 @@ class DatabaseJobSource(object):
 
         jobs = TestJob.objects.filter(status=TestJob.SUBMITTED)
         jobs = jobs.filter(actual_device=None)
+        jobs = jobs.select_related('submitter', 'requested_device')
+        jobs = jobs.prefetch_related('tags')
         jobs = jobs.order_by('-health_check', '-priority', 'submit_time',
                              'vm_group', 'target_group', 'id')
 
@@ -269,20 +272,40 @@ class DatabaseJobSource(object):
         Forced health checks ignore this constraint.
         """
         devices = Device.objects.filter(status=Device.IDLE).order_by('is_public')
+        devices = devices.prefetch_related('tags')
         return devices
 
-    def _validate_non_idle_devices(self, reserved_devices, idle_devices):
+    def _build_matcher(self, snapshot):
+        """
+        Index the idle devices and precompute the requirements of each queued job.
+        :param snapshot: the SchedulerSnapshot for this tick
+        :return: tuple of the DeviceMatcher and the list of Requirements, in queue order
+        """
+        matcher = DeviceMatcher(
+            snapshot.devices, snapshot.device_tags, snapshot.exclusive, snapshot.temporary)
+        requirements = []
+        for job in snapshot.jobs:
+            if job.dynamic_connection:
+                # secondary connection, the "host" has a real device
+                continue
+            requirements.append(matcher.requirement(
+                job, snapshot.job_tags.get(job.id, frozenset()),
+                snapshot.user_groups.get(job.submitter_id, frozenset())))
+        return matcher, requirements
+
+    def _validate_non_idle_devices(self, reserved_devices):
         """
         only check those devices which we *know* should have been changed
         and check that the changes are correct.
         """
         errors = []
-        for device_name in reserved_devices:
-            device = Device.objects.get(hostname=device_name)  # force re-load
+        devices = Device.objects.filter(hostname__in=reserved_devices)  # force re-load
+        devices = devices.select_related('current_job', 'current_job__actual_device')
+        for device in devices:
             if device.status not in [Device.RESERVED, Device.RUNNING]:
                 self.logger.warning("Failed to properly reserve %s", device)
                 errors.append('r')
-            if device in idle_devices:
+            if device.status == Device.IDLE:
                 self.logger.warning("%s is still listed as available!", device)
                 errors.append('a')
             if not device.current_job:
@@ -297,58 +320,55 @@ class DatabaseJobSource(object):
                 errors.append('j')
         return errors == []
 
-    def _validate_queue(self):
+    def _validate_queue(self, snapshot):
         """
         Invalid reservation states can leave zombies which are SUBMITTED with an actual device.
         These jobs get ignored by the get_job_queue function and therfore by assign_jobs *unless*
         another job happens to reference that specific device.
+        :return: list of devices reserved by fixing up a zombie
         """
-        jobs = TestJob.objects.filter(status=TestJob.SUBMITTED)
-        jobs = jobs.filter(actual_device__isnull=False)
-        for job in jobs:
-            if not job.actual_device.current_job:
-                device = Device.objects.get(hostname=job.actual_device.hostname)
-                if device.status != Device.IDLE:
-                    continue
-                self.logger.warning(
-                    "Fixing up a broken device reservation for queued %s on %s", job, device.hostname)
-                device.status = Device.RESERVED
-                device.current_job = job
-                device.save(update_fields=['status', 'current_job'])
-
-    def _validate_idle_device(self, job, device):
+        fixed = []
+        for job in snapshot.zombies:
+            device = job.actual_device
+            if device.current_job_id is not None:
+                continue
+            if device.status != Device.IDLE:
+                continue
+            self.logger.warning(
+                "Fixing up a broken device reservation for queued %s on %s", job, device.hostname)
+            device.status = Device.RESERVED
+            device.current_job = job
+            device.save(update_fields=['status', 'current_job'])
+            fixed.append(device)
+        return fixed
+
+    def _validate_idle_device(self, job, device, snapshot):
         """
         The problem here is that instances with a lot of devices would spend a lot of time
         refetching all of the device details every scheduler tick when it is only under
-        particular circumstances that an error is made. The safe option is always to refuse
-        to use a device which has changed status.
-        get() evaluates immediately.
+        particular circumstances that an error is made. The device details and the jobs
+        referencing each device are taken from the snapshot loaded at the start of the tick,
+        _claim_device then refuses to use a device which has changed status since.
         :param job: job to have a device assigned
-        :param device: device to refresh and check
+        :param device: device to check
+        :param snapshot: the SchedulerSnapshot for this tick
         :return: True if device can be reserved
         """
         # FIXME: do this properly in the dispatcher master.
         # FIXME: fold the find_device current_job check into this routine for clarity
         # FIXME: isolate forced health check requirements
-        if django.VERSION >= (1, 8):
-            # https://docs.djangoproject.com/en/dev/ref/models/instances/#refreshing-objects-from-database
-            device.refresh_from_db()
-        else:
-            device = Device.objects.get(hostname=device.hostname)
         # to be valid for reservation, no queued TestJob can reference this device
-        jobs = TestJob.objects.filter(
-            status__in=[TestJob.RUNNING, TestJob.SUBMITTED, TestJob.CANCELING],
-            actual_device=device)
-        if jobs:
+        job_ids = sorted(snapshot.referenced.get(device.hostname, []))
+        if job_ids:
             self.logger.warning(
                 "%s (which has current_job %s) is already referenced by %d jobs %s",
-                device.hostname, device.current_job, len(jobs), [job.id for job in jobs])
-            if len(jobs) == 1:
+                device.hostname, device.current_job_id, len(job_ids), job_ids)
+            if len(job_ids) == 1:
                 self.logger.warning(
                     "Fixing up a broken device reservation for %s on %s",
-                    jobs[0], device.hostname)
+                    job_ids[0], device.hostname)
                 device.status = Device.RESERVED
-                device.current_job = jobs[0]
+                device.current_job_id = job_ids[0]
                 device.save(update_fields=['status', 'current_job'])
                 return False
         # forced health check support
@@ -360,18 +380,35 @@ class DatabaseJobSource(object):
         elif device.status is not Device.IDLE:
             self.logger.warning("Refusing to reserve %s which is not IDLE", device)
             return False
-        if device.current_job:
+        if device.current_job_id is not None:
             self.logger.warning("Device %s already has a current job", device)
             return False
         return True
 
+    def _claim_device(self, job, device):
+        """
+        The snapshot is only as fresh as the start of the tick, so only reserve
+        a device if its status is unchanged and it has not gained a current job.
+        The conditional update also locks the row until the tick is committed.
+        :return: True if the device was claimed for this job
+        """
+        claimed = Device.objects.filter(
+            hostname=device.hostname, status=device.status,
+            current_job__isnull=True).update(current_job=job)
+        if not claimed:
+            self.logger.warning("Refusing to reserve %s which has changed state", device.hostname)
+            return False
+        return True
+
     def _assign_jobs(self):
         """
         Check all jobs against all available devices and assign only if all conditions are met
         This routine needs to remain fast, so has to manage local cache variables of device status but
-        still cope with a job queue over 1,000 and a device matrix of over 100. The main load is in
-        find_device_for_job as *all* jobs in the queue must be checked at each tick. (A job far back in
-        the queue may be the only job which exactly matches the most recent devices to become available.)
+        still cope with a job queue over 1,000 and a device matrix of over 100. The queue, the idle
+        devices and everything needed to match them is loaded once per tick by SchedulerSnapshot in
+        a fixed number of queries, then *all* jobs in the queue are checked against a DeviceMatcher
+        index. (A job far back in the queue may be the only job which exactly matches the most recent
+        devices to become available.)
 
         When viewing the logs of these operations, the device will be Idle when Assigning to a Submitted
         job. That job may be for a device_type or a specific device (typically health checks use a specific
@@ -384,54 +421,66 @@ class DatabaseJobSource(object):
         # FIXME: this function needs to be moved to dispatcher-master when lava_scheduler_daemon is disabled.
         # FIXME: in dispatcher-master, implement as in share/zmq/assign.[dia|png]
         # FIXME: Make the forced health check constraint explicit
-        # evaluate the testjob query set using list()
-        self._validate_queue()
-        jobs = list(self._get_job_queue())
-        if not jobs:
+        # this takes a significant amount of time when under load, only do it once per tick
+        snapshot = SchedulerSnapshot(self._get_job_queue(), self._get_available_devices())
+        fixed = self._validate_queue(snapshot)
+        if not snapshot.jobs:
             return
         assigned_jobs = []
         reserved_devices = []
-        # this takes a significant amount of time when under load, only do it once per tick
-        devices = list(self._get_available_devices())
+        matcher, requirements = self._build_matcher(snapshot)
+        for device in fixed:
+            matcher.remove(device)
         # a forced health check can be assigned even if the device is not in the list of idle devices.
-        for job in jobs:
-            device = find_device_for_job(job, devices)
+        for requirement in requirements:
+            if not matcher:
+                break
+            job = requirement.job
+            if job.health_check is True and job.requested_device.status == Device.OFFLINE:
+                device = job.requested_device
+            else:
+                device = matcher.match(requirement)
             if device:
-                if not self._validate_idle_device(job, device):
+                if not self._validate_idle_device(job, device, snapshot):
                     self.logger.debug("Removing %s from the list of available devices",
                                       str(device.hostname))
-                    devices.remove(device)
+                    matcher.remove(device)
                     continue
                 self.logger.info("Assigning %s for %s", device, job)
                 # avoid catching exceptions inside atomic (exceptions are slow too)
                 # https://docs.djangoproject.com/en/1.7/topics/db/transactions/#controlling-transactions-explicitly
-                if AuthToken.objects.filter(user=job.submitter).count():
-                    job.submit_token = AuthToken.objects.filter(user=job.submitter).first()
-                else:
-                    job.submit_token = AuthToken.objects.create(user=job.submitter)
+                job.submit_token = snapshot.token_for(job.submitter)
                 try:
-                    # Make this sequence atomic
+                    # Make this sequence atomic, including the claim, so that a failure
+                    # does not leave an idle device with a current job.
                     with transaction.atomic():
-                        job.actual_device = device
-                        job.save()
-                        device.current_job = job
-                        # implicit device save in state_transition_to()
-                        device.state_transition_to(
-                            Device.RESERVED, message="Reserved for job %s" % job.display_id, job=job)
+                        claimed = self._claim_device(job, device)
+                        if claimed:
+                            job.actual_device = device
+                            job.save()
+                            device.current_job = job
+                            # implicit device save in state_transition_to()
+                            device.state_transition_to(
+                                Device.RESERVED, message="Reserved for job %s" % job.display_id, job=job)
                 except IntegrityError:
                     # Retry in the next call to _assign_jobs
                     self.logger.warning(
                         "Transaction failed for job %s, device %s", job.display_id, device.hostname)
+                    job.actual_device = None
+                    device.current_job = None
+                    claimed = False
+                if not claimed:
+                    self.logger.debug("Removing %s from the list of available devices",
+                                      str(device.hostname))
+                    matcher.remove(device)
+                    continue
                 assigned_jobs.append(job.id)
                 reserved_devices.append(device.hostname)
                 self.logger.info("Assigned %s to %s", device, job)
-                if device in devices:
-                    self.logger.debug("Removing %s from the list of available devices",
-                                      str(device.hostname))
-                    devices.remove(device)
-        # re-evaluate the devices query set using list() now that the job loop is complete
-        devices = list(self._get_available_devices())
-        postprocess = self._validate_non_idle_devices(reserved_devices, devices)
+                self.logger.debug("Removing %s from the list of available devices",
+                                  str(device.hostname))
+                matcher.remove(device)
+        postprocess = self._validate_non_idle_devices(reserved_devices)
         if postprocess and reserved_devices:
             self.logger.debug("All queued jobs checked, %d devices reserved and validated", len(reserved_devices))
 
@@ -0,0 +1,205 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Scheduler.
+#
+# LAVA Scheduler is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3 as
+# published by the Free Software Foundation
+#
+# LAVA Scheduler is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory matching of queued jobs to idle devices.
+
+The index is built once per scheduler tick from data which has already
+been fetched from the database in bulk, so no queries are made while
+the job queue is being walked. This module deliberately avoids importing
+the models so that it can be exercised with simple stand-in objects.
+"""
+
+import logging
+from collections import namedtuple
+
+
+# What a queued job needs from a device, computed once per job per tick.
+# principals holds the ('user', id) and ('group', id) owners the submitter
+# may use, any_owner is set for submitters allowed to use private devices
+# regardless of ownership.
+Requirement = namedtuple('Requirement', [
+    'job', 'device', 'device_type', 'pipeline', 'tags',
+    'principals', 'any_owner', 'vm_group'])
+
+# Devices which share the same key are interchangeable for matching.
+BucketKey = namedtuple('BucketKey', [
+    'device_type', 'pipeline', 'exclusive', 'tags', 'owner'])
+
+
+def owner_of(device):
+    """
+    :return: None for public devices, otherwise the principal which owns the device.
+    """
+    if device.is_public:
+        return None
+    if device.user_id is not None:
+        return 'user', device.user_id
+    return 'group', device.group_id
+
+
+class _Bucket(object):
+    """
+    Devices sharing one BucketKey, in the order of the idle device list.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.entries = []
+        self.head = 0
+
+    def first(self, taken, vm_group=None, temporary=None):
+        """
+        :return: the (position, device) of the first device not yet taken, or None
+        """
+        # advance past devices taken by earlier jobs so they are never rescanned
+        while self.head < len(self.entries) and self.entries[self.head][1].hostname in taken:
+            self.head += 1
+        if vm_group is None:
+            if self.head < len(self.entries):
+                return self.entries[self.head]
+            return None
+        for entry in self.entries[self.head:]:
+            hostname = entry[1].hostname
+            if hostname in taken:
+                continue
+            if hostname in temporary and temporary[hostname] != vm_group:
+                continue
+            return entry
+        return None
+
+
+class DeviceMatcher(object):
+    """
+    Index of the idle devices for a single scheduler tick, grouped by
+    device type, pipeline support, exclusivity, tags and owner.
+
+    The preference order of the idle device list (private devices first)
+    is retained: when more than one group of devices can satisfy a job,
+    the device which appeared earliest in the list is chosen.
+    """
+
+    def __init__(self, devices, device_tags, exclusive, temporary=None):
+        """
+        :param devices: idle devices, in order of preference
+        :param device_tags: dict of hostname to frozenset of tag ids
+        :param exclusive: set of hostnames of exclusive pipeline devices
+        :param temporary: dict of hostname to vm_group for temporary devices
+        """
+        self.logger = logging.getLogger(__name__ + '.DeviceMatcher')
+        self.temporary = temporary or {}
+        self.taken = set()
+        self._hostnames = {}
+        self._types = {}
+        self._candidates = {}
+        buckets = {}
+        for position, device in enumerate(devices):
+            if device.current_job_id is not None:
+                # warn the admin that this needs human intervention
+                self.logger.warning(
+                    "Refusing to reserve %s - current job is %s",
+                    device.hostname, device.current_job_id)
+                continue
+            key = BucketKey(
+                device_type=device.device_type_id,
+                pipeline=device.is_pipeline,
+                exclusive=device.hostname in exclusive,
+                tags=device_tags.get(device.hostname, frozenset()),
+                owner=owner_of(device))
+            if key not in buckets:
+                buckets[key] = _Bucket(key)
+                self._types.setdefault(key.device_type, []).append(buckets[key])
+            buckets[key].entries.append((position, device))
+            self._hostnames[device.hostname] = (position, device, key)
+        self._available = len(self._hostnames)
+
+    def __len__(self):
+        return self._available
+
+    def requirement(self, job, job_tags, user_groups):
+        """
+        Precompute what a job needs from a device.
+        :param job: a queued TestJob
+        :param job_tags: frozenset of tag ids for this job
+        :param user_groups: frozenset of group ids of the submitter
+        """
+        principals = set([('user', job.submitter_id)])
+        principals.update([('group', group) for group in user_groups])
+        return Requirement(
+            job=job,
+            device=job.requested_device_id,
+            device_type=job.requested_device_type_id,
+            pipeline=job.is_pipeline,
+            tags=job_tags,
+            principals=frozenset(principals),
+            any_owner=job.submitter.username == "lava-health",
+            vm_group=job.vm_group if job.is_vmgroup else None)
+
+    @staticmethod
+    def _accepts(req, key):
+        """
+        Equivalent of the pipeline, exclusive, tag and can_submit
+        checks of find_device_for_job for one group of devices.
+        """
+        if req.pipeline and not key.pipeline:
+            return False
+        if key.exclusive and not req.pipeline:
+            return False
+        if not req.tags <= key.tags:
+            return False
+        if key.owner is None or req.any_owner:
+            return True
+        return key.owner in req.principals
+
+    def _buckets_for(self, req):
+        """
+        The groups of devices which can satisfy the requirement, cached
+        because most of the queue shares a handful of distinct requirements.
+        """
+        cache_key = (req.device_type, req.pipeline, req.tags, req.principals, req.any_owner)
+        if cache_key not in self._candidates:
+            self._candidates[cache_key] = [
+                bucket for bucket in self._types.get(req.device_type, [])
+                if self._accepts(req, bucket.key)]
+        return self._candidates[cache_key]
+
+    def match(self, req):
+        """
+        :param req: a Requirement from requirement()
+        :return: the preferred idle device for the job or None
+        """
+        if req.device is not None and req.device not in self.taken:
+            entry = self._hostnames.get(req.device)
+            if entry and self._accepts(req, entry[2]):
+                device = entry[1]
+                if not req.vm_group or self.temporary.get(device.hostname, req.vm_group) == req.vm_group:
+                    return device
+        if req.device_type is None:
+            return None
+        best = None
+        for bucket in self._buckets_for(req):
+            entry = bucket.first(self.taken, req.vm_group, self.temporary)
+            if entry and (best is None or entry[0] < best[0]):
+                best = entry
+        return best[1] if best else None
+
+    def remove(self, device):
+        """
+        Take a device out of the index once reserved or found to be invalid.
+        """
+        if device.hostname in self._hostnames and device.hostname not in self.taken:
+            self._available -= 1
+        self.taken.add(device.hostname)
@@ -0,0 +1,83 @@
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Scheduler.
+#
+# LAVA Scheduler is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3 as
+# published by the Free Software Foundation
+#
+# LAVA Scheduler is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with LAVA Scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.contrib.auth.models import User
+
+from linaro_django_xmlrpc.models import AuthToken
+
+from lava_scheduler_app.models import (
+    DeviceDictionary,
+    TemporaryDevice,
+    TestJob,
+)
+
+
+def group_pairs(pairs):
+    """
+    Collapse (key, value) rows from a values_list() into a dict of frozensets.
+    """
+    grouped = {}
+    for key, value in pairs:
+        grouped.setdefault(key, set()).add(value)
+    return dict([(key, frozenset(values)) for key, values in grouped.items()])
+
+
+class SchedulerSnapshot(object):
+    """
+    The state needed to assign the job queue in one scheduler tick, loaded
+    with a fixed number of queries however long the queue is. Nothing is
+    refetched per job or per device while the queue is being walked.
+    """
+
+    def __init__(self, jobs, devices):
+        """
+        :param jobs: queryset of queued jobs with their tags prefetched, in order of precedence
+        :param devices: queryset of idle devices with their tags prefetched, in order of preference
+        """
+        self.jobs = list(jobs)
+        self.devices = list(devices)
+        # Invalid reservation states can leave SUBMITTED jobs with an actual device
+        self.zombies = list(TestJob.objects.filter(
+            status=TestJob.SUBMITTED,
+            actual_device__isnull=False).select_related('actual_device'))
+        hostnames = [device.hostname for device in self.devices]
+        submitters = set([job.submitter_id for job in self.jobs])
+        self.job_tags = dict([
+            (job.id, frozenset([tag.id for tag in job.tags.all()])) for job in self.jobs])
+        self.device_tags = dict([
+            (device.hostname, frozenset([tag.id for tag in device.tags.all()])) for device in self.devices])
+        self.user_groups = group_pairs(User.groups.through.objects.filter(
+            user__in=submitters).values_list('user_id', 'group_id'))
+        self.temporary = dict(TemporaryDevice.objects.filter(
+            hostname__in=hostnames).values_list('hostname', 'vm_group'))
+        self.exclusive = set([
+            hostname for hostname, device_dict in DeviceDictionary.get_many(hostnames).items()
+            if device_dict.exclusive])
+        # ids of the queued or active jobs which reference each device
+        self.referenced = group_pairs(TestJob.objects.filter(
+            status__in=[TestJob.RUNNING, TestJob.SUBMITTED, TestJob.CANCELING],
+            actual_device__isnull=False).values_list('actual_device_id', 'id'))
+        self.tokens = {}
+        for token in AuthToken.objects.filter(user__in=submitters).order_by('id'):
+            self.tokens.setdefault(token.user_id, token)
+
+    def token_for(self, user):
+        """
+        The AuthToken used to submit results, created if the user has none.
+        """
+        if user.id not in self.tokens:
+            self.tokens[user.id] = AuthToken.objects.create(user=user)
+        return self.tokens[user.id]
@@ -1,4 +1,6 @@
 import datetime
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from lava_scheduler_app.models import (
@@ -286,6 +288,50 @@ class DatabaseJobSourceTest(DatabaseJobSourceTestEngine):
         self.assertTrue(third_health_check.health_check)
         self.assertEqual(third_health_check.actual_device.hostname, 'panda01')
 
+    def test_assign_jobs_query_count(self):
+        """
+        The queries made to assign the queue must not grow with the length of the queue.
+        """
+        self.arndale01.state_transition_to(Device.OFFLINE)
+        self.arndale02.state_transition_to(Device.OFFLINE)
+
+        def tick_queries(queued):
+            for _ in range(queued):
+                self.submit_job(device_type='arndale')
+            with CaptureQueriesContext(connection) as queries:
+                self.master._assign_jobs()
+            self.assertEqual(
+                queued, TestJob.objects.filter(status=TestJob.SUBMITTED, actual_device=None).count())
+            TestJob.objects.all().delete()
+            return len(queries)
+
+        self.assertEqual(tick_queries(2), tick_queries(25))
+
+    def test_failed_assignment_transaction(self):
+        """
+        A reservation which fails leaves both the device and the job free for the next tick.
+        """
+        self.arndale01.state_transition_to(Device.OFFLINE)
+        self.arndale02.state_transition_to(Device.OFFLINE)
+        job = self.submit_job(device_type='arndale')
+        self.arndale01.state_transition_to(Device.IDLE)
+        state_transition_to = Device.state_transition_to
+
+        def failing_transition(device, *args, **kwargs):  # pylint: disable=unused-argument
+            raise IntegrityError("unit test")
+
+        Device.state_transition_to = failing_transition
+        try:
+            self.master._assign_jobs()
+        finally:
+            Device.state_transition_to = state_transition_to
+        device = Device.objects.get(hostname='arndale01')
+        self.assertEqual((device.status, device.current_job), (Device.IDLE, None))
+        self.assertIsNone(TestJob.objects.get(id=job.id).actual_device)
+        self.master._assign_jobs()
+        device = Device.objects.get(hostname='arndale01')
+        self.assertEqual((device.status, device.current_job), (Device.RESERVED, TestJob.objects.get(id=job.id)))
+
     def test_find_device_for_job(self):
         """
         tests that find_device_for_job gives preference to matching by requested
@@ -0,0 +1,159 @@
+import random
+import unittest
+
+from lava_scheduler_daemon.matcher import DeviceMatcher, owner_of
+
+# pylint: disable=attribute-defined-outside-init,superfluous-parens,too-many-ancestors,no-self-use,no-member
+# pylint: disable=invalid-name,too-few-public-methods,too-many-arguments
+
+
+class StubUser(object):
+
+    def __init__(self, user_id, username):
+        self.id = user_id
+        self.username = username
+
+
+class StubDevice(object):
+
+    def __init__(self, hostname, device_type, is_pipeline=False, is_public=True, user_id=None, group_id=None):
+        self.hostname = hostname
+        self.device_type_id = device_type
+        self.is_pipeline = is_pipeline
+        self.is_public = is_public
+        self.user_id = user_id
+        self.group_id = group_id
+        self.current_job_id = None
+
+
+class StubJob(object):
+
+    def __init__(self, job_id, submitter, device_type=None, device=None, is_pipeline=False):
+        self.id = job_id
+        self.submitter = submitter
+        self.submitter_id = submitter.id
+        self.requested_device_type_id = device_type
+        self.requested_device_id = device
+        self.is_pipeline = is_pipeline
+        self.vm_group = None
+        self.is_vmgroup = False
+
+
+class DeviceMatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.user = StubUser(1, 'tester')
+        self.health = StubUser(2, 'lava-health')
+
+    def assign(self, matcher, requirements):
+        assigned = {}
+        for requirement in requirements:
+            device = matcher.match(requirement)
+            if device:
+                matcher.remove(device)
+                assigned[requirement.job.id] = device.hostname
+        return assigned
+
+    def test_tags_subset(self):
+        devices = [StubDevice('black01', 'beaglebone'), StubDevice('black02', 'beaglebone')]
+        matcher = DeviceMatcher(devices, {'black01': frozenset([1]), 'black02': frozenset([1, 2])}, set())
+        job = StubJob(1, self.user, device_type='beaglebone')
+        self.assertEqual(matcher.match(matcher.requirement(job, frozenset([1, 2]), frozenset())).hostname, 'black02')
+        self.assertEqual(matcher.match(matcher.requirement(job, frozenset([1]), frozenset())).hostname, 'black01')
+        self.assertIsNone(matcher.match(matcher.requirement(job, frozenset([3]), frozenset())))
+
+    def test_requested_device_preferred(self):
+        devices = [StubDevice('panda02', 'panda'), StubDevice('panda01', 'panda')]
+        matcher = DeviceMatcher(devices, {}, set())
+        job = StubJob(1, self.user, device='panda01')
+        self.assertEqual(matcher.match(matcher.requirement(job, frozenset(), frozenset())).hostname, 'panda01')
+        matcher.remove(devices[1])
+        self.assertIsNone(matcher.match(matcher.requirement(job, frozenset(), frozenset())))
+        self.assertEqual(len(matcher), 1)
+
+    def test_pipeline_and_exclusive(self):
+        devices = [StubDevice('panda01', 'panda', is_pipeline=True), StubDevice('panda02', 'panda')]
+        matcher = DeviceMatcher(devices, {}, set(['panda01']))
+        old = StubJob(1, self.user, device_type='panda')
+        pipeline = StubJob(2, self.user, device_type='panda', is_pipeline=True)
+        self.assertEqual(matcher.match(matcher.requirement(old, frozenset(), frozenset())).hostname, 'panda02')
+        self.assertEqual(matcher.match(matcher.requirement(pipeline, frozenset(), frozenset())).hostname, 'panda01')
+
+    def test_private_devices(self):
+        devices = [
+            StubDevice('panda01', 'panda', is_public=False, user_id=3),
+            StubDevice('panda02', 'panda', is_public=False, group_id=7),
+            StubDevice('panda03', 'panda'),
+        ]
+        matcher = DeviceMatcher(devices, {}, set())
+        job = StubJob(1, self.user, device_type='panda')
+        self.assertEqual(matcher.match(matcher.requirement(job, frozenset(), frozenset())).hostname, 'panda03')
+        self.assertEqual(matcher.match(matcher.requirement(job, frozenset(), frozenset([7]))).hostname, 'panda02')
+        health = StubJob(2, self.health, device_type='panda')
+        self.assertEqual(matcher.match(matcher.requirement(health, frozenset(), frozenset())).hostname, 'panda01')
+
+    def test_busy_device_ignored(self):
+        devices = [StubDevice('panda01', 'panda'), StubDevice('panda02', 'panda')]
+        devices[0].current_job_id = 4
+        matcher = DeviceMatcher(devices, {}, set())
+        job = StubJob(1, self.user, device_type='panda')
+        self.assertEqual(matcher.match(matcher.requirement(job, frozenset(), frozenset())).hostname, 'panda02')
+
+    def linear_scan(self, devices, device_tags, exclusive, jobs, user_groups):
+        """
+        Assign the jobs by scanning the whole idle device list for each job.
+        """
+        taken = set()
+        assigned = {}
+        for job, tags in jobs:
+            principals = set([('user', job.submitter_id)])
+            principals.update([('group', group) for group in user_groups[job.submitter_id]])
+            for device in devices:
+                if device.hostname in taken or device.device_type_id != job.requested_device_type_id:
+                    continue
+                if job.is_pipeline and not device.is_pipeline:
+                    continue
+                if device.hostname in exclusive and not job.is_pipeline:
+                    continue
+                if not tags <= device_tags[device.hostname]:
+                    continue
+                owner = owner_of(device)
+                if owner is not None and owner not in principals:
+                    continue
+                taken.add(device.hostname)
+                assigned[job.id] = device.hostname
+                break
+        return assigned
+
+    def test_large_queue(self):
+        """
+        Synthetic queue of 1,500 jobs against 200 boards, the index must
+        assign the same boards as scanning the device list for each job.
+        """
+        rand = random.Random(1)
+        types = ['type%02d' % index for index in range(20)]
+        users = [StubUser(index, 'user%d' % index) for index in range(3, 50)]
+        user_groups = dict((user.id, frozenset([user.id % 5])) for user in users)
+        devices = []
+        device_tags = {}
+        for index in range(200):
+            public = index % 10 != 0
+            device = StubDevice(
+                'board%03d' % index, rand.choice(types), is_pipeline=index % 2 == 0,
+                is_public=public, group_id=None if public else index % 5)
+            device_tags[device.hostname] = frozenset(rand.sample(range(8), rand.randint(0, 3)))
+            devices.append(device)
+        devices.sort(key=lambda item: item.is_public)
+        exclusive = set([item.hostname for item in devices[::7] if item.is_pipeline])
+        jobs = []
+        for index in range(1500):
+            jobs.append((StubJob(
+                index, rand.choice(users), device_type=rand.choice(types),
+                is_pipeline=rand.random() < 0.5), frozenset(rand.sample(range(8), rand.randint(0, 2)))))
+        matcher = DeviceMatcher(devices, device_tags, exclusive)
+        requirements = [
+            matcher.requirement(job, tags, user_groups[job.submitter_id]) for job, tags in jobs]
+        assigned = self.assign(matcher, requirements)
+        self.assertTrue(assigned)
+        self.assertEqual(len(set(assigned.values())), len(assigned))
+        self.assertEqual(assigned, self.linear_scan(devices, device_tags, exclusive, jobs, user_groups))
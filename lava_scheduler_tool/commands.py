@@ -27,6 +27,7 @@ import time
 import tempfile
 import xmlrpclib
 import yaml
+import zlib
 
 from lava_tool.authtoken import AuthenticatingServerProxy, KeyringAuthBackend
 from lava.tool.command import Command, CommandGroup
@@ -37,6 +38,11 @@ from lava_scheduler_tool.scheduler import (
     jinja2_to_devicedictionary
 )
 
+# Bytes of output requested at a time by job-output
+JOB_OUTPUT_CHUNK_SIZE = 1024 * 1024
+# Fault code of the XML-RPC servers for unknown methods
+METHOD_NOT_FOUND = -32601
+
 
 class scheduler(CommandGroup):
     """
@@ -149,9 +155,42 @@ class job_output(Command):
                             type=argparse.FileType("wb"),
                             default=None,
                             help="Alternate name of the output file")
+        parser.add_argument("--follow", "-f",
+                            action="store_true",
+                            help="Keep writing the output of the job until it finishes")
+        parser.add_argument("--poll-interval",
+                            type=int,
+                            default=5,
+                            help="Seconds to wait for more output when following the job")
+
+    def _write_output(self, server, stream):
+        """
+        Write the output a chunk at a time, so that the memory used does not
+        depend on the size of the output.
+        """
+        offset = 0
+        etag = ''
+        while True:
+            chunk = server.scheduler.job_output_chunk(
+                self.args.JOB_ID, offset, JOB_OUTPUT_CHUNK_SIZE, True, etag)
+            if chunk['modified']:
+                stream.write(zlib.decompress(chunk['data'].data))
+                stream.flush()
+            if chunk['finished'] or (not self.args.follow and chunk['offset'] >= chunk['size']):
+                return
+            if chunk['offset'] >= chunk['size']:
+                # wait for more output, unchanged chunks are not sent again
+                etag = chunk['etag']
+                time.sleep(self.args.poll_interval)
+            else:
+                etag = ''
+            offset = chunk['offset']
 
     def invoke(self):
-        if self.args.output is None:
+        if self.args.output is None and self.args.follow:
+            stream = sys.stdout
+            filename = None
+        elif self.args.output is None:
             filename = str(self.args.JOB_ID) + '_output.txt'
             if os.path.exists(filename) and not self.args.overwrite:
                 print >> sys.stderr, "File {filename!r} already exists".format(
@@ -166,12 +205,21 @@ class job_output(Command):
         server = AuthenticatingServerProxy(
             self.args.SERVER, auth_backend=KeyringAuthBackend())
         try:
-            stream.write(server.scheduler.job_output(self.args.JOB_ID).data)
-            print "Downloaded job output of {0} to file {1!r}".format(
-                self.args.JOB_ID, filename)
+            try:
+                self._write_output(server, stream)
+            except xmlrpclib.Fault as exc:
+                if exc.faultCode != METHOD_NOT_FOUND or self.args.follow:
+                    raise
+                # older servers only return the whole output
+                stream.write(server.scheduler.job_output(self.args.JOB_ID).data)
+            if filename:
+                print "Downloaded job output of {0} to file {1!r}".format(
+                    self.args.JOB_ID, filename)
         except xmlrpclib.Fault as exc:
             print >> sys.stderr, exc
             return -1
+        except KeyboardInterrupt:
+            return -1
 
 
 class job_status(Command):
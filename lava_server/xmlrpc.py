@@ -18,16 +18,82 @@
 # along with LAVA Server.  If not, see <http://www.gnu.org/licenses/>.
 
 import xmlrpclib
-from django.http import Http404
+from django.db.models import Q
 from dashboard_app.models import Bundle
 from dashboard_app.xmlrpc import errors
-from django.core.exceptions import PermissionDenied
-from lava_scheduler_app.views import get_restricted_job
-from lava_scheduler_app.models import Device, DeviceType, DeviceDictionary
+from lava_scheduler_app.models import Device, DeviceType, DeviceDictionary, TestJob
 from linaro_django_xmlrpc.models import Mapper, SystemAPI
 from django.contrib.auth.models import Group, Permission, User
 
 
+# The checks below work on the values of many restricted resources at once,
+# with the same outcome as the RestrictedResource and Device methods.
+
+
+def _principal(username):
+    """
+    :param username: the User to check
+    :return: the user as seen by RestrictedResource, None for anonymous or
+    inactive users, and the ids of the groups of that user
+    """
+    if username is None or not username.is_authenticated() or not username.is_active:
+        return None, set()
+    return username, set(username.groups.values_list('id', flat=True))
+
+
+def _is_owned_by(resource, user, groups):
+    """
+    :param resource: dict holding the user and group of a RestrictedResource
+    """
+    if user is None:
+        return False
+    if resource['user'] is not None:
+        return resource['user'] == user.id
+    return resource['group'] in groups
+
+
+def _is_accessible_by(resource, user, groups):
+    """
+    :param resource: dict holding is_public, user and group of a RestrictedResource
+    """
+    if resource['is_public']:
+        return True
+    if user is None:
+        return False
+    if resource['user'] is not None and resource['user'] == user.id:
+        return True
+    return resource['group'] is not None and resource['group'] in groups
+
+
+def _can_submit(device, username, user, groups):
+    """
+    Device.can_submit for a dict holding the status, is_public, user and
+    group of a device.
+    """
+    if device['status'] == Device.RETIRED:
+        return False
+    if device['is_public']:
+        return True
+    if username.username == "lava-health":
+        return True
+    return _is_owned_by(device, user, groups)
+
+
+def _visible_device_types(type_names, user, groups):
+    """
+    :return: the names of the device types which have devices visible to
+    the user, as DeviceType.devices_visible_to
+    """
+    if not type_names:
+        return set()
+    visible = set()
+    for device in Device.objects.filter(device_type__in=type_names).values(
+            'device_type', 'device_type__owners_only', 'user', 'group'):
+        if not device['device_type__owners_only'] or _is_owned_by(device, user, groups):
+            visible.add(device['device_type'])
+    return visible
+
+
 class LavaSystemAPI(SystemAPI):
     """
     Extend the default SystemAPI with a 'whoami' method.
@@ -107,16 +173,33 @@ class LavaSystemAPI(SystemAPI):
                 errors.BAD_REQUEST,
                 "job list argument must be a list")
         username = self._switch_user(username)
+        user, groups = _principal(username)
+        pks = [int(job_id) for job_id in job_list if '.' not in str(job_id)]
+        sub_ids = [str(job_id) for job_id in job_list if '.' in str(job_id)]
+        jobs = {}
+        for job in TestJob.objects.filter(Q(pk__in=pks) | Q(sub_id__in=sub_ids)).values(
+                'id', 'sub_id', 'is_public', 'user', 'group', 'actual_device__device_type',
+                'requested_device__device_type', 'requested_device_type'):
+            # as get_restricted_job
+            job['device_type'] = (job['actual_device__device_type'] or
+                                  job['requested_device__device_type'] or
+                                  job['requested_device_type'])
+            jobs[str(job['id'])] = job
+            if job['sub_id']:
+                jobs[job['sub_id']] = job
+        visible_types = _visible_device_types(
+            set([job['device_type'] for job in jobs.values() if job['device_type']]), user, groups)
         retval = {}
         for job_id in job_list:
-            try:
-                get_restricted_job(username, job_id)
-            except Http404:
+            job = jobs.get(str(int(job_id)) if '.' not in str(job_id) else str(job_id))
+            if job is None:
                 continue
-            except PermissionDenied:
-                retval[str(job_id)] = False
+            if job['device_type'] is None:
+                retval[str(job_id)] = True
+            elif job['device_type'] not in visible_types:
                 continue
-            retval[str(job_id)] = True
+            else:
+                retval[str(job_id)] = username.is_superuser or _is_accessible_by(job, user, groups)
         return retval
 
     def user_can_view_bundles(self, bundle_list, username=None):
@@ -177,15 +260,16 @@ class LavaSystemAPI(SystemAPI):
                 errors.BAD_REQUEST,
                 "bundle list argument must be a list")
         username = self._switch_user(username)
+        user, groups = _principal(username)
         retval = {}
-        for content_sha1 in bundle_list:
-            try:
-                bundle = Bundle.objects.get(content_sha1=content_sha1)  # pylint: disable=no-member
-                if not bundle.bundle_stream.is_accessible_by(username):
-                    retval[content_sha1] = False
-            except Bundle.DoesNotExist:  # pylint: disable=no-member
-                continue
-            retval[content_sha1] = True
+        for bundle in Bundle.objects.filter(content_sha1__in=bundle_list).values(  # pylint: disable=no-member
+                'content_sha1', 'bundle_stream__is_public', 'bundle_stream__user', 'bundle_stream__group'):
+            stream = {
+                'is_public': bundle['bundle_stream__is_public'],
+                'user': bundle['bundle_stream__user'],
+                'group': bundle['bundle_stream__group'],
+            }
+            retval[bundle['content_sha1']] = _is_accessible_by(stream, user, groups)
         return retval
 
     def user_can_view_devices(self, device_list, username=None):
@@ -278,28 +362,36 @@ class LavaSystemAPI(SystemAPI):
                 errors.BAD_REQUEST,
                 "device list argument must be a list")
         username = self._switch_user(username)
+        user, groups = _principal(username)
+        devices = dict([(device['hostname'], device) for device in Device.objects.filter(
+            hostname__in=device_list).values(
+                'hostname', 'device_type', 'device_type__owners_only', 'status', 'is_public',
+                'is_pipeline', 'user', 'group')])
+        for device in devices.values():
+            # as Device.is_visible_to, the owner of a device of a hidden type can see that type
+            device['visible'] = device['is_public'] or _can_submit(device, username, user, groups)
+        dictionaries = DeviceDictionary.get_many(
+            [hostname for hostname, device in devices.items() if device['visible']])
         retval = {}
         for hostname in device_list:
-            try:
-                device = Device.objects.get(hostname=hostname)
-            except Device.DoesNotExist:
+            device = devices.get(hostname)
+            if device is None:
                 continue
-            device_type = device.device_type
-            if device_type.owners_only and not device.is_owned_by(username):
+            if device['device_type__owners_only'] and not _is_owned_by(device, user, groups):
                 continue
-            retval.setdefault(device_type.name, [])
-            visible = device.is_visible_to(username)
-            if visible:
-                retval[device_type.name].append({
+            retval.setdefault(device['device_type'], [])
+            if device['visible']:
+                device_dict = dictionaries.get(hostname)
+                retval[device['device_type']].append({
                     hostname: {
-                        'is_pipeline': device.is_pipeline,
-                        'visible': visible,
-                        'exclusive': device.is_exclusive
+                        'is_pipeline': device['is_pipeline'],
+                        'visible': True,
+                        'exclusive': device_dict.exclusive if device_dict else False
                     }
                 })
             else:
-                retval[device_type.name].append({
-                    hostname: {'visible': visible}
+                retval[device['device_type']].append({
+                    hostname: {'visible': False}
                 })
         return retval
 
@@ -363,17 +455,13 @@ class LavaSystemAPI(SystemAPI):
                 errors.FORBIDDEN,
                 "User '%s' does not have permissiont to submit jobs." % username
             )
-        retval = {}
-        for type_name in type_list:
-            try:
-                device_type = DeviceType.objects.get(name=type_name)
-            except DeviceType.DoesNotExist:
-                continue
-            devices = Device.objects.filter(device_type=device_type)
-            access = []
-            for device in devices:
-                access.append(device.can_submit(username))
-            retval[device_type.name] = any(access)
+        user, groups = _principal(username)
+        retval = dict([(name, False) for name in DeviceType.objects.filter(
+            name__in=type_list).values_list('name', flat=True)])
+        for device in Device.objects.filter(device_type__in=retval.keys()).values(
+                'device_type', 'status', 'is_public', 'user', 'group'):
+            if _can_submit(device, username, user, groups):
+                retval[device['device_type']] = True
         return retval
 
 
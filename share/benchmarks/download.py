@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+"""
+Reports the speed of compressed downloads, from file:// and from a local
+http server, for each of the compressions supported by the dispatcher.
+Not part of the unit tests: the numbers depend on the machine.
+
+    python share/benchmarks/download.py --size 256
+"""
+
+import argparse
+import BaseHTTPServer
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from lava_dispatcher.pipeline.actions.deploy import download
+from lava_dispatcher.pipeline.test.test_download import (
+    QuietHandler,
+    compress,
+    download_job,
+)
+
+COMPRESSIONS = ['gz', 'bz2', 'xz']
+
+
+def benchmark(size, streams):
+    """
+    :param size: size in MB of the uncompressed file
+    :param streams: number of concatenated compressed streams, as from pigz or pxz
+    :return: list of (scheme, compression, MB/s) tuples
+    """
+    tmpdir = tempfile.mkdtemp()
+    dest = os.path.join(tmpdir, 'dest')
+    os.mkdir(dest)
+    # half random, half compressible: closer to a rootfs than either
+    block = os.urandom(64 * 1024) + ''.join(["%08d" % index for index in range(8 * 1024)])
+    data = block * (size * 8)
+    for compression in COMPRESSIONS:
+        compress(data, compression, os.path.join(tmpdir, 'rootfs.%s' % compression), streams=streams)
+    del data
+    QuietHandler.directory = tmpdir
+    server = BaseHTTPServer.HTTPServer(('localhost', 0), QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    # measure the download, not the worker cache
+    open_cache = download.HttpDownloadAction.open_cache
+    download.HttpDownloadAction.open_cache = lambda action: None
+    results = []
+    try:
+        for scheme in ['file', 'http']:
+            for compression in COMPRESSIONS:
+                if scheme == 'file':
+                    url = 'file://%s/rootfs.%s' % (tmpdir, compression)
+                else:
+                    url = 'http://localhost:%d/rootfs.%s' % (server.server_address[1], compression)
+                job = download_job({'to': 'tmpfs', 'rootfs': url, 'compression': compression}, 'rootfs', dest)
+                start = time.time()
+                job.pipeline.run_actions(None)
+                elapsed = time.time() - start
+                downloaded = os.path.getsize(job.context['download_action']['rootfs']['file'])
+                results.append((scheme, compression, downloaded / (1024.0 * 1024) / elapsed))
+    finally:
+        download.HttpDownloadAction.open_cache = open_cache
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the compressed downloads of the dispatcher")
+    parser.add_argument('--size', type=int, default=64, help="size in MB of the uncompressed file")
+    parser.add_argument('--streams', type=int, default=4, help="number of compressed streams in the file")
+    args = parser.parse_args()
+    for scheme, compression, speed in benchmark(args.size, args.streams):
+        print("%-4s %-3s %8.1f MB/s" % (scheme, compression, speed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2016 Linaro Limited
+#
+# This file is part of LAVA Dispatcher.
+#
+# LAVA Dispatcher is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# LAVA Dispatcher is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along
+# with this program; if not, see <http://www.gnu.org/licenses>.
+
+"""
+Compares appending the LAVA overlay to a gzip compressed ramdisk with
+extracting and rebuilding the ramdisk with cpio and gzip.
+Not part of the unit tests: the numbers depend on the machine.
+
+    python share/benchmarks/ramdisk.py --size 50
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+from distutils.spawn import find_executable
+
+from lava_dispatcher.pipeline.utils.ramdisk import append_to_ramdisk
+from lava_dispatcher.pipeline.test.test_ramdisk import make_ramdisk, make_tarball
+
+
+def benchmark(size):
+    """
+    :param size: size in MB of the files of the ramdisk
+    :return: seconds taken to append the overlay and to repack the ramdisk
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ramdisk = os.path.join(tmpdir, 'initrd.cpio.gz')
+        output = os.path.join(tmpdir, 'ramdisk.cpio.gz')
+        files = [('lib', None)]
+        for index in range(size):
+            # half random, so that the ramdisk does not compress to nothing
+            files.append(('lib/module%d.ko' % index, os.urandom(512 * 1024) * 2))
+        make_ramdisk(ramdisk, files)
+        overlay_dir = os.path.join(tmpdir, 'overlay')
+        os.makedirs(os.path.join(overlay_dir, 'lava-1234', 'bin'))
+        with open(os.path.join(overlay_dir, 'lava-1234', 'bin', 'lava-test-runner'), 'w') as runner:
+            runner.write('#!/bin/sh\necho runner\n')
+        overlay = os.path.join(tmpdir, 'overlay.tar.gz')
+        make_tarball(overlay, overlay_dir)
+
+        start = time.time()
+        append_to_ramdisk(ramdisk, output, [overlay])
+        appended = time.time() - start
+
+        extracted = os.path.join(tmpdir, 'extracted')
+        os.mkdir(extracted)
+        start = time.time()
+        subprocess.check_call('gzip -dc %s | cpio -i --quiet' % ramdisk, shell=True, cwd=extracted)
+        with tarfile.open(overlay) as tar:
+            tar.extractall(extracted)
+        subprocess.check_call('find . | cpio --create --format=newc --quiet | gzip > %s' % output,
+                              shell=True, cwd=extracted)
+        repacked = time.time() - start
+    finally:
+        shutil.rmtree(tmpdir)
+    return appended, repacked
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark adding the overlay to a ramdisk")
+    parser.add_argument('--size', type=int, default=50, help="size in MB of the files of the ramdisk")
+    args = parser.parse_args()
+    if not find_executable('cpio'):
+        parser.error("cpio is not installed")
+    appended, repacked = benchmark(args.size)
+    print("append: %.2fs" % appended)
+    print("repack: %.2fs" % repacked)
+
+
+if __name__ == '__main__':
+    main()